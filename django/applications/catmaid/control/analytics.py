@@ -1,13 +1,28 @@
 from django.db import connection
-from django.http import HttpResponse
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.jobs import report_progress
+from catmaid.control.streaming import json_array_chunks, streaming_json_response
+from catmaid.control.tree_util import Arbor
 from catmaid.models import UserRole
-from collections import namedtuple, defaultdict
-from itertools import chain, islice
-from functools import partial
-from networkx import Graph, single_source_shortest_path
+from collections import defaultdict
+from itertools import combinations, groupby, izip
+from operator import itemgetter
+import numpy as np
 import json
 
+ISSUES = {
+    0: "Autapse",
+    1: "Two or more times postsynaptic to the same connector",
+    2: "Connector without postsynaptic targets",
+    3: "Connector without presynaptic skeleton",
+    4: "Duplicated synapse?",
+    5: "End node without end tag",
+    6: "TODO tag",
+    7: "End-node tag in a non-end node."}
+
+END_LABELS = set(['ends', 'not a branch', 'uncertain end', 'uncertain continuation', 'soma', 'nerve out'])
+
 @requires_user_role(UserRole.Annotate)
 def analyze_skeletons(request, project_id=None):
     project_id = int(project_id)
@@ -49,6 +64,10 @@ def analyze_skeletons(request, project_id=None):
         skids.extend([s[0] for s in cursor.fetchall()])
 
 
+    # Analyze each skeleton once
+    seen = set()
+    skids = [skid for skid in skids if not (skid in seen or seen.add(skid))]
+
     # Obtain neuron names
     cursor.execute('''
     SELECT cici.class_instance_a, ci.name
@@ -61,211 +80,202 @@ def analyze_skeletons(request, project_id=None):
       AND r.relation_name = 'model_of'
     ''' % ",".join(str(skid) for skid in skids))
 
-    blob = {'issues': tuple((skid, _analyze_skeleton(project_id, skid, adjacents)) for skid in skids),
-            'names': dict(cursor.fetchall()),
-            0: "Autapse",
-            1: "Two or more times postsynaptic to the same connector",
-            2: "Connector without postsynaptic targets",
-            3: "Connector without presynaptic skeleton",
-            4: "Duplicated synapse?",
-            5: "End node without end tag",
-            6: "TODO tag",
-            7: "End-node tag in a non-end node."}
-
-    return HttpResponse(json.dumps(blob))
-
-def _analyze_skeleton(project_id, skeleton_id, adjacents):
+    header = {'names': dict(cursor.fetchall())}
+    header.update(ISSUES)
+
+    # Fetch everything up front, then analyze one skeleton at a time while
+    # streaming the response
+    relation_map = get_relation_to_id_map(project_id)
+    connectors, skeleton_connectors = _fetch_connectors(cursor, skids,
+            relation_map['presynaptic_to'], relation_map['postsynaptic_to'])
+    arbors = _fetch_arbors(cursor, skids)
+    labels = _fetch_labels(cursor, skids, relation_map.get('labeled_as', -1))
+
+    def issues():
+        for i, skid in enumerate(skids):
+            report_progress(float(i) / len(skids))
+            yield (skid, _analyze_skeleton(skid, arbors.get(skid), labels.get(skid, ()),
+                    connectors, skeleton_connectors.get(skid, ()), adjacents))
+
+    def chunks():
+        # The header without its closing brace
+        yield json.dumps(header)[:-1] + ', "issues": '
+        for chunk in json_array_chunks(issues()):
+            yield chunk
+        yield '}'
+
+    return streaming_json_response(chunks())
+
+def _fetch_connectors(cursor, skids, PRE, POST):
+    """ Return a dictionary of connector ID vs a tuple of two lists, of its
+    presynaptic and of its postsynaptic links as (treenode ID, skeleton ID)
+    pairs, for all connectors linked to any of the skeletons, and a
+    dictionary of skeleton ID vs the IDs of its connectors. """
+    cursor.execute('''
+    SELECT tc.connector_id, tc.relation_id, tc.treenode_id, tc.skeleton_id
+    FROM treenode_connector tc
+    WHERE tc.connector_id IN (
+            SELECT connector_id
+            FROM treenode_connector
+            WHERE skeleton_id IN %s
+              AND relation_id IN (%s, %s))
+      AND tc.relation_id IN (%s, %s)
+    ORDER BY tc.treenode_id
+    ''', (tuple(skids), PRE, POST, PRE, POST))
+
+    skid_set = set(skids)
+    connectors = defaultdict(lambda: ([], []))
+    skeleton_connectors = defaultdict(set)
+    for connector_id, relation_id, treenode_id, skeleton_id in cursor.fetchall():
+        connectors[connector_id][0 if PRE == relation_id else 1].append((treenode_id, skeleton_id))
+        if skeleton_id in skid_set:
+            skeleton_connectors[skeleton_id].add(connector_id)
+    return connectors, skeleton_connectors
+
+def _fetch_arbors(cursor, skids):
+    """ Return a dictionary of skeleton ID vs its Arbor. """
+    cursor.execute('''
+    SELECT skeleton_id, id, COALESCE(parent_id, -1)
+    FROM treenode
+    WHERE skeleton_id IN %s
+    ORDER BY skeleton_id
+    ''', (tuple(skids),))
+    arbors = {}
+    for skid, rows in groupby(cursor.fetchall(), itemgetter(0)):
+        columns = zip(*rows)
+        arbors[skid] = Arbor(columns[1], np.array(columns[2], dtype=np.int64))
+    return arbors
+
+def _fetch_labels(cursor, skids, labeled_as):
+    """ Return a dictionary of skeleton ID vs a list of (treenode ID, label)
+    pairs of its labeled treenodes. """
+    cursor.execute('''
+    SELECT t.skeleton_id, tci.treenode_id, ci.name
+    FROM treenode t,
+         treenode_class_instance tci,
+         class_instance ci
+    WHERE t.skeleton_id IN %s
+      AND tci.treenode_id = t.id
+      AND tci.relation_id = %s
+      AND tci.class_instance_id = ci.id
+    ''', (tuple(skids), labeled_as))
+    labels = defaultdict(list)
+    for skid, treenode_id, name in cursor.fetchall():
+        labels[skid].append((treenode_id, name))
+    return labels
+
+def _analyze_skeleton(skeleton_id, arbor, labels, connectors, connector_ids, adjacents):
     """ Takes a skeleton and returns a list of potentially problematic issues,
     as a list of tuples of two values: issue type and treenode ID.
+    arbor: the Arbor of the skeleton, or None if it has no treenodes.
+    labels: the (treenode ID, label) pairs of the skeleton.
+    connectors, connector_ids: as returned by _fetch_connectors.
     adjacents: the number of nodes in the paths starting at a node when checking for duplicated connectors.
     """
-    project_id = int(project_id)
-    skeleton_id = int(skeleton_id)
-    cursor = connection.cursor()
-
-    PRE = 'presynaptic_to'
-    POST = 'postsynaptic_to'
-
-    # Retrieve relation IDs vs names
-    cursor.execute('''
-    SELECT id, relation_name
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = '%s'
-           OR relation_name = '%s')
-    ''' % (project_id, PRE, POST))
-    
-    relations = {} # both ways
-    for row in cursor.fetchall():
-        relations[row[0]] = row[1]
-        relations[row[1]] = row[0]
-
-    # Transform strings to integer IDs
-    PRE = relations[PRE]
-    POST = relations[POST]
-
-    # Retrieve all connectors and their associated pre- or postsynaptic treenodes,
-    # plus the parent treenodes of these.
-    cursor.execute('''
-    SELECT tc1.connector_id,
-           tc1.relation_id,
-           t1.id,
-           t1.skeleton_id,
-           tc2.relation_id,
-           t2.id,
-           t2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         treenode t1,
-         treenode t2
-    WHERE tc1.skeleton_id = %s
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.treenode_id = t1.id
-      AND tc2.treenode_id = t2.id
-      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-      AND (tc2.relation_id = %s OR tc2.relation_id = %s)
-    ''' % (skeleton_id,
-           str(PRE), str(POST),
-           str(PRE), str(POST)))
-
-    Treenode = namedtuple('Treenode', ['id', 'skeleton_id'])
-
-    # Map of connector_id vs {pre: {Treenode, ...}, post: {Treenode, ...}}
-    connectors = defaultdict(partial(defaultdict, set))
-
-    # Condense rows to connectors represented by a map with two entries (PRE and POST),
-    # each containing as value a set of Treenode:
-    for row in cursor.fetchall():
-        s = connectors[row[0]]
-        s[row[1]].add(Treenode(row[2], row[3]))
-        # The 'other' could be null
-        if row[4]:
-            s[row[4]].add(Treenode(row[5], row[6]))
-    
     issues = []
 
-    # Set of IDs of outgoing connectors
-    pre_connector_ids = set()
+    # Treenodes of the skeleton linked to connectors, and the skeletons at
+    # the other side of the connector
+    pre_connectors = []
+    post_connectors = []
 
-    for connector_id, connector in connectors.iteritems():
-        pre = connector[PRE]
-        post = connector[POST]
-        if pre and post:
-            for a in pre:
-                for b in post:
-                    if a.skeleton_id == b.skeleton_id:
-                        # Type 0: autapse
-                        issues.append((0, a.id if a.skeleton_id == skeleton_id else b.id))
+    for connector_id in sorted(connector_ids):
+        pre, post = connectors[connector_id]
+        for a in pre:
+            for b in post:
+                if a[1] == b[1]:
+                    # Type 0: autapse
+                    issues.append((0, a[0] if a[1] == skeleton_id else b[0]))
         if not post:
             # Type 2: presynaptic connector without postsynaptic treenodes
-            issues.append((2, iter(pre).next().id))
+            issues.append((2, pre[0][0]))
         if not pre:
             # Type 3: postsynaptic connector without presynaptic treenode
-            issues.append((3, iter(post).next().id))
+            issues.append((3, post[0][0]))
         else:
-            if iter(pre).next().skeleton_id != skeleton_id:
-                repeats = tuple(t.id for t in post if t.skeleton_id == skeleton_id)
+            own = [t for t, s in pre if s == skeleton_id]
+            if own:
+                pre_connectors.append((own[0], set(s for t, s in post)))
+            else:
+                repeats = [t for t, s in post if s == skeleton_id]
                 if len(repeats) > 1:
                     # Type 1: two or more times postsynaptic to the same connector
                     issues.append((1, repeats[0]))
-            else:
-                pre_connector_ids.add(connector_id)
-
-    # Fetch data for type 4 and 5: all treenode, with tags if any
-    cursor.execute('''
-    SELECT treenode.id,
-           treenode.parent_id,
-           class_instance.name
-    FROM treenode
-             LEFT OUTER JOIN
-                 (treenode_class_instance INNER JOIN relation ON (treenode_class_instance.relation_id = relation.id AND relation.relation_name = 'labeled_as') INNER JOIN class_instance ON (treenode_class_instance.class_instance_id = class_instance.id))
-             ON (treenode_class_instance.treenode_id = treenode.id)
-    WHERE treenode.skeleton_id = %s
-    ''' % skeleton_id)
-
-    # Collapse repeated rows into nodes with none or more tags
-    nodes = {}
-    parents = set()
-    root = None
-    for row in cursor.fetchall():
-        node = nodes.get(row[0])
-        if node:
-            # Append tag
-            node[1].append(row[2])
-        else:
-            nodes[row[0]] = (row[1], [row[2]])
-
-        if row[1]:
-            parents.add(row[1])
-        else:
-            root = row[0]
+                post_connectors.append((repeats[0], set(s for t, s in pre)))
 
+    if arbor is None:
+        return issues
 
     # Type 4: potentially duplicated synapses (or triplicated, etc):
     # Check if two or more connectors share pre treenodes and post skeletons,
     # or pre skeletons and post treenodes,
-    # considering the treenode and its parent as a group.
-    if adjacents > 0:
-        graph = Graph()
-        for node_id, props in nodes.iteritems():
-            if props[0]:
-                # Nodes are added automatically
-                graph.add_edge(props[0], node_id)
-    else:
-        graph = None
-
-    Connector = namedtuple("Connector", ['id', 'treenode_id', 'treenodes', 'skeletons'])
-
-    # Check if there are any duplicated presynaptic connectors
-    pre_connectors = []
-    for connector_id in pre_connector_ids:
-        c = connectors[connector_id]
-        treenode_id = iter(c[PRE]).next().id
-        pre_treenodes = set(chain.from_iterable(single_source_shortest_path(graph, treenode_id, adjacents).values()))
-        post_skeletons = set(t.skeleton_id for t in c[POST])
-        pre_connectors.append(Connector(connector_id, treenode_id, pre_treenodes, post_skeletons))
-
-    def issue4s(cs):
-        for i, c1 in enumerate(cs):
-            for c2 in islice(cs, i+1, None):
-                if (c1.treenodes & c2.treenodes) and (c1.skeletons & c2.skeletons):
-                    # Type 4: potentially duplicated connector
-                    issues.append((4, c1.treenode_id))
-                    if c1.treenode_id != c2.treenode_id:
-                        issues.append((4, c2.treenode_id))
-
-    issue4s(pre_connectors)
-
-    # Check if there are any duplicated postsynaptic connectors
-    post_connectors = []
-    for connector_id, c in connectors.iteritems():
-        if connector_id in pre_connector_ids:
-            continue
-        treenode_id = (t.id for t in c[POST] if t.skeleton_id == skeleton_id).next()
-        pre_skeletons = set(t.skeleton_id for t in c[PRE])
-        post_treenodes = set(chain.from_iterable(single_source_shortest_path(graph, treenode_id, adjacents).values()))
-        post_connectors.append(Connector(connector_id, treenode_id, post_treenodes, pre_skeletons))
-
-    issue4s(post_connectors)
-
+    # considering the treenode and its neighbors up to adjacents edges away as a group.
+    for cs in (pre_connectors, post_connectors):
+        for i, j in _overlapping(arbor, [c[0] for c in cs], adjacents):
+            if cs[i][1] & cs[j][1]:
+                issues.append((4, cs[i][0]))
+                if cs[i][0] != cs[j][0]:
+                    issues.append((4, cs[j][0]))
 
     # Type 5: end node without a tag
     # Type 6: node with a TODO tag
     # Type 7: root, slab or branch node with a tag like 'ends', 'not a branch', 'uncertain end', or 'uncertain continuation'
-    end_labels = set(['ends', 'not a branch', 'uncertain end', 'uncertain continuation', 'soma', 'nerve out'])
-    if root in parents:
-        parents.remove(root) # Consider the root as a leaf node
-    for node_id, props in nodes.iteritems():
-        labels = set(props[1])
-        if node_id not in parents:
-            if not (labels & end_labels):
-                # Type 5: node is a leaf without an end-node label
-                issues.append((5, node_id))
-        elif labels & end_labels:
-            # Type 7: node is not a leaf but has an end-node label
-            issues.append((7, node_id))
-        if 'TODO' in labels:
-            # Type 6: node with a tag containing the string 'TODO'
-            issues.append((6, node_id))
+    n = len(arbor)
+    end_labeled = np.zeros(n, dtype=bool)
+    todo = np.zeros(n, dtype=bool)
+    if labels:
+        indices = arbor.index(t for t, _ in labels)
+        names = [name for _, name in labels]
+        end_labeled[indices[np.array([name in END_LABELS for name in names])]] = True
+        todo[indices[np.array(['TODO' == name for name in names])]] = True
+    # The root is considered a leaf node
+    leaves = (arbor.n_children() == 0) | (arbor.parent < 0)
+    issues.extend((5, node_id) for node_id in arbor.ids[leaves & ~end_labeled].tolist())
+    issues.extend((7, node_id) for node_id in arbor.ids[~leaves & end_labeled].tolist())
+    issues.extend((6, node_id) for node_id in arbor.ids[todo].tolist())
 
     return issues
+
+def _overlapping(arbor, treenode_ids, adjacents):
+    """ Return the sorted pairs (i, j), with i < j, of indices of treenodes
+    whose groups of nodes up to adjacents edges away overlap. The groups
+    are grown from all treenodes at once, one edge at a time. """
+    if len(treenode_ids) < 2:
+        return []
+    n = len(arbor)
+    # Neighbors of each node in both directions, in compressed sparse rows
+    child = np.flatnonzero(arbor.parent >= 0)
+    a = np.concatenate((child, arbor.parent[child]))
+    b = np.concatenate((arbor.parent[child], child))
+    order = np.argsort(a, kind='mergesort')
+    neighbors = b[order]
+    indptr = np.searchsorted(a[order], np.arange(n + 1))
+
+    # Groups as keys of group index * n + node index
+    keys = np.arange(len(treenode_ids)) * n + arbor.index(treenode_ids)
+    frontier = keys
+    for _ in xrange(adjacents):
+        owners, nodes = frontier // n, frontier % n
+        starts = indptr[nodes]
+        lengths = indptr[nodes + 1] - starts
+        total = int(lengths.sum())
+        if 0 == total:
+            break
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        positions = np.arange(total) + np.repeat(starts - offsets, lengths)
+        frontier = np.unique(np.repeat(owners, lengths) * n + neighbors[positions])
+        frontier = frontier[~np.in1d(frontier, keys)]
+        if 0 == len(frontier):
+            break
+        keys = np.concatenate((keys, frontier))
+
+    # Groups that share a node
+    order = np.lexsort((keys // n, keys % n))
+    owners = keys[order] // n
+    nodes = keys[order] % n
+    pairs = set()
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(nodes)) + 1, [len(nodes)]))
+    for start, end in izip(bounds[:-1], bounds[1:]):
+        if end - start > 1:
+            pairs.update(combinations(owners[start:end].tolist(), 2))
+    return sorted(pairs)
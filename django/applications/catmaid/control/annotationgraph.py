@@ -0,0 +1,253 @@
+# An in-memory graph of the annotations of a project: the entities, like
+# neurons and other annotations (meta annotations), that each annotation is
+# linked to by annotated_with links, along with the users of these links.
+# Queries of the entities that carry several annotations, of the annotations
+# used alongside others and of the annotations used by a user become
+# operations on sets of IDs.
+#
+# Sets of IDs are kept as sorted arrays, which are intersected and merged in
+# linear time. The graph is validated against the ID of the transaction that
+# last changed an annotated_with link of the project, which a trigger keeps
+# in the annotation_graph_version table, and reloaded if it changed. Write
+# endpoints lock the graph before they change links and then update it in
+# place instead, see lock_annotation_graph and update_annotation_graph.
+
+from threading import Lock, RLock
+
+import numpy as np
+
+_EMPTY = np.zeros(0, dtype=np.int64)
+
+_LINKS_QUERY = '''
+SELECT cici.id, cici.class_instance_a, cici.class_instance_b, cici.user_id,
+       cici.edition_time, c.class_name = 'neuron'
+FROM class_instance_class_instance cici,
+     relation r,
+     class_instance a,
+     class c
+WHERE cici.project_id = %s
+  AND cici.relation_id = r.id
+  AND r.relation_name = 'annotated_with'
+  AND a.id = cici.class_instance_a
+  AND c.id = a.class_id
+'''
+
+
+class AnnotationGraph(object):
+    """ The annotated_with links of a project. """
+
+    def __init__(self, project_id):
+        self.project_id = int(project_id)
+        self.lock = RLock()
+        self.version = None
+        self._clear()
+
+    def _clear(self):
+        # Link ID vs (entity ID, annotation ID, user ID, edition time)
+        self.links = {}
+        # Annotation, entity and user ID vs the set of IDs of their links
+        self.annotation_links = {}
+        self.entity_links = {}
+        self.user_links = {}
+        # The IDs of the entities that are neurons
+        self.neurons = set()
+        # Sorted arrays of IDs derived from the links, computed on demand
+        self._members = {}
+        self._annotations = {}
+        self._user_annotations = {}
+
+    def _index(self, index, key, link_id, add):
+        if add:
+            index.setdefault(key, set()).add(link_id)
+        else:
+            links = index[key]
+            links.discard(link_id)
+            if not links:
+                del index[key]
+
+    def _add(self, link_id, entity_id, annotation_id, user_id, edition_time):
+        """ Add the link, or update it if it is known already. """
+        self._remove(link_id)
+        self.links[link_id] = (entity_id, annotation_id, user_id, edition_time)
+        self._index(self.annotation_links, annotation_id, link_id, True)
+        self._index(self.entity_links, entity_id, link_id, True)
+        self._index(self.user_links, user_id, link_id, True)
+        self._members.pop(annotation_id, None)
+        self._annotations.pop(entity_id, None)
+        self._user_annotations.pop(user_id, None)
+
+    def _remove(self, link_id):
+        link = self.links.pop(link_id, None)
+        if link is None:
+            return
+        entity_id, annotation_id, user_id = link[:3]
+        self._index(self.annotation_links, annotation_id, link_id, False)
+        self._index(self.entity_links, entity_id, link_id, False)
+        self._index(self.user_links, user_id, link_id, False)
+        self._members.pop(annotation_id, None)
+        self._annotations.pop(entity_id, None)
+        self._user_annotations.pop(user_id, None)
+
+    def _add_rows(self, rows):
+        for row in rows:
+            self._add(*row[:5])
+            if row[5]:
+                self.neurons.add(row[1])
+
+    def load(self, cursor, version):
+        """ Read all links of the project, which are at the given version. """
+        with self.lock:
+            cursor.execute(_LINKS_QUERY, (self.project_id,))
+            self._clear()
+            self._add_rows(cursor.fetchall())
+            self.version = version
+
+    def _derived(self, cache, index, key, column):
+        """ The sorted array of the unique values of the given column of the
+        links of the key in the index. """
+        ids = cache.get(key)
+        if ids is None:
+            ids = np.unique(np.array([self.links[link_id][column] for link_id
+                    in index.get(key, ())], dtype=np.int64))
+            cache[key] = ids
+        return ids
+
+    def members(self, annotation_id):
+        """ Return the sorted array of the IDs of the entities annotated with
+        the given annotation. """
+        with self.lock:
+            return self._derived(self._members, self.annotation_links, annotation_id, 0)
+
+    def annotations(self, entity_id):
+        """ Return the sorted array of the IDs of the annotations of the given
+        entity, which is a neuron or, for meta annotations, an annotation. """
+        with self.lock:
+            return self._derived(self._annotations, self.entity_links, entity_id, 1)
+
+    def user_annotations(self, user_id):
+        """ Return the sorted array of the IDs of the annotations that the
+        given user linked to any entity. """
+        with self.lock:
+            return self._derived(self._user_annotations, self.user_links, user_id, 1)
+
+    def annotated_with_all(self, annotation_ids, neurons_only=False):
+        """ Return the sorted array of the IDs of the entities, or of only the
+        neurons, annotated with all of the given annotations. """
+        with self.lock:
+            found = None
+            for annotation_id in set(annotation_ids):
+                members = self.members(annotation_id)
+                found = members if found is None else \
+                        np.intersect1d(found, members, assume_unique=True)
+            if found is None:
+                return _EMPTY
+            if neurons_only:
+                found = found[np.array([e in self.neurons for e in found.tolist()], dtype=bool)]
+            return found
+
+    def annotations_of_any(self, entity_ids):
+        """ Return the sorted array of the IDs of the annotations of any of
+        the given entities. """
+        with self.lock:
+            arrays = [self.annotations(entity_id) for entity_id in entity_ids]
+            return np.unique(np.concatenate(arrays)) if arrays else _EMPTY
+
+    def co_annotations(self, annotation_ids):
+        """ Return the sorted array of the IDs of the annotations of the
+        neurons that are annotated with all of the given annotations. """
+        with self.lock:
+            return self.annotations_of_any(
+                    self.annotated_with_all(annotation_ids, True).tolist())
+
+    def users(self, annotation_id):
+        """ Return the set of the IDs of the users that linked the given
+        annotation to any entity. """
+        with self.lock:
+            return set(self.links[link_id][2] for link_id
+                    in self.annotation_links.get(annotation_id, ()))
+
+    def usage(self, annotation_id):
+        """ Return the number of links to the given annotation, the last time
+        one was edited and the ID of the user who did, or (0, None, None). """
+        with self.lock:
+            links = [self.links[link_id] for link_id
+                    in self.annotation_links.get(annotation_id, ())]
+        if not links:
+            return 0, None, None
+        last = max(links, key=lambda link: link[3])
+        return len(links), last[3], last[2]
+
+    def update(self, cursor, version, added, removed):
+        """ Read the given created or updated links, drop the given deleted
+        ones and move the graph to the given version. """
+        with self.lock:
+            if added:
+                cursor.execute(_LINKS_QUERY + ' AND cici.id IN %s',
+                        (self.project_id, tuple(added)))
+                self._add_rows(cursor.fetchall())
+            for link_id in removed:
+                self._remove(link_id)
+            self.version = version
+
+
+# Project ID vs its AnnotationGraph
+_graphs = {}
+_graphs_lock = Lock()
+
+
+def _graph(project_id):
+    project_id = int(project_id)
+    with _graphs_lock:
+        graph = _graphs.get(project_id)
+        if graph is None:
+            graph = _graphs[project_id] = AnnotationGraph(project_id)
+        return graph
+
+
+def _current_version(cursor, project_id, for_update=False):
+    cursor.execute('''
+    SELECT change_txid
+    FROM annotation_graph_version
+    WHERE project_id = %s
+    ''' + ('FOR UPDATE' if for_update else ''), (int(project_id),))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def annotation_graph(cursor, project_id):
+    """ Return the AnnotationGraph of the project, reloaded if any of its
+    links changed since it was read. """
+    graph = _graph(project_id)
+    version = _current_version(cursor, project_id)
+    with graph.lock:
+        if graph.version != version:
+            graph.load(cursor, version)
+    return graph
+
+
+def lock_annotation_graph(cursor, project_id):
+    """ Keep other transactions from changing the annotation links of the
+    project until the current transaction ends, and return the version of the
+    links. To be called before changing links, followed by a call of
+    update_annotation_graph with this version once they are changed. """
+    version = _current_version(cursor, project_id, True)
+    if not version:
+        cursor.execute('''
+        INSERT INTO annotation_graph_version (project_id)
+        SELECT %s
+        WHERE NOT EXISTS (SELECT 1 FROM annotation_graph_version WHERE project_id = %s)
+        ''', (int(project_id), int(project_id)))
+        version = _current_version(cursor, project_id, True)
+    return version
+
+
+def update_annotation_graph(cursor, project_id, version, added=(), removed=()):
+    """ Update the in-memory graph of the project with the changes of the
+    current transaction since lock_annotation_graph returned the given
+    version: the IDs of the links that were created or updated and of those
+    that were deleted. A graph that wasn't current before is left alone, to
+    be reloaded when it is next used. """
+    graph = _graph(project_id)
+    with graph.lock:
+        if graph.version == version:
+            graph.update(cursor, _current_version(cursor, project_id), added, removed)
@@ -6,6 +6,7 @@ import json
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db import connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.http import HttpResponse, HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
@@ -17,6 +18,7 @@ from django.contrib.auth.models import User, Group
 
 from catmaid.control.common import json_error_response
 from catmaid.control.common import my_render_to_response
+from catmaid.control.cache import LRUCache, request_memo, forget_in_request
 
 from django.contrib.auth import authenticate, logout, login
 
@@ -306,7 +308,7 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
             return True
         # If more than one user, check if the request.user can edit them all
         # In other words, check if the set of user_id associated with ob_ids is a subset of the user's domain (the set of user_id that the user can edit)
-        if set(row[0] for row in rows).issubset(user_domain(cursor, user.id)):
+        if user_can_edit_all(cursor, user, (row[0] for row in rows)):
             return True
 
         raise Exception('User %s cannot edit all of the %s unique objects from table %s' % (user.username, len(ob_ids), table_name))
@@ -315,29 +317,70 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
 
 def user_can_edit(cursor, user_id, other_user_id):
     """ Determine whether the user with id 'user_'id' can edit the work of the user with id 'other_user_id'. This will be the case when the user_id belongs to a group whose name is identical to ther username of other_user_id.
-    This function is equivalent to 'other_user_id in user_domain(cursor, user_id), but consumes less resources."""
+    This function is equivalent to 'other_user_id in user_domain(cursor, user_id), and is answered from the cached domain of the user."""
     # The group with identical name to the username is implicit, doesn't have to exist. Therefore, check this edge case before querying:
     if user_id == other_user_id:
         return True
-    # Retrieve a value larger than zero when the user_id belongs to a group with name equal to that associated with other_user_id
-    cursor.execute("""
-    SELECT count(*)
-    FROM auth_user u,
-         auth_group g,
-         auth_user_groups ug
-    WHERE u.id = %s
-      AND u.username = g.name
-      AND g.id = ug.group_id
-      AND ug.user_id = %s
-    """ % (other_user_id, user_id))
-    rows = cursor.fetchall()
-    return rows and rows[0][0] > 0
+    return other_user_id in user_domain(cursor, user_id)
 
 
-def user_domain(cursor, user_id):
-    """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
-    A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
-    If a user can only edit its own nodes, then the returned set contains only its own user_id. """
+def user_can_edit_all(cursor, user, owner_ids):
+    """ Determine whether the user can edit the work of all the users in
+    owner_ids, with at most one lookup of the domain of the user. """
+    if user.is_superuser:
+        return True
+    owner_ids = set(owner_ids)
+    owner_ids.discard(user.id)
+    return not owner_ids or owner_ids.issubset(user_domain(cursor, user.id))
+
+
+def edit_permission(cursor, user):
+    """ Return a function that tells whether the user can edit the work of a
+    given user ID. The domain of the user is looked up only once, so that the
+    function can be applied to the owners of thousands of nodes. """
+    if user.is_superuser:
+        return lambda owner_id: True
+    domain = user_domain(cursor, user.id)
+    return domain.__contains__
+
+
+# The edit domains of users are cached in memory by each process, under the
+# version of the user_domain_version table, which triggers on the group, group
+# membership and user tables replace whenever groups, group memberships or
+# usernames change. All cached domains are thereby invalidated at once in all
+# processes, whichever way the tables are changed.
+# The version is read once per request, and read again after changes to users
+# and groups made by the request itself, which the signal handlers below
+# notice. Changes made by other processes during a request are seen by the
+# requests that follow.
+_user_domains = LRUCache(getattr(settings, 'USER_DOMAIN_CACHE_SIZE', 1024))
+
+
+def _user_domain_version(cursor):
+    memo = request_memo()
+    if memo and 'user_domain_version' in memo:
+        return memo['user_domain_version']
+    cursor.execute('''
+    SELECT change_txid, change_count FROM user_domain_version
+    ''')
+    row = cursor.fetchone()
+    version = row if row else (0, 0)
+    if memo is not None:
+        memo['user_domain_version'] = version
+    return version
+
+
+def _user_domain_changed(sender, **kwargs):
+    forget_in_request('user_domain_version')
+
+post_save.connect(_user_domain_changed, sender=User)
+post_delete.connect(_user_domain_changed, sender=User)
+post_save.connect(_user_domain_changed, sender=Group)
+post_delete.connect(_user_domain_changed, sender=Group)
+m2m_changed.connect(_user_domain_changed, sender=User.groups.through)
+
+
+def _query_user_domain(cursor, user_id):
     cursor.execute("""
     SELECT u2.id
     FROM auth_user u1,
@@ -351,8 +394,22 @@ def user_domain(cursor, user_id):
     """ % int(user_id))
     domain = set(row[0] for row in cursor.fetchall())
     domain.add(user_id)
+    return frozenset(domain)
+
+
+def user_domain(cursor, user_id):
+    """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
+    A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
+    If a user can only edit its own nodes, then the returned set contains only its own user_id.
+    The returned set is cached and must not be modified. """
+    key = (_user_domain_version(cursor), user_id)
+    domain = _user_domains.get(key)
+    if domain is None:
+        domain = _query_user_domain(cursor, user_id)
+        _user_domains.set(key, domain)
     return domain
 
+
 @requires_user_role([UserRole.Annotate])
 def all_usernames(request, project_id=None):
     """ Return an ordered list of all usernames, each entry a list of id and username. """
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from threading import Lock, local
+
+from django.core.signals import request_started, request_finished
+
+
+class LRUCache(object):
+    """ A thread-safe, in-process dictionary that holds at most max_size
+    entries, discarding the least recently used entry when full. Given a
+    function that returns the size of a value in bytes, it also holds at most
+    max_bytes of values, if max_bytes is positive, and doesn't hold values
+    larger than that. """
+
+    def __init__(self, max_size, max_bytes=0, sizeof=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes if sizeof else 0
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _pop(self, key):
+        value = self._entries.pop(key, self)
+        if value is not self and self.max_bytes > 0:
+            self.bytes -= self.sizeof(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.pop(key, self)
+            if value is self:
+                return default
+            # Re-insert to mark the entry as the most recently used
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        size = self.sizeof(value) if self.max_bytes > 0 else 0
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes > 0:
+                return
+            self._entries[key] = value
+            self.bytes += size
+            while len(self._entries) > self.max_size or \
+                    (self.max_bytes > 0 and self.bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Values that stay valid for the rest of the request a thread is serving
+_request = local()
+
+
+def request_memo():
+    """ Return the dictionary of values remembered by the thread for the
+    request it is serving, or None outside of requests. Cached values are
+    validated against the version of their tables at most once per request
+    this way, rather than once per use. """
+    return getattr(_request, 'memo', None)
+
+
+def forget_in_request(key):
+    """ Drop a value remembered for the current request, if any. Used by
+    changes made within the request, which have to be seen by the rest of it. """
+    memo = request_memo()
+    if memo:
+        memo.pop(key, None)
+
+
+def _start_request(sender, **kwargs):
+    _request.memo = {}
+
+
+def _finish_request(sender, **kwargs):
+    _request.memo = None
+
+
+request_started.connect(_start_request)
+request_finished.connect(_finish_request)
@@ -1,9 +1,12 @@
 from collections import defaultdict
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
 from catmaid.models import Relation, Class, Log, NeuronSearch, CELL_BODY_CHOICES, ClassInstance, ClassInstanceClassInstance, SORT_ORDERS_DICT
+from catmaid.control.cache import request_memo, forget_in_request
 import json
 
 def _create_relation(user, project_id, relation_id, instance_a_id, instance_b_id):
@@ -195,11 +198,90 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
+class _NameToIdMap(dict):
+    """ A dictionary of relation or class name vs ID of a project. Names that
+    are missing, because they were created after the map was loaded, are
+    looked up in the database on access, also by get() and membership tests.
+    Names found to be absent are remembered, as the map is replaced once the
+    ontology changes. """
+    def __init__(self, model, name_field, project_id):
+        self.model = model
+        self.name_field = name_field
+        self.project_id = project_id
+        self.absent = set()
+        super(_NameToIdMap, self).__init__(model.objects.filter(
+                project=project_id).values_list(name_field, "id"))
+
+    def __missing__(self, name):
+        if name in self.absent:
+            raise KeyError(name)
+        ids = list(self.model.objects.filter(project=self.project_id,
+                **{self.name_field: name}).values_list("id", flat=True)[:1])
+        if not ids:
+            self.absent.add(name)
+            raise KeyError(name)
+        self[name] = ids[0]
+        return ids[0]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+def _ontology_version(project_id):
+    memo = request_memo()
+    key = ('ontology_version', project_id)
+    if memo and key in memo:
+        return memo[key]
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT change_txid, change_count FROM ontology_version WHERE project_id = %s
+    ''', (project_id,))
+    row = cursor.fetchone()
+    version = row if row else (0, 0)
+    if memo is not None:
+        memo[key] = version
+    return version
+
+def _ontology_changed(sender, instance, **kwargs):
+    forget_in_request(('ontology_version', int(instance.project_id)))
+
+post_save.connect(_ontology_changed, sender=Relation)
+post_delete.connect(_ontology_changed, sender=Relation)
+post_save.connect(_ontology_changed, sender=Class)
+post_delete.connect(_ontology_changed, sender=Class)
+
+# Project ID vs the version and the name to ID map of its relations and
+# classes. The maps are filled lazily and are valid as long as the version of
+# the ontology of the project, which triggers on the relation and class tables
+# replace on every change, remains the same. Like the version of user domains
+# (see _user_domain_version), the version is read once per request, and again
+# after changes to relations and classes made by the request itself.
+_relation_maps = {}
+_class_maps = {}
+
+def _name_to_id_map(maps, model, name_field, project_id):
+    project_id = int(project_id)
+    version = _ontology_version(project_id)
+    entry = maps.get(project_id)
+    if entry is None or entry[0] != version:
+        entry = (version, _NameToIdMap(model, name_field, project_id))
+        maps[project_id] = entry
+    return entry[1]
+
 def get_relation_to_id_map(project_id):
-    return {rname: ID for rname, ID in Relation.objects.filter(project=project_id).values_list("relation_name", "id")}
+    """ Return a dictionary of relation name vs relation ID for the project.
+    The dictionary is shared by all callers and must not be modified. """
+    return _name_to_id_map(_relation_maps, Relation, "relation_name", project_id)
 
 def get_class_to_id_map(project_id):
-    return {cname: ID for cname, ID in Class.objects.filter(project=project_id).values_list("class_name", "id")}
+    """ Return a dictionary of class name vs class ID for the project.
+    The dictionary is shared by all callers and must not be modified. """
+    return _name_to_id_map(_class_maps, Class, "class_name", project_id)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
@@ -0,0 +1,276 @@
+# An in-memory index of the synaptic connectivity among the skeletons of a
+# project, read from the skeleton_connectivity table: for every pair of
+# skeletons, the number of synapses from the first onto the second.
+#
+# The edges are kept in compressed sparse row arrays, by presynaptic and by
+# postsynaptic skeleton, and updated incrementally. Each row of the table
+# records the transaction that last changed it, and every refresh reads the
+# rows changed by transactions that may have committed since the previous
+# one: those not older than the oldest transaction that was still running
+# back then. Counts of known edges are updated in place, new edges are kept
+# aside until there are enough of them to rebuild the arrays.
+
+from threading import Lock, RLock
+
+import numpy as np
+
+
+class ConnectivityIndex(object):
+    """ The skeleton-to-skeleton synapse counts of a project. """
+
+    def __init__(self, project_id):
+        self.project_id = int(project_id)
+        self.lock = RLock()
+        self.snapshot_xmin = None
+        self._build(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64))
+
+    def _build(self, pre, post, counts):
+        """ Build the arrays from the edges, given as arrays of presynaptic
+        and postsynaptic skeleton IDs and of the number of synapses. """
+        ids = np.unique(np.concatenate((pre, post)))
+        rows = np.searchsorted(ids, pre)
+        cols = np.searchsorted(ids, post)
+        n = len(ids)
+        # Outgoing edges, ordered by presynaptic and then postsynaptic skeleton
+        order = np.lexsort((cols, rows))
+        self.skeleton_ids = ids
+        self.indptr = np.searchsorted(rows[order], np.arange(n + 1)).astype(np.int64)
+        self.indices = cols[order]
+        self.counts = np.asarray(counts, dtype=np.int64)[order]
+        # Incoming edges, as positions in the arrays of outgoing edges, so
+        # that counts updated in place are seen from both sides
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        order_in = np.lexsort((rows, cols))
+        self.in_indptr = np.searchsorted(cols[order_in], np.arange(n + 1)).astype(np.int64)
+        self.in_indices = rows[order_in]
+        self.in_edges = position[order_in]
+        # (pre, post) vs number of synapses, for edges not in the arrays
+        self.pending = {}
+        self.pending_out = {}
+        self.pending_in = {}
+
+    def _index(self, skeleton_id):
+        """ The index of the skeleton in the arrays, or -1. """
+        i = np.searchsorted(self.skeleton_ids, skeleton_id)
+        if i < len(self.skeleton_ids) and self.skeleton_ids[i] == skeleton_id:
+            return int(i)
+        return -1
+
+    def _locate(self, pre, post):
+        """ The position of the edge in the arrays, or -1. """
+        i = self._index(pre)
+        j = self._index(post)
+        if i < 0 or j < 0:
+            return -1
+        start, end = self.indptr[i], self.indptr[i + 1]
+        k = start + np.searchsorted(self.indices[start:end], j)
+        if k < end and self.indices[k] == j:
+            return int(k)
+        return -1
+
+    def _set(self, pre, post, count):
+        k = self._locate(pre, post)
+        if k >= 0:
+            self.counts[k] = count
+        else:
+            self.pending[(pre, post)] = count
+            self.pending_out.setdefault(pre, {})[post] = count
+            self.pending_in.setdefault(post, {})[pre] = count
+
+    def _merge(self):
+        """ Rebuild the arrays to include the pending edges and to drop the
+        edges without synapses. """
+        rows = np.repeat(np.arange(len(self.skeleton_ids)), np.diff(self.indptr))
+        pending = np.array([(a, b, n) for (a, b), n in self.pending.iteritems()],
+                dtype=np.int64).reshape(-1, 3)
+        pre = np.concatenate((self.skeleton_ids[rows], pending[:, 0]))
+        post = np.concatenate((self.skeleton_ids[self.indices], pending[:, 1]))
+        counts = np.concatenate((self.counts, pending[:, 2]))
+        keep = counts > 0
+        self._build(pre[keep], post[keep], counts[keep])
+
+    def refresh(self, cursor):
+        """ Read the edges changed since the last refresh, or all of them the
+        first time. """
+        with self.lock:
+            # Transactions older than this one have all finished, so that
+            # their changes are visible to the queries below.
+            cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            snapshot_xmin = cursor.fetchone()[0]
+            if self.snapshot_xmin is None:
+                cursor.execute('''
+                SELECT pre_skeleton_id, post_skeleton_id, num_synapses
+                FROM skeleton_connectivity
+                WHERE project_id = %s
+                  AND num_synapses > 0
+                ''', (self.project_id,))
+                rows = cursor.fetchall()
+                self._build(*(np.array([row[k] for row in rows], dtype=np.int64) for k in xrange(3)))
+            else:
+                cursor.execute('''
+                SELECT pre_skeleton_id, post_skeleton_id, num_synapses
+                FROM skeleton_connectivity
+                WHERE project_id = %s
+                  AND change_txid >= %s
+                ''', (self.project_id, self.snapshot_xmin))
+                for pre, post, count in cursor.fetchall():
+                    self._set(pre, post, count)
+                if len(self.pending) > max(1024, len(self.counts) // 8):
+                    self._merge()
+            self.snapshot_xmin = snapshot_xmin
+
+    def edges(self, min_synapses=1):
+        """ Return a list of (pre, post, count) tuples of the edges of at
+        least min_synapses synapses. """
+        min_synapses = max(1, min_synapses)
+        with self.lock:
+            rows = np.repeat(np.arange(len(self.skeleton_ids)), np.diff(self.indptr))
+            keep = np.flatnonzero(self.counts >= min_synapses)
+            edges = zip(self.skeleton_ids[rows[keep]].tolist(),
+                    self.skeleton_ids[self.indices[keep]].tolist(),
+                    self.counts[keep].tolist())
+            edges.extend((a, b, n) for (a, b), n in self.pending.iteritems() if n >= min_synapses)
+            return edges
+
+    def _neighbors(self, skeleton_id, indptr, indices, edges, pending, min_synapses):
+        """ Yield the (skeleton ID, count) of the edges of the skeleton along
+        the given arrays, of at least min_synapses synapses. """
+        i = self._index(skeleton_id)
+        if i >= 0:
+            start, end = indptr[i], indptr[i + 1]
+            counts = self.counts[edges[start:end]] if edges is not None else self.counts[start:end]
+            keep = np.flatnonzero(counts >= min_synapses)
+            for j, n in zip(indices[start:end][keep].tolist(), counts[keep].tolist()):
+                yield int(self.skeleton_ids[j]), n
+        for other, n in pending.get(skeleton_id, {}).iteritems():
+            if n >= min_synapses:
+                yield other, n
+
+    def downstream(self, skeleton_id, min_synapses=1):
+        """ Return a dictionary of the skeletons postsynaptic to the given
+        one with at least min_synapses synapses, vs the number of synapses. """
+        with self.lock:
+            return dict(self._neighbors(skeleton_id, self.indptr, self.indices,
+                    None, self.pending_out, max(1, min_synapses)))
+
+    def upstream(self, skeleton_id, min_synapses=1):
+        """ Return a dictionary of the skeletons presynaptic to the given one
+        with at least min_synapses synapses, vs the number of synapses. """
+        with self.lock:
+            return dict(self._neighbors(skeleton_id, self.in_indptr, self.in_indices,
+                    self.in_edges, self.pending_in, max(1, min_synapses)))
+
+
+    def _gather(self, rows, indptr, indices, edges, min_synapses):
+        """ Return the array of indices of the skeletons at the other end of
+        the edges of the given rows, of at least min_synapses synapses. """
+        starts = indptr[rows]
+        lengths = indptr[rows + 1] - starts
+        total = int(lengths.sum())
+        if 0 == total:
+            return np.zeros(0, dtype=np.int64)
+        # Concatenate the ranges of positions of the edges of every row
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        positions = np.arange(total) + np.repeat(starts - offsets, lengths)
+        counts = self.counts[positions if edges is None else edges[positions]]
+        return indices[positions[counts >= min_synapses]]
+
+    def neighbors(self, skeleton_ids, min_downstream=None, min_upstream=None):
+        """ Return the set of skeletons that receive at least min_downstream
+        synapses from any of the given skeletons, or that make at least
+        min_upstream synapses onto any of them. Either direction is left out
+        when its minimum is None. """
+        skeleton_ids = set(skeleton_ids)
+        found = set()
+        with self.lock:
+            ids = np.array(sorted(skeleton_ids), dtype=np.int64)
+            rows = np.searchsorted(self.skeleton_ids, ids)
+            known = rows < len(self.skeleton_ids)
+            known[known] = self.skeleton_ids[rows[known]] == ids[known]
+            rows = rows[known]
+            for minimum, indptr, indices, edges, pending in (
+                    (min_downstream, self.indptr, self.indices, None, self.pending_out),
+                    (min_upstream, self.in_indptr, self.in_indices, self.in_edges, self.pending_in)):
+                if minimum is None:
+                    continue
+                minimum = max(1, minimum)
+                found.update(self.skeleton_ids[self._gather(rows, indptr, indices, edges, minimum)].tolist())
+                for skid in skeleton_ids:
+                    found.update(other for other, n in pending.get(skid, {}).iteritems() if n >= minimum)
+        return found
+
+    def circles(self, skeleton_ids, n_circles, min_downstream=None, min_upstream=None):
+        """ Breadth-first search from the given skeletons, for n_circles
+        steps along the edges selected as in neighbors. Returns the set of
+        all skeletons reached, including the given ones. """
+        all_circles = set(skeleton_ids)
+        current_circle = all_circles
+        while n_circles > 0 and current_circle:
+            n_circles -= 1
+            current_circle = self.neighbors(current_circle, min_downstream, min_upstream) - all_circles
+            all_circles |= current_circle
+        return all_circles
+
+    def directed_paths(self, skeleton_ids, max_length, min_synapses=1):
+        """ Return the set of skeletons on the simple directed paths of at
+        most max_length edges, of at least min_synapses synapses each, from
+        any of the given skeletons to any other of them. """
+        skeleton_ids = set(skeleton_ids)
+        on_paths = set()
+        for target in skeleton_ids:
+            # Distance to the target of the skeletons that can reach it
+            distance = {target: 0}
+            frontier = set([target])
+            for d in xrange(1, max_length + 1):
+                frontier = self.neighbors(frontier, None, min_synapses) - set(distance)
+                if not frontier:
+                    break
+                for skid in frontier:
+                    distance[skid] = d
+
+            successors = {}
+            def next_steps(skid, remaining):
+                """ The successors from which the target is within reach. """
+                if skid not in successors:
+                    successors[skid] = [(other, distance[other]) for other
+                            in self.downstream(skid, min_synapses) if other in distance]
+                return [other for other, d in successors[skid] if d < remaining]
+
+            # Enumerate the paths depth-first, only along skeletons that are
+            # close enough to the target
+            for source in skeleton_ids:
+                if source == target or source not in distance:
+                    continue
+                path = [source]
+                stack = [iter(next_steps(source, max_length))]
+                while stack:
+                    skid = next(stack[-1], None)
+                    if skid is None:
+                        stack.pop()
+                        path.pop()
+                    elif skid == target:
+                        on_paths.update(path)
+                        on_paths.add(target)
+                    elif skid not in path:
+                        path.append(skid)
+                        stack.append(iter(next_steps(skid, max_length - len(path) + 1)))
+        return on_paths
+
+
+# Project ID vs its ConnectivityIndex
+_indices = {}
+_indices_lock = Lock()
+
+
+def connectivity_index(cursor, project_id):
+    """ Return the ConnectivityIndex of the project, refreshed to include all
+    changes committed so far. """
+    project_id = int(project_id)
+    with _indices_lock:
+        index = _indices.get(project_id)
+        if index is None:
+            index = _indices[project_id] = ConnectivityIndex(project_id)
+    index.refresh(cursor)
+    return index
@@ -2,13 +2,15 @@ import json
 from string import upper
 
 from django.http import HttpResponse
-from django.db.models import Count
 from django.shortcuts import get_object_or_404
 
 from catmaid.models import *
 from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.nodecache import invalidate_connector_tiles
+from catmaid.control.datatable import sort_columns, table_versions, \
+        count_rows, page_rows
 
 from itertools import imap
 
@@ -113,8 +115,6 @@ def list_connector(request, project_id=None):
     relation_type = int(request.POST.get('relation_type', 0))  # 0: Presyn, 1 Postsyn
     display_start = int(request.POST.get('iDisplayStart', 0))
     display_length = int(request.POST.get('iDisplayLength', 0))
-    sorting_column = int(request.POST.get('iSortCol_0', 0))
-    sort_descending = upper(request.POST.get('sSortDir_0', 'DESC')) != 'ASC'
 
     response_on_error = ''
     try:
@@ -135,176 +135,75 @@ def list_connector(request, project_id=None):
         resolution = get_object_or_404(Stack, id=int(stack_id)).resolution
         translation = get_object_or_404(ProjectStack, stack=int(stack_id), project=project_id).translation
 
-        response_on_error = 'Failed to select connectors.'
+        # The columns of the table, by name and whether they can be NULL.
+        # Connectors without partners have a row of their own, located at
+        # the connector.
+        fields = [('connector_id', False), ('other_skeleton_id', True),
+                ('x', False), ('y', False), ('z', False), ('z', False),
+                ('labels', True), ('node_count', False), ('username', False),
+                ('other_treenode_id', True)]
+        order = sort_columns(request, fields,
+                ['connector_id', 'this_link_id', 'other_link_id'])
+
+        query = '''
+        SELECT c.id AS connector_id,
+               tn_other.skeleton_id AS other_skeleton_id,
+               COALESCE((tn_other.location).x, (c.location).x) AS x,
+               COALESCE((tn_other.location).y, (c.location).y) AS y,
+               COALESCE((tn_other.location).z, (c.location).z) AS z,
+               (SELECT string_agg(ci.name, ', ' ORDER BY upper(ci.name))
+                FROM connector_class_instance cci, class_instance ci
+                WHERE cci.connector_id = c.id
+                  AND cci.relation_id = %s
+                  AND cci.class_instance_id = ci.id) AS labels,
+               COALESCE(ss.node_count, 0) AS node_count,
+               u.username,
+               tn_other.id AS other_treenode_id,
+               tc_this.id AS this_link_id,
+               COALESCE(tc_other.id, 0) AS other_link_id
+        FROM treenode_connector tc_this
+        JOIN connector c ON c.id = tc_this.connector_id
+        LEFT OUTER JOIN treenode_connector tc_other
+          ON tc_other.connector_id = c.id
+         AND tc_other.relation_id = %s
+        LEFT OUTER JOIN treenode tn_other ON tn_other.id = tc_other.treenode_id
+        LEFT OUTER JOIN skeleton_summary ss ON ss.skeleton_id = tn_other.skeleton_id
+        JOIN auth_user u ON u.id = COALESCE(tn_other.user_id, c.user_id)
+        WHERE tc_this.skeleton_id = %s
+          AND tc_this.relation_id = %s
+        '''
+        params = [relation_map['labeled_as'], inverse_relation_type_id,
+                skeleton_id, relation_type_id]
+
         cursor = connection.cursor()
-        cursor.execute(
-            '''
-            SELECT
-            connector.id AS connector_id,
-            tn_other.user_id AS connector_user_id,
-            treenode_user.username AS connector_username,
-            (connector.location).x AS connector_x,
-            (connector.location).y AS connector_y,
-            (connector.location).z AS connector_z,
-            tn_other.id AS other_treenode_id,
-            (tn_other.location).x AS other_treenode_x,
-            (tn_other.location).y AS other_treenode_y,
-            (tn_other.location).z AS other_treenode_z,
-            tn_other.skeleton_id AS other_skeleton_id,
-            (tn_this.location).x AS this_treenode_x,
-            (tn_this.location).y AS this_treenode_y,
-            (tn_this.location).z AS this_treenode_z,
-            tn_this.id AS this_treenode_id,
-            tc_this.relation_id AS this_to_connector_relation_id,
-            tc_other.relation_id AS connector_to_other_relation_id
-            FROM
-            treenode tn_other,
-            treenode_connector tc_other,
-            connector,
-            "auth_user" treenode_user,
-            treenode_connector tc_this,
-            treenode tn_this
-            WHERE
-            treenode_user.id = tn_other.user_id AND
-            tn_other.id = tc_other.treenode_id AND
-            tc_other.connector_id = connector.id AND
-            tc_other.relation_id = %s AND
-            tc_this.connector_id = connector.id AND
-            tn_this.id = tc_this.treenode_id AND
-            tn_this.skeleton_id = %s AND
-            tc_this.relation_id = %s
-            ORDER BY
-            connector_id, other_treenode_id, this_treenode_id
-            ''',  [inverse_relation_type_id, skeleton_id, relation_type_id])
-
-        connectors = cursor_fetch_dictionary(cursor)
-        connected_skeletons = map(lambda con: con['other_skeleton_id'], connectors)
-        connector_ids = map(lambda con: con['connector_id'], connectors)
-
-        response_on_error = 'Failed to find counts of treenodes in skeletons.'
-        skel_tn_count = Treenode.objects.filter(skeleton__in=connected_skeletons)\
-        .values('skeleton').annotate(treenode_count=Count('skeleton'))
-        # .values to group by skeleton_id. See http://tinyurl.com/dj-values-annotate
-
-        skeleton_to_treenode_count = {}
-        for s in skel_tn_count:
-            skeleton_to_treenode_count[s['skeleton']] = s['treenode_count']
-
-        # Rather than do a LEFT OUTER JOIN to also include the connectors
-        # with no partners, just do another query to find the connectors
-        # without the conditions:
-
-        response_on_error = 'Failed to select all connectors.'
-        cursor.execute(
-            '''
-            SELECT
-            connector.id AS connector_id,
-            connector.user_id AS connector_user_id,
-            connector_user.username AS connector_username,
-            (connector.location).x AS connector_x,
-            (connector.location).y AS connector_y,
-            (connector.location).z AS connector_z,
-            tn_this.id AS this_treenode_id,
-            tc_this.relation_id AS this_to_connector_relation_id
-            FROM
-            connector,
-            "auth_user" connector_user,
-            treenode_connector tc_this,
-            treenode tn_this
-            WHERE
-            connector_user.id = connector.user_id AND
-            tc_this.connector_id = connector.id AND
-            tn_this.id = tc_this.treenode_id AND
-            tn_this.skeleton_id = %s AND
-            tc_this.relation_id = %s
-            ORDER BY
-            connector_id, this_treenode_id
-            ''',  [skeleton_id, relation_type_id])
-        for row in cursor_fetch_dictionary(cursor):
-            connector_id = row['connector_id']
-            if connector_id not in connector_ids:
-                connectors.append(row)
-                connector_ids.append(connector_id)
-
-        # For each of the connectors, find all of its labels:
-        response_on_error = 'Failed to find the labels for connectors'
-        if (connector_ids > 0):
-            connector_labels = ConnectorClassInstance.objects.filter(
-                project=project_id,
-                connector__in=connector_ids,
-                relation=relation_map['labeled_as']).values(
-                'connector',
-                'class_instance__name')
-
-            labels_by_connector = {}  # Key: Connector ID, Value: List of labels.
-            for label in connector_labels:
-                if label['connector'] not in labels_by_connector:
-                    labels_by_connector[label['connector']] = [label['class_instance__name']]
-                else:
-                    labels_by_connector[label['connector']].append(label['class_instance__name'])
-                # Sort labels by name
-            for labels in labels_by_connector.values():
-                labels.sort(key=upper)
-
-        total_result_count = len(connectors)
-
-        # Paging
-        if display_length == 0:
-            connectors = connectors[display_start:]
-            connector_ids = connector_ids[display_start:]
-        else:
-            connectors = connectors[display_start:display_start + display_length]
-            connector_ids = connector_ids[display_start:display_start + display_length]
+        version = table_versions(cursor, ('treenode_connector', 'connector',
+                'treenode', 'connector_class_instance', 'class_instance'))
+
+        response_on_error = 'Failed to count connectors.'
+        total_result_count = count_rows(cursor, query, params, version)
+
+        response_on_error = 'Failed to select connectors.'
+        # A length of 0 means all rows
+        connectors = page_rows(cursor, query, params, [f[0] for f in fields[:5]] +
+                ['labels', 'node_count', 'username', 'other_treenode_id',
+                 'this_link_id', 'other_link_id'], order, display_start,
+                display_length or -1, version)
 
         # Format output
         aaData_output = []
         for c in connectors:
-            response_on_error = 'Failed to format output for connector with ID %s.' % c['connector_id']
-            if 'other_skeleton_id' in c:
-                connected_skeleton_treenode_count = skeleton_to_treenode_count[c['other_skeleton_id']]
-            else:
-                c['other_skeleton_id'] = ''
-                c['other_treenode_id'] = ''
-                c['other_treenode_x'] = c['connector_x']
-                c['other_treenode_y'] = c['connector_y']
-                c['other_treenode_z'] = c['connector_z']
-                connected_skeleton_treenode_count = 0
-
-            if c['connector_id'] in labels_by_connector:
-                labels = ', '.join(map(str, labels_by_connector[c['connector_id']]))
-            else:
-                labels = ''
-
-            row = []
-            row.append(c['connector_id'])
-            row.append(c['other_skeleton_id'])
-            row.append(c['other_treenode_x']) #('%.2f' % )
-            row.append(c['other_treenode_y'])
-            z = c['other_treenode_z']
-            row.append(z)
-            row.append(int((z - translation.z) / resolution.z))
-            row.append(labels)
-            row.append(connected_skeleton_treenode_count)
-            row.append(c['connector_username'])
-            row.append(c['other_treenode_id'])
-            aaData_output.append(row)
-
-        # Sort output
-        def fetch_value_for_sorting(row):
-            value = row[sorting_column]
-            if isinstance(value, str) or isinstance(value, unicode):
-                return upper(value)
-            return value
-        aaData_output.sort(key=fetch_value_for_sorting)
-
-        # Fix excessive decimal precision in coordinates
-        for row in aaData_output:
-            row[2] = float('%.2f' % row[2])
-            row[3] = float('%.2f' % row[3])
-            row[4] = float('%.2f' % row[4])
-
-        if sort_descending:
-            aaData_output.reverse()
+            z = c[4]
+            aaData_output.append([
+                c[0],
+                '' if c[1] is None else c[1],
+                float('%.2f' % c[2]),
+                float('%.2f' % c[3]),
+                float('%.2f' % z),
+                int((z - translation.z) / resolution.z),
+                c[5] or '',
+                c[6],
+                c[7],
+                '' if c[8] is None else c[8]])
 
         return HttpResponse(json.dumps({
             'iTotalRecords': total_result_count,
@@ -320,14 +219,7 @@ def _connector_skeletons(connector_ids, project_id):
     and 'postsynaptic_to' with a list of skeleton IDs (maybe empty). """
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     PRE = relations['presynaptic_to']
     POST = relations['postsynaptic_to']
 
@@ -378,6 +270,7 @@ def create_connector(request, project_id=None):
         location=location,
         confidence=parsed_confidence)
     new_connector.save()
+    invalidate_connector_tiles(project_id, (new_connector.id,))
 
     return HttpResponse(json.dumps({'connector_id': new_connector.id}))
 
@@ -386,6 +279,7 @@ def create_connector(request, project_id=None):
 def delete_connector(request, project_id=None):
     connector_id = int(request.POST.get("connector_id", 0))
     can_edit_or_fail(request.user, connector_id, 'connector')
+    invalidate_connector_tiles(project_id, (connector_id,))
     Connector.objects.filter(id=connector_id).delete()
     return HttpResponse(json.dumps({
         'message': 'Removed connector and class_instances',
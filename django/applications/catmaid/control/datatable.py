@@ -0,0 +1,187 @@
+# A backend for the server-side processing of DataTables tables, which sorts,
+# filters and pages the rows of an SQL query in the database.
+#
+# Pages are selected by keyset (seek) pagination: rather than skipping the
+# rows of all previous pages with OFFSET, a page starts with a condition on
+# the sort columns that selects the rows after the last row of the previous
+# page, which an index on the sort columns answers directly. DataTables only
+# sends the offset of a page, so the sort keys of the last row of every page
+# are remembered, by query, ordering and offset, and the page that follows
+# seeks from there. Pages without such an anchor seek from the nearest one
+# before them, and skip the remaining rows with OFFSET. Deep pages that
+# aren't reached page by page thereby still skip rows with OFFSET.
+#
+# The total numbers of rows of queries are cached as well. Both are validated
+# against the versions of the tables a query reads from, which triggers
+# advance on every statement that changes them, so changes are noticed right
+# away, including those of the current transaction. Nothing is cached while
+# other transactions that changed the tables are still in progress.
+
+from collections import namedtuple
+
+from django.conf import settings
+
+from catmaid.control.cache import LRUCache
+from catmaid.control.streaming import stream_rows
+
+# name: the name of a column of the query
+# descending: whether to sort in descending order
+# nullable: whether the column can be NULL, which sorts before all values
+SortColumn = namedtuple('SortColumn', ['name', 'descending', 'nullable'])
+
+# (query, params) vs (version, count)
+_counts = LRUCache(getattr(settings, 'DATATABLE_CACHE_SIZE', 0))
+# (query, params, order) vs (version, dictionary of offset vs sort key)
+_anchors = LRUCache(getattr(settings, 'DATATABLE_CACHE_SIZE', 0))
+
+# The maximum number of pages remembered per query and ordering
+_MAX_ANCHORS = 256
+
+# The first key of the advisory locks that statements changing the tables
+# take on them until their transaction ends, see migration 0040
+_TABLE_VERSION_LOCK = 1400
+
+
+def table_versions(cursor, tables):
+    """ Return the edit version of the given tables, which have to be among
+    those whose changes are counted, see migration 0040: the number of
+    statements that changed each of them, along with the ID of the current
+    transaction if it changed any of them, which others don't see. Returns
+    None, which results must not be cached under, while other transactions
+    that changed the tables are in progress. None of this waits for them. """
+    tables = sorted(tables)
+    cursor.execute('SELECT ' + ', '.join(
+            '(SELECT last_value FROM table_version_%s_seq)' % table
+            for table in tables))
+    counts = cursor.fetchone()
+    # Changes counted above whose transaction still holds its lock on the
+    # table aren't visible yet. Own locks don't conflict.
+    cursor.execute('''
+    SELECT bool_and(CASE WHEN pg_try_advisory_lock(%s, t::regclass::oid::integer)
+                         THEN pg_advisory_unlock(%s, t::regclass::oid::integer)
+                         ELSE false END),
+           CASE WHEN (SELECT setting FROM pg_settings
+                      WHERE name = 'catmaid.table_version_changed') = 'on'
+                THEN txid_current() END
+    FROM unnest(%s::text[]) t
+    ''', (_TABLE_VERSION_LOCK, _TABLE_VERSION_LOCK, tables))
+    settled, txid = cursor.fetchone()
+    if not settled:
+        return None
+    return tuple(zip(tables, counts)) + (txid,)
+
+
+def count_rows(cursor, query, params, version):
+    """ Return the number of rows of the query, from the cache if the tables
+    it reads from are still at the given version, see table_versions. """
+    key = (query, repr(params))
+    entry = _counts.get(key)
+    if entry and version is not None and entry[0] == version:
+        return entry[1]
+    cursor.execute('SELECT count(*) FROM (' + query + ') q', params)
+    count = cursor.fetchone()[0]
+    if version is not None:
+        _counts.set(key, (version, count))
+    return count
+
+
+def sort_columns(request, fields, unique):
+    """ Return the list of SortColumns requested by the DataTables parameters
+    of the request, given the list of (name, nullable) tuples of the columns
+    of the table, or None for columns that can't be sorted. The order is made
+    total by the given list of columns that are not nullable and unique
+    together. """
+    order = []
+    if request.POST.get('iSortCol_0', None):
+        for d in xrange(int(request.POST.get('iSortingCols', 0))):
+            field = fields[int(request.POST.get('iSortCol_%d' % d))]
+            if field is None or field[0] in [c.name for c in order]:
+                continue
+            descending = 'DESC' == request.POST.get('sSortDir_%d' % d, 'ASC').upper()
+            order.append(SortColumn(field[0], descending, field[1]))
+    for name in unique:
+        if name not in [c.name for c in order]:
+            order.append(SortColumn(name, False, False))
+    return order
+
+
+def _order_by(alias, order):
+    return 'ORDER BY ' + ', '.join('%s.%s%s%s' % (alias, c.name,
+            ' DESC' if c.descending else '',
+            ' NULLS FIRST' if c.nullable else '') for c in order)
+
+
+def _seek(order, key):
+    """ Return the condition, and the list of its parameters, that selects
+    the rows which follow the row with the given sort key in the order. """
+    alternatives = []
+    params = []
+    for i, column in enumerate(order):
+        terms = []
+        for previous, value in zip(order[:i], key[:i]):
+            if value is None:
+                terms.append('q.%s IS NULL' % previous.name)
+            else:
+                terms.append('q.%s = %%s' % previous.name)
+                params.append(value)
+        if key[i] is None:
+            terms.append('q.%s IS NOT NULL' % column.name)
+        else:
+            terms.append('q.%s %s %%s' % (column.name, '<' if column.descending else '>'))
+            params.append(key[i])
+        alternatives.append('(' + ' AND '.join(terms) + ')')
+    condition = '(' + ' OR '.join(alternatives) + ')'
+    # A range on the first sort column lets an index on it narrow the scan
+    first = order[0]
+    if key[0] is not None:
+        condition = 'q.%s %s %%s AND %s' % (first.name,
+                '<=' if first.descending else '>=', condition)
+        params.insert(0, key[0])
+    return condition, params
+
+
+def page_rows(cursor, query, params, columns, order, start, length, version,
+        select='p.*', select_params=()):
+    """ Return the rows of the page of the query that starts at the given
+    offset and that has the given length, or all remaining rows if the length
+    is negative, sorted by the given list of SortColumns. The given columns
+    of the query are selected, which have to include the sort columns, and
+    rows are then made up of the SQL select list, which refers to them as
+    "p.<column>" and is only evaluated for the rows of the page. Anchors of
+    pages are used if the tables the query reads from are still at the given
+    version, see table_versions. Rows of pages of negative length are
+    streamed. """
+    signature = (query, repr(params), tuple(order))
+    entry = _anchors.get(signature)
+    anchors = entry[1] if entry and version is not None and entry[0] == version else {}
+    base = max([offset for offset in anchors if offset <= start] or [0])
+    if base:
+        condition, condition_params = _seek(order, anchors[base])
+    else:
+        condition, condition_params = 'TRUE', []
+
+    page = 'SELECT %s FROM (%s) q WHERE %s %s OFFSET %%s' % (
+            ', '.join('q.' + c for c in columns), query, condition,
+            _order_by('q', order))
+    page_params = list(params) + condition_params + [start - base]
+    if length >= 0:
+        page += ' LIMIT %s'
+        page_params.append(length)
+
+    if length < 0:
+        sql = 'SELECT %s FROM (%s) p %s' % (select, page, _order_by('p', order))
+        return stream_rows(sql, list(select_params) + page_params)
+
+    # The sort key of each row follows the select list
+    n = len(order)
+    sql = 'SELECT %s, %s FROM (%s) p %s' % (select,
+            ', '.join('p.' + c.name for c in order), page, _order_by('p', order))
+    cursor.execute(sql, list(select_params) + page_params)
+    rows = cursor.fetchall()
+    if rows and len(rows) == length and version is not None and _anchors.max_size > 0:
+        anchors = dict(anchors)
+        anchors[start + length] = tuple(rows[-1][-n:])
+        if len(anchors) > _MAX_ANCHORS:
+            del anchors[min(anchors)]
+        _anchors.set(signature, (version, anchors))
+    return [row[:-n] for row in rows]
@@ -2,64 +2,47 @@ import json
 from django.db import connection
 from django.http import HttpResponse
 from catmaid.control.authentication import *
-from catmaid.models import Relation
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.skeletoncache import get_cached_skeletons, cache_skeletons
 import networkx as nx
-from networkx.algorithms import weakly_connected_component_subgraphs
+import numpy as np
 from collections import defaultdict
 from itertools import chain, ifilter, imap
 from functools import partial
 from synapseclustering import tree_max_density
-from numpy import subtract
-from numpy.linalg import norm
-from tree_util import edge_count_to_root, simplify, find_root, reroot, partition, spanning_tree, cable_length
+from tree_util import Arbor, edge_count_to_root, simplify, find_root, reroot, partition, spanning_tree, cable_length
 from math import sqrt
 import sys
 
-def split_by_confidence_and_add_edges(confidence_threshold, digraphs, rows):
-    """ dipgrahs is a dictionary of skeleton IDs as keys and DiGraph instances as values,
-    where the DiGraph does not have any edges yet.
-    WARNING: side effect on contents of digraph: will add the edges
+def split_by_confidence(confidence_threshold, arbors, confidences):
+    """ arbors is a dictionary of skeleton IDs as keys and Arbor instances as values,
+    and confidences a dictionary of skeleton IDs vs the array of the confidence
+    of the edge from each node of the Arbor to its parent.
+    Returns a dictionary of skeleton IDs vs the list of Arbor instances that
+    each skeleton is split into at its low-confidence edges.
     """
-    arbors = {}
-    # Define edges, which may result in multiple subgraphs for each skeleton
-    # when splitting at low-confidence edges:
     if 0 == confidence_threshold:
         # Do not split skeletons
-        for row in rows:
-            if row[1]:
-                digraphs[row[3]].add_edge(row[1], row[0])
-        for skid, digraph in digraphs.iteritems():
-            arbors[skid] = [digraph]
-    else:
-        # The DiGraph representing the skeleton may be disconnected at a low-confidence edge
-        to_split = set()
-        for row in rows:
-            if row[2] < confidence_threshold:
-                to_split.add(row[3])
-            elif row[1]:
-                digraphs[row[3]].add_edge(row[1], row[0])
-        for skid, digraph in digraphs.iteritems():
-            if skid in to_split:
-                arbors[skid] = weakly_connected_component_subgraphs(digraph)
-            else:
-                arbors[skid] = [digraph]
+        return {skid: [arbor] for skid, arbor in arbors.iteritems()}
+    return {skid: arbor.split(confidences[skid] < confidence_threshold)
+            for skid, arbor in arbors.iteritems()}
 
-    return arbors
-
-def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, minis):
-    """ locations: dictionary of treenode ID vs tuple with x,y,z
-        arbors: dictionary of skeleton ID vs list of DiGraph (that were, or not, split by confidence)
+def split_by_synapse_domain(bandwidth, arbors, treenode_connector, minis):
+    """ arbors: dictionary of skeleton ID vs list of Arbor (that were, or not, split by confidence)
         treenode_connectors: dictionary of treenode ID vs list of tuples of connector_id, string of 'presynaptic_to' or 'postsynaptic_to'
+        minis: dictionary of skeleton ID vs list, to which the minified Arbor
+        among the synapse domains of each split arbor is added, along with the
+        dictionary of node ID vs the Arbor it stands for.
     """
     arbors2 = {} # Some arbors will be split further
-    for skeleton_id, graphs in arbors.iteritems():
+    for skeleton_id, trees in arbors.iteritems():
         subdomains = []
         arbors2[skeleton_id] = subdomains
-        for graph in graphs:
+        for tree in trees:
             treenode_ids = []
             connector_ids =[]
             relation_ids = []
-            for treenode_id in ifilter(treenode_connector.has_key, graph.nodes_iter()):
+            for treenode_id in ifilter(treenode_connector.has_key, tree):
                 for c in treenode_connector.get(treenode_id):
                     connector_id, relation = c
                     treenode_ids.append(treenode_id)
@@ -67,97 +50,139 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                     relation_ids.append(relation)
 
             if not connector_ids:
-                subdomains.append(graph)
+                subdomains.append(tree)
                 continue
 
-            for parent_id, treenode_id in graph.edges_iter():
-                loc0 = locations[treenode_id]
-                loc1 = locations[parent_id]
-                graph[parent_id][treenode_id]['weight'] = norm(subtract(loc0, loc1))
-
-            # Invoke Casey's magic
-            synapse_group = tree_max_density(graph.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
+            # Invoke Casey's magic. The edges of the Arbor are weighted by their length.
+            synapse_group = tree_max_density(tree, treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
             # The list of nodes of each synapse_group contains only nodes that have connectors
             # A local_max is the skeleton node most central to a synapse_group
             anchors = {}
             for domain in synapse_group.itervalues():
-                g = nx.DiGraph()
-                g.add_nodes_from(domain.node_ids) # bogus graph, containing treenodes that point to connectors
+                g = tree.select(domain.node_ids) # bogus arbor, containing treenodes that point to connectors
                 subdomains.append(g)
                 anchors[domain.local_max] = g
-            # Define edges between domains: create a simplified graph
-            mini = simplify(graph, anchors.keys())
-            # Replace each node by the corresponding graph, or a graph of a single node
-            for node in mini.nodes_iter():
+            # Define edges between domains: create a simplified arbor
+            mini = simplify(tree, anchors.keys())
+            # Replace each node by the corresponding arbor, or an arbor of a single node
+            graphs = {}
+            for node in mini:
                 g = anchors.get(node)
-                if not g:
+                if g is None:
                     # A branch node that was not an anchor, i.e. did not represent a synapse group
-                    g = nx.Graph()
-                    g.add_node(node, {'branch': True})
+                    g = tree.select((node,))
+                    g.branch = True
                     subdomains.append(g)
-                # Associate the Graph with treenodes that have connectors
+                # Associate the Arbor with treenodes that have connectors
                 # with the node in the minified tree
-                mini.node[node]['g'] = g
+                graphs[node] = g
             # Put the mini into a map of skeleton_id and list of minis,
             # to be used later for defining intra-neuron edges in the circuit graph
-            minis[skeleton_id].append(mini)
+            minis[skeleton_id].append((mini, graphs))
 
     return arbors2, minis
 
 
-def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence):
-    """ Assumes all skeleton_ids belong to project_id. """
-    skeletons_string = ",".join(str(int(x)) for x in skeleton_ids)
-    cursor = connection.cursor()
+class ArborDecomposition(object):
+    """ The arbors that a skeleton is split into, by confidence and, when
+    expanded, by synapse domain, along with the minified arbors among its
+    synapse domains and its synapses as tuples of (connector_id, relation_id,
+    treenode_id). """
+    def __init__(self, arbors, minis, synapses):
+        self.arbors = arbors
+        self.minis = minis
+        self.synapses = synapses
+
 
-    # Fetch all treenodes of all skeletons
+def _decompose_skeletons(project_id, skeleton_ids, confidence_threshold, bandwidth, expand):
+    """ Return a dictionary of skeleton ID vs ArborDecomposition. The
+    decomposition of each skeleton is cached until the skeleton is edited,
+    so that only skeletons that changed since the last request are split
+    and clustered by synapses again. """
+    cursor = connection.cursor()
+    params = {int(skid): (confidence_threshold, bandwidth if skid in expand and bandwidth > 0 else 0) for skid in skeleton_ids}
+    versions, decompositions = get_cached_skeletons(cursor, 'graph.decomposition', params)
+    to_decompose = [skid for skid in params if skid not in decompositions]
+    if not to_decompose:
+        return decompositions
+    skeletons_string = ",".join(str(skid) for skid in to_decompose)
+
+    # Fetch all treenodes of the skeletons to decompose
     cursor.execute('''
-    SELECT id, parent_id, confidence, skeleton_id, location, reviewer_id
+    SELECT id, parent_id, confidence, skeleton_id,
+           (location).x, (location).y, (location).z, reviewer_id
     FROM treenode
     WHERE skeleton_id IN (%s)
     ''' % skeletons_string)
-    rows = tuple(cursor.fetchall())
-    # Each skeleton is represented with a DiGraph
-    arbors = defaultdict(nx.DiGraph)
+    rows = defaultdict(list)
+    for row in cursor.fetchall():
+        rows[row[3]].append(row)
 
-    # Create a DiGraph for every skeleton
-    for row in rows:
-        arbors[row[3]].add_node(row[0], {'reviewer_id': row[5]})
+    # Each skeleton is represented with an Arbor
+    arbors = {}
+    confidences = {}
+    for skid, skeleton_rows in rows.iteritems():
+        arbors[skid] = Arbor([row[0] for row in skeleton_rows],
+                             [row[1] for row in skeleton_rows],
+                             [row[4:7] for row in skeleton_rows],
+                             {'reviewer_id': [row[7] for row in skeleton_rows]})
+        confidences[skid] = np.array([row[2] for row in skeleton_rows])
 
-    # Dictionary of skeleton IDs vs list of DiGraph instances
-    arbors = split_by_confidence_and_add_edges(confidence_threshold, arbors, rows)
+    # Dictionary of skeleton IDs vs list of Arbor instances
+    arbors = split_by_confidence(confidence_threshold, arbors, confidences)
 
     # Fetch all synapses
-    relations = {'presynaptic_to': -1, 'postsynaptic_to': -1}
-    for r in Relation.objects.filter(relation_name__in=('presynaptic_to', 'postsynaptic_to'), project_id=project_id).values_list('relation_name', 'id'):
-        relations[r[0]] = r[1]
     cursor.execute('''
     SELECT connector_id, relation_id, treenode_id, skeleton_id
     FROM treenode_connector
     WHERE skeleton_id IN (%s)
     ''' % skeletons_string)
-    connectors = defaultdict(partial(defaultdict, list))
-    skeleton_synapses = defaultdict(partial(defaultdict, list))
+    synapses = defaultdict(list)
     for row in cursor.fetchall():
-        connectors[row[0]][row[1]].append((row[2], row[3]))
-        skeleton_synapses[row[3]][row[1]].append(row[2])
+        synapses[row[3]].append(row[:3])
 
     # Cluster by synapses
-    minis = defaultdict(list) # skeleton_id vs list of minified graphs
-    locations = None
-    whole_arbors = arbors
-    if expand and bandwidth > 0:
-        locations = {row[0]: tuple(imap(float, row[4][1:-1].split(','))) for row in rows}
+    minis = defaultdict(list) # skeleton_id vs list of minified arbors
+    arbors_to_expand = {skid: arbors[skid] for skid in to_decompose if params[skid][1] > 0 and skid in arbors}
+    if arbors_to_expand:
+        relation_map = get_relation_to_id_map(project_id)
+        relation_names = {relation_map.get('presynaptic_to', -1): 'presynaptic_to',
+                          relation_map.get('postsynaptic_to', -1): 'postsynaptic_to'}
         treenode_connector = defaultdict(list)
-        for connector_id, pp in connectors.iteritems():
-            for treenode_id in chain.from_iterable(pp[relations['presynaptic_to']]):
-                treenode_connector[treenode_id].append((connector_id, "presynaptic_to"))
-            for treenode_id in chain.from_iterable(pp[relations['postsynaptic_to']]):
-                treenode_connector[treenode_id].append((connector_id, "postsynaptic_to"))
-        arbors_to_expand = {skid: ls for skid, ls in arbors.iteritems() if skid in expand}
-        expanded_arbors, minis = split_by_synapse_domain(bandwidth, locations, arbors_to_expand, treenode_connector, minis)
+        for skid in arbors_to_expand:
+            for connector_id, relation_id, treenode_id in synapses[skid]:
+                if relation_id in relation_names:
+                    treenode_connector[treenode_id].append((connector_id, relation_names[relation_id]))
+        expanded_arbors, minis = split_by_synapse_domain(bandwidth, arbors_to_expand, treenode_connector, minis)
         arbors.update(expanded_arbors)
 
+    new_decompositions = {skid: ArborDecomposition(arbors.get(skid, []), minis.get(skid, []), synapses.get(skid, []))
+                          for skid in to_decompose}
+    cache_skeletons(cursor, 'graph.decomposition', params, versions, new_decompositions)
+    decompositions.update(new_decompositions)
+    return decompositions
+
+def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand, compute_risk, cable_spread, path_confluence):
+    """ Assumes all skeleton_ids belong to project_id. """
+    skeletons_string = ",".join(str(int(x)) for x in skeleton_ids)
+    cursor = connection.cursor()
+
+    decompositions = _decompose_skeletons(project_id, skeleton_ids, confidence_threshold, bandwidth, expand)
+
+    # Dictionary of skeleton IDs vs list of Arbor instances
+    arbors = {skid: d.arbors for skid, d in decompositions.iteritems() if d.arbors}
+    minis = {skid: d.minis for skid, d in decompositions.iteritems() if d.minis}
+    whole_arbors = arbors
+
+    relation_map = get_relation_to_id_map(project_id)
+    relations = {'presynaptic_to': relation_map.get('presynaptic_to', -1),
+                 'postsynaptic_to': relation_map.get('postsynaptic_to', -1)}
+    connectors = defaultdict(partial(defaultdict, list))
+    skeleton_synapses = defaultdict(partial(defaultdict, list))
+    for skid, d in decompositions.iteritems():
+        for connector_id, relation_id, treenode_id in d.synapses:
+            connectors[connector_id][relation_id].append((treenode_id, skid))
+            skeleton_synapses[skid][relation_id].append(treenode_id)
 
     # Obtain neuron names
     cursor.execute('''
@@ -191,7 +216,7 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                                  'label': label,
                                  'skeleton_id': skid,
                                  'node_count': len(g),
-                                 'node_reviewed_count': sum(1 for v in g.node.itervalues() if -1 != v.get('reviewer_id', -1)), # TODO when bandwidth > 0, not all nodes are included. They will be included when the bandwidth is computed with an O(n) algorithm rather than the current O(n^2)
+                                 'node_reviewed_count': int((g.properties['reviewer_id'] != -1).sum()), # TODO when bandwidth > 0, not all nodes are included. They will be included when the bandwidth is computed with an O(n) algorithm rather than the current O(n^2)
                                  'branch': False})
             i += 1
 
@@ -200,11 +225,11 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
         for pre_treenode, pre_skeleton in c[relations['presynaptic_to']]:
             for pre_arbor in arbors.get(pre_skeleton, ()):
                 if pre_treenode in pre_arbor:
-                    # Found the DiGraph representing an arbor derived from the skeleton to which the presynaptic treenode belongs.
+                    # Found the Arbor representing an arbor derived from the skeleton to which the presynaptic treenode belongs.
                     for post_treenode, post_skeleton in c[relations['postsynaptic_to']]:
                         for post_arbor in arbors.get(post_skeleton, ()):
                             if post_treenode in post_arbor:
-                                # Found the DiGraph representing an arbor derived from the skeleton to which the postsynaptic treenode belongs.
+                                # Found the Arbor representing an arbor derived from the skeleton to which the postsynaptic treenode belongs.
                                 edge_props = circuit.get_edge_data(pre_arbor, post_arbor)
                                 if edge_props:
                                     edge_props['c'] += 1
@@ -223,6 +248,9 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
             pre = synapses[relations['presynaptic_to']]
             post = synapses[relations['postsynaptic_to']]
             for arbor in arbors:
+                if hasattr(arbor, 'treenode_synapse_counts'):
+                    # Computed already, when the decomposition was cached
+                    continue
                 # The subset of synapses that belong to the fraction of the original arbor
                 pre_sub = tuple(treenodeID for treenodeID in pre if treenodeID in arbor)
                 post_sub = tuple(treenodeID for treenodeID in post if treenodeID in arbor)
@@ -242,9 +270,6 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
 
                 arbor.treenode_synapse_counts = tc
 
-        if not locations:
-            locations = {row[0]: imap(float, row[4][1:-1].split(',')) for row in rows}
-
         # Estimate the risk factor of the edge between two arbors,
         # as a function of the number of synapses and their location within the arbor.
         # Algorithm by Casey Schneider-Mizell
@@ -263,10 +288,10 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                 tc = post_arbor.treenode_synapse_counts
                 count = spanning.number_of_nodes()
                 if count < 3:
-                    median_synapse_centrality = sum(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes_iter()) / count
+                    median_synapse_centrality = sum(tc[treenodeID].synapse_centrality for treenodeID in spanning) / count
                 else:
-                    median_synapse_centrality = sorted(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes_iter())[count / 2]
-                cable = cable_length(spanning, locations)
+                    median_synapse_centrality = sorted(tc[treenodeID].synapse_centrality for treenodeID in spanning)[count / 2]
+                cable = spanning.cable_length()
                 if -1 == median_synapse_centrality:
                     # Signal not computable
                     edge_props['risk'] = -1
@@ -281,10 +306,9 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
     if expand and bandwidth > 0:
         # Add edges between circuit nodes that represent different domains of the same neuron
         for skeleton_id, list_mini in minis.iteritems():
-            for mini in list_mini:
-                for node in mini.nodes_iter():
-                    g = mini.node[node]['g']
-                    if 1 == len(g) and g.nodes_iter(data=True).next()[1].get('branch'):
+            for mini, graphs in list_mini:
+                for node, g in graphs.iteritems():
+                    if getattr(g, 'branch', False):
                         # A branch node that was preserved in the minified arbor
                         circuit.add_node(g, {'id': '%s-%s' % (skeleton_id, node),
                                              'skeleton_id': skeleton_id,
@@ -292,8 +316,8 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                                              'node_count': 1,
                                              'branch': True})
                 for node1, node2 in mini.edges_iter():
-                    g1 = mini.node[node1]['g']
-                    g2 = mini.node[node2]['g']
+                    g1 = graphs[node1]
+                    g2 = graphs[node2]
                     circuit.add_edge(g1, g2, {'c': 10, 'arrow': 'none', 'directed': False})
 
     return circuit
@@ -351,8 +375,7 @@ def _node_centrality_by_synapse_db(skeleton_id):
     ''' % skeleton_id)
 
     nodes = {} # node ID vs Counts
-    tree = nx.DiGraph()
-    root = None
+    parents = {} # node ID vs parent ID
     totalInputs = 0
     totalOutputs = 0
 
@@ -368,17 +391,15 @@ def _node_centrality_by_synapse_db(skeleton_id):
             elif 'postsynaptic_to' == row[2]:
                 counts.inputs += 1
                 totalInputs += 1
-        if row[1]:
-            tree.add_edge(row[0], row[1])
-        else:
-            root = row[0]
+        parents[row[0]] = row[1]
 
+    tree = Arbor(parents.keys(), parents.values())
     _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs)
 
     return nodes
 
 def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
-    """ tree: a DiGraph
+    """ tree: an Arbor
         nodes: a dictionary of treenode ID vs Counts instance
         totalOutputs: the total number of output synapses of the tree
         totalInputs: the total number of input synapses of the tree
@@ -391,11 +412,10 @@ def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
             counts.synapse_centrality = -1
         return
 
-    if len(tree.successors(find_root(tree))) > 1:
+    if tree.n_children()[tree.parent < 0][0] > 1:
         # Reroot at the first end node found
         tree = tree.copy()
-        endNode = (nodeID for nodeID in nodes.iterkeys() if not tree.successors(nodeID)).next()
-        reroot(tree, endNode)
+        tree.reroot(int(tree.end_nodes()[0]))
 
     # 2. Partition into sequences, sorted from small to large
     sequences = sorted(partition(tree), key=len)
@@ -2,16 +2,15 @@ import json
 from django.db import connection
 from django.http import HttpResponse
 from catmaid.control.authentication import *
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.skeletoncache import get_cached_skeletons, cache_skeletons
 from catmaid.models import Relation
-import networkx as nx
-from networkx.algorithms import weakly_connected_component_subgraphs
+import numpy as np
 from collections import defaultdict
-from itertools import chain, ifilter, imap, izip, count
+from itertools import chain, ifilter, imap, izip, count, repeat
 from functools import partial
 from synapseclustering import tree_max_density
-from numpy import subtract
-from numpy.linalg import norm
-from tree_util import edge_count_to_root, simplify, find_root, reroot, partition, spanning_tree, cable_length
+from tree_util import Arbor, edge_count_to_root, simplify, find_root, reroot, partition, spanning_tree, cable_length
 from math import sqrt
 import sys
 from operator import getitem
@@ -19,13 +18,7 @@ from operator import getitem
 def basic_graph(project_id, skeleton_ids):
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
     cursor.execute('''
@@ -73,204 +66,72 @@ def basic_graph(project_id, skeleton_ids):
     """
 
 
-def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
-    """ Assumes 0 < confidence_threshold <= 5. """
-    cursor = connection.cursor()
-    skids = ",".join(str(int(skid)) for skid in skeleton_ids)
-
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
-
-    # Fetch synapses of all skeletons
-    cursor.execute('''
-    SELECT skeleton_id, treenode_id, connector_id, relation_id
-    FROM treenode_connector
-    WHERE project_id = %s
-      AND skeleton_id IN (%s)
-    ''' % (int(project_id), skids))
-
-    stc = defaultdict(list)
-    for row in cursor.fetchall():
-        stc[row[0]].append(row[1:]) # skeleton_id vs (treenode_id, connector_id, relation_id)
-
-    # Fetch all treenodes of all skeletons
-    cursor.execute('''
-    SELECT skeleton_id, id, parent_id, confidence
-    FROM treenode
-    WHERE project_id = %s
-      AND skeleton_id IN (%s)
-    ORDER BY skeleton_id
-    ''' % (project_id, skids))
-
-    # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
-    connectors = defaultdict(partial(defaultdict, list))
-
-    # All nodes of the graph
-    nodeIDs = []
-
-    # Read out into memory only one skeleton at a time
-    current_skid = None
-    tree = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-    # Create the edges of the graph from the connectors, which was populated as a side effect of 'split_by_confidence'
-    edges = defaultdict(partial(defaultdict, int)) # pre vs post vs count
-    for c in connectors.itervalues():
-        for pre in c[preID]:
-            for post in c[postID]:
-                edges[pre][post] += 1
-
-    return {'nodes': nodeIDs,
-            'edges': [(pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems()]}
-
-
-def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand):
-    """ Assumes bandwidth > 0 and some skeleton_id in expand. """
+def split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand):
+    """ Split skeletons at edges below the confidence_threshold and, those in
+    expand, also by synapse domain when the bandwidth is larger than zero.
+    The split of each skeleton is cached until the skeleton is edited, so
+    that only skeletons that changed since the last request are split again. """
     cursor = connection.cursor()
-    skeleton_ids = set(skeleton_ids)
-    expand = set(expand)
-
-    # assumes all skeleton_id in expand are also present in skeleton_ids
+    skeleton_ids = sorted(set(int(skid) for skid in skeleton_ids))
+    expand = set(expand) if bandwidth > 0 else set()
 
-    skids = ",".join(str(int(skid)) for skid in skeleton_ids)
-
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
 
-    # Fetch synapses of all skeletons
-    cursor.execute('''
-    SELECT skeleton_id, treenode_id, connector_id, relation_id
-    FROM treenode_connector
-    WHERE project_id = %s
-      AND skeleton_id IN (%s)
-    ''' % (int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
-
-    stc = defaultdict(list)
-    for row in cursor.fetchall():
-        stc[row[0]].append(row[1:]) # skeleton_id vs (treenode_id, connector_id, relation_id)
-
-    # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
-    connectors = defaultdict(partial(defaultdict, list))
-
-    # All nodes of the graph (with or without edges. Includes those representing synapse domains)
-    nodeIDs = []
+    params = {skid: (confidence_threshold, bandwidth if skid in expand else 0) for skid in skeleton_ids}
+    versions, splits = get_cached_skeletons(cursor, 'graph2.split', params)
+    to_split = [skid for skid in skeleton_ids if skid not in splits]
 
-    not_to_expand = skeleton_ids - expand
+    if to_split:
+        skids = ",".join(str(skid) for skid in to_split)
 
-    if confidence_threshold > 0 and not_to_expand:
-        # Now fetch all treenodes of only skeletons in skeleton_ids (the ones not to expand)
+        # Fetch synapses of the skeletons to split
         cursor.execute('''
-        SELECT skeleton_id, id, parent_id, confidence
-        FROM treenode
+        SELECT skeleton_id, treenode_id, connector_id, relation_id
+        FROM treenode_connector
         WHERE project_id = %s
           AND skeleton_id IN (%s)
-        ORDER BY skeleton_id
-        ''' % (project_id, ",".join(str(int(skid)) for skid in not_to_expand)))
+        ''' % (int(project_id), skids))
 
-        # Read out into memory only one skeleton at a time
-        current_skid = None
-        tree = None
+        stc = defaultdict(list)
         for row in cursor.fetchall():
-            if row[0] == current_skid:
-                # Build the tree, breaking it at the low-confidence edges
-                if row[2] and row[3] >= confidence_threshold:
-                        tree.add_edge(row[2], row[1])
-                continue
-
-            if tree:
-                nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-            # Start the next tree
-            current_skid = row[0]
-            tree = nx.DiGraph()
-            if row[2] and row[3] > confidence_threshold:
-                tree.add_edge(row[2], row[1])
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-    else:
-        # No need to split.
-        # Populate connectors from the connections among them
-        for skid in not_to_expand:
-            nodeIDs.append(skid)
-            for c in stc[skid]:
-                connectors[c[1]][c[2]].append(skid)
-
-
-    # Now fetch all treenodes of all skeletons to expand
-    cursor.execute('''
-    SELECT skeleton_id, id, parent_id, confidence, (location).x, (location).y, (location).z
-    FROM treenode
-    WHERE project_id = %s
-      AND skeleton_id IN (%s)
-    ORDER BY skeleton_id
-    ''' % (project_id, ",".join(str(int(skid)) for skid in expand)))
-
-    # list of edges among synapse domains
-    intraedges = []
+            stc[row[0]].append(row[1:]) # skeleton_id vs (treenode_id, connector_id, relation_id)
+
+        # Fetch the treenodes, unless the skeletons don't have to be split at all
+        treenodes = defaultdict(list)
+        if confidence_threshold > 0 or expand:
+            cursor.execute('''
+            SELECT skeleton_id, id, parent_id, confidence, (location).x, (location).y, (location).z
+            FROM treenode
+            WHERE project_id = %s
+              AND skeleton_id IN (%s)
+            ''' % (int(project_id), skids))
+            for row in cursor.fetchall():
+                treenodes[row[0]].append(row[1:])
+
+        new_splits = {}
+        for skid in to_split:
+            new_splits[skid] = split_skeleton(skid, treenodes[skid], stc[skid],
+                    confidence_threshold, params[skid][1])
+        cache_skeletons(cursor, 'graph2.split', params, versions, new_splits)
+        splits.update(new_splits)
 
+    # All nodes of the graph (with or without edges. Includes those representing synapse domains)
+    nodeIDs = []
     # list of branch nodes, merely structural
     branch_nodeIDs = []
+    # list of edges among synapse domains
+    intraedges = []
+    # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
+    connectors = defaultdict(partial(defaultdict, list))
 
-    # reset
-    current_skid = None
-    tree = None
-    locations = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            locations[row[1]] = row[4:]
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-            nodeIDs.extend(ns)
-            branch_nodeIDs.extend(bs)
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        locations = {}
-        locations[row[1]] = row[4:]
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
+    for skid in skeleton_ids:
+        ns, bs, ies, memberships = splits[skid]
         nodeIDs.extend(ns)
         branch_nodeIDs.extend(bs)
-
+        intraedges.extend(ies)
+        for connector_id, relation_id, nodeID in memberships:
+            connectors[connector_id][relation_id].append(nodeID)
 
     # Create the edges of the graph
     edges = defaultdict(partial(defaultdict, int)) # pre vs post vs count
@@ -279,25 +140,70 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
             for post in c[postID]:
                 edges[pre][post] += 1
 
-    return {'nodes': nodeIDs,
-            'edges': [(pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems()],
-            'branch_nodes': branch_nodeIDs,
-            'intraedges': intraedges}
+    graph = {'nodes': nodeIDs,
+             'edges': [(pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems()]}
+    if expand:
+        graph['branch_nodes'] = branch_nodeIDs
+        graph['intraedges'] = intraedges
+    return graph
+
+
+def split_skeleton(skeleton_id, rows, cs, confidence_threshold, bandwidth):
+    """ Split a skeleton by confidence and, when the bandwidth is larger than
+    zero, by synapse domain.
+    rows: the treenodes of the skeleton, as (id, parent_id, confidence, x, y, z)
+    cs: the synapses of the skeleton, as (treenode_id, connector_id, relation_id)
+    Returns a tuple with the list of node IDs, the list of branch node IDs,
+    the list of edges among synapse domains and the list of (connector_id,
+    relation_id, node ID) of each synapse. """
+    connectors = defaultdict(partial(defaultdict, list))
+    intraedges = []
+    branch_nodes = []
+
+    if 0 == confidence_threshold and 0 == bandwidth:
+        # No need to split.
+        # Populate connectors from the connections among them
+        nodes = [skeleton_id]
+        for c in cs:
+            connectors[c[1]][c[2]].append(skeleton_id)
+    else:
+        # Build the tree, to be broken at the low-confidence edges
+        if not rows:
+            nodes = []
+        else:
+            tree = Arbor([row[0] for row in rows], [row[1] for row in rows],
+                         [row[3:6] for row in rows])
+            cut = np.array([row[2] for row in rows]) < confidence_threshold
+            if bandwidth > 0:
+                nodes, branch_nodes = split_by_both(skeleton_id, tree, cut, bandwidth, cs, connectors, intraedges)
+            else:
+                nodes = list(split_by_confidence(skeleton_id, tree, cut, cs, connectors))
+
+    memberships = [(connector_id, relation_id, nodeID)
+                   for connector_id, relations in connectors.iteritems()
+                   for relation_id, nodeIDs in relations.iteritems()
+                   for nodeID in nodeIDs]
+
+    return nodes, branch_nodes, intraedges, memberships
 
 
 def populate_connectors(chunkIDs, chunks, cs, connectors):
     # Build up edges via the connectors
-    IDchunks = zip(chunkIDs, chunks)
+    chunk_of = {}
+    for chunkID, chunk in izip(chunkIDs, chunks):
+        chunk_of.update(izip(chunk.nodes(), repeat(chunkID)))
     for c in cs:
         # c is (treenode_id, connector_id, relation_id)
-        for chunkID, chunk in IDchunks:
-            if c[0] in chunk:
-                connectors[c[1]][c[2]].append(chunkID)
-                break
+        chunkID = chunk_of.get(c[0])
+        if chunkID is not None:
+            connectors[c[1]][c[2]].append(chunkID)
 
 
-def subgraphs(digraph, skeleton_id):
-    chunks = weakly_connected_component_subgraphs(digraph)
+def subgraphs(arbor, cut, skeleton_id):
+    """ Split the arbor at the edges from the nodes selected by the boolean
+    mask cut to their parents. Nodes left without any edge belong to none of
+    the chunks. """
+    chunks = [chunk for chunk in arbor.split(cut) if len(chunk) > 1]
     if 1 == len(chunks):
         chunkIDs = (str(skeleton_id),)
     else:
@@ -305,27 +211,24 @@ def subgraphs(digraph, skeleton_id):
     return chunks, chunkIDs
 
 
-def split_by_confidence(skeleton_id, digraph, cs, connectors):
+def split_by_confidence(skeleton_id, arbor, cut, cs, connectors):
     """ Split by confidence threshold. Populates connectors (side effect). """
-    chunks, chunkIDs = subgraphs(digraph, skeleton_id)
+    chunks, chunkIDs = subgraphs(arbor, cut, skeleton_id)
     populate_connectors(chunkIDs, chunks, cs, connectors)
     return chunkIDs
 
 
-def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, intraedges):
+def split_by_both(skeleton_id, arbor, cut, bandwidth, cs, connectors, intraedges):
     """ Split by confidence and synapse domain. Populates connectors and intraedges (side effects). """
     nodes = []
     branch_nodes = []
 
-    chunks, chunkIDs = subgraphs(digraph, skeleton_id)
+    chunks, chunkIDs = subgraphs(arbor, cut, skeleton_id)
 
     for i, chunkID, chunk in izip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
-
         # Check if need to expand at all
-        blob = tuple(c for c in cs if c[0] in chunk)
+        members = set(chunk.nodes())
+        blob = tuple(c for c in cs if c[0] in members)
         if 0 == len(blob):
             nodes.append(chunkID)
             continue
@@ -336,8 +239,9 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
             nodes.append(chunkID)
             continue
 
-        # Invoke Casey's magic: split by synapse domain
-        domains = tree_max_density(chunk.to_undirected(), treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
+        # Invoke Casey's magic: split by synapse domain. The edges of the
+        # Arbor are weighted by their length.
+        domains = tree_max_density(chunk, treenode_ids, connector_ids, relation_ids, [bandwidth]).values()[0]
 
         # domains is a dictionary of index vs SynapseGroup instance
 
@@ -351,7 +255,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         # Pick one treenode from each domain to act as anchor
         anchors = {d.node_ids[0]: (i+k, d) for k, d in domains.iteritems()}
 
-        # Create new Graph where the edges are the edges among synapse domains
+        # Create new Arbor where the edges are the edges among synapse domains
         mini = simplify(chunk, anchors.iterkeys())
 
         # Many side effects:
@@ -360,7 +264,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         # * custom-apply populate_connectors with the known synapses of each domain
         #   (rather than having to sift through all in cs)
         mini_nodes = {}
-        for node in mini.nodes_iter():
+        for node in mini:
             blob = anchors.get(node, None)
             if blob:
                 index, domain = blob
@@ -387,10 +291,7 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
     if 0 == confidence_threshold and 0 == bandwidth:
         return basic_graph(project_id, skeleton_ids)
 
-    if 0 == bandwidth:
-        return confidence_split_graph(project_id, skeleton_ids, confidence_threshold)
-
-    return dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand)
+    return split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, expand)
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -0,0 +1,334 @@
+# A queue of jobs that run long analyses and exports outside of the request
+# that submits them. A job is submitted with the name of its kind and the
+# parameters of the view that computes it, polled for its progress and then
+# its result is fetched: the response of that view. Identical submissions
+# share the same job, found by the hash of their kind and parameters, as long
+# as it is less than JOB_RESULT_MAX_AGE seconds old. The status and result of
+# a job whose kind depends on the user are only available to the user who
+# submitted it. While a job runs, a thread next to it records a heartbeat
+# every JOB_HEARTBEAT seconds, whether or not the view reports progress. Jobs
+# that stay queued for JOB_TIMEOUT seconds, or run that long without a
+# heartbeat because their thread or worker died, are considered to have failed.
+#
+# Jobs are run by the backend chosen with the JOB_BACKEND setting: 'local'
+# runs them on a pool of JOB_THREADS threads of the web server process, which
+# needs no broker, and 'celery' sends them to the Celery workers. Job state
+# lives in the database, so any web server process can answer the polls.
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock, Thread, local
+from time import time
+
+from celery.task import task
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+from django.db import connection, transaction
+from django.http import HttpRequest, HttpResponse, QueryDict
+
+from catmaid.models import Job, UserRole
+from catmaid.control.authentication import requires_user_role
+
+# view: dotted path of the view that computes a job of this kind
+# roles: the roles the submitting user needs in the project
+# method: whether the view reads its parameters from GET or POST
+# url_args: names of the URL arguments of the view, read from the parameters
+# per_user: whether the result depends on the submitting user
+JobKind = namedtuple('JobKind', ['view', 'roles', 'method', 'url_args', 'per_user'])
+
+_browse = [UserRole.Annotate, UserRole.Browse]
+
+_job_kinds = {
+    'analyze_skeletons': JobKind('catmaid.control.analytics.analyze_skeletons',
+            [UserRole.Annotate], 'POST', ('project_id',), False),
+    'evaluate_user': JobKind('catmaid.control.user_evaluation.evaluate_user',
+            _browse, 'POST', ('project_id',), False),
+    'plot_useranalytics': JobKind('catmaid.control.useranalytics.plot_useranalytics',
+            _browse, 'GET', (), True),
+    'skeleton_graph': JobKind('catmaid.control.graph.skeleton_graph',
+            _browse, 'POST', ('project_id',), False),
+    'skeletons_neuroml': JobKind('catmaid.control.skeletonexport.skeletons_neuroml',
+            _browse, 'POST', ('project_id',), False),
+    'export_neuroml_level3_v181': JobKind('catmaid.control.skeletonexport.export_neuroml_level3_v181',
+            [UserRole.Annotate], 'POST', ('project_id',), False),
+    'skeleton_neurohdf': JobKind('catmaid.control.neurohdf.skeleton_neurohdf',
+            _browse, 'POST', ('project_id', 'skeleton_id'), False),
+    'microcircuit_neurohdf': JobKind('catmaid.control.neurohdf.microcircuit_neurohdf',
+            _browse, 'POST', ('project_id',), False),
+}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# The job run by the current thread, if any
+_current = local()
+
+
+def report_progress(fraction):
+    """ Record the progress, from 0 to 1, of the job run by the current
+    thread, at most once per second. Raises JobCancelled when the job has
+    been cancelled meanwhile. Does nothing outside of jobs, so that views
+    can call it unconditionally. """
+    job_id = getattr(_current, 'job_id', None)
+    if job_id is None:
+        return
+    now = time()
+    if now - _current.last_report < 1.0:
+        return
+    _current.last_report = now
+    if not Job.objects.filter(pk=job_id, status='running').update(
+            progress=fraction, edition_time=datetime.now()):
+        raise JobCancelled()
+
+
+def _is_text(mimetype):
+    return mimetype.startswith('text/') or 'json' in mimetype
+
+
+def _beat(job_id):
+    Job.objects.filter(pk=job_id, status='running').update(
+            edition_time=datetime.now())
+
+
+class Heartbeat(Thread):
+    """ Records that the job is alive every JOB_HEARTBEAT seconds until it
+    is stopped, on a thread and database connection of its own. """
+
+    def __init__(self, job_id):
+        Thread.__init__(self)
+        self.daemon = True
+        self.job_id = job_id
+        self.stopped = Event()
+
+    def run(self):
+        interval = getattr(settings, 'JOB_HEARTBEAT', 60)
+        try:
+            while not self.stopped.wait(interval):
+                _beat(self.job_id)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_job(job_id):
+    """ Run the view of the job with the parameters and the user it was
+    submitted with, and store its response. """
+    heartbeat = None
+    try:
+        if not Job.objects.filter(pk=job_id, status='queued').update(
+                status='running', edition_time=datetime.now()):
+            # Cancelled before it started
+            return
+        job = Job.objects.select_related('user').get(pk=job_id)
+        kind = _job_kinds[job.kind]
+        params = QueryDict(job.params.encode('utf-8'))
+        request = HttpRequest()
+        request.method = kind.method
+        request.GET = params if 'GET' == kind.method else QueryDict('')
+        request.POST = params if 'POST' == kind.method else QueryDict('')
+        request.user = job.user
+        kwargs = {name: params.get(name) for name in kind.url_args}
+        if 'project_id' in kind.url_args:
+            kwargs['project_id'] = str(job.project_id)
+
+        _current.job_id = job_id
+        _current.last_report = 0
+        heartbeat = Heartbeat(job_id)
+        heartbeat.start()
+        response = get_callable(kind.view)(request, **kwargs)
+        content = response.content
+        mimetype = response['Content-Type']
+        Job.objects.filter(pk=job_id, status='running').update(
+                status='done',
+                progress=1.0,
+                result=content if _is_text(mimetype) else base64.b64encode(content),
+                result_mimetype=mimetype,
+                result_disposition=response.get('Content-Disposition', ''),
+                completion_time=datetime.now(),
+                edition_time=datetime.now())
+    except JobCancelled:
+        # Discard whatever the view has written so far
+        transaction.rollback()
+    except Exception as e:
+        # The transaction of the view may have been aborted by the error, so
+        # roll it back before recording the failure
+        transaction.rollback()
+        Job.objects.filter(pk=job_id, status='running').update(status='failed', error=str(e),
+                completion_time=datetime.now(), edition_time=datetime.now())
+    finally:
+        _current.job_id = None
+        if heartbeat:
+            heartbeat.stop()
+
+
+def _run_job_outside_request(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        # Jobs run outside of requests, so end their transaction here
+        connection.close()
+
+
+@task(name='catmaid.run_job')
+def run_job_task(job_id):
+    _run_job_outside_request(job_id)
+
+
+class LocalBackend(object):
+    """ Runs jobs on a pool of threads of this process. Jobs still queued
+    or running when the process exits fail after JOB_TIMEOUT seconds. """
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.pool = None
+        self.lock = Lock()
+
+    def submit(self, job_id):
+        with self.lock:
+            if self.pool is None:
+                # Created lazily, to not start threads before forking
+                self.pool = ThreadPool(self.threads)
+        self.pool.apply_async(_run_job_outside_request, (job_id,))
+
+
+class CeleryBackend(object):
+    """ Sends jobs to the Celery workers. """
+
+    def submit(self, job_id):
+        run_job_task.delay(job_id)
+
+
+_backend = CeleryBackend() if 'celery' == getattr(settings, 'JOB_BACKEND', 'local') \
+        else LocalBackend(getattr(settings, 'JOB_THREADS', 2))
+
+
+def _params_hash(kind_name, project_id, user_id, params):
+    return sha1(json.dumps([kind_name, int(project_id), user_id,
+            sorted(params.lists())])).hexdigest()
+
+
+def _fail_stale_jobs(jobs):
+    """ Mark the jobs of the query set that have been queued, or running
+    without a heartbeat, for JOB_TIMEOUT seconds as failed. """
+    timeout = getattr(settings, 'JOB_TIMEOUT', 1800)
+    now = datetime.now()
+    jobs.filter(status__in=('queued', 'running'),
+            edition_time__lt=now - timedelta(seconds=timeout)).update(
+            status='failed', error='Not alive for %s seconds' % timeout,
+            completion_time=now, edition_time=now)
+
+
+def _get_job(request, project_id, job_id):
+    """ Return the job and None, or None and the response that denies the
+    user access to it. Jobs of kinds that depend on the user are only
+    accessible to the user who submitted them, and the others to the users
+    with the roles of their kind, who would have shared them. """
+    job = Job.objects.get(pk=job_id, project=project_id)
+    if job.user_id == request.user.id:
+        return job, None
+    kind = _job_kinds.get(job.kind)
+    if kind and not kind.per_user:
+        denied = requires_user_role(kind.roles)(lambda request, project_id: None)(
+                request, project_id=project_id)
+        if not denied:
+            return job, None
+        return None, denied
+    return None, HttpResponse(json.dumps({
+            'error': 'The job %s belongs to another user' % job.id,
+            'permission_error': True}), mimetype='text/json')
+
+
+def _job_status(job):
+    return {'id': job.id,
+            'kind': job.kind,
+            'status': job.status,
+            'progress': job.progress,
+            'error': job.error}
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def submit_job(request, project_id=None):
+    """ Submit a job of the given kind, whose view gets the remaining POST
+    parameters. Returns the status of the job, which is an identical job
+    submitted before if that is still running or its result still current. """
+    kind_name = request.POST.get('kind')
+    kind = _job_kinds.get(kind_name)
+    if not kind:
+        raise Exception('Unknown kind of job: %s' % kind_name)
+
+    # Check the roles of the view, given that its result may be shared
+    denied = requires_user_role(kind.roles)(lambda request, project_id: None)(
+            request, project_id=project_id)
+    if denied:
+        return denied
+
+    params = request.POST.copy()
+    del params['kind']
+    params_hash = _params_hash(kind_name, project_id,
+            request.user.id if kind.per_user else None, params)
+
+    jobs = Job.objects.filter(project=project_id, kind=kind_name,
+            params_hash=params_hash)
+    _fail_stale_jobs(jobs)
+    max_age = getattr(settings, 'JOB_RESULT_MAX_AGE', 3600)
+    job = jobs.filter(status__in=('queued', 'running', 'done'),
+            edition_time__gte=datetime.now() - timedelta(seconds=max_age)) \
+            .order_by('-edition_time')[:1]
+    if job:
+        return HttpResponse(json.dumps(_job_status(job[0])), mimetype='text/json')
+
+    job = Job(user=request.user, project_id=project_id, kind=kind_name,
+            params=params.urlencode(), params_hash=params_hash)
+    job.save()
+    # The job has to be visible to the backend before it starts
+    transaction.commit()
+    _backend.submit(job.id)
+
+    return HttpResponse(json.dumps(_job_status(job)), mimetype='text/json')
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def job_status(request, project_id=None, job_id=None):
+    """ Return the status and progress of the job. """
+    _fail_stale_jobs(Job.objects.filter(pk=job_id, project=project_id))
+    job, denied = _get_job(request, project_id, job_id)
+    if denied:
+        return denied
+    return HttpResponse(json.dumps(_job_status(job)), mimetype='text/json')
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def job_result(request, project_id=None, job_id=None):
+    """ Return the response of the view of the job, once it is done. """
+    job, denied = _get_job(request, project_id, job_id)
+    if denied:
+        return denied
+    if 'done' != job.status:
+        raise Exception('Job %s is %s, not done.' % (job.id, job.status))
+    content = job.result if _is_text(job.result_mimetype) else base64.b64decode(job.result)
+    response = HttpResponse(content, mimetype=job.result_mimetype)
+    if job.result_disposition:
+        response['Content-Disposition'] = job.result_disposition
+    return response
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def cancel_job(request, project_id=None, job_id=None):
+    """ Cancel the job unless it has finished already. A running job stops
+    the next time it reports its progress. """
+    job, denied = _get_job(request, project_id, job_id)
+    if denied:
+        return denied
+    Job.objects.filter(pk=job_id, project=project_id,
+            status__in=('queued', 'running')).update(status='cancelled',
+            completion_time=datetime.now(), edition_time=datetime.now())
+    job = Job.objects.get(pk=job_id, project=project_id)
+    return HttpResponse(json.dumps(_job_status(job)), mimetype='text/json')
@@ -9,12 +9,20 @@ from django.shortcuts import get_object_or_404
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.nodecache import invalidate_treenode_tiles, \
+        invalidate_connector_tiles
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def label_remove(request, project_id=None):
     # check if superuser, then delete label and all associated instances
     class_instance_for_label = int(request.POST['class_instance_id'])
     if request.user.is_superuser:
+        invalidate_treenode_tiles(project_id, TreenodeClassInstance.objects \
+                .filter(class_instance=class_instance_for_label) \
+                .values_list('treenode_id', flat=True))
+        invalidate_connector_tiles(project_id, ConnectorClassInstance.objects \
+                .filter(class_instance=class_instance_for_label) \
+                .values_list('connector_id', flat=True))
         ClassInstance.objects.filter(id=class_instance_for_label).delete()
         return HttpResponse(json.dumps({'message': 'success'}), mimetype="text/plain")
     return HttpResponse(json.dumps({}), mimetype="text/plain")
@@ -111,23 +119,25 @@ def labels_for_nodes(request, project_id=None):
 def label_update(request, project_id=None, location_id=None, ntype=None):
     """ location_id is the ID of a treenode or connector.
         ntype is either 'treenode' or 'connector'. """
-    labeled_as_relation = Relation.objects.get(project=project_id, relation_name='labeled_as')
+    labeled_as_relation_id = get_relation_to_id_map(project_id)['labeled_as']
     p = get_object_or_404(Project, pk=project_id)
 
     # TODO will FAIL when a tag contains a coma by itself
     new_tags = request.POST['tags'].split(',')
 
-    kwargs = {'relation': labeled_as_relation,
+    kwargs = {'relation': labeled_as_relation_id,
               'class_instance__class_column__class_name': 'label'}
 
     if 'treenode' == ntype:
         table = TreenodeClassInstance
         kwargs['treenode__id'] = location_id
         node = Treenode.objects.get(id=location_id)
+        invalidate_treenode_tiles(project_id, (location_id,))
     elif 'connector' == ntype:
         table = ConnectorClassInstance
         kwargs['connector__id'] = location_id
         node = Connector.objects.get(id=location_id)
+        invalidate_connector_tiles(project_id, (location_id,))
 
     if not table:
         raise Http404('Unknown node type: "%s"' % (ntype,))
@@ -160,10 +170,10 @@ def label_update(request, project_id=None, location_id=None, ntype=None):
     existing_names = set(ele.class_instance.name for ele in existingLabels)
 
     # Add any new labels.
-    label_class = Class.objects.get(project=project_id, class_name='label')
+    label_class_id = get_class_to_id_map(project_id)['label']
     kwargs = {'user': request.user,
               'project': p,
-              'relation': labeled_as_relation,
+              'relation_id': labeled_as_relation_id,
               ntype: node}
 
     for tag_name in new_tags:
@@ -172,13 +182,13 @@ def label_update(request, project_id=None, location_id=None, ntype=None):
             existing_tags = tuple(ClassInstance.objects.filter(
                 project=p,
                 name=tag_name,
-                class_column=label_class))
+                class_column=label_class_id))
             if len(existing_tags) < 1:
                 tag = ClassInstance(
                     project=p,
                     name=tag_name,
                     user=request.user,
-                    class_column=label_class)
+                    class_column_id=label_class_id)
                 tag.save()
             else:
                 tag = existing_tags[0]
@@ -228,12 +238,16 @@ def remove_label(label_id, node_type):
     # If the tag was removed and added again then this will do nothing and the tag will remain.
     if node_type == 'treenode':
         try:
-            label = TreenodeClassInstance.objects.get(pk=label_id).delete()
+            label = TreenodeClassInstance.objects.get(pk=label_id)
+            invalidate_treenode_tiles(label.project_id, (label.treenode_id,))
+            label.delete()
         except TreenodeClassInstance.DoesNotExist:
             pass
     elif node_type == 'connector':
         try:
-            label = ConnectorClassInstance.objects.get(pk=label_id).delete()
+            label = ConnectorClassInstance.objects.get(pk=label_id)
+            invalidate_connector_tiles(label.project_id, (label.connector_id,))
+            label.delete()
         except ConnectorClassInstance.DoesNotExist:
             pass
     else:
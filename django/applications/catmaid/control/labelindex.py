@@ -0,0 +1,59 @@
+# Lookups of class instances, like labels, neurons and skeletons, by parts of
+# their names, and of the treenodes that are labeled with them.
+#
+# Names are matched with ILIKE, which the trigram index on class_instance.name
+# answers without a sequential scan for substrings of at least three
+# characters. Shorter substrings have no trigram to look up and are matched
+# against all names of the project.
+
+
+def _escape_like(s):
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def name_condition(column, substring):
+    """ Return the SQL condition, and the list of its parameters, that
+    matches the names in the given column which contain the substring, case
+    insensitively. """
+    return '%s ILIKE %%s' % column, ['%' + _escape_like(substring) + '%']
+
+
+def find_class_instances(cursor, project_id, substring):
+    """ Return a list of (ID, name, class name) tuples of the class instances
+    of the project whose name matches the substring as in name_condition,
+    ordered by class name and name. """
+    condition, params = name_condition('ci.name', substring)
+    cursor.execute('''
+    SELECT ci.id, ci.name, c.class_name
+    FROM class_instance ci,
+         class c
+    WHERE ci.project_id = %s
+      AND ci.class_id = c.id
+      AND ''' + condition + '''
+    ORDER BY c.class_name, ci.name
+    ''', [int(project_id)] + params)
+    return cursor.fetchall()
+
+
+def labeled_treenodes(cursor, project_id, relation_id, label_ids):
+    """ Return a dictionary of label ID vs the list of (treenode ID, x, y, z,
+    skeleton ID) tuples of the treenodes of the project that are labeled with
+    it, by descending treenode ID. """
+    label_ids = tuple(int(label_id) for label_id in label_ids)
+    treenodes = {}
+    if not label_ids:
+        return treenodes
+    cursor.execute('''
+    SELECT tci.class_instance_id, t.id, (t.location).x, (t.location).y,
+           (t.location).z, t.skeleton_id
+    FROM treenode_class_instance tci,
+         treenode t
+    WHERE tci.class_instance_id IN %s
+      AND tci.relation_id = %s
+      AND tci.project_id = %s
+      AND tci.treenode_id = t.id
+    ORDER BY t.id DESC
+    ''', (label_ids, relation_id, int(project_id)))
+    for row in cursor.fetchall():
+        treenodes.setdefault(row[0], []).append(row[1:])
+    return treenodes
@@ -6,6 +6,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.nodecache import invalidate_connector_tiles
 
 @requires_user_role(UserRole.Annotate)
 def create_link(request, project_id=None):
@@ -16,15 +17,18 @@ def create_link(request, project_id=None):
     to_id = int(request.POST.get('to_id', 0))
     link_type = request.POST.get('link_type', 'none')
 
+    relation_id = get_relation_to_id_map(project_id).get(link_type)
+    if relation_id is None:
+        return HttpResponse(json.dumps({'error': "Relation '%s' does not exist" % link_type}))
+
     try:
         project = Project.objects.get(id=project_id)
-        relation = Relation.objects.get(project=project, relation_name=link_type)
         from_treenode = Treenode.objects.get(id=from_id)
         to_connector = Connector.objects.get(id=to_id, project=project)
         links = TreenodeConnector.objects.filter(
             connector=to_id,
             treenode=from_id,
-            relation=relation.id)
+            relation=relation_id)
     except ObjectDoesNotExist as e:
         return HttpResponse(json.dumps({'error': e.message}))
 
@@ -40,18 +44,19 @@ def create_link(request, project_id=None):
 
     if link_type == 'presynaptic_to':
         # Enforce only one presynaptic link
-        presyn_links = TreenodeConnector.objects.filter(project=project, connector=to_connector, relation=relation)
+        presyn_links = TreenodeConnector.objects.filter(project=project, connector=to_connector, relation=relation_id)
         if (presyn_links.count() != 0):
             return HttpResponse(json.dumps({'error': 'Connector %s does not have zero presynaptic connections.' % to_id}))
 
     TreenodeConnector(
         user=request.user,
         project=project,
-        relation=relation,
+        relation_id=relation_id,
         treenode=from_treenode,  # treenode_id = from_id
         skeleton=from_treenode.skeleton,  # treenode.skeleton_id where treenode.id = from_id
         connector=to_connector  # connector_id = to_id
     ).save()
+    invalidate_connector_tiles(project_id, (to_id,))
 
     return HttpResponse(json.dumps({'message': 'success'}), mimetype='text/json')
 
@@ -73,6 +78,7 @@ def delete_link(request, project_id=None):
     # and the user_id not matching or not being superuser.
     can_edit_or_fail(request.user, links[0].id, 'treenode_connector')
 
+    invalidate_connector_tiles(project_id, (connector_id,))
     links[0].delete()
     return HttpResponse(json.dumps({'result': 'Removed treenode to connector link'}))
 
@@ -0,0 +1,74 @@
+# Measurements of the morphology of skeletons, computed with numpy on arrays
+# of their nodes, optionally on the pool of worker processes.
+
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+
+from tree_util import Arbor
+from catmaid.control.workers import worker_pool
+
+Measurements = namedtuple('Measurements', ['n_nodes', 'raw_cable', 'smooth_cable',
+        'principal_branch_cable', 'n_ends', 'n_branch'])
+
+
+def measure_arbor(ids, parent_ids, locations):
+    """ Measure the arbor of a skeleton, given the arrays of the IDs of its
+    nodes, their parent IDs (None for the root) and their N x 3 locations.
+    The smoothed cable is measured on node positions where every slab node
+    is moved towards the distance-weighted average of its neighbors. The
+    principal branch is the longest sequence of the partition of the arbor,
+    see tree_util.partition. Returns a Measurements instance. """
+    arbor = Arbor(ids, parent_ids, locations)
+    loc = arbor.locations
+    n = len(arbor)
+    parent = arbor.parent
+    child = np.flatnonzero(parent >= 0)
+    up = parent[child]
+
+    # Length of the edge from each child to its parent
+    lengths = np.sqrt(((loc[child] - loc[up]) ** 2).sum(axis=1))
+
+    n_children = arbor.n_children()
+    is_root = parent < 0
+    ends = np.where(is_root, n_children == 1, n_children == 0)
+    branches = np.where(is_root, n_children > 2, n_children > 1)
+    # Root, branch and end nodes do not move
+    slabs = ~(ends | branches)
+
+    # Sum of the distances to the neighbors, and of their locations weighted by distance
+    sum_distances = np.bincount(up, weights=lengths, minlength=n)
+    sum_distances[child] += lengths
+    weighted = np.empty((n, 3))
+    for k in xrange(3):
+        weighted[:, k] = np.bincount(up, weights=lengths * loc[child, k], minlength=n)
+        weighted[child, k] += lengths * loc[up, k]
+    moved = slabs & (sum_distances > 0)
+    smooth = loc.copy()
+    smooth[moved] = loc[moved] * 0.4 + (weighted[moved] / sum_distances[moved, np.newaxis]) * 0.6
+    smooth_lengths = np.sqrt(((smooth[child] - smooth[up]) ** 2).sum(axis=1))
+
+    sequences = sorted(arbor.partition(), key=len)
+    principal = np.zeros(n, dtype=bool)
+    if sequences:
+        principal[arbor.index(sequences[-1])] = True
+
+    return Measurements(n, float(lengths.sum()), float(smooth_lengths.sum()),
+            float(smooth_lengths[principal[child]].sum()),
+            int(ends.sum()), int(branches.sum()))
+
+
+def _measure_arbor(args):
+    return measure_arbor(*args)
+
+
+def measure_arbors(arbors):
+    """ Measure each of the arbors, given as tuples of the arguments of
+    measure_arbor, and return the list of their Measurements. Uses the pool
+    of worker processes when it has been started, see workers. """
+    pool = worker_pool()
+    if pool is not None and len(arbors) > 1:
+        return pool.map(_measure_arbor, arbors,
+                chunksize=max(1, len(arbors) // (4 * settings.WORKER_PROCESSES)))
+    return [measure_arbor(*args) for args in arbors]
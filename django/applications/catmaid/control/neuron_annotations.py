@@ -1,6 +1,8 @@
 import json, sys
 from string import upper
 
+import numpy as np
+
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.db.models import Count, Max
@@ -9,6 +11,10 @@ from django.db import connection
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.datatable import sort_columns, table_versions, \
+        count_rows, page_rows
+from catmaid.control.annotationgraph import annotation_graph, \
+        lock_annotation_graph, update_annotation_graph
 
 from itertools import chain, imap, izip
 
@@ -115,8 +121,8 @@ def create_annotated_entity_list(project, entities_qs, relations, annotations=Tr
 def query_neurons_by_annotations(request, project_id = None):
     p = get_object_or_404(Project, pk = project_id)
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id)
+    relations = get_relation_to_id_map(project_id)
 
     query = create_basic_annotated_entity_query(p, request.POST, relations,
             classes)
@@ -129,8 +135,8 @@ def query_neurons_by_annotations(request, project_id = None):
 def query_neurons_by_annotations_datatable(request, project_id=None):
     p = get_object_or_404(Project, pk = project_id)
 
-    classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
+    classes = get_class_to_id_map(project_id)
+    relations = get_relation_to_id_map(project_id)
 
     display_start = int(request.POST.get('iDisplayStart', 0))
     display_length = int(request.POST.get('iDisplayLength', -1))
@@ -144,31 +150,17 @@ def query_neurons_by_annotations_datatable(request, project_id=None):
     if len(search_term) > 0:
         neuron_query = neuron_query.filter(name__regex=search_term)
 
-    should_sort = request.POST.get('iSortCol_0', False)
-    if should_sort:
-        column_count = int(request.POST.get('iSortingCols', 0))
-        sorting_directions = [request.POST.get('sSortDir_%d' % d, 'DESC')
-                for d in range(column_count)]
-        sorting_directions = map(lambda d: '-' if upper(d) == 'DESC' else '',
-                sorting_directions)
-
-        fields = ['name', 'first_name', 'last_name']
-        sorting_index = [int(request.POST.get('iSortCol_%d' % d))
-                for d in range(column_count)]
-        sorting_cols = map(lambda i: fields[i], sorting_index)
-
-        neuron_query = neuron_query.extra(order_by=[di + col for (di, col) in zip(
-                sorting_directions, sorting_cols)])
-
     # Make sure we get a distinct result (which otherwise might not be the case
     # due to the JOINS that are made).
-    neuron_query = neuron_query.distinct()
+    neuron_query = neuron_query.values_list('id', 'name').distinct()
+    query, params = neuron_query.query.get_compiler(using=neuron_query.db).as_sql()
 
-    # Since it is very likely that there are many neurons, it is more efficient
-    # to do two queries: 1. Get total number of neurons 2. Get limited set. The
-    # alternative would be to get all neurons for counting and limiting on the
-    # Python side. This, however, is too expensive when there are many neurons.
-    num_records = neuron_query.count()
+    # Only the name column can be sorted by. Pages are sorted and sliced in
+    # the database, see datatable.page_rows.
+    order = sort_columns(request, [('name', False), None, None], ['id'])
+    cursor = connection.cursor()
+    version = table_versions(cursor, ('class_instance', 'class_instance_class_instance'))
+    num_records = count_rows(cursor, query, params, version)
 
     response = {
         'iTotalRecords': num_records,
@@ -176,8 +168,12 @@ def query_neurons_by_annotations_datatable(request, project_id=None):
         'aaData': []
     }
 
+    neuron_ids = [row[0] for row in page_rows(cursor, query, params,
+            ['id', 'name'], order, display_start, display_length, version)]
     entities = create_annotated_entity_list(p,
-            neuron_query[display_start:display_start + display_length], relations)
+            ClassInstance.objects.filter(id__in=neuron_ids), relations)
+    position = {neuron_id: i for i, neuron_id in enumerate(neuron_ids)}
+    entities.sort(key=lambda entity: position[entity['id']])
     for entity in entities:
         if entity['type'] == 'neuron':
           response['aaData'] += [[
@@ -215,29 +211,34 @@ def _update_neuron_annotations(project_id, user, neuron_id, annotations):
 
 
 def _annotate_neurons(project_id, user, neuron_ids, annotations):
-    r = Relation.objects.get(project_id = project_id,
-            relation_name = 'annotated_with')
+    cursor = connection.cursor()
+    graph_version = lock_annotation_graph(cursor, project_id)
 
-    annotation_class = Class.objects.get(project_id = project_id,
-                                         class_name = 'annotation')
+    relation_id = get_relation_to_id_map(project_id)['annotated_with']
+    annotation_class_id = get_class_to_id_map(project_id)['annotation']
     annotation_objects = []
+    link_ids = []
     for annotation in annotations:
         # Make sure the annotation's class instance exists.
         ci, created = ClassInstance.objects.get_or_create(
                 project_id=project_id, name=annotation,
-                class_column=annotation_class,
-                defaults={'user': user});
+                class_column__id=annotation_class_id,
+                defaults={'user': user, 'class_column_id': annotation_class_id});
         annotation_objects.append(ci)
         # Annotate each of the neurons. Avoid duplicates for the current user,
         # but it's OK for multiple users to annotate with the same instance.
         for neuron_id in neuron_ids:
             cici, created = ClassInstanceClassInstance.objects.get_or_create(
-                    project_id=project_id, relation=r,
+                    project_id=project_id, relation__id=relation_id,
                     class_instance_a__id=neuron_id,
                     class_instance_a__class_column__class_name='neuron',
                     class_instance_b=ci, user=user,
-                    defaults={'class_instance_a_id': neuron_id})
+                    defaults={'class_instance_a_id': neuron_id,
+                              'relation_id': relation_id})
             cici.save() # update the last edited time
+            link_ids.append(cici.id)
+
+    update_annotation_graph(cursor, project_id, graph_version, added=link_ids)
 
     return annotation_objects
 
@@ -278,6 +279,8 @@ def remove_annotation(request, project_id=None, neuron_id=None,
     """ Removes an annotation from a neuron.
     """
     p = get_object_or_404(Project, pk=project_id)
+    cursor = connection.cursor()
+    graph_version = lock_annotation_graph(cursor, project_id)
 
     # Get CICI instance representing the link
     cici_n_a = ClassInstanceClassInstance.objects.get(project=p,
@@ -285,7 +288,9 @@ def remove_annotation(request, project_id=None, neuron_id=None,
     # Make sure the current user has permissions to remove the annotation.
     can_edit_or_fail(request.user, cici_n_a.id, 'class_instance_class_instance')
     # Remove link between neuron and annotation.
+    link_id = cici_n_a.id
     cici_n_a.delete()
+    update_annotation_graph(cursor, project_id, graph_version, removed=[link_id])
 
     message = "Removed annotation from neuron."
 
@@ -307,63 +312,64 @@ def remove_annotation(request, project_id=None, neuron_id=None,
 def create_annotation_query(project_id, param_dict):
 
     classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
 
     annotation_query = ClassInstance.objects.filter(project_id=project_id,
             class_column__id=classes['annotation'])
 
+    # Constraints on the links of the annotations are answered by the
+    # annotation graph, each with the set of the IDs of the annotations that
+    # satisfy it.
+    graph = annotation_graph(connection.cursor(), project_id)
+    constraints = []
+
     # Meta annotations are annotations that are used to annotate other
     # annotations.
     meta_annotations = [v for k,v in param_dict.iteritems()
             if k.startswith('annotations[')]
     for meta_annotation in meta_annotations:
-        annotation_query = annotation_query.filter(
-                cici_via_b__relation_id = relations['annotated_with'],
-                cici_via_b__class_instance_a = meta_annotation)
+        constraints.append(graph.annotations(int(meta_annotation)))
 
     # If information about annotated annotations is found, the current query
     # will include only annotations that are meta annotations for it.
     annotated_annotations = [v for k,v in param_dict.iteritems()
             if k.startswith('annotates[')]
     for sub_annotation in annotated_annotations:
-        annotation_query = annotation_query.filter(
-                cici_via_a__relation_id = relations['annotated_with'],
-                cici_via_a__class_instance_b = sub_annotation)
+        constraints.append(graph.members(int(sub_annotation)))
 
     # If parallel_annotations is given, only annotations are returned, that
     # are used alongside with these.
     parallel_annotations = [v for k,v in param_dict.iteritems()
             if k.startswith('parallel_annotations[')]
     for p_annotation in parallel_annotations:
-        annotation_query = annotation_query.filter(
-                cici_via_b__class_instance_a__cici_via_a__relation_id = relations['annotated_with'],
-                cici_via_b__class_instance_a__cici_via_a__class_instance_b = p_annotation)
+        constraints.append(graph.annotations_of_any(
+                graph.members(int(p_annotation)).tolist()))
 
     # Passing in a user ID causes the result set to only contain annotations
-    # that are used by the respective user. The query filter could lead to
-    # duplicate entries, therefore distinct() is added here.
+    # that are used by the respective user.
     user_id = param_dict.get('user_id', None)
     if user_id:
-        user_id = int(user_id)
-        annotation_query = annotation_query.filter(
-                cici_via_b__user__id=user_id).distinct()
+        constraints.append(graph.user_annotations(int(user_id)))
 
     # With the help of the neuron_id field, it is possible to restrict the
     # result set to only show annotations that are used for a particular neuron.
     neuron_id = param_dict.get('neuron_id', None)
     if neuron_id:
-        annotation_query = annotation_query.filter(
-                cici_via_b__relation_id = relations['annotated_with'],
-                cici_via_b__class_instance_a__id=neuron_id)
+        constraints.append(graph.annotations(int(neuron_id)))
 
     # Instead of a neuron a user can also use to skeleton id to constrain the
     # annotation set returned. This is implicetely a neuron id restriction.
     skeleton_id = param_dict.get('skeleton_id', None)
     if skeleton_id:
-        annotation_query = annotation_query.filter(
-                cici_via_b__relation_id = relations['annotated_with'],
-                cici_via_b__class_instance_a__cici_via_b__relation_id = relations['model_of'],
-                cici_via_b__class_instance_a__cici_via_b__class_instance_a__id = skeleton_id)
+        neuron_ids = ClassInstanceClassInstance.objects.filter(
+                project_id=project_id,
+                relation__relation_name='model_of',
+                class_instance_a=skeleton_id).values_list('class_instance_b', flat=True)
+        constraints.append(graph.annotations_of_any(neuron_ids))
+
+    if constraints:
+        annotation_ids = reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True),
+                constraints)
+        annotation_query = annotation_query.filter(id__in=annotation_ids.tolist())
 
     # If annotations to ignore are passed in, they won't appear in the
     # result set.
@@ -377,106 +383,27 @@ def create_annotation_query(project_id, param_dict):
 
 
 def generate_annotation_intersection_query(project_id, annotations):
+    """ Return a query of the IDs and names of the class instances of the
+    project that are annotated with all of the annotations of the given
+    names, which are found in the annotation graph. """
     if not annotations:
         return
 
-    tables = []
-    where = []
-
-    for i, annotation in enumerate(annotations):
-        tables.append("""
-        class_instance c%s,
-        class_instance_class_instance cc%s""" % (i, i))
-
-        where.append("""
-        AND c%s.name = '%s'
-        AND c%s.id = cc%s.class_instance_b
-        AND cc%s.relation_id = r.id""" % (i, annotation, i, i, i))
+    annotation_ids = set(ClassInstance.objects.filter(project_id=project_id,
+            class_column__class_name='annotation',
+            name__in=annotations).values_list('id', flat=True))
+    if len(annotation_ids) < len(set(annotations)):
+        entity_ids = []
+    else:
+        graph = annotation_graph(connection.cursor(), project_id)
+        entity_ids = graph.annotated_with_all(annotation_ids).tolist()
 
-    q = """
+    return """
         SELECT c.id,
                c.name
-
-        FROM class_instance c,
-             relation r,
-             %s
-
-        WHERE r.relation_name = 'annotated_with'
-        AND c.project_id = %s
-             %s
-
-             %s
-        """ % (',\n    '.join(tables),
-               project_id,
-               '\n'.join(where),
-               '\n        '.join('AND cc%s.class_instance_a = c.id' % i for i in xrange(len(annotations))))
-
-    return q
-
-
-def generate_co_annotation_query(project_id, co_annotation_ids, classIDs, relationIDs):
-    if not co_annotation_ids:
-        return
-
-    tables = []
-    where = []
-
-    annotation_class = classIDs['annotation']
-    annotated_with = relationIDs['annotated_with']
-
-    for i, annotation_id in enumerate(co_annotation_ids):
-        tables.append("""
-        class_instance a%s,
-        class_instance_class_instance cc%s""" % (i, i))
-
-        where.append("""
-        AND a%s.project_id = %s
-        AND a%s.class_id = %s
-        AND cc%s.class_instance_a = neuron.id
-        AND cc%s.relation_id = %s
-        AND cc%s.class_instance_b = a%s.id
-        AND a%s.id = '%s'
-        """ % (i, project_id,
-               i, annotation_class,
-               i,
-               i, annotated_with,
-               i, i,
-               i, annotation_id))
-
-    select = """
-    SELECT DISTINCT
-        a.id,
-        a.name,
-        (SELECT username FROM auth_user, class_instance_class_instance cici
-          WHERE cici.class_instance_b = cc.id
-            AND cici.user_id = auth_user.id
-            ORDER BY cici.edition_time DESC LIMIT 1) AS "last_user",
-        (SELECT MAX(edition_time) FROM class_instance_class_instance cici WHERE cici.class_instance_b = a.id) AS "last_used",
-        (SELECT count(*) FROM class_instance_class_instance cici WHERE cici.class_instance_b = a.id) AS "num_usage"
-    """
-
-    rest = """
-    FROM 
-        class_instance a,
-        class_instance_class_instance cc,
-        class_instance neuron,
-        %s
-    WHERE
-            neuron.class_id = %s
-        AND a.class_id = %s
-        AND a.project_id = %s
-        AND cc.class_instance_a = neuron.id
-        AND cc.relation_id = %s
-        AND cc.class_instance_b = a.id
-    %s
-    """ % (',\n'.join(tables),
-           classIDs['neuron'],
-           annotation_class,
-           project_id,
-           annotated_with,
-           ''.join(where))
-
-    return select, rest
+        FROM class_instance c
+        WHERE c.id IN (%s)
+        """ % (','.join(str(int(entity_id)) for entity_id in entity_ids) or 'NULL')
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -485,86 +412,79 @@ def list_annotations(request, project_id=None):
     name and ID of the users having linked that particular annotation.
     """
     annotation_query = create_annotation_query(project_id, request.POST)
-    annotation_tuples = annotation_query.distinct().values_list('name', 'id',
-        'cici_via_b__user__id', 'cici_via_b__user__username')
-    # Create a set mapping annotation names to its users
-    ids = {}
-    annotation_dict = {}
-    for annotation, aid, uid, username in annotation_tuples:
-        ids[aid] = annotation
-        ls = annotation_dict.get(aid)
-        if ls is None:
-            ls = []
-            annotation_dict[aid] = ls
-        ls.append({'id': uid, 'name': username})
-    # Flatten dictionary to list
-    annotations = tuple({'name': ids[aid], 'id': aid, 'users': users} for aid, users in annotation_dict.iteritems())
+    annotation_tuples = list(annotation_query.values_list('name', 'id'))
+    # The users of each annotation are looked up in the annotation graph
+    graph = annotation_graph(connection.cursor(), project_id)
+    user_ids = {aid: graph.users(aid) for name, aid in annotation_tuples}
+    usernames = dict(User.objects.filter(
+            id__in=set(chain.from_iterable(user_ids.itervalues()))) \
+            .values_list('id', 'username'))
+    annotations = tuple({'name': name, 'id': aid, 'users': [{'id': uid,
+            'name': usernames.get(uid)} for uid in user_ids[aid]]}
+            for name, aid in annotation_tuples)
     return HttpResponse(json.dumps({'annotations': annotations}), mimetype="text/json")
 
 def _fast_co_annotations(request, project_id, display_start, display_length):
     classIDs = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
-    relationIDs = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
     co_annotation_ids = set(int(v) for k, v in request.POST.iteritems() if k.startswith('parallel_annotations'))
 
-    select, rest = generate_co_annotation_query(int(project_id), co_annotation_ids, classIDs, relationIDs)
-
-    entries = []
-
-    search_term = request.POST.get('sSearch', '').strip()
-    if search_term:
-        rest += "\nAND a.name ~ %s" # django will escape and quote the string
-        entries.append(search_term)
-
-    # Sorting?
-    sorting = request.POST.get('iSortCol_0', False)
-    sorter = ''
-    if sorting:
-        column_count = int(request.POST.get('iSortingCols', 0))
-        sorting_directions = (request.POST.get('sSortDir_%d' % d, 'DESC') for d in xrange(column_count))
-
-        fields = ('a.name', 'last_used', 'num_usage', 'last_user')
-        sorting_index = (int(request.POST.get('iSortCol_%d' % d)) for d in xrange(column_count))
-        sorting_cols = (fields[i] for i in sorting_index)
-
-        sorter = '\nORDER BY ' + ','.join('%s %s' % u for u in izip(sorting_cols, sorting_directions))
-
-
+    # The annotations of the neurons that carry all of the given ones, and
+    # their usage, are looked up in the annotation graph. They are then
+    # joined with their names, filtered, sorted and paged in the database.
     cursor = connection.cursor()
-
-    cursor.execute("SELECT count(DISTINCT a.id) " + rest, entries)
-    num_records = cursor.fetchone()[0]
+    graph = annotation_graph(cursor, project_id)
+    annotation_ids = graph.co_annotations(co_annotation_ids).tolist()
 
     response = {
-        'iTotalRecords': num_records,
-        'iTotalDisplayRecords': num_records,
+        'iTotalRecords': 0,
+        'iTotalDisplayRecords': 0,
+        'aaData': []
     }
-
-    rest += sorter
-    rest += '\nLIMIT %s OFFSET %s'
-    entries.append(display_length) # total to return
-    entries.append(display_start) # offset
-
-    cursor.execute(select + rest, entries)
-
-    # 0: a.id
-    # 1: a.name
-    # 2: last_user
-    # 3: last_used
-    # 4: num_usage
-    aaData = []
-    for row in cursor.fetchall():
-        last_used = row[3]
+    if not annotation_ids:
+        return HttpResponse(json.dumps(response), mimetype='text/json')
+
+    usage = [graph.usage(annotation_id) for annotation_id in annotation_ids]
+    query = """
+    SELECT a.id, a.name, g.last_used, g.num_usage, u.username AS last_user
+    FROM (SELECT unnest(%s::bigint[]) AS id,
+                 unnest(%s::integer[]) AS num_usage,
+                 unnest(%s::timestamp with time zone[]) AS last_used,
+                 unnest(%s::integer[]) AS user_id) g
+         JOIN class_instance a ON a.id = g.id
+         LEFT OUTER JOIN auth_user u ON u.id = g.user_id
+    WHERE a.project_id = %s
+      AND a.class_id = %s
+    """
+    num_usage, last_used, last_user = zip(*usage)
+    params = [annotation_ids, list(num_usage), list(last_used), list(last_user),
+            int(project_id), classIDs['annotation']]
+    search_term = request.POST.get('sSearch', '').strip()
+    if search_term:
+        query += "\nAND a.name ~ %s" # django will escape and quote the string
+        params.append(search_term)
+
+    # Pages are sorted and sliced in the database, see datatable.page_rows
+    order = sort_columns(request, [('name', False), ('last_used', True),
+            ('num_usage', False), ('last_user', True)], ['id'])
+    version = table_versions(cursor, ('class_instance', 'auth_user'))
+    num_records = count_rows(cursor, query, params, version)
+    response['iTotalRecords'] = num_records
+    response['iTotalDisplayRecords'] = num_records
+
+    for row in page_rows(cursor, query, params,
+            ['id', 'name', 'last_used', 'num_usage', 'last_user'], order,
+            display_start, display_length, version):
+        last_used = row[2]
         if last_used:
             last_used = last_used.strftime("%Y-%m-%d %H:%M:%S")
         else:
             last_used = 'never'
-        aaData.append([row[1], # Annotation name
-                       last_used,
-                       row[4], # Last use
-                       row[2], # Last annotator
-                       row[0]])
+        response['aaData'].append([row[1], # Annotation name
+                                   last_used,
+                                   row[3], # Usage
+                                   row[4], # Last annotator
+                                   row[0]])
 
-    response['aaData'] = aaData
     return HttpResponse(json.dumps(response), mimetype='text/json')
 
 
@@ -583,7 +503,6 @@ def list_annotations_datatable(request, project_id=None):
 
     annotation_query = create_annotation_query(project_id, request.POST)
 
-    should_sort = request.POST.get('iSortCol_0', False)
     search_term = request.POST.get('sSearch', '')
 
     # Annotate last used time
@@ -609,31 +528,21 @@ def list_annotations_datatable(request, project_id=None):
     if len(search_term) > 0:
         annotation_query = annotation_query.filter(name__regex=search_term)
 
-    if should_sort:
-        column_count = int(request.POST.get('iSortingCols', 0))
-        sorting_directions = [request.POST.get('sSortDir_%d' % d, 'DESC')
-                for d in xrange(column_count)]
-        sorting_directions = map(lambda d: '-' if upper(d) == 'DESC' else '',
-                sorting_directions)
-
-        fields = ['name', 'last_used', 'num_usage', 'last_user']
-        sorting_index = [int(request.POST.get('iSortCol_%d' % d))
-                for d in xrange(column_count)]
-        sorting_cols = map(lambda i: fields[i], sorting_index)
-
-        annotation_query = annotation_query.extra(order_by=[di + col for (di, col) in zip(
-                sorting_directions, sorting_cols)])
-
-    # We only require ID, name, last used and usage number
+    # We only require ID, name, last used and usage number. Make sure we get
+    # a distinct result (which otherwise might not be the case due to the
+    # JOINS that are made).
     annotation_query = annotation_query.values_list(
-            'id', 'name', 'last_used', 'num_usage', 'last_user')
-
-    # Make sure we get a distinct result (which otherwise might not be the case
-    # due to the JOINS that are made).
-    annotation_query = annotation_query.distinct()
+            'id', 'name', 'last_used', 'num_usage', 'last_user').distinct()
+    query, params = annotation_query.query.get_compiler(
+            using=annotation_query.db).as_sql()
 
-    #num_records = annotation_query.count() # len(annotation_query)
-    num_records = len(annotation_query)
+    # Pages are sorted and sliced in the database, see datatable.page_rows
+    order = sort_columns(request, [('name', False), ('last_used', True),
+            ('num_usage', False), ('last_user', True)], ['id'])
+    cursor = connection.cursor()
+    version = table_versions(cursor, ('class_instance',
+            'class_instance_class_instance', 'auth_user'))
+    num_records = count_rows(cursor, query, params, version)
 
     response = {
         'iTotalRecords': num_records,
@@ -641,7 +550,9 @@ def list_annotations_datatable(request, project_id=None):
         'aaData': []
     }
 
-    for annotation in annotation_query[display_start:display_start + display_length]:
+    for annotation in page_rows(cursor, query, params,
+            ['id', 'name', 'last_used', 'num_usage', 'last_user'], order,
+            display_start, display_length, version):
         # Format last used time
         if annotation[2]:
             last_used = annotation[2].strftime("%Y-%m-%d %H:%M:%S")
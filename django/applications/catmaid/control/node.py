@@ -2,6 +2,7 @@ import json
 
 from collections import defaultdict
 from datetime import datetime
+from itertools import chain
 
 from django.db import connection
 from django.http import HttpResponse
@@ -13,6 +14,11 @@ from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
 from catmaid.control.treenode import can_edit_treenode_or_fail
+from catmaid.control.spatial import node_tile_size, tile_for_location, \
+        tile_bounds, tiles_for_view, section_condition, section_case, section_of
+from catmaid.control.nodecache import get_cached_node_tiles, cache_node_tiles, \
+        invalidate_treenode_tiles, invalidate_connector_tiles
+from catmaid.control.streaming import json_array_chunks, streaming_json_response
 
 import sys
 try:
@@ -21,6 +27,483 @@ except:
     pass
 
 
+def _box_condition(alias, boxes, params):
+    """ Return an SQL condition that is true for rows of the table aliased as
+    alias whose location is within any of the (left, top, right, bottom)
+    boxes, and append the bounds of the boxes to params. The point containment
+    test is answered by the GiST index on the xy location; the additional
+    comparisons make the right and bottom bounds exclusive, so that a node on
+    the border between two boxes only belongs to one of them. """
+    condition = '''(point((%(a)s.location).x, (%(a)s.location).y) <@ box(point(%%s, %%s), point(%%s, %%s))
+                AND (%(a)s.location).x < %%s
+                AND (%(a)s.location).y < %%s)''' % {'a': alias}
+    conditions = []
+    for left, top, right, bottom in boxes:
+        conditions.append(condition)
+        params.extend((left, top, right, bottom, right, bottom))
+    return '(' + ' OR '.join(conditions) + ')'
+
+
+def _fetch_node_tiles(cursor, project_id, sections, half, tiles, locate,
+        relation_map, with_labels, limit):
+    """ Query the treenodes, connectors and (optionally) labels of the given
+    tiles of each of the sections, a sequence of z values, which
+    extend half a section thickness, given as half, around their z (see
+    section_condition). The tiles are a dictionary of tile key vs (left, top,
+    right, bottom) bounds, and locate is a function that returns the key of
+    the tile that contains a given x, y coordinate.
+    Returns a dictionary of (z, tile key) vs tile content, and the set of the
+    sections whose node limit has been reached, in which case the content of
+    their tiles is incomplete. The limit is a number of treenodes, and applies
+    to each section.
+    The content of a tile is a dictionary with three entries:
+    'treenodes': treenode ID vs tuple of id, parent_id, x, y, z, confidence,
+                 radius, skeleton_id and user_id.
+    'connectors': connector ID vs list of id, x, y, z, confidence, a dictionary
+                  of presynaptic treenode ID vs confidence, another one for
+                  postsynaptic treenodes, and user_id.
+    'labels': node ID vs list of label names, for nodes in the section.
+    The owner is kept as a user ID, so that the content of a tile does not
+    depend on the user that requested it. """
+    sections = tuple(sections)
+    content = {(z, key): {'treenodes': {}, 'connectors': {}, 'labels': {}}
+               for z in sections for key in tiles}
+    # Treenode ID vs set of keys of the tiles that include the treenode
+    node_tiles = defaultdict(set)
+
+    def tile_of(x, y, z):
+        z = section_of(z, sections, half)
+        key = locate(x, y)
+        if key in tiles:
+            return (z, key)
+        # Rounding may place a location on a tile border in the neighbouring
+        # tile, fall back to the bounds the database has used.
+        for key, (left, top, right, bottom) in tiles.iteritems():
+            if left <= x <= right and top <= y <= bottom:
+                return (z, key)
+
+    # Fetch treenodes which are in the tiles of each section, along with their
+    # parent and children nodes, which may lay in the prior or next section.
+    # All sections are queried at once, numbering the treenodes of each
+    # section to give each its own node limit.
+    node_query = '''
+    SELECT
+        t1.id,
+        t1.parent_id,
+        (t1.location).x,
+        (t1.location).y,
+        (t1.location).z,
+        t1.confidence,
+        t1.radius,
+        t1.skeleton_id,
+        t1.user_id,
+        t2.id,
+        t2.parent_id,
+        (t2.location).x,
+        (t2.location).y,
+        (t2.location).z,
+        t2.confidence,
+        t2.radius,
+        t2.skeleton_id,
+        t2.user_id
+    FROM (SELECT t.id, t.parent_id, t.location, t.confidence, t.radius,
+                 t.skeleton_id, t.user_id,
+                 row_number() OVER (PARTITION BY %s) AS n
+          FROM treenode t
+          WHERE %s
+            AND %s
+            AND t.project_id = %%s) t1
+         INNER JOIN treenode t2 ON
+           (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
+            OR (t1.parent_id IS NULL AND t1.id = t2.id))
+    WHERE t1.n <= %%s
+    '''
+
+    # Above, notice that the join is done for:
+    # 1. A parent-child or child-parent pair (where the first one is in one of the sections)
+    # 2. A node with itself when the parent is null
+    # This is by far the fastest way to retrieve all parents and children nodes
+    # of the nodes in the sections within the specified 2d bounds.
+    # Both nodes of a row belong to the tile that contains the first one.
+
+    params = []
+    section = section_case('(t.location).z', sections, half, params)
+    condition = section_condition('(t.location).z', sections, half, params)
+    boxes = _box_condition('t', tiles.itervalues(), params)
+    params.extend((project_id, limit))
+    cursor.execute(node_query % (section, condition, boxes), params)
+    rows = cursor.fetchall()
+    # Section vs IDs of its treenodes, one or more rows each
+    section_nodes = defaultdict(set)
+    for row in rows:
+        key = tile_of(row[2], row[3], row[4])
+        section_nodes[key[0]].add(row[0])
+        treenodes = content[key]['treenodes']
+        for node in (row[0:9], row[9:18]):
+            if node[0] not in treenodes:
+                treenodes[node[0]] = node
+                node_tiles[node[0]].add(key)
+    limit_reached = set(z for z, ids in section_nodes.iteritems()
+                        if len(ids) >= limit)
+
+    presynaptic_to = relation_map['presynaptic_to']
+
+    def add_connector(key, row):
+        # row[5]: treenode_connector.relation_id
+        # row[6]: treenode_connector.treenode_id, None for a disconnected connector
+        # row[7]: treenode_connector.confidence
+        connectors = content[key]['connectors']
+        c = connectors.get(row[0])
+        if not c:
+            c = [row[0], row[1], row[2], row[3], row[4], {}, {}, row[8]]
+            connectors[row[0]] = c
+        if row[6] is not None:
+            c[5 if row[5] == presynaptic_to else 6][row[6]] = row[7]
+
+    # Find connectors related to treenodes in the tiles. They belong to every
+    # tile that includes the treenode.
+    if node_tiles:
+        cursor.execute('''
+        SELECT connector.id,
+            (connector.location).x,
+            (connector.location).y,
+            (connector.location).z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id
+        FROM treenode_connector,
+             connector
+        WHERE treenode_connector.treenode_id IN (%s)
+          AND treenode_connector.connector_id = connector.id
+        ''' % ','.join(str(x) for x in node_tiles))
+
+        for row in cursor.fetchall():
+            for key in node_tiles[row[6]]:
+                add_connector(key, row)
+
+    # Obtain connectors within the tiles that were not captured above.
+    # Uses a LEFT OUTER JOIN to include disconnected connectors,
+    # that is, connectors that aren't referenced from treenode_connector.
+    params = [project_id]
+    condition = section_condition('(connector.location).z', sections, half, params)
+    boxes = _box_condition('connector', tiles.itervalues(), params)
+    cursor.execute('''
+    SELECT connector.id,
+        (connector.location).x,
+        (connector.location).y,
+        (connector.location).z,
+        connector.confidence,
+        treenode_connector.relation_id,
+        treenode_connector.treenode_id,
+        treenode_connector.confidence,
+        connector.user_id
+    FROM connector LEFT OUTER JOIN treenode_connector
+                   ON connector.id = treenode_connector.connector_id
+    WHERE connector.project_id = %s
+      AND ''' + condition + '''
+      AND ''' + boxes, params)
+
+    for row in cursor.fetchall():
+        add_connector(tile_of(row[1], row[2], row[3]), row)
+
+    # Fetch missing treenodes. These are related to connectors of a tile
+    # but not in the tile itself. This is so that we can draw arrows from any
+    # displayed connector to all of its connected treenodes, even if one is
+    # several slices below.
+    missing = defaultdict(set) # treenode ID vs keys of the tiles that lack it
+    for key, tile in content.iteritems():
+        treenodes = tile['treenodes']
+        for c in tile['connectors'].itervalues():
+            for tnid in chain(c[5], c[6]):
+                if tnid not in treenodes:
+                    missing[tnid].add(key)
+
+    if missing:
+        cursor.execute('''
+        SELECT id,
+            parent_id,
+            (location).x,
+            (location).y,
+            (location).z,
+            confidence,
+            radius,
+            skeleton_id,
+            user_id
+        FROM treenode
+        WHERE id IN (%s)
+        ''' % ','.join(str(x) for x in missing))
+
+        for row in cursor.fetchall():
+            for key in missing[row[0]]:
+                content[key]['treenodes'][row[0]] = row
+
+    if with_labels:
+        labeled_as = relation_map['labeled_as']
+
+        def fetch_labels(visible, query):
+            if visible:
+                cursor.execute(query % (labeled_as, ','.join(str(x) for x in visible)))
+                for row in cursor.fetchall():
+                    for key in visible[row[0]]:
+                        content[key]['labels'].setdefault(row[0], []).append(row[1])
+
+        # Collect treenodes and connectors visible in the section of each tile
+        visible_treenodes = defaultdict(set)
+        visible_connectors = defaultdict(set)
+        for key, tile in content.iteritems():
+            z = key[0]
+            for row in tile['treenodes'].itervalues():
+                if section_of(row[4], (z,), half) is not None:
+                    visible_treenodes[row[0]].add(key)
+            for c in tile['connectors'].itervalues():
+                if section_of(c[3], (z,), half) is not None:
+                    visible_connectors[c[0]].add(key)
+
+        fetch_labels(visible_treenodes, '''
+        SELECT treenode.id, class_instance.name
+        FROM treenode, class_instance, treenode_class_instance
+        WHERE treenode_class_instance.relation_id = %s
+          AND treenode.id IN (%s)
+          AND treenode_class_instance.treenode_id = treenode.id
+          AND class_instance.id = treenode_class_instance.class_instance_id
+        ''')
+
+        fetch_labels(visible_connectors, '''
+        SELECT connector.id, class_instance.name
+        FROM connector, class_instance, connector_class_instance
+        WHERE connector_class_instance.relation_id = %s
+          AND connector.id IN (%s)
+          AND connector_class_instance.connector_id = connector.id
+          AND class_instance.id = connector_class_instance.class_instance_id
+        ''')
+
+    return content, limit_reached
+
+
+def _json_prefix(values):
+    """ Return the compact JSON array of the values without its closing
+    bracket and followed by a comma, ready to be completed with one more value
+    (the edit permission of the requesting user). """
+    return json.dumps(values, separators=(',', ':'))[:-1] + ','
+
+
+def _serialize_node_tile(tile):
+    """ Pre-serialize the content of a tile, as returned by _fetch_node_tiles.
+    Treenodes and connectors are stored as tuples of the JSON fragment of their
+    row (see _json_prefix) and the ID of their owner. Connectors keep as well
+    their row, to be able to merge their relations with the ones found in other
+    tiles. Treenodes keep as well their parent ID and location, to be able to
+    clip the merged tiles to the field of view (see _clip_node_view). """
+    return {
+        'treenodes': {tnid: (_json_prefix(row[0:8]), row[8], row[1:5])
+                      for tnid, row in tile['treenodes'].iteritems()},
+        'connectors': {cid: (c, _json_prefix(c[0:5] + [c[5].items(), c[6].items()]), c[7])
+                       for cid, c in tile['connectors'].iteritems()},
+        'labels': tile['labels']}
+
+
+def _merge_node_tiles(tiles):
+    """ Merge the content of several pre-serialized tiles into a single
+    dictionary of the same form. The tiles are not modified. Connectors present
+    in more than one tile accumulate the relations to treenodes found in each
+    tile and are serialized again. """
+    treenodes = {}
+    connectors = {}
+    labels = {}
+    for tile in tiles:
+        treenodes.update(tile['treenodes'])
+        labels.update(tile['labels'])
+        for cid, entry in tile['connectors'].iteritems():
+            merged = connectors.get(cid)
+            if merged:
+                c, other = merged[0], entry[0]
+                pre = dict(c[5])
+                pre.update(other[5])
+                post = dict(c[6])
+                post.update(other[6])
+                c = c[0:5] + [pre, post, c[7]]
+                connectors[cid] = (c, _json_prefix(c[0:5] + [pre.items(), post.items()]), c[7])
+            else:
+                connectors[cid] = entry
+    return {'treenodes': treenodes, 'connectors': connectors, 'labels': labels}
+
+
+def _clip_node_view(view, z, half, bounds, limit):
+    """ Restrict the merged tiles of a section to the field of view, given as
+    (left, top, right, bottom) bounds, the right and bottom ones exclusive:
+    the treenodes of the section within the bounds, at most limit of them,
+    along with their parent and child nodes, the connectors within the bounds
+    or linked to these treenodes, and all treenodes linked to these connectors.
+    This is what a query of the field of view alone returns. Returns the
+    clipped view and whether treenodes have been left out by the limit. """
+    left, top, right, bottom = bounds
+
+    def in_view(x, y, node_z):
+        return left <= x < right and top <= y < bottom and \
+                section_of(node_z, (z,), half) is not None
+
+    treenodes = view['treenodes']
+    # Keep the treenodes with the lowest IDs, so that the same ones are
+    # left out no matter which tiles the view is merged from.
+    shown = sorted(tnid for tnid, t in treenodes.iteritems() if in_view(*t[2][1:4]))
+    limit_reached = len(shown) > limit
+    shown = set(shown[:limit])
+    kept = set(shown)
+    for tnid, t in treenodes.iteritems():
+        if tnid in shown:
+            kept.add(t[2][0])
+        elif t[2][0] in shown:
+            kept.add(tnid)
+
+    connectors = {}
+    for cid, entry in view['connectors'].iteritems():
+        c = entry[0]
+        if in_view(c[1], c[2], c[3]) or any(tnid in kept for tnid in chain(c[5], c[6])):
+            connectors[cid] = entry
+    for c, prefix, owner_id in connectors.itervalues():
+        kept.update(chain(c[5], c[6]))
+
+    treenodes = {tnid: treenodes[tnid] for tnid in kept if tnid in treenodes}
+    labels = {nid: names for nid, names in view['labels'].iteritems()
+              if nid in treenodes or nid in connectors}
+    return {'treenodes': treenodes, 'connectors': connectors,
+            'labels': labels}, limit_reached
+
+
+def _view_tiles(params):
+    """ Return the tiles that cover the field of view described by params, as a
+    dictionary of tile key vs tile bounds, along with the function that locates
+    the tile of a x, y coordinate. When tiling is disabled (NODE_LIST_TILE_SIZE
+    is zero), the field of view itself is the only tile and its key is None. """
+    size = node_tile_size()
+    if size > 0:
+        keys = tiles_for_view(params['left'], params['top'],
+                params['right'], params['bottom'], size)
+        tiles = {key: tile_bounds(key, size) for key in keys}
+        return tiles, lambda x, y: tile_for_location(x, y, size)
+    bounds = (params['left'], params['top'], params['right'], params['bottom'])
+    return {None: bounds}, lambda x, y: None
+
+
+def _section_node_lists(cursor, project_id, sections, params, relation_map,
+        with_labels):
+    ''' Return the pre-serialized treenodes, connectors and labels of the
+    field of view described by params in each of the sections, as a dictionary
+    of z vs merged tile content (see _merge_node_tiles), along with the set of
+    the sections whose node limit has been reached. Sections extend half a
+    section thickness (zres) around their z. Tiles are served from the node
+    tile cache when possible, and all the others are fetched together.
+    The node limit applies to the treenodes of a section within the field of
+    view, once its tiles are merged and clipped to it. Tiles are fetched with
+    a limit of as many treenodes per tile, so only the sections of very dense
+    tiles can be incomplete, which reports the limit as reached as well. '''
+    half = params['zres'] / 2.0 if params['zres'] > 0 else 0.0
+    tiles, locate = _view_tiles(params)
+    tiled = None not in tiles
+    if tiled:
+        versions, content = get_cached_node_tiles(cursor, project_id, sections,
+                half, tiles.iterkeys(), with_labels)
+    else:
+        content = {}
+    missing_sections = set()
+    missing_tiles = {}
+    for z in sections:
+        for key, bounds in tiles.iteritems():
+            if (z, key) not in content:
+                missing_sections.add(z)
+                missing_tiles[key] = bounds
+    limit_reached = set()
+    if missing_sections:
+        fetched, limit_reached = _fetch_node_tiles(cursor, project_id,
+                sorted(missing_sections), half, missing_tiles, locate,
+                relation_map, with_labels, params['limit'] * len(missing_tiles))
+        fetched = {key: _serialize_node_tile(tile)
+                   for key, tile in fetched.iteritems() if key not in content}
+        # Incomplete tiles are not cached
+        if tiled:
+            cache_node_tiles(project_id, versions, half, dict((key, tile)
+                    for key, tile in fetched.iteritems()
+                    if key[0] not in limit_reached), with_labels)
+        content.update(fetched)
+
+    bounds = (params['left'], params['top'], params['right'], params['bottom'])
+    views = {}
+    for z in sections:
+        views[z], clipped = _clip_node_view(
+                _merge_node_tiles(content[(z, key)] for key in tiles),
+                z, half, bounds, params['limit'])
+        if clipped:
+            limit_reached.add(z)
+    return views, limit_reached
+
+
+def _node_list_chunks(view, limit_reached, can_edit):
+    ''' Yield the JSON array of the treenodes, connectors, labels and limit
+    flag of a merged view, completing the pre-serialized treenode and connector
+    arrays with the edit permission returned by can_edit for their owner. '''
+    # No spaces in the JSON separators: less space, more compact json
+    closing = {True: 'true]', False: 'false]'}
+    yield '['
+    for chunk in json_array_chunks(view['treenodes'].itervalues(),
+            lambda t: t[0] + closing[can_edit(t[1])]):
+        yield chunk
+    yield ','
+    for chunk in json_array_chunks(view['connectors'].itervalues(),
+            lambda (c, prefix, owner_id): prefix + closing[can_edit(owner_id)]):
+        yield chunk
+    yield ',' + json.dumps(view['labels'], separators=(',', ':'))
+    yield ',true]' if limit_reached else ',false]'
+
+
+def _node_list_params(request, project_id):
+    ''' Parse the field of view and section parameters shared by the node list
+    requests. '''
+    params = {}
+    # z: the section index in calibrated units.
+    # width: the width of the field of view in calibrated units.
+    # height: the height of the field of view in calibrated units.
+    # zres: the resolution in the Z axis, used to determine the thickness of a section.
+    # as: the ID of the active skeleton
+    # top: the Y coordinate of the bounding box (field of view) in calibrated units
+    # left: the X coordinate of the bounding box (field of view) in calibrated units
+    for p in ('top', 'left', 'z', 'width', 'height', 'zres'):
+        params[p] = float(request.POST.get(p, 0))
+    params['limit'] = 5000  # Limit the number of retrieved treenodes within the section
+    params['project_id'] = project_id
+    params['bottom'] = params['top'] + params['height']
+    params['right'] = params['left'] + params['width']
+    return params
+
+
+def _active_treenode(cursor, atnid, views):
+    ''' Add the active treenode to every view that does not include it already.
+    If atnid is a connector, it doesn't matter, won't be found in treenode table. '''
+    if -1 == atnid:
+        return
+    views = [view for view in views if atnid not in view['treenodes']
+             and atnid not in view['connectors']]
+    if not views:
+        return
+    cursor.execute('''
+    SELECT id,
+        parent_id,
+        (location).x,
+        (location).y,
+        (location).z,
+        confidence,
+        radius,
+        skeleton_id,
+        user_id
+    FROM treenode
+    WHERE id = %s
+    ''', (atnid,))
+    for row in cursor.fetchall():
+        for view in views:
+            view['treenodes'][row[0]] = (_json_prefix(row[0:8]), row[8], row[1:5])
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_list_tuples(request, project_id=None):
     ''' Retrieve an JSON array with four entries:
@@ -35,263 +518,86 @@ def node_list_tuples(request, project_id=None):
     so care must be taken never to alter the order of the variables in the SQL
     statements without modifying the accesses to said data both in this function
     and in the client that consumes it.
+    The field of view is served from the fixed-size spatial tiles that cover
+    it (see NODE_LIST_TILE_SIZE), clipped to the requested bounds.
     '''
     project_id = int(project_id) # sanitize
-    params = {}
-    # z: the section index in calibrated units.
-    # width: the width of the field of view in calibrated units.
-    # height: the height of the field of view in calibrated units.
-    # zres: the resolution in the Z axis, used to determine the thickness of a section.
-    # as: the ID of the active skeleton
-    # top: the Y coordinate of the bounding box (field of view) in calibrated units
-    # left: the X coordinate of the bounding box (field of view) in calibrated units
+    params = _node_list_params(request, project_id)
     atnid = int(request.POST.get('atnid', -1))
-    for p in ('top', 'left', 'z', 'width', 'height', 'zres'):
-        params[p] = float(request.POST.get(p, 0))
-    params['limit'] = 5000  # Limit the number of retrieved treenodes within the section
-    params['project_id'] = project_id
+    with_labels = 'true' == request.POST.get('labels')
 
+    response_on_error = ''
     try:
         cursor = connection.cursor()
 
-        cursor.execute('''
-        SELECT relation_name, id FROM relation WHERE project_id=%s
-        ''' % project_id)
-        relation_map = dict(cursor.fetchall())
+        response_on_error = 'Failed to query relations'
+        relation_map = get_relation_to_id_map(project_id)
 
-        response_on_error = 'Failed to query treenodes'
+        can_edit = edit_permission(cursor, request.user)
 
-        is_superuser = request.user.is_superuser
-        user_id = request.user.id
+        response_on_error = 'Failed to query treenodes and connectors'
+        z = params['z']
+        views, limit_reached = _section_node_lists(cursor, project_id, (z,),
+                params, relation_map, with_labels)
 
-        # Set of other user_id for which the request user has editing rights on.
-        # For a superuser, the domain is all users, and implicit.
-        domain = None if is_superuser else user_domain(cursor, user_id)
+        response_on_error = 'Failed to query the active treenode'
+        _active_treenode(cursor, atnid, views.values())
 
-        # Fetch treenodes which are in the bounding box,
-        # which in z it includes the full thickess of the prior section
-        # and of the next section (therefore the '<' and not '<=' for zhigh)
-        params['bottom'] = params['top'] + params['height']
-        params['right'] = params['left'] + params['width']
-        cursor.execute('''
-        SELECT
-            t1.id,
-            t1.parent_id,
-            (t1.location).x,
-            (t1.location).y,
-            (t1.location).z,
-            t1.confidence,
-            t1.radius,
-            t1.skeleton_id,
-            t1.user_id,
-            t2.id,
-            t2.parent_id,
-            (t2.location).x,
-            (t2.location).y,
-            (t2.location).z,
-            t2.confidence,
-            t2.radius,
-            t2.skeleton_id,
-            t2.user_id
-        FROM treenode t1
-             INNER JOIN treenode t2 ON
-               (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
-                OR (t1.parent_id IS NULL AND t1.id = t2.id))
-        WHERE
-            (t1.location).z = %(z)s
-            AND (t1.location).x > %(left)s
-            AND (t1.location).x < %(right)s
-            AND (t1.location).y > %(top)s
-            AND (t1.location).y < %(bottom)s
-            AND t1.project_id = %(project_id)s
-        LIMIT %(limit)s
-        ''', params)
-
-        # Above, notice that the join is done for:
-        # 1. A parent-child or child-parent pair (where the first one is in section z)
-        # 2. A node with itself when the parent is null
-        # This is by far the fastest way to retrieve all parents and children nodes
-        # of the nodes in section z within the specified 2d bounds.
-
-        # A list of tuples, each tuple containing the selected columns for each treenode
-        # The id is the first element of each tuple
-        treenodes = []
-        # A set of unique treenode IDs
-        treenode_ids = set()
-
-        n_retrieved_nodes = 0 # at one per row, only those within the section
-        for row in cursor.fetchall():
-          n_retrieved_nodes += 1
-          t1id = row[0]
-          if t1id not in treenode_ids:
-              treenode_ids.add(t1id)
-              treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
-          t2id = row[9]
-          if t2id not in treenode_ids:
-              treenode_ids.add(t2id)
-              treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
-
-
-        # Find connectors related to treenodes in the field of view
-        # Connectors found attached to treenodes
-        crows = []
-
-        if treenode_ids:
-            response_on_error = 'Failed to query connector locations.'
-            cursor.execute('''
-            SELECT connector.id,
-                (connector.location).x,
-                (connector.location).y,
-                (connector.location).z,
-                connector.confidence,
-                treenode_connector.relation_id,
-                treenode_connector.treenode_id,
-                treenode_connector.confidence,
-                connector.user_id
-            FROM treenode_connector,
-                 connector
-            WHERE treenode_connector.treenode_id IN (%s)
-              AND treenode_connector.connector_id = connector.id
-            ''' % ','.join(str(x) for x in treenode_ids))
-
-            crows = list(cursor.fetchall())
-
-        # Obtain connectors within the field of view that were not captured above.
-        # Uses a LEFT OUTER JOIN to include disconnected connectors,
-        # that is, connectors that aren't referenced from treenode_connector.
+        return streaming_json_response(
+                _node_list_chunks(views[z], z in limit_reached, can_edit))
 
-        cursor.execute('''
-        SELECT connector.id,
-            (connector.location).x,
-            (connector.location).y,
-            (connector.location).z,
-            connector.confidence,
-            treenode_connector.relation_id,
-            treenode_connector.treenode_id,
-            treenode_connector.confidence,
-            connector.user_id
-        FROM connector LEFT OUTER JOIN treenode_connector
-                       ON connector.id = treenode_connector.connector_id
-        WHERE connector.project_id = %(project_id)s
-          AND (connector.location).z = %(z)s
-          AND (connector.location).x > %(left)s
-          AND (connector.location).x < %(right)s
-          AND (connector.location).y > %(top)s
-          AND (connector.location).y < %(bottom)s
-        ''', params)
-
-        crows.extend(cursor.fetchall())
-
-        connectors = []
-        # A set of missing treenode IDs
-        missing_treenode_ids = set()
-        # Check if the active treenode is present; if not, load it
-        if -1 != atnid and atnid not in treenode_ids:
-            # If atnid is a connector, it doesn't matter, won't be found in treenode table
-            missing_treenode_ids.add(atnid)
-        # A set of unique connector IDs
-        connector_ids = set()
-        # The relations between connectors and treenodes, stored
-        # as connector ID keys vs a list of tuples, each with the treenode id,
-        # the type of relation (presynaptic_to or postsynaptic_to), and the confidence.
-        # The list of tuples is generated later from a dict,
-        # so that repeated tnid entries are overwritten.
-        pre = defaultdict(dict)
-        post = defaultdict(dict)
-
-        # Process crows (rows with connectors) which could have repeated connectors
-        # given the join with treenode_connector
-        presynaptic_to = relation_map['presynaptic_to']
-        for row in crows:
-            # Collect treeenode IDs related to connectors but not yet in treenode_ids
-            # because they lay beyond adjacent sections
-            tnid = row[6] # The tnid column is index 7 (see SQL statement above)
-            cid = row[0] # connector ID
-            if tnid is not None:
-                if tnid not in treenode_ids:
-                    missing_treenode_ids.add(tnid)
-                # Collect relations between connectors and treenodes
-                # row[5]: treenode_relation_id
-                # row[6]: treenode_id (tnid above)
-                # row[7]: tc_confidence
-                if row[5] == presynaptic_to:
-                    pre[cid][tnid] = row[7]
-                else:
-                    post[cid][tnid] = row[7]
-
-            # Collect unique connectors
-            if cid not in connector_ids:
-                connectors.append(row)
-                connector_ids.add(cid)
-
-        # Fix connectors to contain only the relevant entries, plus the relations
-        for i in xrange(len(connectors)):
-            c = connectors[i]
-            cid = c[0]
-            connectors[i] = (cid, c[1], c[2], c[3], c[4],
-                    [kv for kv in  pre[cid].iteritems()],
-                    [kv for kv in post[cid].iteritems()],
-                    is_superuser or c[8] == user_id or c[8] in domain)
-
-
-        # Fetch missing treenodes. These are related to connectors
-        # but not in the bounding box of the field of view.
-        # This is so that we can draw arrows from any displayed connector
-        # to all of its connected treenodes, even if one is several slices
-        # below.
-
-        if missing_treenode_ids:
-            params['missing'] = tuple(missing_treenode_ids)
-            response_on_error = 'Failed to query treenodes from connectors'
-            cursor.execute('''
-            SELECT id,
-                parent_id,
-                (location).x,
-                (location).y,
-                (location).z,
-                confidence,
-                radius,
-                skeleton_id,
-                user_id
-            FROM treenode
-            WHERE id IN %(missing)s''', params)
-
-            for row in cursor.fetchall():
-                treenodes.append(row)
-                treenode_ids.add(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
-
-        labels = defaultdict(list)
-        if 'true' == request.POST['labels']:
-            z0 = params['z']
-            # Collect treenodes visible in the current section
-            visible = ','.join(str(row[0]) for row in treenodes if row[4] == z0)
-            if visible:
-                cursor.execute('''
-                SELECT treenode.id, class_instance.name
-                FROM treenode, class_instance, treenode_class_instance
-                WHERE treenode_class_instance.relation_id = %s
-                  AND treenode.id IN (%s)
-                  AND treenode_class_instance.treenode_id = treenode.id
-                  AND class_instance.id = treenode_class_instance.class_instance_id
-                ''' % (relation_map['labeled_as'], visible))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
+    except Exception as e:
+        raise Exception(response_on_error + ':' + str(e))
 
-            # Collect connectors visible in the current section
-            visible = ','.join(str(row[0]) for row in connectors if row[3] == z0)
-            if visible:
-                cursor.execute('''
-                SELECT connector.id, class_instance.name
-                FROM connector, class_instance, connector_class_instance
-                WHERE connector_class_instance.relation_id = %s
-                  AND connector.id IN (%s)
-                  AND connector_class_instance.connector_id = connector.id
-                  AND class_instance.id = connector_class_instance.class_instance_id
-                ''' % (relation_map['labeled_as'], visible))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
 
-        return HttpResponse(json.dumps((treenodes, connectors, labels, n_retrieved_nodes == params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_list_sections(request, project_id=None):
+    ''' Retrieve the nodes of the field of view in a window of sections around
+    z, from z - n_sections * zres to z + n_sections * zres, in a single query
+    pass. This lets the tracing overlay prefetch the sections next to the
+    current one. Returns a JSON array with an entry [z, nodes] for each
+    section, in ascending z, where nodes is the array that node_list_tuples
+    returns for that section. The node limit and its flag apply to each
+    section, and a node belongs to the section it is less than half a section
+    thickness (zres) away from.
+    '''
+    project_id = int(project_id) # sanitize
+    params = _node_list_params(request, project_id)
+    atnid = int(request.POST.get('atnid', -1))
+    with_labels = 'true' == request.POST.get('labels')
+    n_sections = int(request.POST.get('n_sections', 1))
+    if n_sections < 0 or n_sections > 10:
+        raise Exception('The number of sections around z must be between 0 and 10.')
+
+    response_on_error = ''
+    try:
+        cursor = connection.cursor()
+
+        response_on_error = 'Failed to query relations'
+        relation_map = get_relation_to_id_map(project_id)
+
+        can_edit = edit_permission(cursor, request.user)
+
+        response_on_error = 'Failed to query treenodes and connectors'
+        sections = sorted(set(params['z'] + i * params['zres']
+                          for i in xrange(-n_sections, n_sections + 1)))
+        views, limit_reached = _section_node_lists(cursor, project_id,
+                sections, params, relation_map, with_labels)
+
+        response_on_error = 'Failed to query the active treenode'
+        _active_treenode(cursor, atnid, views.values())
+
+        def chunks():
+            separator = '['
+            for z in sections:
+                yield separator + '[' + json.dumps(z) + ','
+                for chunk in _node_list_chunks(views[z], z in limit_reached, can_edit):
+                    yield chunk
+                yield ']'
+                separator = ','
+            yield ']'
+
+        return streaming_json_response(chunks())
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -326,6 +632,7 @@ def update_confidence(request, project_id=None, node_id=0):
         rows_affected = Treenode.objects.filter(id=tnid).update(confidence=new_confidence,editor=request.user)
 
     if rows_affected > 0:
+        invalidate_treenode_tiles(project_id, (tnid,))
         location = Location.objects.get(id=tnid).location
         insert_into_log(project_id, request.user.id, "change_confidence", location, "Changed to %s" % new_confidence)
         return HttpResponse(json.dumps({'message': 'success'}), mimetype='text/json')
@@ -366,7 +673,7 @@ def most_recent_treenode(request, project_id=None):
     }))
 
 
-def _update(Kind, table, nodes, now, user):
+def _update(Kind, table, nodes, now, user, invalidate):
     if not nodes:
         return
     # 0: id
@@ -374,11 +681,15 @@ def _update(Kind, table, nodes, now, user):
     # 2: Y
     # 3: Z
     can_edit_all_or_fail(user, (node[0] for node in nodes.itervalues()), table)
+    ids = [int(node[0]) for node in nodes.itervalues()]
+    # Invalidate the cached tiles the nodes move away from and into
+    invalidate(ids)
     for node in nodes.itervalues():
         Kind.objects.filter(id=int(node[0])).update(
             editor=user,
             edition_time=now,
             location=Double3D(float(node[1]), float(node[2]), float(node[3])))
+    invalidate(ids)
 
 @requires_user_role(UserRole.Annotate)
 def node_update(request, project_id=None):
@@ -399,8 +710,10 @@ def node_update(request, project_id=None):
         node[j] = value
 
     now = datetime.now()
-    _update(Treenode, 'treenode', nodes['t'], now, request.user)
-    _update(Connector, 'connector', nodes['c'], now, request.user)
+    _update(Treenode, 'treenode', nodes['t'], now, request.user,
+            lambda ids: invalidate_treenode_tiles(project_id, ids))
+    _update(Connector, 'connector', nodes['c'], now, request.user,
+            lambda ids: invalidate_connector_tiles(project_id, ids))
 
     return HttpResponse(json.dumps(len(nodes)))
 
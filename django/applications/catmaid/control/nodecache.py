@@ -0,0 +1,198 @@
+# An in-process LRU cache of the content of the spatial tiles that
+# node_list_tuples serves the field of view of the tracing overlay from.
+#
+# Cached tiles are validated against the edit version of each tile, which is
+# stored in the node_tile_version table. Write endpoints bump the version of
+# every tile their edit affects, in the same transaction as the edit itself.
+# This way, all worker processes see a consistent version and never serve a
+# tile that is stale with respect to a committed edit, while the expensive
+# tile queries are only run again for tiles that actually changed.
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+
+from catmaid.control.cache import LRUCache
+from catmaid.control.spatial import node_tile_size, section_condition, \
+        section_of
+
+# (project_id, z, half section thickness, tile, with_labels) vs
+# (version, tile content)
+_node_tiles = LRUCache(getattr(settings, 'NODE_TILE_CACHE_SIZE', 0))
+
+
+def get_cached_node_tiles(cursor, project_id, sections, half, tiles, with_labels):
+    """ Return the current version of each of the given tiles in each of the
+    given sections, which extend half a section thickness, given as half,
+    around their z (see section_condition), as a dictionary of (z, tile) vs
+    version, and the content of those tiles that are cached with their current
+    version, as a dictionary of (z, tile) vs content. Versions are kept for
+    the z of the edited nodes, so the version of a tile of a section is the
+    sum of those of the z values within it, which grows with any of them. """
+    tiles = set(tiles)
+    versions = {(z, tile): 0 for z in sections for tile in tiles}
+    if not versions:
+        return versions, {}
+    cols = [tile[0] for tile in tiles]
+    rows = [tile[1] for tile in tiles]
+    params = [project_id]
+    condition = section_condition('z', sections, half, params)
+    params.extend((min(cols), max(cols), min(rows), max(rows)))
+    cursor.execute('''
+    SELECT z, col, "row", version
+    FROM node_tile_version
+    WHERE project_id = %s
+      AND ''' + condition + '''
+      AND col BETWEEN %s AND %s
+      AND "row" BETWEEN %s AND %s
+    ''', params)
+    for z, col, row, version in cursor.fetchall():
+        key = (section_of(z, sections, half), (col, row))
+        if key in versions:
+            versions[key] += version
+
+    cached = {}
+    for (z, tile), version in versions.iteritems():
+        entry = _node_tiles.get((project_id, z, half, tile, with_labels))
+        if entry and entry[0] == version:
+            cached[(z, tile)] = entry[1]
+    return versions, cached
+
+
+def cache_node_tiles(project_id, versions, half, contents, with_labels):
+    """ Store the content of tiles of sections of the given half thickness,
+    as a dictionary of (z, tile) vs content, which has been fetched after
+    reading their versions with get_cached_node_tiles. The content must not be
+    modified afterwards. """
+    for (z, tile), content in contents.iteritems():
+        _node_tiles.set((project_id, z, half, tile, with_labels),
+                (versions[(z, tile)], content))
+
+
+def _tile_columns(alias):
+    """ The SQL expressions of the z, column and row of the tile that contains
+    the location of the row aliased as alias. """
+    return '''(%(a)s.location).z,
+              floor((%(a)s.location).x / %%(size)s),
+              floor((%(a)s.location).y / %%(size)s)''' % {'a': alias}
+
+
+def _invalidate(project_id, query, ids):
+    """ Bump the version of the tiles returned by the query, which selects
+    their z, column and row. The query refers to the tuple of IDs as %(ids)s
+    and to the tile size as %(size)s. """
+    size = node_tile_size()
+    if size <= 0:
+        return
+    cursor = connection.cursor()
+    cursor.execute(query, {'ids': ids, 'size': size})
+    tiles = set((row[0], int(row[1]), int(row[2])) for row in cursor.fetchall())
+    _bump_tile_versions(cursor, int(project_id), tiles)
+
+
+def _bump_tile_versions(cursor, project_id, tiles):
+    """ Increment the version of each (z, col, row) tile. Tiles that have
+    never been edited before are inserted. Cached tiles of the sections that
+    contain them are then outdated, see get_cached_node_tiles. """
+    if not tiles:
+        return
+
+    def tile_values(tiles):
+        params = []
+        for tile in tiles:
+            params.extend(tile)
+        return ','.join(['(%s::float8, %s, %s)'] * len(tiles)), params
+
+    values, params = tile_values(tiles)
+    cursor.execute('''
+    UPDATE node_tile_version v
+    SET version = v.version + 1
+    FROM (VALUES ''' + values + ''') AS t(z, col, "row")
+    WHERE v.project_id = %s
+      AND v.z = t.z
+      AND v.col = t.col
+      AND v."row" = t."row"
+    RETURNING v.z, v.col, v."row"
+    ''', params + [project_id])
+    new_tiles = tiles - set(cursor.fetchall())
+    if not new_tiles:
+        return
+
+    values, params = tile_values(new_tiles)
+    sid = transaction.savepoint()
+    try:
+        cursor.execute('''
+        INSERT INTO node_tile_version (project_id, z, col, "row", version)
+        SELECT %s, t.z, t.col, t."row", 1
+        FROM (VALUES ''' + values + ''') AS t(z, col, "row")
+        ''', [project_id] + params)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # A concurrent edit inserted some of the tiles first: update them now
+        transaction.savepoint_rollback(sid)
+        _bump_tile_versions(cursor, project_id, new_tiles)
+
+
+def invalidate_treenode_tiles(project_id, treenode_ids):
+    """ Invalidate the tiles that include any of the treenodes: those that
+    contain the treenodes, their parents and children (which are fetched along
+    with the nodes of a tile), and their connectors (whose tiles include all
+    treenodes linked to them). Has to be called before a treenode is deleted
+    or moved away, and after it is created or moved. """
+    ids = tuple(int(tnid) for tnid in treenode_ids)
+    if not ids:
+        return
+    _invalidate(project_id, '''
+    SELECT DISTINCT ''' + _tile_columns('t') + '''
+    FROM treenode t
+    WHERE t.id IN %(ids)s
+       OR t.parent_id IN %(ids)s
+       OR t.id IN (SELECT parent_id FROM treenode WHERE id IN %(ids)s)
+    UNION
+    SELECT DISTINCT ''' + _tile_columns('c') + '''
+    FROM connector c, treenode_connector tc
+    WHERE tc.treenode_id IN %(ids)s
+      AND tc.connector_id = c.id
+    ''', ids)
+
+
+def invalidate_connector_tiles(project_id, connector_ids):
+    """ Invalidate the tiles that include any of the connectors: those that
+    contain the connectors and those that include a treenode linked to them.
+    Has to be called before a connector is deleted or moved away, and after it
+    is created or moved. """
+    ids = tuple(int(cid) for cid in connector_ids)
+    if not ids:
+        return
+    _invalidate(project_id, '''
+    SELECT DISTINCT ''' + _tile_columns('c') + '''
+    FROM connector c
+    WHERE c.id IN %(ids)s
+    UNION
+    SELECT DISTINCT ''' + _tile_columns('t') + '''
+    FROM treenode t
+    WHERE t.id IN (SELECT treenode_id FROM treenode_connector WHERE connector_id IN %(ids)s)
+       OR t.parent_id IN (SELECT treenode_id FROM treenode_connector WHERE connector_id IN %(ids)s)
+       OR t.id IN (SELECT t2.parent_id
+                   FROM treenode t2, treenode_connector tc
+                   WHERE tc.connector_id IN %(ids)s
+                     AND tc.treenode_id = t2.id)
+    ''', ids)
+
+
+def invalidate_skeleton_tiles(project_id, skeleton_ids):
+    """ Invalidate the tiles that include any treenode of the skeletons, or any
+    connector linked to them. Used by edits that alter many nodes of a skeleton
+    at once, like splits and joins. """
+    ids = tuple(int(skid) for skid in skeleton_ids)
+    if not ids:
+        return
+    _invalidate(project_id, '''
+    SELECT DISTINCT ''' + _tile_columns('t') + '''
+    FROM treenode t
+    WHERE t.skeleton_id IN %(ids)s
+    UNION
+    SELECT DISTINCT ''' + _tile_columns('c') + '''
+    FROM connector c, treenode_connector tc
+    WHERE tc.skeleton_id IN %(ids)s
+      AND tc.connector_id = c.id
+    ''', ids)
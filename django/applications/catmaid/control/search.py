@@ -1,43 +1,25 @@
 import json
 
+from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.models import *
-from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.labelindex import find_class_instances, labeled_treenodes
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def search(request, project_id=None):
-    def format_node_data(node):
-        '''
-        Formats node data for our json output.
-
-        When we start using Django 1.4, we can use prefetch_related instead of using
-        .values('treenode__xxx'), and will then be able to access a proper location
-        object.
-        '''
-        location = Double3D.from_str(node['treenode__location'])
-        return {
-            'id': node['treenode'],
-            'x': int(location.x),
-            'y': int(location.y),
-            'z': int(location.z),
-            'skid': node['treenode__skeleton']}
-
     search_string = request.GET.get('substring', "")
-
-    ids = set()
+    cursor = connection.cursor()
 
     # 1. Query ClassInstance objects, where the name contains the search string.
-    # This retrieves neurons, skeletons and groups by name.
-    row_query = ClassInstance.objects.values('id', 'name', 'class_column__class_name').filter(
-        name__icontains=search_string,
-        project=project_id).order_by('class_column__class_name', 'name')
-    rows = list(row_query)
-    for row in rows:
-        ids.add(row['id'])
+    # This retrieves neurons, skeletons and groups by name. Names are matched
+    # through the label index, see labelindex.name_condition.
+    rows = [{'id': row[0], 'name': row[1], 'class_name': row[2]}
+            for row in find_class_instances(cursor, project_id, search_string)]
+    ids = set(row['id'] for row in rows)
 
     # 2. Query skeletons and neurons by ID, if the search string is a number
     try:
@@ -48,39 +30,24 @@ def search(request, project_id=None):
                 ).values('id', 'name', 'class_column__class_name')
         for row in oid_query:
             if row['id'] not in ids:
+                row['class_name'] = row.pop('class_column__class_name')
                 rows.append(row)
     except ValueError:
         pass
 
-    # 3. Query labels in treenodes. First get a list of matching labels,
-    # and then find a list of treenodes for each label.
+    # 3. Query labels in treenodes. Find the treenodes of each of the
+    # matching labels.
     relation_map = get_relation_to_id_map(project_id)
-    label_rows = {}
-    for row in rows:
-        # Change key-name of class_column__class_name for json output
-        row['class_name'] = row.pop('class_column__class_name')
-        # Prepare for retrieving nodes holding text labels
-        if row['class_name'] == 'label':
-            label_rows[row['name']] = row
-
-    node_query = TreenodeClassInstance.objects.filter(
-        project=project_id,
-        treenode__project=project_id,
-        relation=relation_map['labeled_as'],
-        class_instance__name__in=label_rows.keys())\
-    .order_by('-treenode__id')\
-    .values('treenode',
-        'treenode__location',
-        'treenode__skeleton',
-        'class_instance__name')
-
-    for node in node_query:
-        row_with_node = label_rows[node['class_instance__name']]
-        nodes = row_with_node.get('nodes', None)
-        if not nodes:
-          nodes = []
-          row_with_node['nodes'] = nodes
-        nodes.append(format_node_data(node))
+    label_rows = {row['id']: row for row in rows if row['class_name'] == 'label'}
+    treenodes = labeled_treenodes(cursor, project_id,
+            relation_map.get('labeled_as', -1), label_rows.keys())
+
+    for label_id, nodes in treenodes.iteritems():
+        label_rows[label_id]['nodes'] = [{
+            'id': node[0],
+            'x': int(node[1]),
+            'y': int(node[2]),
+            'z': int(node[3]),
+            'skid': node[4]} for node in nodes]
 
     return HttpResponse(json.dumps(rows))
-
@@ -11,6 +11,7 @@ from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
 from catmaid.control.stack import get_stack_info
+from catmaid.control import tileserver
 
 try:
     import numpy as np
@@ -265,7 +266,7 @@ def create_segmentation_neurohdf_file(request, project_id, stack_id):
     filename=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_segmentation.hdf'.format( project_id, stack_id ) )
 
     print >> sys.stderr, filename
-    with closing(h5py.File(filename, 'w')) as hfile:
+    with tileserver.open_hdf5_for_writing(filename, 'w') as hfile:
         hfile.attrs['neurohdf_version'] = '0.1'
         scaleGroup = hfile.create_group("scale")
         scale_zero = scaleGroup.create_group("0")
@@ -413,63 +414,12 @@ def get_segmentation_tile(project_id, stack_id,scale,height,width,x,y,z,type):
     if int(scale) < 0:
         scale = 0
 
-    with closing(h5py.File(fpath, 'r')) as hfile:
-
-        #hdfpath = 'scale/' + str(int(scale)) + '/section/'+ str(z)+'/skeletons_rgb'
-        hdfpath = 'scale/' + str(int(scale)) + '/section/'+ str(z)+'/skeletons_rgb'
-        image_data=hfile[hdfpath].value
-        data=image_data[y:y+height,x:x+width,:]
-
-        #data=image_data[y:y+height,x:x+width]
-        # create membrane labeling
-        #data[data == 700] = 0
-        #data[data == 600] = 0
-        #data[data == 800] = 0
-        #data[data > 0] = 255
-        #data = data.astype( np.uint8 )
-
-        #data[data != 300] = 0
-        #data[data == 300] = 255
-        #data = data.astype( np.uint8 )
-
-        #pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-
-        #pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','RGBA',0,1)
-
-        pilImage = Image.fromarray(data)
-        response = HttpResponse(mimetype="image/png")
-        pilImage.save(response, "PNG")
-        #pilImage.save('segmentation_tile_'+str(x)+'_'+str(y), "PNG")
-        return response
+    #hdfpath = 'scale/' + str(int(scale)) + '/section/'+ str(z)+'/skeletons_rgb'
+    hdfpath = 'scale/' + str(int(scale)) + '/section/'+ str(z)+'/skeletons_rgb'
+    return HttpResponse(tileserver.tile(fpath, hdfpath, x, y, width, height, False),
+            mimetype="image/png")
 
 
-        if type == 'all':
-            hdfpath = 'scale/' + str(int(scale)) + '/section/'+ str(z)+'/mitochondria'
-            image_data=hfile[hdfpath].value
-            data=image_data[y:y+height,x:x+width]
-
-            hdfpath = 'scale/' + str(int(scale)) + '/section/'+ str(z)+'/components'
-            image_data=hfile[hdfpath].value
-            data_components=image_data[y:y+height,x:x+width]
-
-            indices=np.where(data_components>0)
-            data[indices[0],indices[1]] = 1
-
-        else:
-            hdfpath = 'scale/' + str(int(scale)) + '/section/'+ str(z)+'/'+type
-            image_data=hfile[hdfpath].value
-            data=image_data[y:y+height,x:x+width]
-
-        data[data > 0] = 255
-        data = data.astype( np.uint8 )
-
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-
-        response = HttpResponse(mimetype="image/png")
-        pilImage.save(response, "PNG")
-        #pilImage.save('segmentation_tile_'+str(x)+'_'+str(y), "PNG")
-        return response
-
 """
 def get_tile(request, project_id=None, stack_id=None):
     scale = float(request.GET.get('scale', '0'))
@@ -524,7 +474,7 @@ def put_tile(request, project_id=None, stack_id=None):
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
     #print >> sys.stderr, 'fpath', fpath
 
-    with closing(h5py.File(fpath, 'a')) as hfile:
+    with tileserver.open_hdf5_for_writing(fpath, 'a') as hfile:
         hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
         #print >> sys.stderr, 'storage', x,y,z,height,width,hdfpath
         #print >> sys.stderr, 'image', base64.decodestring(image)
@@ -9,11 +9,16 @@ from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.neuron_annotations import create_annotation_query
 from catmaid.control.neuron_annotations import _annotate_neurons
 from catmaid.control.neuron_annotations import _update_neuron_annotations
+from catmaid.control.nodecache import invalidate_skeleton_tiles
 from collections import defaultdict
 import json
+import logging
+import time
 from operator import itemgetter
-import networkx as nx
-from tree_util import reroot, edge_count_to_root
+import numpy as np
+from tree_util import Arbor, reroot
+
+logger = logging.getLogger(__name__)
 
 
 def get_skeleton_permissions(request, project_id, skeleton_id):
@@ -47,48 +52,30 @@ def last_openleaf(request, project_id=None, skeleton_id=None):
     ''' % int(skeleton_id))
 
     # Some entries repeated, when a node has more than one tag
-    # Create a graph with edges from parent to child, and accumulate parents
-    tree = nx.DiGraph()
+    parents = {}
+    locations = {}
+    tagged = set()
     for row in cursor.fetchall():
-        nodeID = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], nodeID)
-        else:
-            tree.add_node(nodeID)
-        tree.node[nodeID]['loc'] = row[2]
+        parents[row[0]] = row[1]
+        locations[row[0]] = row[2]
         if row[3]:
-            props = tree.node[nodeID]
-            tags = props.get('tags')
-            if tags:
-                tags.append(row[3])
-            else:
-                props['tags'] = [row[3]]
+            tagged.add(row[0])
 
-    if tnid not in tree:
+    if tnid not in parents:
         raise Exception("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
+    tree = Arbor(parents.keys(), parents.values())
     reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
+    depths = tree.depths()
 
-    # Iterate end nodes, find closest
+    # Find the closest open end, that is, an end node without tags
+    ends = np.flatnonzero(tree.n_children() == 0)
+    ends = ends[~np.in1d(tree.ids[ends], np.array(list(tagged), dtype=np.int64))]
     nearest = None
-    distance = tree.number_of_nodes() + 1
     loc = None
-    other_tags = set(('uncertain continuation', 'not a branch', 'soma'))
-
-    for nodeID, out_degree in tree.out_degree_iter():
-        if 0 == out_degree:
-            # Found an end node
-            props = tree.node[nodeID]
-            # Check if not tagged with a tag containing 'end'
-            if not 'tags' in props and not [s for s in props if 'end' in s or s in other_tags]:
-                # Found an open end
-                d = distances[nodeID]
-                if d < distance:
-                    nearest = nodeID
-                    distance = d
-                    loc = props['loc']
+    if len(ends):
+        nearest = int(tree.ids[ends[np.argmin(depths[ends])]])
+        loc = locations[nearest]
 
     return HttpResponse(json.dumps((nearest, loc)))
 
@@ -208,6 +195,67 @@ def check_annotations_on_join(project_id, user, from_neuron_id, to_neuron_id,
     return check_new_annotations(project_id, user, from_neuron_id, ann_set) and \
            check_new_annotations(project_id, user, to_neuron_id, ann_set)
 
+# Treenodes move between skeletons in chunks of at most this many
+_MOVE_CHUNK_SIZE = 10000
+
+def _skeleton_node_count(cursor, skeleton_id):
+    """ Return the number of treenodes of the skeleton, as kept in its
+    summary, or None if it has no summary. """
+    cursor.execute('''
+    SELECT node_count FROM skeleton_summary WHERE skeleton_id = %s
+    ''', (int(skeleton_id),))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _subtree(cursor, treenode_id, limit=None):
+    """ Return the list of IDs of the treenodes downstream of the given one,
+    including it, or of the first limit of them in breadth-first order. The
+    walk stops once the limit is reached. """
+    cursor.execute('''
+    WITH RECURSIVE subtree (id) AS (
+        SELECT %s::bigint
+      UNION ALL
+        SELECT t.id
+        FROM treenode t,
+             subtree s
+        WHERE t.parent_id = s.id
+    )
+    SELECT id FROM subtree
+    ''' + ('' if limit is None else 'LIMIT %s'),
+    (int(treenode_id),) + (() if limit is None else (int(limit),)))
+    return [row[0] for row in cursor.fetchall()]
+
+def _upstream(cursor, skeleton_id, treenode_id):
+    """ Return the list of IDs of the treenodes of the skeleton that are not
+    downstream of the given treenode. """
+    cursor.execute('''
+    WITH RECURSIVE upstream (id) AS (
+        SELECT id
+        FROM treenode
+        WHERE skeleton_id = %s
+          AND parent_id IS NULL
+      UNION ALL
+        SELECT t.id
+        FROM treenode t,
+             upstream u
+        WHERE t.parent_id = u.id
+          AND t.id <> %s
+    )
+    SELECT id FROM upstream
+    ''', (int(skeleton_id), int(treenode_id)))
+    return [row[0] for row in cursor.fetchall()]
+
+def _move_treenodes(cursor, treenode_ids, skeleton_id):
+    """ Assign the treenodes and their links to connectors to the skeleton,
+    in chunks of at most _MOVE_CHUNK_SIZE treenodes. The summaries of the
+    skeletons are updated once per chunk rather than once per row (see the
+    move_treenodes database function). """
+    for start in xrange(0, len(treenode_ids), _MOVE_CHUNK_SIZE):
+        chunk = treenode_ids[start:start + _MOVE_CHUNK_SIZE]
+        cursor.execute('''
+        SELECT move_treenodes(%s::bigint[], %s)
+        ''', (chunk, skeleton_id))
+
 @requires_user_role(UserRole.Annotate)
 def split_skeleton(request, project_id=None):
     """ The split is only possible if the neuron is not locked or if it is
@@ -225,7 +273,7 @@ def split_skeleton(request, project_id=None):
     cursor = connection.cursor()
 
     # Check if the treenode is root!
-    if not treenode.parent:
+    if treenode.parent_id is None:
         return HttpResponse(json.dumps({'error': 'Can\'t split at the root node: it doesn\'t have a parent.'}))
 
     # Check if annotations are valid
@@ -245,32 +293,28 @@ def split_skeleton(request, project_id=None):
     # Make sure the user has permissions to edit
     can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
 
-    # retrieve the id, parent_id of all nodes in the skeleton
-    # with minimal ceremony
-    cursor.execute('''
-    SELECT id, parent_id FROM treenode WHERE skeleton_id=%s
-    ''' % skeleton_id) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
+    # The treenodes downstream of the split node, including it, make up a new
+    # skeleton and neuron, and the upstream part keeps the neuron. Only the
+    # smaller part moves to the new skeleton, so that the work done is
+    # proportional to it: the walk down from the split node stops after half
+    # of the nodes of the skeleton. If it gets there, the upstream part moves,
+    # and the two skeletons swap neurons instead.
+    total = _skeleton_node_count(cursor, skeleton_id)
+    limit = total // 2 + 1 if total else None
+    downstream = _subtree(cursor, treenode_id, limit)
+    move_upstream = limit is not None and len(downstream) >= limit
+    if move_upstream:
+        moved = _upstream(cursor, skeleton_id, treenode_id)
+    else:
+        moved = downstream
+
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
     new_skeleton.project_id = project_id
     new_skeleton.user = skeleton.user # The same user that owned the skeleton to split
-    new_skeleton.class_column = Class.objects.get(class_name='skeleton', project_id=project_id)
+    class_map = get_class_to_id_map(project_id)
+    new_skeleton.class_column_id = class_map['skeleton']
     new_skeleton.save()
     new_skeleton.name = 'Skeleton {0}'.format( new_skeleton.id ) # This could be done with a trigger in the database
     new_skeleton.save()
@@ -279,28 +323,29 @@ def split_skeleton(request, project_id=None):
     new_neuron.name = 'Neuron'
     new_neuron.project_id = project_id
     new_neuron.user = skeleton.user
-    new_neuron.class_column = Class.objects.get(class_name='neuron',
-            project_id=project_id)
+    new_neuron.class_column_id = class_map['neuron']
     new_neuron.save()
     new_neuron.name = 'Neuron %s' % str(new_neuron.id)
     new_neuron.save()
-    # Assign the skeleton to new neuron
+    # Assign the skeleton of the downstream part to the new neuron
+    model_of = get_relation_to_id_map(project_id)['model_of']
+    if move_upstream:
+        ClassInstanceClassInstance.objects.filter(class_instance_a=skeleton_id,
+                relation=model_of).update(class_instance_b=new_neuron.id)
+        upstream_skeleton_id = new_skeleton.id
+    else:
+        upstream_skeleton_id = skeleton_id
     cici = ClassInstanceClassInstance()
     cici.class_instance_a = new_skeleton
-    cici.class_instance_b = new_neuron
-    cici.relation = Relation.objects.get(relation_name='model_of', project_id=project_id)
+    cici.class_instance_b = neuron if move_upstream else new_neuron
+    cici.relation_id = model_of
     cici.user = skeleton.user # The same user that owned the skeleton to split
     cici.project_id = project_id
     cici.save()
-    # update skeleton_id of list in treenode table
-    # This creates a lazy QuerySet that, upon calling update, returns a new QuerySet
-    # that is then executed. It does NOT create an update SQL query for every treenode.
-    tns = Treenode.objects.filter(id__in=change_list).update(skeleton=new_skeleton)
-    # update the skeleton_id value of the treenode_connector table
-    tc = TreenodeConnector.objects.filter(
-        relation__relation_name__endswith = 'synaptic_to',
-        treenode__in=change_list,
-    ).update(skeleton=new_skeleton)
+    # The nodes of the skeleton stay in place, but one part of them changes
+    # its skeleton.
+    invalidate_skeleton_tiles(project_id, (skeleton_id,))
+    _move_treenodes(cursor, moved, new_skeleton.id)
     # setting new root treenode's parent to null
     Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
 
@@ -312,8 +357,9 @@ def split_skeleton(request, project_id=None):
     _annotate_neurons(project_id, request.user, [new_neuron.id],
             downstream_annotation_set)
 
-    # Log the location of the node at which the split was done
-    insert_into_log( project_id, request.user.id, "split_skeleton", treenode.location, "Split skeleton with ID {0} (neuron: {1})".format( skeleton_id, neuron.name ) )
+    # Log the location of the node at which the split was done, with the
+    # skeleton that now models the neuron
+    insert_into_log( project_id, request.user.id, "split_skeleton", treenode.location, "Split skeleton with ID {0} (neuron: {1})".format( upstream_skeleton_id, neuron.name ) )
 
     return HttpResponse(json.dumps({}), mimetype='text/json')
 
@@ -492,15 +538,7 @@ def _skeleton_info_raw(project_id, skeletons, synaptic_count_high_pass, op):
     cursor = connection.cursor()
 
     # Obtain the IDs of the 'presynaptic_to', 'postsynaptic_to' and 'model_of' relations
-    cursor.execute('''
-    SELECT relation_name,
-           id
-    FROM relation
-    WHERE project_id=%s
-      AND (relation_name='presynaptic_to'
-        OR relation_name='postsynaptic_to'
-        OR relation_name='model_of')''' % project_id)
-    relation_ids = dict(cursor.fetchall())
+    relation_ids = get_relation_to_id_map(project_id)
 
     # Obtain partner skeletons and their info
     incoming = _connected_skeletons(skeletons, op, relation_ids['postsynaptic_to'], relation_ids['presynaptic_to'], relation_ids['model_of'], cursor)
@@ -597,10 +635,10 @@ def review_status(request, project_id=None):
     skeleton_ids = set(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM treenode
+    SELECT skeleton_id, reviewer_id, node_count
+    FROM skeleton_reviewer_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id, reviewer_id
+      AND node_count > 0
     ''' % ",".join(str(skid) for skid in skeleton_ids))
 
     s = defaultdict(dict)
@@ -620,6 +658,39 @@ def review_status(request, project_id=None):
     return HttpResponse(json.dumps(status))
 
 
+def _skeleton_summaries(project_id, skeleton_ids=None):
+    """ Return the rows of skeleton_summary of the given skeletons, or of all
+    skeletons of the project, as tuples of skeleton ID, node count, cable
+    length, number of presynaptic and of postsynaptic links and last edition
+    time. """
+    cursor = connection.cursor()
+    if skeleton_ids is None:
+        condition = 's.project_id = %s'
+        params = (int(project_id),)
+    else:
+        condition = 's.project_id = %s AND s.skeleton_id IN %s'
+        params = (int(project_id), tuple(int(skid) for skid in skeleton_ids) or (-1,))
+
+    cursor.execute('''
+    SELECT s.skeleton_id, s.node_count, s.cable_length, s.num_presynaptic,
+           s.num_postsynaptic, s.last_edition_time
+    FROM skeleton_summary s
+    WHERE s.node_count > 0
+      AND ''' + condition, params)
+    return cursor.fetchall()
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def skeleton_summaries(request, project_id=None):
+    """ Return the summary of each skeleton in the request, or of all skeletons
+    of the project if none is given, as a list of [skeleton ID, node count,
+    cable length, number of presynaptic links, number of postsynaptic links,
+    last edition time]. """
+    skeleton_ids = [int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids[')]
+    rows = _skeleton_summaries(project_id, skeleton_ids if skeleton_ids else None)
+    return HttpResponse(json.dumps([row[:5] + (row[5].isoformat(),) for row in rows]))
+
+
 @requires_user_role(UserRole.Annotate)
 def reroot_skeleton(request, project_id=None):
     """ Any user with an Annotate role can reroot any skeleton.
@@ -646,6 +717,8 @@ def _reroot_skeleton(treenode_id, project_id):
 
     response_on_error = ''
     try:
+        start = time.time()
+
         response_on_error = 'Failed to select treenode with id %s.' % treenode_id
         q_treenode = Treenode.objects.filter(
             id=treenode_id,
@@ -654,44 +727,52 @@ def _reroot_skeleton(treenode_id, project_id):
         # Obtain the treenode from the response
         response_on_error = 'An error occured while rerooting. No valid query result.'
         treenode = q_treenode[0]
-        first_parent = treenode.parent
 
         # If no parent found it is assumed this node is already root
-        if first_parent is None:
+        if treenode.parent_id is None:
             return False
 
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parent = treenode
-        new_confidence = treenode.confidence
-        node = first_parent
+        invalidate_skeleton_tiles(project_id, (treenode.skeleton_id,))
 
-        while True:
-            response_on_error = 'Failed to update treenode with id %s to have new parent %s' % (node.id, new_parent.id)
-
-            # Store current values to be used in next iteration
-            parent = node.parent
-            confidence = node.confidence
-
-            # Set new values
-            node.parent = new_parent
-            node.confidence = new_confidence
-            node.save()
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
+        # Follow the chain of parents up to the root and reverse the parent
+        # relationships along it, so that the selected treenode becomes the
+        # root: every node on the path gets the node below it as its parent,
+        # along with that node's confidence, and the new root gets the
+        # maximum confidence.
+        response_on_error = 'Failed to reverse the path from treenode %s ' \
+                'to the root.' % treenode.id
+        cursor = connection.cursor()
+        cursor.execute('''
+        WITH RECURSIVE path (id, parent_id, confidence, depth) AS (
+            SELECT id, parent_id, confidence, 0
+            FROM treenode
+            WHERE id = %s
+          UNION ALL
+            SELECT t.id, t.parent_id, t.confidence, p.depth + 1
+            FROM treenode t,
+                 path p
+            WHERE t.id = p.parent_id
+        ),
+        reversed AS (
+            SELECT id,
+                   lag(id) OVER (ORDER BY depth) AS parent_id,
+                   lag(confidence) OVER (ORDER BY depth) AS confidence
+            FROM path
+        )
+        UPDATE treenode t
+        SET parent_id = r.parent_id,
+            confidence = COALESCE(r.confidence, 5)
+        FROM reversed r
+        WHERE t.id = r.id
+        ''', (treenode.id,))
+        n_nodes = cursor.rowcount
 
-        # Finally make treenode root
-        response_on_error = 'Failed to set treenode with ID %s as root.' % treenode.id
         treenode.parent = None
-        treenode.confidence = 5 # reset to maximum confidence, now it is root.
-        treenode.save()
+        treenode.confidence = 5
+
+        logger.info('Rerooted skeleton %s at treenode %s: reversed %s '
+                'nodes in %.1f ms', treenode.skeleton_id, treenode.id,
+                n_nodes, 1000 * (time.time() - start))
 
         return treenode
 
@@ -748,10 +829,10 @@ def join_skeleton(request, project_id=None):
 def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         annotation_set):
     """ Take the IDs of two nodes, each belonging to a different skeleton, and
-    make to_treenode be a child of from_treenode, and join the nodes of the
-    skeleton of to_treenode into the skeleton of from_treenode, and delete the
-    former skeleton of to_treenode. All annotations in annotation_set will be
-    linked to the skeleton of to_treenode."""
+    make to_treenode be a child of from_treenode, and join the nodes of both
+    skeletons into the larger one, and delete the other. The joined skeleton
+    models the neuron of from_treenode, whose annotations become those of
+    annotation_set."""
     if from_treenode_id is None or to_treenode_id is None:
         raise Exception('Missing arguments to _join_skeleton')
 
@@ -791,24 +872,45 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         if from_skid == to_skid:
             raise Exception('Cannot join treenodes of the same skeleton, this would introduce a loop.')
 
+        # All nodes of both skeletons stay in place, but change their parent
+        # or skeleton.
+        response_on_error = 'Could not invalidate cached nodes of the skeletons.'
+        invalidate_skeleton_tiles(project_id, (from_skid, to_skid))
+
         # Reroot to_skid at to_treenode if necessary
         response_on_error = 'Could not reroot at treenode %s' % to_treenode_id
         _reroot_skeleton(to_treenode_id, project_id)
 
-        # The target skeleton is removed and its treenode assumes
-        # the skeleton id of the from-skeleton.
-
-        response_on_error = 'Could not update Treenode table with new skeleton id for joined treenodes.'
-        Treenode.objects.filter(skeleton=to_skid).update(skeleton=from_skid)
-
-        response_on_error = 'Could not update TreenodeConnector table.'
-        TreenodeConnector.objects.filter(
-            skeleton=to_skid).update(skeleton=from_skid)
+        # The treenodes of the smaller skeleton move to the larger one, so
+        # that the work done is proportional to the smaller one. The larger
+        # skeleton then models the neuron of the from-skeleton, and the other
+        # skeleton is removed.
+        cursor = connection.cursor()
+        from_count = _skeleton_node_count(cursor, from_skid)
+        to_count = _skeleton_node_count(cursor, to_skid)
+        if from_count is not None and to_count is not None and to_count > from_count:
+            keep_skid, remove_skid = to_skid, from_skid
+        else:
+            keep_skid, remove_skid = from_skid, to_skid
 
-        # Remove skeleton of to_id (deletes cicic part_of to neuron by cascade,
-        # leaving the parent neuron dangling in the object tree).
-        response_on_error = 'Could not delete skeleton with ID %s.' % to_skid
-        ClassInstance.objects.filter(pk=to_skid).delete()
+        response_on_error = 'Could not move the treenodes of skeleton %s ' \
+                'to skeleton %s.' % (remove_skid, keep_skid)
+        cursor.execute('''
+        SELECT id FROM treenode WHERE skeleton_id = %s
+        ''', (remove_skid,))
+        _move_treenodes(cursor, [row[0] for row in cursor.fetchall()], keep_skid)
+
+        if keep_skid == to_skid:
+            response_on_error = 'Could not make skeleton %s the model of ' \
+                    'neuron %s.' % (to_skid, from_neuron['neuronid'])
+            ClassInstanceClassInstance.objects.filter(class_instance_a=to_skid,
+                    relation=get_relation_to_id_map(project_id)['model_of']) \
+                    .update(class_instance_b=from_neuron['neuronid'])
+
+        # Remove the other skeleton (deletes cicic part_of to neuron by
+        # cascade, leaving the parent neuron dangling in the object tree).
+        response_on_error = 'Could not delete skeleton with ID %s.' % remove_skid
+        ClassInstance.objects.filter(pk=remove_skid).delete()
 
         # Remove the 'losing' neuron if it is empty
         _delete_if_empty(to_neuron['neuronid'])
@@ -826,7 +928,7 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         insert_into_log(project_id, user.id, 'join_skeleton',
                 from_treenode.location, 'Joined skeleton with ID %s (neuron: ' \
                 '%s) into skeleton with ID %s (neuron: %s, annotations: %s)' % \
-                (to_skid, to_neuron['neuronname'], from_skid,
+                (remove_skid, to_neuron['neuronname'], keep_skid,
                         from_neuron['neuronname'], ', '.join(annotation_set)))
 
     except Exception as e:
@@ -0,0 +1,59 @@
+# An in-process LRU cache of values computed from whole skeletons, like the
+# decomposition of their arbors that the circuit graph is assembled from.
+#
+# Cached values are validated against the edit version of their skeleton: the
+# node count and last edition time of its summary, which triggers on the
+# treenode and treenode_connector tables keep current (see SkeletonSummary).
+# Any insert, update or delete of its rows changes the version, so write
+# endpoints need not invalidate anything, and reading it costs a single index
+# lookup per skeleton.
+
+from django.conf import settings
+
+from catmaid.control.cache import LRUCache
+
+# (kind, skeleton_id, params) vs (version, value)
+_skeleton_values = LRUCache(getattr(settings, 'SKELETON_CACHE_SIZE', 0))
+
+
+def skeleton_versions(cursor, skeleton_ids):
+    """ Return a dictionary of skeleton ID vs its current edit version. """
+    skeleton_ids = tuple(int(skid) for skid in skeleton_ids)
+    versions = dict.fromkeys(skeleton_ids, (0, None))
+    if not skeleton_ids:
+        return versions
+    cursor.execute('''
+    SELECT skeleton_id, node_count, last_edition_time
+    FROM skeleton_summary
+    WHERE skeleton_id IN %s
+    ''', (skeleton_ids,))
+    for row in cursor.fetchall():
+        versions[row[0]] = row[1:]
+    return versions
+
+
+def get_cached_skeletons(cursor, kind, params):
+    """ Given a dictionary of skeleton ID vs the parameters of the computation
+    of the given kind, return the current version of each skeleton and the
+    values cached for those skeletons at their current version, both as
+    dictionaries of skeleton ID keys. """
+    versions = skeleton_versions(cursor, params.iterkeys())
+    cached = {}
+    for skid, version in versions.iteritems():
+        entry = _skeleton_values.get((kind, skid, params[skid]))
+        if entry and entry[0] == version:
+            cached[skid] = entry[1]
+    return versions, cached
+
+
+def cache_skeletons(cursor, kind, params, versions, values):
+    """ Cache the values, a dictionary of skeleton ID vs value, which were
+    computed from the skeletons at the given versions. Values of skeletons
+    that were edited meanwhile are not cached, given that they may have been
+    computed from a mix of old and new rows. """
+    if not values or _skeleton_values.max_size <= 0:
+        return
+    current = skeleton_versions(cursor, values.iterkeys())
+    for skid, value in values.iteritems():
+        if current[skid] == versions[skid]:
+            _skeleton_values.set((kind, skid, params[skid]), (versions[skid], value))
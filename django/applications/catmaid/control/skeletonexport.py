@@ -8,18 +8,22 @@ from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
 from catmaid.control import export_NeuroML_Level3
+from catmaid.control.streaming import stream_rows, json_array_chunks, \
+        streaming_json_response
 
 import networkx as nx
-from tree_util import edge_count_to_root, partition
+import numpy as np
+from tree_util import edge_count_to_root
+from morphology import measure_arbors
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
     print "NeuroML is not loading"
 
-from itertools import imap
+import struct
+from itertools import imap, chain, izip
 from functools import partial
 from collections import defaultdict
-from math import sqrt
 
 def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     treenode_qs = Treenode.objects.filter(skeleton_id=skeleton_id)
@@ -63,7 +67,11 @@ def export_skeleton_response(request, project_id=None, skeleton_id=None, format=
         raise Exception, "Unknown format ('%s') in export_skeleton_response" % (format,)
 
 
-def _skeleton_for_3d_viewer(skeleton_id, with_connectors=True):
+def _skeleton_for_3d_viewer(skeleton_id, project_id, with_connectors=True):
+    ''' Return the neuron name, the nodes, the tags and, optionally, the
+    connectors of the skeleton. The nodes and connectors are iterators over
+    rows streamed from the database (see stream_rows), to be consumed only
+    once, in this order. '''
     skeleton_id = int(skeleton_id) # sanitize
     cursor = connection.cursor()
 
@@ -85,52 +93,151 @@ def _skeleton_for_3d_viewer(skeleton_id, with_connectors=True):
             raise Exception("No neuron found for skeleton #%s" % skeleton_id)
 
     name = row[0]
+    relation_map = get_relation_to_id_map(project_id)
 
-    # TODO split into two fast queries, both tables have skeleton_id as a b-tree key
-    
-    # Fetch all nodes, with their tags if any
+    # Fetch the tags of the nodes
     cursor.execute(
-        '''SELECT t.id, t.user_id, t.location, t.reviewer_id, t.parent_id, t.radius, t.confidence, ci.name
-          FROM treenode t LEFT OUTER JOIN (treenode_class_instance tci INNER JOIN class_instance ci ON tci.class_instance_id = ci.id INNER JOIN relation r ON tci.relation_id = r.id AND r.relation_name = 'labeled_as') ON t.id = tci.treenode_id
-          WHERE t.skeleton_id = %s
-        ''' % skeleton_id)
-
-    nodes = [] # node properties
-    tags = defaultdict(list) # node ID vs list of tags
+        '''SELECT ci.name, tci.treenode_id
+           FROM treenode_class_instance tci,
+                class_instance ci,
+                treenode t
+           WHERE t.skeleton_id = %s
+             AND tci.treenode_id = t.id
+             AND tci.relation_id = %s
+             AND tci.class_instance_id = ci.id
+        ''', (skeleton_id, relation_map['labeled_as']))
+    tags = defaultdict(list) # tag vs list of node IDs
     for row in cursor.fetchall():
-        if row[7]:
-            tags[row[7]].append(row[0])
-        x, y, z = imap(float, row[2][1:-1].split(','))
-        # properties: id, parent_id, user_id, reviewer_id, x, y, z, radius, confidence
-        nodes.append((row[0], row[4], row[1], row[3], x, y, z, row[5], row[6]))
+        tags[row[0]].append(row[1])
+
+    # Fetch all nodes
+    # properties: id, parent_id, user_id, reviewer_id, x, y, z, radius, confidence
+    nodes = stream_rows(
+        '''SELECT t.id, t.parent_id, t.user_id, t.reviewer_id,
+                  (t.location).x, (t.location).y, (t.location).z,
+                  t.radius, t.confidence
+           FROM treenode t
+           WHERE t.skeleton_id = %s
+        ''', (skeleton_id,))
 
     if with_connectors:
         # Fetch all connectors with their partner treenode IDs
-        cursor.execute(
-            ''' SELECT tc.treenode_id, tc.connector_id, r.relation_name, c.location, c.reviewer_id
+        # List of (treenode_id, connector_id, relation_id, x, y, z, reviewer_id)
+        # with relation_id replaced by 0 (presynaptic) or 1 (postsynaptic)
+        connectors = stream_rows(
+            ''' SELECT tc.treenode_id, tc.connector_id,
+                       CASE WHEN tc.relation_id = %s THEN 0 ELSE 1 END,
+                       (c.location).x, (c.location).y, (c.location).z,
+                       c.reviewer_id
                 FROM treenode_connector tc,
-                     connector c,
-                     relation r
+                     connector c
                 WHERE tc.skeleton_id = %s
                   AND tc.connector_id = c.id
-                  AND tc.relation_id = r.id
-            ''' % skeleton_id)
+            ''', (relation_map['presynaptic_to'], skeleton_id))
         # Above, purposefully ignoring connector tags. Would require a left outer join on the inner join of connector_class_instance and class_instance, and frankly connector tags are pointless in the 3d viewer.
-        connectors = []
-
-        # List of (treenode_id, connector_id, relation_id, x, y, z)n with relation_id replaced by 0 (presynaptic) or 1 (postsynaptic)
-        # 'presynaptic_to' has an 'r' at position 1:
-        for row in cursor.fetchall():
-            x, y, z = imap(float, row[3][1:-1].split(','))
-            connectors.append((row[0], row[1], 0 if 'r' == row[2][1] else 1, x, y, z, row[4]))
         return name, nodes, tags, connectors
 
     return name, nodes, tags
 
 
+# The media type of the binary arbor format, see _arbor_binary
+ARBOR_MEDIA_TYPE = 'application/x-catmaid-arbor'
+ARBOR_MAGIC = 'CMARBOR1'
+
+
+def _arbor_binary(name, nodes, tags, connectors=()):
+    ''' Encode the neuron name, nodes, tags and connectors of a skeleton, as
+    returned by _skeleton_for_3d_viewer, in a binary format that a client can
+    map onto typed arrays without parsing. All numbers are little-endian.
+
+    The header consists of the 8 byte magic string 'CMARBOR1', and four uint32:
+    the number of nodes N, the number of connectors M, and the length in bytes
+    of the name and of the tags, which follow as UTF-8 strings (the tags as a
+    JSON object of tag vs list of node IDs). The header is padded with zeros to
+    a multiple of 8 bytes, and followed by these arrays, each aligned to the
+    size of its type:
+      int64   node IDs[N]
+      int64   parent IDs[N], -1 for the root
+      int64   connector treenode IDs[M]
+      int64   connector IDs[M]
+      float32 node x, y, z[3N], interleaved
+      float32 node radius[N]
+      int32   node user IDs[N]
+      int32   node reviewer IDs[N]
+      float32 connector x, y, z[3M], interleaved
+      int32   connector reviewer IDs[M]
+      uint8   node confidence[N]
+      uint8   connector relation[M], 0 for presynaptic and 1 for postsynaptic
+    '''
+    # properties: id, parent_id, user_id, reviewer_id, x, y, z, radius, confidence
+    nodes = list(nodes)
+    connectors = list(connectors)
+    n, m = len(nodes), len(connectors)
+
+    def column(rows, i, dtype, default=None):
+        return np.fromiter((default if row[i] is None else row[i] for row in rows),
+                           dtype=dtype, count=len(rows))
+
+    def xyz(rows, i):
+        return np.fromiter(chain.from_iterable(row[i:i+3] for row in rows),
+                           dtype=np.float32, count=3 * len(rows))
+
+    name = name.encode('utf-8')
+    tags = json.dumps(tags, separators=(',', ':')).encode('utf-8')
+    header = struct.pack('<8sIIII', ARBOR_MAGIC, n, m, len(name), len(tags)) + name + tags
+    header += '\0' * (-len(header) % 8)
+
+    arrays = (
+        column(nodes, 0, np.int64),
+        column(nodes, 1, np.int64, -1),
+        column(connectors, 0, np.int64),
+        column(connectors, 1, np.int64),
+        xyz(nodes, 4),
+        column(nodes, 7, np.float32),
+        column(nodes, 2, np.int32),
+        column(nodes, 3, np.int32, -1),
+        xyz(connectors, 3),
+        column(connectors, 6, np.int32, -1),
+        column(nodes, 8, np.uint8),
+        column(connectors, 2, np.uint8))
+    return header + ''.join(a.astype(a.dtype.newbyteorder('<')).tostring() for a in arrays)
+
+
+def _wants_arbor_binary(request):
+    ''' Whether the binary arbor format has been requested, either with the
+    format parameter or in the Accept header. '''
+    if 'binary' == request.REQUEST.get('format'):
+        return True
+    return ARBOR_MEDIA_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def skeleton_for_3d_viewer(request, project_id=None, skeleton_id=None):
-    return HttpResponse(json.dumps(_skeleton_for_3d_viewer(skeleton_id, with_connectors=request.POST.get('with_connectors', True)), separators=(',', ':')))
+    ''' Return the JSON array of the neuron name, the nodes, the tags and the
+    connectors of the skeleton. The nodes and connectors are streamed from the
+    database into the response, so that large skeletons don't have to be held
+    in memory.
+    With format=binary, or when the Accept header asks for the media type
+    application/x-catmaid-arbor, the same data is returned in the binary
+    format described in _arbor_binary instead. '''
+    data = _skeleton_for_3d_viewer(skeleton_id, project_id,
+            with_connectors=request.POST.get('with_connectors', True))
+
+    if _wants_arbor_binary(request):
+        return HttpResponse(_arbor_binary(*data), mimetype=ARBOR_MEDIA_TYPE)
+
+    def chunks():
+        yield '[' + json.dumps(data[0]) + ','
+        for chunk in json_array_chunks(data[1]):
+            yield chunk
+        yield ',' + json.dumps(data[2], separators=(',', ':'))
+        if len(data) > 3:
+            yield ','
+            for chunk in json_array_chunks(data[3]):
+                yield chunk
+        yield ']'
+
+    return streaming_json_response(chunks())
 
 
 def _measure_skeletons(skeleton_ids):
@@ -141,121 +248,43 @@ def _measure_skeletons(skeleton_ids):
 
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location
+    SELECT skeleton_id, id, COALESCE(parent_id, -1),
+           (location).x, (location).y, (location).z
     FROM treenode
     WHERE skeleton_id IN (%s)
+    ORDER BY skeleton_id
     ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
+    rows = cursor.fetchall()
 
     class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
+        def __init__(self, measurements):
+            self.n_nodes = measurements.n_nodes
+            self.raw_cable = measurements.raw_cable
+            self.smooth_cable = measurements.smooth_cable
+            self.principal_branch_cable = measurements.principal_branch_cable
+            self.n_ends = measurements.n_ends
+            self.n_branch = measurements.n_branch
             self.n_pre = 0
             self.n_post = 0
 
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        x, y, z = imap(float, row[3][1:-1].split(','))
-        skeleton.nodes[row[0]] = Node(row[1], x, y, z)
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    skeletons = {}
+    if rows:
+        # Split the typed columns into the arrays of each skeleton
+        skids = np.array([row[0] for row in rows], dtype=np.int64)
+        ids = np.array([row[1] for row in rows], dtype=np.int64)
+        parent_ids = np.array([row[2] for row in rows], dtype=np.int64)
+        locations = np.array([row[3:6] for row in rows], dtype=np.float64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(skids)) + 1))
+        ends = np.concatenate((starts[1:], [len(rows)]))
+        arbors = [(ids[a:b], parent_ids[a:b], locations[a:b]) for a, b in izip(starts, ends)]
+        for skid, measurements in izip(skids[starts].tolist(), measure_arbors(arbors)):
+            skeletons[skid] = Skeleton(measurements)
 
     # Count inputs
     cursor.execute('''
-    SELECT tc.skeleton_id, count(tc.skeleton_id)
-    FROM treenode_connector tc,
-         relation r
-    WHERE tc.skeleton_id IN (%s)
-      AND tc.relation_id = r.id
-      AND r.relation_name = 'postsynaptic_to'
-    GROUP BY tc.skeleton_id
+    SELECT skeleton_id, num_postsynaptic
+    FROM skeleton_summary
+    WHERE skeleton_id IN (%s)
     ''' % skids_string)
 
     for row in cursor.fetchall():
@@ -287,7 +316,7 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_ends, sk.n_branch, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_ends, sk.n_branch, sk.principal_branch_cable)
     return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
 
 
@@ -464,13 +493,7 @@ def skeletons_neuroml(request, project_id=None):
 
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % project_id)
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     preID = relations['presynaptic_to']
     postID = relations['postsynaptic_to']
 
@@ -494,15 +517,7 @@ def export_neuroml_level3_v181(request, project_id=None):
     skeleton_strings = ",".join(str(skid) for skid in skeleton_ids)
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to'
-           OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-
-    relations = dict(cursor.fetchall())
+    relations = get_relation_to_id_map(project_id)
     presynaptic_to = relations['presynaptic_to']
     postsynaptic_to = relations['postsynaptic_to']
 
@@ -664,10 +679,9 @@ def skeleton_connectors_by_partner(request, project_id):
     skeleton_ids = set(int(v) for k,v in request.POST.iteritems() if k.startswith('skids['))
     cursor = connection.cursor()
 
-    cursor.execute('''
-    SELECT id, relation_name FROM relation WHERE relation_name = 'postsynaptic_to' OR relation_name = 'presynaptic_to'
-    ''')
-    relations = dict(cursor.fetchall())
+    relation_map = get_relation_to_id_map(project_id)
+    relations = {relation_map['presynaptic_to']: 'presynaptic_to',
+                 relation_map['postsynaptic_to']: 'postsynaptic_to'}
 
     cursor.execute('''
     SELECT tc1.skeleton_id, tc1.relation_id,
@@ -0,0 +1,71 @@
+# The tracing space of a project is addressed as a regular grid of square
+# tiles, aligned to the project's origin and sized in calibrated units.
+# A tile is identified by its (column, row) pair within one section.
+
+from math import floor, ceil
+
+from django.conf import settings
+
+
+def node_tile_size():
+    """ Return the edge length of a node tile in calibrated units, as
+    configured by NODE_LIST_TILE_SIZE. A value of zero (or less) disables
+    the tiling of the field of view. """
+    return float(getattr(settings, 'NODE_LIST_TILE_SIZE', 0))
+
+def tile_for_location(x, y, size):
+    """ Return the (column, row) of the tile containing the point x, y. """
+    return (int(floor(x / size)), int(floor(y / size)))
+
+def tile_bounds(tile, size):
+    """ Return the (left, top, right, bottom) bounds of a tile. The left
+    and top bounds are inclusive, the right and bottom ones exclusive. """
+    col, row = tile
+    return (col * size, row * size, (col + 1) * size, (row + 1) * size)
+
+def tiles_for_view(left, top, right, bottom, size):
+    """ Return the list of tiles that together cover the given bounding box,
+    in row-major order. """
+    first_col, first_row = tile_for_location(left, top, size)
+    last_col = max(first_col, int(ceil(right / size)) - 1)
+    last_row = max(first_row, int(ceil(bottom / size)) - 1)
+    return [(col, row) for row in xrange(first_row, last_row + 1)
+                       for col in xrange(first_col, last_col + 1)]
+
+def section_condition(expression, sections, half, params):
+    """ Return an SQL condition that is true when the z coordinate computed by
+    the SQL expression lies within any of the sections, given as a sequence of
+    z values, and append its parameters to params. A location belongs to a
+    section when it is at most half a section thickness, given as half,
+    below it and less than that above it. Sections of zero thickness only
+    contain their own z. """
+    if half <= 0:
+        params.append(tuple(sections))
+        return '%s IN %%s' % expression
+    conditions = []
+    for z in sections:
+        conditions.append('(%s >= %%s AND %s < %%s)' % (expression, expression))
+        params.extend((z - half, z + half))
+    return '(' + ' OR '.join(conditions) + ')'
+
+def section_case(expression, sections, half, params):
+    """ Return an SQL expression that evaluates to the section, among the
+    given ones, that contains the z coordinate computed by the SQL expression,
+    as matched by section_condition, and append its parameters to params. """
+    cases = []
+    for z in sections:
+        if half <= 0:
+            cases.append('WHEN %s = %%s THEN %%s' % expression)
+            params.extend((z, z))
+        else:
+            cases.append('WHEN %s >= %%s AND %s < %%s THEN %%s' % (expression, expression))
+            params.extend((z - half, z + half, z))
+    return 'CASE ' + ' '.join(cases) + ' END'
+
+def section_of(z, sections, half):
+    """ Return the section among the given ones that contains the z
+    coordinate, as matched by section_condition, or None. """
+    for section in sections:
+        if (section - half <= z < section + half) if half > 0 else z == section:
+            return section
+    return None
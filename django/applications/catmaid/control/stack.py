@@ -1,13 +1,35 @@
+from django.db import connection
 from django.shortcuts import get_object_or_404
 
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.datatable import table_versions
 
 import os, os.path
 from contextlib import closing
 import h5py
 
+# Stack ID vs the version of the broken_slice table and the frozenset of the
+# indices of the broken slices of the stack. The sets are valid as long as the
+# version of the table, which a trigger advances on every change, remains the
+# same, whichever process or way the table was changed by.
+_broken_slices = {}
+
+def get_broken_slices(stack_id):
+    """ Return the frozenset of the indices of the broken slices of the stack.
+    The set is shared by all callers. """
+    stack_id = int(stack_id)
+    cursor = connection.cursor()
+    version = table_versions(cursor, ('broken_slice',))
+    entry = _broken_slices.get(stack_id)
+    if entry is None or version is None or entry[0] != version:
+        entry = (version, frozenset(BrokenSlice.objects.filter(
+                stack=stack_id).values_list('index', flat=True)))
+        if version is not None:
+            _broken_slices[stack_id] = entry
+    return entry[1]
+
 def get_stack_info(project_id=None, stack_id=None, user=None):
     """ Returns a dictionary with relevant information for stacks.
     Depending on the tile_source_type, get information from database
@@ -43,10 +65,7 @@ def get_stack_info(project_id=None, stack_id=None, user=None):
         # convert it back to dictionary str->dict
         return json.loads(read_response)
     else:
-        broken_slices_qs = BrokenSlice.objects.filter(stack=stack_id)
-        broken_slices = {}
-        for ele in broken_slices_qs:
-            broken_slices[ele.index] = 1
+        broken_slices = dict((index, 1) for index in get_broken_slices(stack_id))
         overlays = []
         overlays_qs = Overlay.objects.filter(stack=stack_id)
         for ele in overlays_qs:
@@ -0,0 +1,83 @@
+# Helpers to stream large JSON responses, whose rows are read from the
+# database in chunks through a server-side cursor and encoded incrementally,
+# so that the memory used by a request does not grow with the size of the
+# result.
+#
+# Django's TransactionMiddleware commits the transaction of a request before
+# the content of a streaming response is consumed, so cursors are declared
+# WITH HOLD to outlive it. Such a cursor is declared (and its query checked)
+# when stream_rows is called, within the view, and it is closed once all of
+# its rows have been read.
+#
+# This comes at a cost on the database server: when the transaction commits,
+# PostgreSQL runs the query to completion and materializes its whole result
+# in a temporary store of the backend (in memory up to work_mem, then in
+# temporary files), from which the rows are fetched afterwards. The memory of
+# the web process is bounded, but the first row is only sent once the whole
+# result has been computed, and the result is held on the server until the
+# cursor is closed, or until the connection is, should the client go away.
+# A cursor without HOLD would stream rows as the query produces them, but it
+# would require keeping the transaction of the request open, with its
+# snapshot and locks, for as long as the client takes to read the response.
+# The result sets streamed here are the ones of read-only exports and tables,
+# for which the copy on the server is the lesser evil.
+
+import json
+from itertools import count, islice
+
+from django.db import connection
+from django.http import HttpResponse
+
+_cursor_ids = count()
+
+
+def stream_rows(query, params=None, chunk_size=2000):
+    """ Execute the query with a server-side cursor and return an iterator
+    over its rows, which are fetched chunk_size rows at a time. The result is
+    materialized on the database server when the transaction commits (see
+    above), so this bounds the memory of the web process only. """
+    cursor = connection.cursor()
+    name = 'catmaid_stream_%s' % next(_cursor_ids)
+    cursor.execute('DECLARE ' + name + ' NO SCROLL CURSOR WITH HOLD FOR ' + query, params)
+    return _fetch_rows(cursor, name, chunk_size)
+
+
+def _fetch_rows(cursor, name, chunk_size):
+    try:
+        while True:
+            cursor.execute('FETCH FORWARD %s FROM ' + name, (chunk_size,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        try:
+            cursor.execute('CLOSE ' + name)
+        except Exception:
+            # The connection is gone already, which closes the cursor as well
+            pass
+
+
+def json_array_chunks(items, encode=None, chunk_size=2000):
+    """ Yield the JSON array of the items in strings of up to chunk_size
+    encoded items. Each item is encoded by the encode function, compact JSON
+    by default. """
+    if encode is None:
+        encoder = json.JSONEncoder(separators=(',', ':'))
+        encode = encoder.encode
+    items = iter(items)
+    separator = '['
+    while True:
+        chunk = ','.join(encode(item) for item in islice(items, chunk_size))
+        if not chunk:
+            break
+        yield separator + chunk
+        separator = ','
+    yield '[]' if '[' == separator else ']'
+
+
+def streaming_json_response(chunks, mimetype='text/json'):
+    """ Return a response that writes out the JSON strings yielded by chunks
+    as they are generated. """
+    return HttpResponse(chunks, mimetype=mimetype)
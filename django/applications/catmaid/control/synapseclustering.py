@@ -1,14 +1,11 @@
 from numpy import array, float32
 from numpy.linalg import norm
+import numpy as np
 import networkx as nx
 from sets import Set
 from catmaid.objects import *
 from collections import namedtuple, defaultdict
-
-try:
-    from scipy.sparse.csgraph import dijkstra
-except:
-    pass
+from catmaid.control.tree_util import Arbor
 
 def synapse_clustering( skeleton_id, h_list ):
 
@@ -18,56 +15,31 @@ def synapse_clustering( skeleton_id, h_list ):
     return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
 
 
-def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
-    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list, cutoff=None):
+    """ Gwud: networkx graph were the edges are weighted by length, and undirected,
+        or an Arbor with locations.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+        h_list: the bandwidths, all of which are evaluated in one pass.
+        cutoff: synapses farther than cutoff times the bandwidth from a node
+        do not contribute to its density, which bounds the walk from each
+        synapse (4.0 leaves out contributions below exp(-16)). None, the
+        default, includes all synapses and gives the exact densities.
     """
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
-    
+    nodeList, id2index, indptr, neighbors, weights = adjacency( Gwud )
+    synIndices = np.array(sorted(set(id2index[node] for node in synNodes)), dtype=np.int64)
+    densities = synapseDensity( indptr, neighbors, weights, synIndices, h_list, cutoff )
+
     SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
 
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-    
-        targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:    
-                currNode = startNode
-                allOnPath = []
-                
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-    
-                while True:
-                    allOnPath.append(currNode)
-    
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-                    
-                    for nn in Gwud.neighbors( currNode ): 
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-                    
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-                                                    
-                    if currNode == prevNode:
-                        break
-                            
-                for node in allOnPath:
-                    targLoc[node] = currNode
+    for h, densityField in zip(h_list, densities):
+        # targLoc hosts the final destination nodes of the hill climbing
+        target = climbDensity( indptr, neighbors, densityField )
+        targLoc = {node: nodeList[target[id2index[node]]] for node in synNodes}
 
         uniqueTargs = set(targLoc[node] for node in synNodes)
 
@@ -86,18 +58,102 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
-
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
-
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+def adjacency( G ):
+    """ Given a nx graph, or an Arbor whose edges are weighted by their length,
+    return its list of nodes, the mapping from a node id to
+    its index in that list and the adjacency in compressed sparse row form:
+    the neighbors of the node at index i are neighbors[indptr[i]:indptr[i+1]],
+    at the distances in the same range of weights. """
+    nodeList = G.nodes()
+    id2index = {node: i for i,node in enumerate(nodeList)}
+    if isinstance(G, Arbor):
+        b = np.flatnonzero(G.parent >= 0)
+        a = G.parent[b]
+        if G.locations is None:
+            w = np.ones(len(b))
+        else:
+            d = G.locations[b] - G.locations[a]
+            w = np.sqrt((d * d).sum(axis=1))
+    else:
+        edges = [(id2index[a], id2index[b], d.get('weight', 1.0)) for a, b, d in G.edges_iter(data=True)]
+        a = np.array([e[0] for e in edges], dtype=np.int64)
+        b = np.array([e[1] for e in edges], dtype=np.int64)
+        w = np.array([e[2] for e in edges], dtype=np.float64)
+    # Both directions of every edge, sorted by origin
+    origins = np.concatenate((a, b))
+    order = np.argsort(origins, kind='mergesort')
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(origins, minlength=len(nodeList)))))
+    return nodeList, id2index, indptr, np.concatenate((b, a))[order], np.concatenate((w, w))[order]
+
+def synapseDensity( indptr, neighbors, weights, synIndices, h_list, cutoff, chunk_size=256 ):
+    """ Return an array with one row per bandwidth h and one column per node,
+    holding the sum over synapse nodes of exp(-d^2/h^2), where d is the
+    distance from the synapse node to the node along the tree.
+    The distances are found by walking the tree outwards from chunks of
+    synapse nodes at once, never further than cutoff times the largest
+    bandwidth, so that memory is proportional to the number of nodes rather
+    than to the number of nodes times the number of synapses. """
+    h_list = np.array(h_list, dtype=np.float64)
+    n = len(indptr) - 1
+    density = np.zeros((len(h_list), n))
+    radius = np.inf if cutoff is None else cutoff * h_list.max()
+    degree = np.diff(indptr)
+
+    for start in xrange(0, len(synIndices), chunk_size):
+        # The frontier of the walk: nodes, the node each was reached from and the distance walked
+        node = synIndices[start:start + chunk_size]
+        prev = np.empty(len(node), dtype=np.int64)
+        prev.fill(-1)
+        dist = np.zeros(len(node))
+        while len(node):
+            nodes, inverse = np.unique(node, return_inverse=True)
+            for i, h in enumerate(h_list):
+                contribution = np.exp(-(dist * dist) / (h * h))
+                if cutoff is not None:
+                    contribution[dist > cutoff * h] = 0
+                density[i, nodes] += np.bincount(inverse, weights=contribution)
+            # Step to all neighbors except the one the walk came from,
+            # which is enough to never revisit a node in a tree
+            counts = degree[node]
+            owner = np.repeat(np.arange(len(node)), counts)
+            edge = np.repeat(indptr[node] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            nextNode = neighbors[edge]
+            nextDist = dist[owner] + weights[edge]
+            keep = (nextNode != prev[owner]) & (nextDist <= radius)
+            prev = node[owner][keep]
+            node = nextNode[keep]
+            dist = nextDist[keep]
+
+    return density
+
+def climbDensity( indptr, neighbors, densityField ):
+    """ Return for each node the index of the node reached by hill climbing
+    the densityField from it: moving on to the neighbor of highest density
+    while it is higher than that of the current node. """
+    n = len(densityField)
+    degree = np.diff(indptr)
+    step = np.arange(n)
+    hasNeighbors = degree > 0
+    if not hasNeighbors.any():
+        return step
+    values = densityField[neighbors]
+    owner = np.repeat(np.arange(n), degree)
+    best = np.zeros(n)
+    best[hasNeighbors] = np.maximum.reduceat(values, indptr[:-1][hasNeighbors])
+    # The first neighbor of highest density of each node
+    candidates = np.flatnonzero(values == best[owner])
+    first = candidates[np.concatenate(([True], owner[candidates][1:] != owner[candidates][:-1]))]
+    up = hasNeighbors & (best > densityField)
+    bestNeighbor = step.copy()
+    bestNeighbor[owner[first]] = neighbors[first]
+    step[up] = bestNeighbor[up]
+    # Follow the steps to their end by pointer jumping. Density grows
+    # strictly along steps, so there are no cycles.
+    while True:
+        jump = step[step]
+        if (jump == step).all():
+            return step
+        step = jump
 
 def countTargets( skeleton_id ):
     nTargets = {}
@@ -1,6 +1,4 @@
 import os
-from contextlib import closing
-import h5py
 import json
 import numpy as np
 
@@ -12,10 +10,9 @@ except:
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control import tileserver
 
 def get_tile(request, project_id=None, stack_id=None):
-    import sys
-
     scale = float(request.GET.get('scale', '0'))
     height = int(request.GET.get('height', '0'))
     width = int(request.GET.get('width', '0'))
@@ -30,33 +27,12 @@ def get_tile(request, project_id=None, stack_id=None):
     # need to know the stack name
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
 
-    if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(mimetype="image/png")
-        pilImage.save(response, "PNG")
-        return response
-        # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(mimetype="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(mimetype="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+    #import math
+    #zoomlevel = math.log(int(scale), 2)
+    hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
+    # Missing files and scales are served as black tiles
+    return HttpResponse(tileserver.tile(fpath, hdfpath, x, y, width, height),
+            mimetype="image/png")
 
 def put_tile(request, project_id=None, stack_id=None):
     """ Store labels to HDF5 """
@@ -75,7 +51,7 @@ def put_tile(request, project_id=None, stack_id=None):
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
     #print >> sys.stderr, 'fpath', fpath
 
-    with closing(h5py.File(fpath, 'a')) as hfile:
+    with tileserver.open_hdf5_for_writing(fpath, 'a') as hfile:
         hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
         #print >> sys.stderr, 'storage', x,y,z,height,width,hdfpath
         #print >> sys.stderr, 'image', base64.decodestring(image)
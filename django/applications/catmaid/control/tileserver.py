@@ -0,0 +1,171 @@
+# Serving of image tiles from HDF5 files.
+#
+# Files are kept open in a bounded pool of read-only handles, rather than
+# opened for every tile, and only the hyperslab of a tile is read from its
+# dataset, which for chunked datasets touches only the chunks it overlaps.
+# Encoded tiles are kept in an LRU cache bounded in entries and in bytes,
+# validated against the inode, modification and change times and size of
+# their file, so that a file that is rewritten or replaced, also by another
+# process, is reopened and its tiles are encoded again. Views that write
+# HDF5 files open them with open_hdf5_for_writing, which also closes the
+# pooled handle of the file and drops its tiles in this process, where
+# HDF5 wouldn't open a file for writing that is still open for reading.
+# Tiles outside of files, scales or sections are blank and encoded only once
+# per tile size.
+
+import os
+from contextlib import closing, contextmanager
+from cStringIO import StringIO
+from collections import OrderedDict
+from threading import Lock
+
+import h5py
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    pass
+
+from django.conf import settings
+
+from catmaid.control.cache import LRUCache
+
+
+class HDF5HandlePool(object):
+    """ A thread-safe pool of at most max_size read-only HDF5 file handles,
+    closing the least recently used handle when full. Reads are serialized,
+    as h5py does anyway, so that handles aren't closed while in use. """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._handles = OrderedDict()
+        self._lock = Lock()
+
+    def _handle(self, path, version):
+        entry = self._handles.pop(path, None)
+        if entry and entry[0] != version:
+            entry[1].close()
+            entry = None
+        if entry is None:
+            entry = (version, h5py.File(path, 'r'))
+        self._handles[path] = entry
+        while len(self._handles) > max(1, self.max_size):
+            self._handles.popitem(last=False)[1][1].close()
+        return entry[1]
+
+    def evict(self, path):
+        """ Close the handle of the file at the given path, if any. """
+        with self._lock:
+            entry = self._handles.pop(path, None)
+            if entry:
+                entry[1].close()
+
+    def read(self, path, version, dataset, y, x, height, width):
+        """ Return the array of the rows y to y + height and the columns x to
+        x + width of the dataset of the file at the given version, see
+        file_version, padded with zeros where they exceed the dataset, or None
+        if the file doesn't have the dataset. Further dimensions of the
+        dataset are read in full. """
+        with self._lock:
+            hfile = self._handle(path, version)
+            try:
+                data = hfile[dataset]
+            except KeyError:
+                return None
+            data = data[y:y + height, x:x + width]
+        if data.shape[:2] != (height, width):
+            padded = np.zeros((height, width) + data.shape[2:], dtype=data.dtype)
+            padded[:data.shape[0], :data.shape[1]] = data
+            data = padded
+        return data
+
+
+_handles = HDF5HandlePool(getattr(settings, 'HDF5_HANDLE_POOL_SIZE', 16))
+
+# (path, dataset, x, y, width, height, grayscale) vs (file version, PNG data)
+_tiles = LRUCache(getattr(settings, 'HDF5_TILE_CACHE_SIZE', 0),
+        getattr(settings, 'HDF5_TILE_CACHE_BYTES', 0), lambda entry: len(entry[1]))
+
+# Path vs the number of times the file was opened for writing by this
+# process, which is part of the versions of its tiles
+_writes = {}
+
+# (width, height) vs PNG data of a blank tile
+_blank_tiles = LRUCache(64)
+
+
+def file_version(path):
+    """ Return the inode, modification time, change time and size of the
+    file, or None if it doesn't exist. """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime, stat.st_ctime, stat.st_size)
+
+
+def evict_hdf5_file(path):
+    """ Close the pooled handle of the HDF5 file at the given path and drop
+    its cached tiles. """
+    _writes[path] = _writes.get(path, 0) + 1
+    _handles.evict(path)
+
+
+@contextmanager
+def open_hdf5_for_writing(path, mode='a'):
+    """ Open the HDF5 file at the given path in the given h5py mode for the
+    duration of the with block, evicting it from the pool and the tile cache
+    before and after. """
+    evict_hdf5_file(path)
+    try:
+        with closing(h5py.File(path, mode)) as hfile:
+            yield hfile
+    finally:
+        evict_hdf5_file(path)
+
+
+def _encode(image):
+    buf = StringIO()
+    image.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def _grayscale_image(data, width, height):
+    return Image.frombuffer('RGBA', (width, height), data, 'raw', 'L', 0, 1)
+
+
+def blank_tile(width, height):
+    """ Return the PNG data of a black tile of the given size. """
+    key = (width, height)
+    png = _blank_tiles.get(key)
+    if png is None:
+        png = _encode(_grayscale_image(np.zeros((height, width), dtype=np.uint8),
+                width, height))
+        _blank_tiles.set(key, png)
+    return png
+
+
+def tile(path, dataset, x, y, width, height, grayscale=True):
+    """ Return the PNG data of the tile of the given size at x, y of the
+    dataset of the HDF5 file, or that of a blank tile if the file or the
+    dataset doesn't exist. Grayscale datasets are two-dimensional, others
+    have a third dimension of color channels. """
+    version = file_version(path)
+    if version is None:
+        return blank_tile(width, height)
+    version += (_writes.get(path, 0),)
+    key = (path, dataset, x, y, width, height, grayscale)
+    entry = _tiles.get(key)
+    if entry and entry[0] == version:
+        return entry[1]
+    data = _handles.read(path, version, dataset, y, x, height, width)
+    if data is None:
+        return blank_tile(width, height)
+    if grayscale:
+        image = _grayscale_image(np.ascontiguousarray(data, dtype=np.uint8), width, height)
+    else:
+        image = Image.fromarray(np.ascontiguousarray(data))
+    png = _encode(image)
+    _tiles.set(key, (version, png))
+    return png
@@ -0,0 +1,82 @@
+# Walks along the arbor of a skeleton from one of its treenodes: down to the
+# next branch or end node, up to the previous branch node or up to the root.
+#
+# Walks run in the database as recursive queries, which follow the parent_id
+# index one node at a time. They only touch the nodes along the path and those
+# next to it, rather than loading the whole skeleton, and always see its
+# current state, so nothing has to be invalidated on edits. Updates of the
+# nodes along a path are a single statement.
+
+# The treenode and every node below it for as long as the node above has
+# exactly one child, which includes the next branch or end node.
+DOWN_TO_BRANCH = 'down_to_branch'
+# The treenode and every node above it that has exactly one child, up to but
+# excluding the previous branch node.
+UP_TO_BRANCH = 'up_to_branch'
+# The treenode and every node above it, up to and including the root.
+UP_TO_ROOT = 'up_to_root'
+
+_steps = {
+    DOWN_TO_BRANCH: '''
+        SELECT t.id, t.parent_id, p.depth + 1
+        FROM path p,
+             treenode t
+        WHERE t.parent_id = p.id
+          AND 1 = (SELECT count(*) FROM treenode c WHERE c.parent_id = p.id)
+    ''',
+    UP_TO_BRANCH: '''
+        SELECT t.id, t.parent_id, p.depth + 1
+        FROM path p,
+             treenode t
+        WHERE t.id = p.parent_id
+          AND 1 = (SELECT count(*) FROM treenode c WHERE c.parent_id = t.id)
+    ''',
+    UP_TO_ROOT: '''
+        SELECT t.id, t.parent_id, p.depth + 1
+        FROM path p,
+             treenode t
+        WHERE t.id = p.parent_id
+    ''',
+}
+
+
+def _path(kind):
+    """ The recursive WITH clause that defines the table path (id, parent_id,
+    depth) of the nodes of the walk of the given kind, from the treenode
+    whose ID is its only parameter at depth 0. """
+    step = _steps.get(kind)
+    if step is None:
+        raise ValueError('Unknown kind of path: %s' % kind)
+    return '''
+    WITH RECURSIVE path (id, parent_id, depth) AS (
+        SELECT id, parent_id, 0
+        FROM treenode
+        WHERE id = %s
+      UNION ALL
+    ''' + step + '''
+    )
+    '''
+
+
+def path_nodes(cursor, treenode_id, kind):
+    """ Return the list of IDs of the treenodes along the walk of the given
+    kind, starting with the treenode. """
+    cursor.execute(_path(kind) + '''
+    SELECT id FROM path ORDER BY depth
+    ''', (int(treenode_id),))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def update_path(cursor, treenode_id, kind, values):
+    """ Set the columns of the treenodes along the walk of the given kind to
+    the values of the given dictionary of column name vs value, and return
+    the list of IDs of the updated treenodes. Column names are not escaped. """
+    columns = sorted(values)
+    cursor.execute(_path(kind) + '''
+    UPDATE treenode t
+    SET ''' + ', '.join('%s = %%s' % column for column in columns) + '''
+    FROM path p
+    WHERE t.id = p.id
+    RETURNING t.id
+    ''', [int(treenode_id)] + [values[column] for column in columns])
+    return [row[0] for row in cursor.fetchall()]
@@ -16,6 +16,7 @@ from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
 from catmaid.control.tracing import check_tracing_setup_detailed
+from catmaid.control.nodecache import invalidate_skeleton_tiles
 
 from collections import defaultdict
 from functools import partial
@@ -40,7 +41,22 @@ def instance_operation(request, project_id=None):
     instance_operation.res_on_err = ''
 
     def remove_skeletons(skeleton_id_list):
+        # The summaries of the skeletons are deleted along with them, so the
+        # triggers needn't update them for every deleted row.
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT set_config('catmaid.defer_skeleton_summary', 'on', true)
+        ''')
+        try:
+            _remove_skeletons(skeleton_id_list)
+        finally:
+            cursor.execute('''
+            SELECT set_config('catmaid.defer_skeleton_summary', 'off', true)
+            ''')
+
+    def _remove_skeletons(skeleton_id_list):
         if request.user.is_superuser:
+            invalidate_skeleton_tiles(project_id, skeleton_id_list)
             instance_operation.res_on_err = 'Failed to delete in treenode for skeletons #%s' % skeleton_id_list
             # TODO this failed at least once, whereas direct deletion of a single skeleton by skeleton_id on the treenode table succeeded. Inspect!
             Treenode.objects.filter(
@@ -64,6 +80,7 @@ def instance_operation(request, project_id=None):
                 ''', [skid])
                 rows = tuple(row for row in cursor.fetchall())
                 if 1 == len(rows) and rows[0][0] == request.user.id:
+                    invalidate_skeleton_tiles(project_id, (skid,))
                     instance_operation.res_on_err = 'Failed to delete in treenode for skeletons #%s' % skeleton_id_list
                     Treenode.objects.filter(
                             project=project_id,
@@ -1,23 +1,339 @@
-# A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# A 'tree' is a networkx.DiGraph with a single root node (a node without parents),
+# or an Arbor, which all functions below accept as well.
 
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
 from math import sqrt
-from itertools import izip, islice, imap
-from catmaid.models import Treenode
-from catmaid.fields import Double3D
+from itertools import izip, groupby
+import numpy as np
+from catmaid.control.streaming import stream_rows
+
+
+class Arbor(object):
+    """ A tree stored in arrays: the IDs of its nodes, the index of the parent
+    of each node (-1 for the root) and, optionally, an N x 3 array with the
+    location of each node. Its methods are vectorized versions of the tree
+    functions of this module, which dispatch to them when given an Arbor. """
+
+    def __init__(self, ids, parent_ids, locations=None, properties=None):
+        """ ids: the node IDs.
+        parent_ids: the ID of the parent of each node, None for the root, or
+        an array with -1 for the root.
+        locations: optional sequence of the (x, y, z) of each node.
+        properties: optional dictionary of property name vs an array with the
+        value of that property for each node. """
+        self.ids = np.array(ids, dtype=np.int64)
+        self._sorter = np.argsort(self.ids, kind='mergesort')
+        self._sorted = self.ids[self._sorter]
+        if isinstance(parent_ids, np.ndarray):
+            # The root is marked with a parent ID of -1
+            parent_ids = parent_ids.astype(np.int64)
+        else:
+            parent_ids = np.array([-1 if p is None else p for p in parent_ids], dtype=np.int64)
+        self.parent = np.empty(len(self.ids), dtype=np.int64)
+        self.parent.fill(-1)
+        has_parent = parent_ids != -1
+        self.parent[has_parent] = self._index(parent_ids[has_parent])
+        self.locations = None if locations is None else np.array(locations, dtype=np.float64)
+        self.properties = {} if properties is None else \
+                {k: np.asarray(v) for k, v in properties.iteritems()}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Create an Arbor from rows of (id, parent_id) or of
+        (id, parent_id, x, y, z). """
+        rows = list(rows)
+        locations = [row[2:5] for row in rows] if rows and len(rows[0]) > 2 else None
+        return cls([row[0] for row in rows], [row[1] for row in rows], locations)
+
+    def _derive(self, mask, parent):
+        """ Return a new Arbor with the nodes selected by the boolean mask,
+        given the index of the parent of every node in this Arbor. """
+        new_index = np.cumsum(mask) - 1
+        parent = parent[mask]
+        return self._take(np.flatnonzero(mask),
+                np.where(parent >= 0, new_index[parent], -1))
+
+    def _take(self, indices, parent):
+        """ Return a new Arbor with the nodes at the given indices, given the
+        index of the parent of each of them in the new Arbor. """
+        arbor = object.__new__(Arbor)
+        arbor.ids = self.ids[indices]
+        arbor._sorter = np.argsort(arbor.ids, kind='mergesort')
+        arbor._sorted = arbor.ids[arbor._sorter]
+        arbor.parent = parent
+        arbor.locations = None if self.locations is None else self.locations[indices]
+        arbor.properties = {k: v[indices] for k, v in self.properties.iteritems()}
+        return arbor
+
+    def copy(self):
+        """ Return a copy that can be rerooted independently. """
+        return self._derive(np.ones(len(self.ids), dtype=bool), self.parent)
+
+    def _index(self, node_ids):
+        pos = np.searchsorted(self._sorted, node_ids)
+        pos[pos == len(self._sorted)] = 0
+        missing = self._sorted[pos] != node_ids if len(self._sorted) else np.ones(len(pos), dtype=bool)
+        if missing.any():
+            raise KeyError(np.asarray(node_ids)[missing][0])
+        return self._sorter[pos]
+
+    def index(self, node_ids):
+        """ Return the array indices of the given node IDs. """
+        return self._index(np.array(list(node_ids), dtype=np.int64))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __contains__(self, node_id):
+        i = np.searchsorted(self._sorted, node_id)
+        return i < len(self._sorted) and self._sorted[i] == node_id
+
+    def nodes(self):
+        return self.ids.tolist()
+
+    def number_of_nodes(self):
+        return len(self.ids)
+
+    def edges_iter(self):
+        """ Iterate pairs of (parent ID, child ID). """
+        child = np.flatnonzero(self.parent >= 0)
+        return izip(self.ids[self.parent[child]].tolist(), self.ids[child].tolist())
+
+    @property
+    def root(self):
+        roots = np.flatnonzero(self.parent < 0)
+        return int(self.ids[roots[0]]) if len(roots) else None
+
+    def n_children(self):
+        """ Return the number of children of each node. """
+        return np.bincount(self.parent[self.parent >= 0], minlength=len(self.ids))
+
+    def end_nodes(self):
+        """ Return the IDs of the nodes without children. """
+        return self.ids[self.n_children() == 0]
+
+    def branch_nodes(self):
+        """ Return the IDs of the nodes with more than one child. """
+        return self.ids[self.n_children() > 1]
+
+    def _path_sums(self, values):
+        """ Return for each node the sum of the values of the node and of all
+        the nodes above it, computed by pointer jumping in O(n log(depth)). """
+        sums = np.array(values)
+        jump = self.parent.copy()
+        active = np.flatnonzero(jump >= 0)
+        while len(active):
+            j = jump[active]
+            sums[active] += sums[j]
+            jump[active] = jump[j]
+            active = active[jump[active] >= 0]
+        return sums
+
+    def depths(self):
+        """ Return the number of edges from each node to the root. """
+        return self._path_sums((self.parent >= 0).astype(np.int64))
+
+    def _subtree_sums(self, weights):
+        """ Return for each node the sum of the weights of its subtree,
+        computed by pointer jumping in O(n log(depth)): after k steps, sums
+        holds the weights of the nodes less than 2^k edges below each node,
+        and jump the node 2^k edges above it. """
+        sums = np.array(weights, dtype=np.float64)
+        jump = self.parent.copy()
+        active = np.flatnonzero(jump >= 0)
+        while len(active):
+            sums = sums + np.bincount(jump[active], weights=sums[active],
+                    minlength=len(sums))
+            jump[active] = jump[jump[active]]
+            active = active[jump[active] >= 0]
+        return sums
+
+    def _preorder(self):
+        """ Return the position of each node in a depth-first preorder, in
+        which the subtree of every node follows it, and the number of nodes in
+        the subtree of each node. """
+        size = self._subtree_sums(np.ones(len(self.ids))).astype(np.int64)
+        # Each node follows its parent and the subtrees of its earlier siblings
+        child = np.flatnonzero(self.parent >= 0)
+        child = child[np.argsort(self.parent[child], kind='mergesort')]
+        before = np.cumsum(size[child]) - size[child]
+        first = np.ones(len(child), dtype=bool)
+        first[1:] = self.parent[child[1:]] != self.parent[child[:-1]]
+        offset = np.zeros(len(self.ids), dtype=np.int64)
+        offset[child] = 1 + before - before[first][np.cumsum(first) - 1]
+        return self._path_sums(offset), size
+
+    def edge_count_to_root(self):
+        """ Return a map of node ID vs number of edges to the root plus one,
+        like the edge_count_to_root function. """
+        return dict(izip(self.ids.tolist(), (self.depths() + 1).tolist()))
+
+    def reroot(self, new_root):
+        """ Reverse in place the direction of the edges from the new_root to root. """
+        i = int(self.index((new_root,))[0])
+        path = [i]
+        parent = self.parent.tolist()
+        p = parent[i]
+        while p != -1:
+            path.append(p)
+            p = parent[p]
+        path = np.array(path, dtype=np.int64)
+        self.parent[path[1:]] = path[:-1]
+        self.parent[i] = -1
+
+    def find_common_ancestor(self, nodes, preorder=None):
+        """ Return a tuple with the node that is the nearest common ancestor to
+        all nodes, and its edge count to root as in edge_count_to_root. """
+        if 1 == len(nodes):
+            return nodes[0], 0
+        pre, size = self._preorder() if preorder is None else preorder
+        positions = pre[self.index(nodes)]
+        # The common ancestors are the nodes whose subtree spans the positions
+        # of all nodes, which make up the path from the root to the nearest.
+        common = np.flatnonzero((pre <= positions.min()) & (pre + size > positions.max()))
+        nearest = common[np.argmax(pre[common])]
+        return int(self.ids[nearest]), len(common)
+
+    def find_common_ancestors(self, node_groups):
+        preorder = self._preorder()
+        return (self.find_common_ancestor(nodes, preorder=preorder) for nodes in node_groups)
+
+    def partition(self):
+        """ Generate the same sequences as the partition function. """
+        depths = self.depths()
+        ends = np.flatnonzero(self.n_children() == 0)
+        ends = ends[np.argsort(-depths[ends], kind='mergesort')]
+        ids = self.ids.tolist()
+        parent = self.parent.tolist()
+        seen = [False] * len(ids)
+        for i in ends.tolist():
+            sequence = [ids[i]]
+            p = parent[i]
+            while p != -1:
+                sequence.append(ids[p])
+                if seen[p]:
+                    break
+                seen[p] = True
+                p = parent[p]
+            if len(sequence) > 1:
+                yield sequence
+
+    def _spanning(self, node_ids):
+        """ Return a copy rerooted at the first of node_ids, the indices of
+        node_ids in it and a mask of the nodes on the paths among them. """
+        node_ids = list(node_ids)
+        arbor = self.copy()
+        arbor.reroot(node_ids[0])
+        indices = arbor.index(node_ids)
+        weights = np.zeros(len(arbor.ids))
+        weights[indices] = 1
+        return arbor, indices, arbor._subtree_sums(weights) > 0
+
+    def spanning_tree(self, preserve):
+        """ Return a new Arbor with the nodes on the paths among the nodes to
+        preserve, rooted at one of them. """
+        arbor, indices, on_path = self._spanning(set(preserve))
+        return arbor._derive(on_path, arbor.parent)
+
+    def simplify(self, keepers):
+        """ Return a new Arbor with only the keepers and the branch nodes among
+        them, rooted at one of the keepers. Unlike the simplify function,
+        this Arbor is left untouched. """
+        arbor, indices, on_path = self._spanning(set(keepers))
+        parent = arbor.parent
+        n_on_path_children = np.bincount(parent[on_path & (parent >= 0)], minlength=len(parent))
+        kept = n_on_path_children > 1
+        kept[indices] = True
+        # For each node, the nearest node at or above it that is kept
+        up = np.where(kept, np.arange(len(parent)), parent)
+        while True:
+            valid = np.flatnonzero(up >= 0)
+            pending = valid[~kept[up[valid]]]
+            if not len(pending):
+                break
+            up[pending] = up[up[pending]]
+        mini_parent = np.where(parent >= 0, up[parent], -1)
+        return arbor._derive(kept, mini_parent)
+
+    def split(self, cut):
+        """ Return the list of Arbors that the tree falls apart into when the
+        edges from the nodes selected by the boolean mask cut to their parents
+        are removed, the largest first, like the weakly connected components
+        of a DiGraph. The Arbor itself is returned when no edge is cut. """
+        n = len(self.ids)
+        if not (cut & (self.parent >= 0)).any():
+            return [self]
+        parent = np.where(cut, -1, self.parent)
+        # The root of the part of each node, found by pointer jumping
+        root = np.where(parent >= 0, parent, np.arange(n))
+        while True:
+            jump = root[root]
+            if (jump == root).all():
+                break
+            root = jump
+        roots, label = np.unique(root, return_inverse=True)
+        sizes = np.bincount(label)
+        # The nodes of each part, in their order in this Arbor
+        members = np.argsort(label, kind='mergesort')
+        starts = np.cumsum(sizes) - sizes
+        rank = np.empty(n, dtype=np.int64)
+        rank[members] = np.arange(n) - starts[label[members]]
+        arbors = []
+        for k in np.lexsort((roots, -sizes)).tolist():
+            indices = members[starts[k]:starts[k] + sizes[k]]
+            p = parent[indices]
+            arbors.append(self._take(indices, np.where(p >= 0, rank[p], -1)))
+        return arbors
+
+    def select(self, node_ids):
+        """ Return a new Arbor with only the given nodes, and without edges
+        among them. """
+        indices = np.unique(self.index(set(node_ids)))
+        parent = np.empty(len(indices), dtype=np.int64)
+        parent.fill(-1)
+        return self._take(indices, parent)
+
+    def cable_length(self, locations=None):
+        """ Return the total cable length, using the locations of the Arbor
+        unless a dictionary of node ID vs location is given. """
+        if locations is None:
+            locations = self.locations
+        else:
+            locations = np.array([tuple(locations[node]) for node in self.ids.tolist()], dtype=np.float64)
+        child = np.flatnonzero(self.parent >= 0)
+        if not len(child):
+            return 0.0
+        deltas = locations[child] - locations[self.parent[child]]
+        return float(np.sqrt((deltas * deltas).sum(axis=1)).sum())
+
 
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
     Will be the root node in directed graphs.
     Avoids one database lookup. """
+    if isinstance(tree, Arbor):
+        return tree.root
     for node in tree:
         if not next(tree.predecessors_iter(node), None):
             return node
 
+def _rooted(arbor, root_node):
+    """ Return the Arbor, or a copy of it rerooted at root_node if given. """
+    if root_node is None or root_node == arbor.root:
+        return arbor
+    arbor = arbor.copy()
+    arbor.reroot(root_node)
+    return arbor
+
 def edge_count_to_root(tree, root_node=None):
     """ Return a map of nodeID vs number of edges from the first node that lacks predecessors (aka the root). If root_id is None, it will be searched for."""
+    if isinstance(tree, Arbor):
+        return _rooted(tree, root_node).edge_count_to_root()
     distances = {}
     count = 1
     current_level = [root_node if root_node else find_root(tree)]
@@ -38,11 +354,13 @@ def find_common_ancestor(tree, nodes, ds=None, root_node=None):
     Assumes that nodes contains at least 1 node.
     Assumes that all nodes are present in tree.
     Returns a tuple with the ancestor node and its distance to root. """
+    if isinstance(tree, Arbor):
+        return _rooted(tree, root_node).find_common_ancestor(nodes)
     if 1 == len(nodes):
         return nodes[0], 0
     distances = ds if ds else edge_count_to_root(tree, root_node=root_node)
     # Pick the pair with the shortest edge count to root
-    first, second = sorted({node: distances(node) for node in nodes}.iteritems(), key=itemgetter(1))[:2]
+    first, second = sorted({node: distances[node] for node in nodes}.iteritems(), key=itemgetter(1))[:2]
     # Start from the second, and bring it to an edge count equal to the first
     while second[1] < first[1]:
         second = (tree.predecessors_iter(second[0]).next(), second[1] - 1)
@@ -55,11 +373,15 @@ def find_common_ancestor(tree, nodes, ds=None, root_node=None):
     return first, distances[first]
 
 def find_common_ancestors(tree, node_groups):
+    if isinstance(tree, Arbor):
+        return tree.find_common_ancestors(node_groups)
     distances = edge_count_to_root(tree)
     return (find_common_ancestor(tree, nodes, ds=distances) for nodes in node_groups)
 
 def reroot(tree, new_root):
     """ Reverse in place the direction of the edges from the new_root to root. """
+    if isinstance(tree, Arbor):
+        return tree.reroot(new_root)
     parent = next(tree.predecessors_iter(new_root), None)
     if not parent:
         # new_root is already the root
@@ -75,7 +397,10 @@ def simplify(tree, keepers):
     """ Given a tree and a set of nodes to keep, create a new tree
     where only the nodes to keep and the branch points between them are preserved.
     WARNING: will reroot the tree at the first of the keepers.
-    WARNING: keepers can't be empty. """
+    WARNING: keepers can't be empty.
+    Given an Arbor, returns a new Arbor and leaves the original untouched. """
+    if isinstance(tree, Arbor):
+        return tree.simplify(keepers)
     # Ensure no repeats
     keepers = set(keepers)
     # Add all keeper nodes to the minified graph
@@ -126,6 +451,10 @@ def partition(tree, root_node=None):
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
     Each sequence runs from an end node to either the root or a branch node. """
+    if isinstance(tree, Arbor):
+        for sequence in tree.partition():
+            yield sequence
+        return
     distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
     seen = set()
     # Iterate end nodes sorted from highest to lowest distance to root
@@ -146,7 +475,10 @@ def partition(tree, root_node=None):
 
 def spanning_tree(tree, preserve):
     """ Return a new DiGraph with the spanning tree including the desired nodes.
-    preserve: the set of nodes that delimit the spanning tree. """
+    preserve: the set of nodes that delimit the spanning tree.
+    Given an Arbor, returns a new Arbor. """
+    if isinstance(tree, Arbor):
+        return tree.spanning_tree(preserve)
     spanning = DiGraph()
     preserve = set(preserve) # duplicate, will be altered
     if 1 == len(preserve):
@@ -187,45 +519,50 @@ def spanning_tree(tree, preserve):
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
+    if isinstance(tree, Arbor):
+        return tree.cable_length(locations)
     return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
 
 
+# Columns of the treenode table that lazy_load_trees can load, other than the
+# location: name vs SQL expression and array type. Timestamps are loaded as
+# seconds since the epoch, and missing values as NaN or -1.
+_TREENODE_COLUMNS = {
+    'creation_time': ('EXTRACT(EPOCH FROM creation_time)', np.float64),
+    'edition_time': ('EXTRACT(EPOCH FROM edition_time)', np.float64),
+    'review_time': ('EXTRACT(EPOCH FROM review_time)', np.float64),
+    'radius': ('radius', np.float64),
+    'confidence': ('COALESCE(confidence, -1)', np.int64),
+    'user_id': ('COALESCE(user_id, -1)', np.int64),
+    'editor_id': ('COALESCE(editor_id, -1)', np.int64),
+    'reviewer_id': ('COALESCE(reviewer_id, -1)', np.int64),
+}
+
 def lazy_load_trees(skeleton_ids, node_properties):
-    """ Return a lazy collection of pairs of (long, DiGraph)
-    representing (skeleton_id, tree).
-    The node_properties is a list of strings, each being a name of a column
-    in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
-
-    values_list = ('id', 'parent_id', 'skeleton_id')
-    props = tuple(set(node_properties) - set(values_list))
-    values_list += props
-
-    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
-            .order_by('skeleton') \
-            .values_list(*values_list)
-    skid = None
-    tree = None
-    for t in ts:
-        if t[2] != skid:
-            if tree:
-                yield (skid, tree)
-            # Prepare for the next one
-            skid = t[2]
-            tree = DiGraph()
-
-        props = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-
-        # Hack: why doesn't django parse well the location?
-        loc = props.get('location')
-        if loc:
-            props['location'] = Double3D(*(imap(float, loc[1:-1].split(','))))
-        tree.add_node(t[0], props)
-
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
-
-    if tree:
-        yield (skid, tree)
+    """ Return a lazy collection of pairs of (long, Arbor)
+    representing (skeleton_id, tree), read through a single server-side
+    cursor. The node_properties is a list of strings, each being a name of
+    a column of the Treenode table in _TREENODE_COLUMNS or 'location'. The
+    locations are loaded into the locations of each Arbor, and every other
+    column into an array of its properties. """
+
+    props = [p for p in node_properties if 'location' != p]
+    columns = [_TREENODE_COLUMNS[p] for p in props]
+    with_location = 'location' in node_properties
+
+    rows = stream_rows('''
+    SELECT skeleton_id, id, COALESCE(parent_id, -1),
+           (location).x, (location).y, (location).z%s
+    FROM treenode
+    WHERE skeleton_id IN %%s
+    ORDER BY skeleton_id
+    ''' % ''.join(', ' + expression for expression, _ in columns),
+        (tuple(int(skid) for skid in skeleton_ids),))
 
+    for skid, group in groupby(rows, itemgetter(0)):
+        values = zip(*group)
+        properties = {p: np.array(values[6 + i], dtype=dtype)
+                      for i, (p, (_, dtype)) in enumerate(izip(props, columns))}
+        locations = np.array(values[3:6], dtype=np.float64).T if with_location else None
+        yield (skid, Arbor(values[1], np.array(values[2], dtype=np.int64),
+                           locations, properties))
@@ -13,6 +13,11 @@ from catmaid.fields import Double3D
 from catmaid.control.authentication import *
 from catmaid.control.common import *
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control.nodecache import invalidate_treenode_tiles, \
+        invalidate_skeleton_tiles
+from catmaid.control.stack import get_broken_slices
+from catmaid.control.topology import DOWN_TO_BRANCH, UP_TO_BRANCH, \
+        UP_TO_ROOT, update_path
 import sys
 import math
 
@@ -87,6 +92,7 @@ def create_treenode(request, project_id=None):
         if parent_id:
             new_treenode.parent_id = parent_id
         new_treenode.save()
+        invalidate_treenode_tiles(project_id, (new_treenode.id,))
         return new_treenode
 
     def relate_neuron_to_skeleton(neuron, skeleton):
@@ -222,32 +228,45 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
         dy = (params['y'] - parent_y) / steps
         dz = (params['z'] - parent_z) / steps
 
-        broken_slices = set(int(bs.index) for bs in BrokenSlice.objects.filter(stack=params['stack_id']))
+        broken_slices = get_broken_slices(params['stack_id'])
         sign = -1 if dz < 0 else 1
 
-        # Loop the creation of treenodes in z resolution steps until target
-        # section is reached
-        parent_id = params['parent_id']
+        # The positions of the treenodes, in z resolution steps until the
+        # target section is reached
         atn_slice_index = ((parent_z - params['stack_translation_z']) / params['resz']).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_FLOOR)
-        for i in range(1, steps + (0 if skip_last else 1)):
-            if (atn_slice_index + i * sign) in broken_slices:
-                continue
-            response_on_error = 'Error while trying to insert treenode.'
-            new_treenode = Treenode()
-            new_treenode.user_id = request.user.id
-            new_treenode.editor_id = request.user.id
-            new_treenode.project_id = project_id
-            new_treenode.location = Double3D(
-                    float(parent_x + dx * i),
-                    float(parent_y + dy * i),
-                    float(parent_z + dz * i))
-            new_treenode.radius = params['radius']
-            new_treenode.skeleton_id = parent_skeleton_id
-            new_treenode.confidence = params['confidence']
-            new_treenode.parent_id = parent_id  # This is not a root node.
-            new_treenode.save()
-
-            parent_id = new_treenode.id
+        positions = [(i, float(parent_x + dx * i), float(parent_y + dy * i),
+                float(parent_z + dz * i))
+                for i in range(1, steps + (0 if skip_last else 1))
+                if (atn_slice_index + i * sign) not in broken_slices]
+
+        parent_id = params['parent_id']
+        new_treenode_ids = []
+        if positions:
+            # Insert all treenodes at once, each with the one before it, or
+            # the parent for the first, as its parent
+            response_on_error = 'Error while trying to insert treenodes.'
+            cursor = connection.cursor()
+            cursor.execute('''
+            INSERT INTO treenode (id, user_id, editor_id, project_id, location,
+                    radius, skeleton_id, confidence, parent_id)
+            SELECT n.id, %s, %s, %s, ROW(n.x, n.y, n.z)::double3d, %s, %s, %s,
+                   lag(n.id, 1, %s::bigint) OVER (ORDER BY n.i)
+            FROM (SELECT nextval('concept_id_seq') AS id, v.i,
+                         v.x::double precision AS x,
+                         v.y::double precision AS y,
+                         v.z::double precision AS z
+                  FROM (VALUES ''' + ', '.join(['(%s, %s, %s, %s)'] * len(positions)) + ''')
+                       v (i, x, y, z)) n
+            RETURNING parent_id, id
+            ''', [request.user.id, request.user.id, int(project_id),
+                    params['radius'], parent_skeleton_id, params['confidence'],
+                    parent_id] + [v for position in positions for v in position])
+            children = dict(cursor.fetchall())
+            while parent_id in children:
+                parent_id = children[parent_id]
+                new_treenode_ids.append(parent_id)
+
+        invalidate_treenode_tiles(project_id, new_treenode_ids)
 
         # parent_id contains the ID of the last added node
         return parent_id, parent_skeleton_id
@@ -279,6 +298,7 @@ def update_treenode_table(request, project_id=None):
         setattr(treenode, property_name, property_value)
         treenode.editor = request.user
         treenode.save()
+        invalidate_treenode_tiles(project_id, (treenode_id,))
 
         return HttpResponse(json.dumps({'success': 'Updated %s of treenode %s to %s.' % (property_name, treenode_id, property_value)}))
 
@@ -297,61 +317,23 @@ def update_radius(request, project_id=None, treenode_id=None):
     if 0 == option:
         # Update radius only for the treenode
         Treenode.objects.filter(pk=treenode_id).update(editor=request.user, radius=radius)
+        invalidate_treenode_tiles(project_id, (treenode_id,))
         return HttpResponse(json.dumps({'success': True}))
     
-    cursor.execute('''
-    SELECT id, parent_id FROM treenode WHERE skeleton_id = (SELECT t.skeleton_id FROM treenode t WHERE id = %s)
-    ''' % treenode_id)
-
-    if 1 == option:
-        # Update radius from treenode_id to the next branch or end node (included)
-        children = defaultdict(list)
-        for row in cursor.fetchall():
-            children[row[1]].append(row[0])
-
-        include = [treenode_id]
-        c = children[treenode_id]
-        while 1 == len(c):
-            child = c[0]
-            include.append(child)
-            c = children[child]
-
-        Treenode.objects.filter(pk__in=include).update(editor=request.user, radius=radius)
-        return HttpResponse(json.dumps({'success': True}))
-    
-    if 2 == option:
-        # Update radius from treenode_id to the previous branch node or root (excluded)
-        parents = {}
-        children = defaultdict(list)
-        for row in cursor.fetchall():
-            parents[row[0]] = row[1]
-            children[row[1]].append(row[0])
-
-        include = [treenode_id]
-        parent = parents[treenode_id]
-        while parent and 1 == len(children[parent]):
-            include.append(parent)
-            parent = parents[parent]
-
-        Treenode.objects.filter(pk__in=include).update(editor=request.user, radius=radius)
-        return HttpResponse(json.dumps({'success': True}))
-
-    if 3 == option:
-        # Update radius from treenode_id to root (included)
-        parents = {row[0]: row[1] for row in cursor.fetchall()}
-
-        include = [treenode_id]
-        parent = parents[treenode_id]
-        while parent:
-            include.append(parent)
-            parent = parents[parent]
-
-        Treenode.objects.filter(pk__in=include).update(editor=request.user, radius=radius)
+    # Update radius from treenode_id to the next branch or end node (included),
+    # to the previous branch node or root (excluded) or to root (included)
+    kind = {1: DOWN_TO_BRANCH, 2: UP_TO_BRANCH, 3: UP_TO_ROOT}.get(option)
+    if kind:
+        include = update_path(cursor, treenode_id, kind,
+                {'editor_id': request.user.id, 'radius': radius})
+        invalidate_treenode_tiles(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 4 == option:
         # Update radius of all nodes (in a single query)
-        Treenode.objects.filter(skeleton_id=Treenode.objects.filter(pk=treenode_id).values('skeleton_id')).update(editor=request.user, radius=radius)
+        skeleton_id = Treenode.objects.filter(pk=treenode_id).values_list('skeleton_id', flat=True)[0]
+        Treenode.objects.filter(skeleton_id=skeleton_id).update(editor=request.user, radius=radius)
+        invalidate_skeleton_tiles(project_id, (skeleton_id,))
         return HttpResponse(json.dumps({'success': True}))
 
 
@@ -371,6 +353,9 @@ def delete_treenode(request, project_id=None):
     response_on_error = ''
     try:
         cursor = connection.cursor()
+        # The treenode, its parent and children are about to change
+        response_on_error = 'Could not invalidate the cached nodes of treenode #%s' % treenode_id
+        invalidate_treenode_tiles(project_id, (treenode_id,))
         if not parent_id:
             # This treenode is root.
             response_on_error = 'Could not retrieve children for treenode #%s' % treenode_id
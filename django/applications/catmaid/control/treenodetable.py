@@ -2,13 +2,18 @@ import json
 import math
 from string import upper
 
+from django.db import connection
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
-from django.db.models import Count
 
 from catmaid.models import *
 from catmaid.control.authentication import *
 from catmaid.control.common import *
+from catmaid.control.streaming import json_array_chunks, streaming_json_response
+from catmaid.control.datatable import sort_columns, table_versions, \
+        count_rows, page_rows
+from catmaid.control.nodecache import invalidate_treenode_tiles
+from catmaid.control.labelindex import name_condition
 
 
 @requires_user_role(UserRole.Annotate)
@@ -43,6 +48,7 @@ def update_treenode_table(request, project_id=None):
         setattr(treenode, property_name, property_value)
         treenode.user = request.user
         treenode.save()
+        invalidate_treenode_tiles(project_id, (treenode_id,))
 
         # return HttpResponse(json.dumps({'success': 'Updated %s of treenode %s to %s.' % (property_name, treenode_id, property_value)}))
         return HttpResponse(property_value)
@@ -55,9 +61,8 @@ def update_treenode_table(request, project_id=None):
 def list_treenode_table(request, project_id=None):
     stack_id = request.POST.get('stack_id', None)
     specified_skeleton_count = request.POST.get('skeleton_nr', 0)
-    display_start = request.POST.get('iDisplayStart', 0)
-    display_length = request.POST.get('iDisplayLength', -1)
-    should_sort = request.POST.get('iSortCol_0', None)
+    display_start = int(request.POST.get('iDisplayStart', 0))
+    display_length = int(request.POST.get('iDisplayLength', -1))
     filter_nodetype = request.POST.get('sSearch_1', None)
     filter_labels = request.POST.get('sSearch_2', None)
 
@@ -82,156 +87,148 @@ def list_treenode_table(request, project_id=None):
                 'aaData': []}))
         else:
             response_on_error = 'Could not fetch %s skeleton IDs.' % specified_skeleton_count
-            skeleton_ids = [int(request.POST.get('skeleton_%s' % i, 0)) for i in range(int(specified_skeleton_count))]
+            skeleton_ids = tuple(int(request.POST.get('skeleton_%s' % i, 0)) for i in range(int(specified_skeleton_count)))
+
+        relation_id = relation_map.get('labeled_as', -1)
+        labels_fmt = '''(SELECT string_agg(ci.name, ', ')
+                FROM treenode_class_instance tci, class_instance ci
+                WHERE tci.treenode_id = %s.id
+                  AND tci.relation_id = %%s
+                  AND tci.class_instance_id = ci.id)'''
+
+        # The columns of the table, by name and whether they can be NULL.
+        # TODO type field not supported.
+        fields = [('id', False), None, ('labels', True), ('confidence', False),
+                ('x', False), ('y', False), ('z', False), ('z', False),
+                ('radius', False), ('username', False), ('edition_time', False),
+                ('reviewer_id', False)]
+        order = sort_columns(request, fields, ['id'])
+        sort_by_labels = 'labels' in [c.name for c in order]
 
-        if should_sort:
-            column_count = int(request.POST.get('iSortingCols', 0))
-            sorting_directions = [request.POST.get('sSortDir_%d' % d) for d in range(column_count)]
-            sorting_directions = map(lambda d: '-' if upper(d) == 'DESC' else '', sorting_directions)
+        response_on_error = 'Could not retrieve resolution and translation parameters for project.'
+        resolution = get_object_or_404(Stack, id=int(stack_id)).resolution
+        translation = get_object_or_404(ProjectStack, stack=int(stack_id), project=project_id).translation
+
+        users = {u[0]: u[1] for u in User.objects.filter().values_list('id', 'username')}
+        users[-1] = "None" # Rather than AnonymousUser
 
-            fields = ['tid', 'type', '"treenode"."labels"', 'confidence', 'x', 'y', 'z', '"treenode"."section"', 'radius', 'username', 'last_modified', 'last_reviewer']
-            # TODO type field not supported.
-            sorting_index = [int(request.POST.get('iSortCol_%d' % d)) for d in range(column_count)]
-            sorting_cols = map(lambda i: fields[i], sorting_index)
+        cursor = connection.cursor()
+        version = table_versions(cursor, ('treenode', 'treenode_class_instance',
+                'class_instance', 'auth_user'))
+
+        query = '''
+        SELECT t.id,
+               t.parent_id,
+               t.confidence,
+               (t.location).x AS x,
+               (t.location).y AS y,
+               (t.location).z AS z,
+               t.radius,
+               u.username,
+               t.edition_time,
+               t.reviewer_id%s
+        FROM treenode t,
+             auth_user u
+        WHERE t.project_id = %%s
+          AND t.skeleton_id IN %%s
+          AND t.user_id = u.id'''
+        columns = ['id', 'parent_id', 'confidence', 'x', 'y', 'z', 'radius',
+                'username', 'edition_time', 'reviewer_id']
+        params = [int(project_id), skeleton_ids]
+
+        # The number of results to be displayed includes the items that are
+        # filtered out and those of other pages.
+        response_on_error = 'Could not count the treenodes.'
+        row_count = count_rows(cursor, query % '', params, version)
+
+        # Only treenodes that carry a label which matches the filter, found
+        # through the label index, see labelindex.name_condition.
+        if filter_labels:
+            condition, condition_params = name_condition('ci.name', filter_labels)
+            query += '''
+          AND t.id IN (SELECT tci.treenode_id
+                       FROM treenode_class_instance tci, class_instance ci
+                       WHERE tci.relation_id = %%s
+                         AND tci.class_instance_id = ci.id
+                         AND ci.project_id = %%s
+                         AND ''' + condition.replace('%', '%%') + ')'
+            params += [relation_id, int(project_id)] + condition_params
+
+        # Labels are only fetched for the treenodes of the page, unless the
+        # page is sorted by them. Pages of unlimited length are streamed
+        # through a server-side cursor rather than held in memory.
+        if sort_by_labels:
+            query = query % (',\n               ' + labels_fmt % 't' + ' AS labels')
+            params.insert(0, relation_id)
+            columns.append('labels')
+            page_labels = 'p.labels'
+            select_params = []
+        else:
+            query = query % ''
+            page_labels = labels_fmt % 'p'
+            select_params = [relation_id]
 
         response_on_error = 'Could not get the list of treenodes.'
-        t = Treenode.objects.filter(
-            project = project_id,
-            skeleton_id__in = skeleton_ids).extra(
-            tables=['auth_user'],
-            where=[
-                '"treenode"."user_id" = "auth_user"."id"'],
-            select={
-                'tid': '"treenode"."id"',
-                'radius': '"treenode"."radius"',
-                'confidence': '"treenode"."confidence"',
-                'parent_id': '"treenode"."parent_id"',
-                'user_id': '"treenode"."user_id"',
-                'edition_time': '"treenode"."edition_time"',
-                'x': '("treenode"."location")."x"',
-                'y': '("treenode"."location")."y"',
-                'z': '("treenode"."location")."z"',
-                'username': '"auth_user"."username"',
-                'last_reviewer': '"treenode"."reviewer_id"',
-                'last_modified': 'to_char("treenode"."edition_time", \'DD-MM-YYYY HH24:MI\')'
-            }).distinct()
-        # Rationale for using .extra():
-        # Since we don't use .order_by() for ordering, extra fields are not
-        # included in the SELECT statement, and so .distinct() will work as
-        # intended. See http://tinyurl.com/dj-distinct
-        if should_sort:
-            t = t.extra(order_by=[di + col for (di, col) in zip(sorting_directions, sorting_cols)])
-
-        if int(display_length) == -1:
-            treenodes = list(t[display_start:])
-        else:
-            treenodes = list(t[display_start:display_start + display_length])
-
-        # The number of results to be displayed should include items that are
-        # filtered out.
-        row_count = len(treenodes)
-
-        # Filter out irrelevant treenodes if a label has been specified
-        if 'labeled_as' in relation_map:
-            response_on_error = 'Could not retrieve labels for project.'
-            project_lables = TreenodeClassInstance.objects.filter(
-                project=project_id,
-                relation=relation_map['labeled_as']).values(
-                'treenode',
-                'class_instance__name')
-            labels_by_treenode = {}  # Key: Treenode ID, Value: List of labels.
-            for label in project_lables:
-                if label['treenode'] not in labels_by_treenode:
-                    labels_by_treenode[label['treenode']] = [label['class_instance__name']]
-                else:
-                    labels_by_treenode[label['treenode']].append(label['class_instance__name'])
-
-            if filter_labels:
-                def label_filter(treenode):
-                    if treenode.id not in labels_by_treenode:
-                        return False
-                    return upper(filter_labels) in upper(' '.join(labels_by_treenode[treenode.tid]))
-                treenodes = filter(label_filter, treenodes)
-
-        # Filter out irrelevant treenodes if a node type has been specified.
-
-        # Count treenode's children to derive treenode types. The number of
-        # children a treenode has determines its type. Types:
+        treenodes = page_rows(cursor, query, params, columns, order,
+                display_start, display_length, version, '''
+               p.id,
+               p.parent_id,
+               p.confidence,
+               p.x,
+               p.y,
+               p.z,
+               p.radius,
+               p.username,
+               to_char(p.edition_time, 'DD-MM-YYYY HH24:MI'),
+               p.reviewer_id,
+               (SELECT count(*) FROM treenode c WHERE c.parent_id = p.id),
+               ''' + page_labels, select_params)
+
+        # Types are derived from the number of children of a treenode:
         # R : root (parent = null)
         # S : slab (has one child)
         # B : branch (has more than one child)
         # L : leaf (has no children)
-        # X : undefined (uh oh!)
-        if 0 == display_start and -1 == display_length:
-            # All nodes are loaded: determine child_count from loaded nodes
-            child_count = {}
-            for treenode in treenodes:
-                if treenode.parent is None:
-                    continue
-                n_children = child_count.get(treenode.parent_id, 0)
-                child_count[treenode.parent_id] = n_children + 1
-        else:
-            # Query for parents
-            response_on_error = 'Could not retrieve treenode parents.'
-            child_count_query = Treenode.objects.filter(
-                project=project_id,
-                skeleton_id__in=skeleton_ids).annotate(
-                child_count=Count('children'))
-            child_count = {}
-            for treenode in child_count_query:
-                child_count[treenode.id] = treenode.child_count
-
-        # Determine type
-        for treenode in treenodes:
-            if None == treenode.parent_id:
-                treenode.nodetype = 'R' # Root
-                continue
-            children = child_count.get(treenode.tid, 0)
-            if children == 1:
-                treenode.nodetype = 'S' # Slab
-            elif children == 0:
-                treenode.nodetype = 'L' # Leaf
-            elif children > 1:
-                treenode.nodetype = 'B' # Branch
-            else:
-                treenode.nodetype = 'X' # Unknown, can never happen
-
-        # Now that we've assigned node types, filter based on them:
-        if filter_nodetype:
-            filter_nodetype = upper(filter_nodetype)
-            treenodes = [t for t in treenodes if t.nodetype in filter_nodetype]
-
-        response_on_error = 'Could not retrieve resolution and translation parameters for project.'
-        resolution = get_object_or_404(Stack, id=int(stack_id)).resolution
-        translation = get_object_or_404(ProjectStack, stack=int(stack_id), project=project_id).translation
-
-        users = {u[0]: u[1] for u in User.objects.filter().values_list('id', 'username')}
-        users[-1] = "None" # Rather than AnonymousUser
+        def nodetype(tn):
+            if tn[1] is None:
+                return 'R' # Root
+            if 1 == tn[10]:
+                return 'S' # Slab
+            if 0 == tn[10]:
+                return 'L' # Leaf
+            return 'B' # Branch
 
         def formatTreenode(tn):
-            row = [str(tn.tid)]
-            row.append(tn.nodetype)
-            if tn.tid in labels_by_treenode:
-                row.append(', '.join(map(str, labels_by_treenode[tn.tid])))
-            else:
-                row.append('')
-            row.append(str(tn.confidence))
-            row.append('%.2f' % tn.x)
-            row.append('%.2f' % tn.y)
-            row.append('%.2f' % tn.z)
-            row.append(int((tn.z - translation.z) / resolution.z))
-            row.append(str(tn.radius))
-            row.append(tn.username)
-            row.append(tn.last_modified)
-            row.append(str(users.get(tn.last_reviewer, "Unknown")))
+            row = [str(tn[0])]
+            row.append(nodetype(tn))
+            row.append(tn[11] or '')
+            row.append(str(tn[2]))
+            row.append('%.2f' % tn[3])
+            row.append('%.2f' % tn[4])
+            row.append('%.2f' % tn[5])
+            row.append(int((tn[5] - translation.z) / resolution.z))
+            row.append(str(tn[6]))
+            row.append(tn[7])
+            row.append(tn[8])
+            row.append(str(users.get(tn[9], "Unknown")))
             return row
 
-        result = {'iTotalRecords': row_count, 'iTotalDisplayRecords': row_count}
-        response_on_error = 'Could not format output.'
-        result['aaData'] = map(formatTreenode, treenodes)
+        def filtered_rows():
+            upper_filter_nodetype = upper(filter_nodetype) if filter_nodetype else None
+            for tn in treenodes:
+                row = formatTreenode(tn)
+                # Filter based on node types
+                if upper_filter_nodetype and row[1] not in upper_filter_nodetype:
+                    continue
+                yield row
 
-        return HttpResponse(json.dumps(result))
+        def chunks():
+            yield '{"aaData": '
+            for chunk in json_array_chunks(filtered_rows()):
+                yield chunk
+            yield ', "iTotalRecords": %s, "iTotalDisplayRecords": %s}' % (row_count, row_count)
+
+        return streaming_json_response(chunks(), mimetype='text/html; charset=utf-8')
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
-
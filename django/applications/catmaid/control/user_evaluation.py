@@ -1,142 +1,114 @@
 from datetime import datetime, timedelta
-from catmaid.models import Treenode, Log, Relation, TreenodeConnector, UserRole
-from catmaid.fields import Double3D
+from catmaid.models import Treenode, Relation, UserRole, SkeletonReviewerSummary
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
+from django.db import connection
 from django.db.models import Count
 from django.http import HttpResponse
+from catmaid.control.jobs import report_progress
 from catmaid.control.tree_util import lazy_load_trees
+from catmaid.control.workers import worker_pool
 from collections import defaultdict, namedtuple
-from itertools import imap
+from itertools import imap, izip
 import json
-from operator import attrgetter
-from networkx import connected_components
-from functools import partial
-
-
-def _find_nearest(tree, nodes, loc1):
-    """ Returns a tuple of the closest node and the square of the distance. """
-    min_sqdist = float('inf')
-    for node in nodes:
-        loc2 = tree.node[node]['location']
-        dsq = pow(loc1.x - loc2.x, 2) + pow(loc1.y - loc2.y, 2) + pow(loc1.z - loc2.z, 2)
-        if dsq < min_sqdist:
-            min_sqdist = dsq
-            closest = node
-
-    return node, min_sqdist
-
-def _parse_location(loc):
-    return Double3D(*(imap(float, loc[1:-1].split(','))))
-
-def _evaluate_epochs(epochs, skeleton_id, tree, relations):
+import re
+import numpy as np
+
+
+# review_date_range: list of two timestamps, for the oldest and newest review time.
+# creation_date_range: dictionary of user_id vs dictionary of 'start' and 'end' timestamps for node creation.
+# user_node_counts: dictionary of user_id vs count of nodes created within the epoch
+# splits: list of dictionary of user_id vs count
+# merges: list of dictionary of user_id vs count
+# appended: similar to merges; list of dictionary of user_id vs count of nodes added by the reviewer within the review epoch
+# node_count: total number of nodes reviewed within the epoch.
+# Timestamps are in seconds since the epoch.
+EpochOps = namedtuple('EpochOps', ['reviewer_id', 'review_date_range', 'creation_date_range', 'user_node_counts', 'splits', 'merges', 'appended', 'node_count', 'n_pre', 'n_post', 'reviewer_n_pre', 'reviewer_n_post', 'newer_pre_count', 'newer_post_count'])
+
+
+def _find_nearest(arbor, nodes, loc1):
+    """ Returns a tuple of the index of the closest of the nodes, given as
+    array indices, and the square of the distance. """
+    sqdists = ((arbor.locations[nodes] - loc1) ** 2).sum(axis=1)
+    i = np.argmin(sqdists)
+    return nodes[i], sqdists[i]
+
+def _count(keys):
+    """ Return a dictionary of each unique key vs the number of times it
+    appears. """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse) if len(keys) else []
+    return dict(izip(unique.tolist(), (int(n) for n in counts)))
+
+def _evaluate_epochs(epochs, skeleton_id, arbor, synapses, log_ops, relations):
     """ Evaluate each epoch:
     1. Detect merges done by the reviewer: one of the two nodes is edited by the reviewer within the review epoch (but not both: could be a reroot then), with a corresponding join_skeleton entry in the log table. Perhaps the latter is enough, if the x,y,z of the log corresponds to that of the node (plus/minus a tiny bit, may have moved).
     2. Detect additions by the reviewer (a kind of merge), where the reviewer's node is newer than the other node, and it was created within the review epoch. These nodes would have been created and reviewed by the reviewer within the review epoch.
     3. Detect splits by the reviewer: query the log table for split_skeleton events involving the skeleton, performed by the reviewer within the review epoch.
     Returns a list with one entry per epoch, where each entry is an object with three fields: 
     4. Detect synapses added by the reviewer within the epoch. Unfortunately, the removal of synapses has not been logged.
+    The synapses are given as a dictionary of arrays of the 'node' index, 'user_id', 'relation_id' and 'creation_time' of each link of the skeleton to a connector, and the log_ops as a list of tuples of (operation_type, creation_time, user_id, location) of the split and join operations on the skeleton.
     """
 
     # TODO extended branches when the last node didn't have an ends tag prior to reviewing should not be considered an error.
 
-    # review_date_range: list of two dates, for the oldest and newest node creation time.
-    # creation_date_range: dictionary of user_id vs dictionary of 'start' and 'end' datetime instances for node creation.
-    # user_node_counts: dictionary of user_id vs count of nodes created within the epoch
-    # splits: list of dictionary of user_id vs count
-    # merges: list of dictionary of user_id vs count
-    # appended: similar to merges; list of dictionary of user_id vs count of nodes added by the reviewer within the review epoch
-    # node_count: total number of nodes reviewed within the epoch.
-    EpochOps = namedtuple('EpochOps', ['reviewer_id', 'review_date_range', 'creation_date_range', 'user_node_counts', 'splits', 'merges', 'appended', 'node_count', 'n_pre', 'n_post', 'reviewer_n_pre', 'reviewer_n_post', 'newer_pre_count', 'newer_post_count'])
-
     # List of EpochOps, indexed like epochs
     epoch_ops = []
 
-    # Synapses on the arbor: keyed by treenode_id
-    all_synapses = defaultdict(list)
-    for s in TreenodeConnector.objects.filter(skeleton=skeleton_id):
-        all_synapses[s.treenode_id].append(s)
+    props = arbor.properties
+    node_user = props['user_id']
+    node_creation = props['creation_time']
+    parent = arbor.parent
 
-    for epoch in epochs:
+    # Synapses on the arbor, and the creator of their treenode
+    syn_node = synapses['node']
+    syn_user = synapses['user_id']
+    syn_relation = synapses['relation_id']
+    syn_creation = synapses['creation_time']
+    syn_node_user = node_user[syn_node]
+    is_pre = syn_relation == relations['presynaptic_to']
+    is_post = syn_relation == relations['postsynaptic_to']
+    # Synapses created by a user other than the user who created the treenode, after the treeenode's creation time
+    newer = (syn_user != syn_node_user) & (syn_creation > node_creation[syn_node])
 
-        reviewer_id, nodes = epoch
+    for reviewer_id, nodes in epochs:
 
         # Range of the review epoch
-        start_date = datetime.max
-        end_date = datetime.min
-
-        # Range for node creation, per user
-        def default_dates():
-            return {'start': datetime.max,
-                    'end': datetime.min}
-        user_ranges = defaultdict(default_dates)
-
-        # Node counts per user
-        user_node_counts = defaultdict(int)
-
-        # Synapses for the set of nodes reviewed in this epoch, keyed by user_id and relation
-        nodes_synapses = defaultdict(partial(defaultdict, list))
-
-        # Synapses, keyed by user and relation, created by a user other than the user who created the treenode, after the treeenode's creation time
-        newer_synapses_count = defaultdict(partial(defaultdict, int))
-
-        for node in nodes:
-            props = tree.node[node]
-            # Find out review date range for this epoch
-            tr = props['review_time']
-            start_date = min(start_date, tr)
-            end_date = max(end_date, tr)
-            # Count nodes created by each user
-            user_id = props['user_id']
-            user_node_counts[user_id] += 1
-            # Find out date range for each user's created nodes
-            u = user_ranges[user_id]
-            tc = props['creation_time']
-            u['start'] = min(u['start'], tc)
-            u['end'] = max(u['end'], tc)
-            # Synapses
-            syns = all_synapses.get(node)
-            if syns:
-                for s in syns:
-                    nodes_synapses[s.user_id][s.relation_id].append(s)
-                    # Count synapses created by a user other than the user that created the treenode, after the treenode was created
-                    if s.user_id != user_id and s.creation_time > tc:
-                        newer_synapses_count[s.relation_id][user_id] += 1
-
-
-        def in_range(date):
-            return start_date <= date <= end_date
+        review_times = props['review_time'][nodes]
+        start_date = review_times.min()
+        end_date = review_times.max()
+
+        def in_range(dates):
+            return (start_date <= dates) & (dates <= end_date)
+
+        # Node counts per user, and date range for each user's created nodes
+        users = node_user[nodes]
+        creation = node_creation[nodes]
+        order = np.lexsort((creation, users))
+        users = users[order]
+        creation = creation[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(users)) + 1))
+        ends = np.concatenate((starts[1:], [len(users)]))
+        user_node_counts = dict(izip(users[starts].tolist(), (ends - starts).tolist()))
+        user_ranges = {user_id: {'start': creation[start], 'end': creation[end - 1]}
+                       for user_id, start, end in izip(users[starts].tolist(), starts, ends)}
+
+        # Synapses for the set of nodes reviewed in this epoch
+        member = np.zeros(len(arbor), dtype=bool)
+        member[nodes] = True
+        in_epoch = member[syn_node]
 
         # Total number of synapses related to nodes reviewed within the epoch
-        epoch_n_pre = sum(len(r.get(relations['presynaptic_to'], [])) for r in nodes_synapses.itervalues())
-        epoch_n_post = sum(len(r.get(relations['postsynaptic_to'], [])) for r in nodes_synapses.itervalues())
-
-        # Find out synapses added by the reviewer within the epoch, keyed by treenode user
-        reviewer_n_pre = defaultdict(int)
-        reviewer_n_post = defaultdict(int)
-        reviewer_synapses = nodes_synapses.get(reviewer_id)
-
-        if reviewer_synapses:
-            pre = reviewer_synapses.get(relations['presynaptic_to'])
-            if pre:
-                for s in pre:
-                    if in_range(s.creation_time):
-                        reviewer_n_pre[tree.node[s.treenode_id]['user_id']] += 1
-            post = reviewer_synapses.get(relations['postsynaptic_to'])
-            if post:
-                for s in post:
-                    if in_range(s.creation_time):
-                        reviewer_n_post[tree.node[s.treenode_id]['user_id']] += 1
+        epoch_n_pre = int((in_epoch & is_pre).sum())
+        epoch_n_post = int((in_epoch & is_post).sum())
 
+        # Synapses added by the reviewer within the epoch, keyed by treenode user
+        by_reviewer = in_epoch & (syn_user == reviewer_id) & in_range(syn_creation)
+        reviewer_n_pre = _count(syn_node_user[by_reviewer & is_pre])
+        reviewer_n_post = _count(syn_node_user[by_reviewer & is_post])
 
         date_range = [start_date, end_date]
 
-        log_ops = Log.objects.filter(
-                      user_id=reviewer_id,
-                      freetext__contains=' %s ' % skeleton_id,
-                      creation_time__range=date_range,
-                      operation_type__in=('split_skeleton', 'join_skeleton')) \
-                   .values_list('operation_type', 'location')
-
         # Only join_skeleton operations performed by the reviewer
         # within the reviewing epoch are considered.
         # The potential errors arising from the fact that the freetext
@@ -150,99 +122,150 @@ def _evaluate_epochs(epochs, skeleton_id, tree, relations):
         epoch_ops.append(EpochOps(reviewer_id, date_range, user_ranges,
             user_node_counts, splits, merges, appended, len(nodes),
             epoch_n_pre, epoch_n_post, reviewer_n_pre, reviewer_n_post,
-            newer_synapses_count.get(relations['presynaptic_to'], {}),
-            newer_synapses_count.get(relations['postsynaptic_to'], {})))
-
+            _count(syn_node_user[in_epoch & newer & is_pre]),
+            _count(syn_node_user[in_epoch & newer & is_post])))
 
-        for operation_type, location in log_ops:
+        for operation_type, creation_time, user_id, location in log_ops:
+            if user_id != reviewer_id or not start_date <= creation_time <= end_date:
+                continue
             # find nearest node to x,y,z of the logged operation
             # NOTE this is a potential source of false positives.
             # For merges, the sqdist should be very close to zero.
             # For splits, the x,y,z are if the splitted node, which may no longer be part of the arbor (but could have been joined again).
             # False positives could originate in splitted and re-joined nodes (invalid split and merge error), and in deleted and re-created nodes (potentially incorrect user attribution).
-            node, sqdist = _find_nearest(tree, nodes, _parse_location(location))
+            node, sqdist = _find_nearest(arbor, nodes, location)
 
             if 'split_skeleton' == operation_type:
-                splits[tree.node[node]['user_id']] += 1
+                splits[int(node_user[node])] += 1
 
             elif 'join_skeleton' == operation_type:
-                edges = tree[node]
-                if edges:
+                if parent[node] >= 0:
                     # Replace node with its parent
-                    node = edges.iterkeys().next()
-                merges[tree.node[node]['user_id']] += 1
+                    node = parent[node]
+                merges[int(node_user[node])] += 1
 
         # Count nodes created by the reviewer, as well as
         # the number of connected arbors made by that nodes
         # which will add to the count of merges missed.
-        def newlyAdded(node):
-            props = tree.node[node]
-            return props['user_id'] == reviewer_id and in_range(props['creation_time'])
-
-        owned = filter(newlyAdded, nodes)
-
-        if owned:
-            sub = tree.subgraph(owned)
-            additions = connected_components(sub.to_undirected())
-            for addition in additions:
-                # Find a node whose parent's creator is not the reviewer, if any
-                # (Could not find any if the reviewer had created that parent node
-                # outside of the review epoch, in which case it does not count
-                # as an error)
-                for node in addition:
-                    edges = tree[node]
-                    if edges:
-                        parent = edges.iterkeys().next()
-                        creator_id = tree.node[parent]['user_id']
-                        if creator_id != reviewer_id:
-                            appended[creator_id].append(len(addition))
-                            break
-
+        owned = np.zeros(len(arbor), dtype=bool)
+        owned[nodes] = (node_user[nodes] == reviewer_id) & in_range(node_creation[nodes])
+
+        if owned.any():
+            # Label each connected set of owned nodes with its top node,
+            # the one whose parent is not owned
+            has_parent = parent >= 0
+            joined = owned & has_parent
+            joined[joined] = owned[parent[joined]]
+            label = np.arange(len(arbor))
+            label[joined] = parent[joined]
+            while True:
+                jumped = label[label]
+                if (jumped == label).all():
+                    break
+                label = jumped
+            sizes = np.bincount(label[owned], minlength=len(arbor))
+            # Only the top node of an addition can have a parent whose
+            # creator is not the reviewer (Could not find any if the reviewer
+            # had created that parent node outside of the review epoch, in
+            # which case it does not count as an error)
+            tops = np.flatnonzero(owned & ~joined & has_parent)
+            creators = node_user[parent[tops]]
+            for top, creator_id in izip(tops[creators != reviewer_id], creators[creators != reviewer_id].tolist()):
+                appended[creator_id].append(int(sizes[top]))
 
     return epoch_ops
 
-def _split_into_epochs(skeleton_id, tree, max_gap):
+def _split_into_epochs(skeleton_id, arbor, max_gap):
     """ Split the arbor into one or more review epochs.
     An epoch is defined as a continuous range of time containing gaps
-    of up to max_gap (e.g. 3 days) and fully reviewed by the same reviewer.
+    of up to max_gap (e.g. 3 days, in seconds) and fully reviewed by the same reviewer.
     Treenodes reviewed within an epoch may not form a coherent subset of the arbor,
-    given that different subsets of the arbor may have been joined at a later time. """
+    given that different subsets of the arbor may have been joined at a later time.
+    Returns a list of tuples of reviewer ID and the array indices of the nodes. """
 
     # Sort nodes by date
-    def get_review_time(e):
-        return e[1]['review_time']
-    nodes = sorted(tree.nodes_iter(data=True), key=get_review_time)
+    order = np.argsort(arbor.properties['review_time'], kind='mergesort')
+    review_times = arbor.properties['review_time'][order]
+    reviewers = arbor.properties['reviewer_id'][order]
 
-    # Grab the oldest node
-    oldest = nodes[0]
-    last = oldest[1] # props of first node 
+    # A new epoch starts when the reviewer changes or at a long enough gap
+    breaks = np.flatnonzero((reviewers[1:] != reviewers[:-1]) |
+                            ~(np.diff(review_times) < max_gap)) + 1
+    return [(int(reviewers[epoch[0]]), epoch)
+            for epoch in np.split(order, breaks) if len(epoch)]
 
-    # First epoch contains the oldest node
-    epoch = [oldest[0]] # id of first node
 
-    # Collect epochs
-    epochs = [(last['reviewer_id'], epoch)]
-
-    # Iterate from second-oldest node forward in time
-    for node, props in nodes:
-        if props['reviewer_id'] == last['reviewer_id'] and props['review_time'] - last['review_time'] < max_gap:
-            epoch.append(node)
-        else:
-            # Start new epoch
-            epoch = [node]
-            epochs.append((props['reviewer_id'], epoch))
-
-        last = props
-
-    return epochs
-
-
-def _evaluate_arbor(user_id, skeleton_id, tree, relations, max_gap):
+def _evaluate_arbor(user_id, skeleton_id, arbor, synapses, log_ops, relations, max_gap):
     """ Split the arbor into review epochs and then evaluate each independently. """
-    epochs = _split_into_epochs(skeleton_id, tree, max_gap)
-    epoch_ops = _evaluate_epochs(epochs, skeleton_id, tree, relations)
+    epochs = _split_into_epochs(skeleton_id, arbor, max_gap)
+    epoch_ops = _evaluate_epochs(epochs, skeleton_id, arbor, synapses, log_ops, relations)
     return epoch_ops
 
+def _evaluate_arbor_task(args):
+    return args[1], _evaluate_arbor(*args)
+
+
+def _load_synapses(cursor, skeleton_ids):
+    """ Return a dictionary of skeleton ID vs a dictionary of arrays of the
+    'treenode_id', 'user_id', 'relation_id' and 'creation_time' of each of
+    its links to connectors. """
+    cursor.execute('''
+    SELECT skeleton_id, treenode_id, user_id, relation_id,
+           EXTRACT(EPOCH FROM creation_time)
+    FROM treenode_connector
+    WHERE skeleton_id IN %s
+    ORDER BY skeleton_id
+    ''', (tuple(skeleton_ids),))
+    synapses = {}
+    rows = cursor.fetchall()
+    if rows:
+        columns = zip(*rows)
+        skids = np.array(columns[0], dtype=np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(skids)) + 1, [len(skids)]))
+        arrays = {'treenode_id': np.array(columns[1], dtype=np.int64),
+                  'user_id': np.array(columns[2], dtype=np.int64),
+                  'relation_id': np.array(columns[3], dtype=np.int64),
+                  'creation_time': np.array(columns[4], dtype=np.float64)}
+        for start, end in izip(starts[:-1], starts[1:]):
+            synapses[int(skids[start])] = {k: v[start:end] for k, v in arrays.iteritems()}
+    return synapses
+
+def _no_synapses():
+    return {k: np.zeros(0, dtype=dtype) for k, dtype in (('treenode_id', np.int64),
+            ('user_id', np.int64), ('relation_id', np.int64), ('creation_time', np.float64))}
+
+def _load_log_ops(cursor, project_id, skeleton_ids):
+    """ Return a dictionary of skeleton ID vs a list of tuples of
+    (operation_type, creation_time, user_id, location) of the split and join
+    operations whose freetext mentions the skeleton. Only operations that
+    _evaluate_epochs can attribute are loaded: those by a reviewer of the
+    skeletons between the first and the last of their reviews. """
+    skeleton_ids = set(skeleton_ids)
+    cursor.execute('''
+    WITH reviews AS (
+        SELECT reviewer_id, min(review_time) AS first, max(review_time) AS last
+        FROM treenode
+        WHERE skeleton_id IN %s
+          AND reviewer_id <> -1
+        GROUP BY reviewer_id
+    )
+    SELECT l.operation_type, EXTRACT(EPOCH FROM l.creation_time), l.user_id,
+           (l.location).x, (l.location).y, (l.location).z, l.freetext
+    FROM log l,
+         reviews r
+    WHERE l.project_id = %s
+      AND l.operation_type IN ('split_skeleton', 'join_skeleton')
+      AND l.user_id = r.reviewer_id
+      AND l.creation_time BETWEEN r.first AND r.last
+    ''', (tuple(skeleton_ids), int(project_id)))
+    log_ops = defaultdict(list)
+    for row in cursor.fetchall():
+        op = (row[0], row[1], row[2], np.array(row[3:6], dtype=np.float64))
+        for skid in set(int(m.group(1)) for m in re.finditer(r' (\d+)(?= )', row[6])):
+            if skid in skeleton_ids:
+                log_ops[skid].append(op)
+    return log_ops
+
 
 def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
 
@@ -264,28 +287,40 @@ def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
         return None
 
     # Find the subset of fully reviewed skeletons
-    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
-         .values_list('skeleton', 'reviewer_id') \
-         .annotate(Count('reviewer_id'))
-
-    review_status = defaultdict(partial(defaultdict, int))
-    for skid, reviewer_id, count in ts:
-        review_status[skid][reviewer_id] = count
-
-    not_fully_reviewed = set()
-    for skid, reviewers in review_status.iteritems():
-        if -1 in reviewers:
-            not_fully_reviewed.add(skid)
+    not_fully_reviewed = set(SkeletonReviewerSummary.objects.filter(
+            skeleton__in=skeleton_ids, reviewer_id=-1, node_count__gt=0) \
+         .values_list('skeleton', flat=True))
 
     skeleton_ids = skeleton_ids - not_fully_reviewed
 
     if not skeleton_ids:
         return None
 
-    relations = dict(Relation.objects.filter(project_id=project_id, relation_name__in=['presynaptic_to', 'postsynaptic_to']).values_list('relation_name', 'id'))
-
-    # 2. Load each fully reviewed skeleton one at a time
-    evaluations = {skid: _evaluate_arbor(user_id, skid, tree, relations, max_gap) for skid, tree in lazy_load_trees(skeleton_ids, ('location', 'creation_time', 'user_id', 'reviewer_id', 'review_time', 'editor_id', 'edition_time'))}
+    relation_map = get_relation_to_id_map(project_id)
+    relations = {name: relation_map[name] for name in ('presynaptic_to', 'postsynaptic_to')}
+
+    # 2. Stream the fully reviewed skeletons and evaluate each, on the pool
+    #    of worker processes when it has been started
+    cursor = connection.cursor()
+    synapses = _load_synapses(cursor, skeleton_ids)
+    log_ops = _load_log_ops(cursor, project_id, skeleton_ids)
+    max_gap = max_gap.total_seconds()
+
+    def tasks():
+        for i, (skid, arbor) in enumerate(lazy_load_trees(skeleton_ids, ('location', 'creation_time', 'user_id', 'reviewer_id', 'review_time'))):
+            report_progress(float(i) / len(skeleton_ids))
+            syns = synapses.get(skid) or _no_synapses()
+            syns['node'] = arbor.index(syns['treenode_id'])
+            yield (user_id, skid, arbor, syns, log_ops.get(skid, []), relations, max_gap)
+
+    pool = worker_pool()
+    if pool is not None and len(skeleton_ids) > 1:
+        # Trees are loaded in this thread while the pool evaluates those
+        # loaded before
+        results = [pool.apply_async(_evaluate_arbor_task, (task,)) for task in tasks()]
+        evaluations = dict(result.get() for result in results)
+    else:
+        evaluations = dict(imap(_evaluate_arbor_task, tasks()))
 
     # 3. Extract evaluations for the user_id over time
     # Each evaluation contains an instance of EpochOps namedtuple, with members:
@@ -312,14 +347,13 @@ def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
 
     for skid, arbor_epoch_ops in evaluations.iteritems():
         for epoch_ops in arbor_epoch_ops:
-            if 0 == epoch_ops.user_node_counts[user_id]:
+            if 0 == epoch_ops.user_node_counts.get(user_id, 0):
                 # user did not contribute at all to this chunk
                 continue
             appended = epoch_ops.appended[user_id]
-            print appended
             d.append({'skeleton_id': skid,
                       'reviewer_id': epoch_ops.reviewer_id,
-                      'timepoint': epoch_ops.creation_date_range[user_id]['end'].strftime('%Y-%m-%d'),
+                      'timepoint': datetime.fromtimestamp(epoch_ops.creation_date_range[user_id]['end']).strftime('%Y-%m-%d'),
                       'n_created_nodes': epoch_ops.user_node_counts[user_id],
                       'n_nodes': epoch_ops.node_count,
                       'n_missed_nodes': sum(appended),
@@ -1,73 +1,42 @@
 import json
 
+from django.db import connection
 from django.http import HttpResponse
-from django.db.models import Count
 
 from catmaid.models import *
 from catmaid.control.authentication import *
+from catmaid.control.connectivity import connectivity_index
+from catmaid.control.streaming import stream_rows, json_array_chunks, \
+        streaming_json_response
 
 
 def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
-
-    # result dictionary: {connectorid: presyn_skeletonid}
-    tmp={}
-    result={}
-    # get the presynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'presynaptic_to'
-    )
-    for e in qs:
-        if not e.connector_id in tmp:
-            tmp[e.connector_id]=e.skeleton_id
-            result[e.skeleton_id]={}
-        else:
-            # connector with multiple presynaptic connections
-            pass
-
-    skeletons={}
-    qs = Treenode.objects.filter(project=project_id).values('skeleton').annotate(Count('skeleton'))
-    for e in qs:
-        skeletons[ e['skeleton'] ]=e['skeleton__count']
-
-    # get the postsynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'postsynaptic_to'
-    )
-    for e in qs:
-        if e.connector_id in tmp:
-
-            # limit the skeletons to include
-            if skeletons[ tmp[e.connector_id] ] < lower_treenode_number_limit or\
-               skeletons[ e.skeleton_id ] < lower_treenode_number_limit:
-                continue
-
-            # an existing connector, so we add a connection
-            if e.skeleton_id in result[tmp[e.connector_id]]:
-                result[tmp[e.connector_id]][e.skeleton_id] += 1
-            else:
-                result[tmp[e.connector_id]][e.skeleton_id] = 1
-        else:
-            # connector with only postsynaptic connections
-            pass
+    """ Return the nodes and edges of the wiring diagram of the project, read
+    from its in-memory connectivity index. Only skeletons with at least
+    lower_treenode_number_limit treenodes are included. """
+    lower_treenode_number_limit = int(lower_treenode_number_limit)
+    index = connectivity_index(connection.cursor(), project_id)
+    skeletons = dict(SkeletonSummary.objects.filter(project=project_id).values_list('skeleton', 'node_count'))
 
     nodes_tmp={}
     edges=[]
 
-    for k,v in result.iteritems():
+    for pre, post, n in index.edges():
 
-        for kk,vv in v.iteritems():
+        # limit the skeletons to include
+        if skeletons.get(pre, 0) < lower_treenode_number_limit or\
+           skeletons.get(post, 0) < lower_treenode_number_limit:
+            continue
 
-            edges.append(
-                    {"id": str(k)+"_"+str(kk),
-                     "source": str(k),
-                     "target": str(kk),
-                     "number_of_connector": vv}
-            )
+        edges.append(
+                {"id": str(pre)+"_"+str(post),
+                 "source": str(pre),
+                 "target": str(post),
+                 "number_of_connector": n}
+        )
 
-            nodes_tmp[k]=None
-            nodes_tmp[kk]=None
+        nodes_tmp[pre]=None
+        nodes_tmp[post]=None
 
     nodes=[]
     for k,v in nodes_tmp.iteritems():
@@ -75,7 +44,7 @@ def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
                 {
                 "id": str(k),
                 "label": "Skeleton "+str(k),
-                'node_count': skeletons[k]
+                'node_count': skeletons.get(k, 0)
             }
         )
 
@@ -106,13 +75,27 @@ def export_wiring_diagram_nx(request, project_id=None):
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def export_wiring_diagram(request, project_id=None):
-
-    if request.POST.has_key('lower_skeleton_count'):
-        lower_treenode_number_limit=request.POST['lower_skeleton_count']
-    else:
-        lower_treenode_number_limit=0
-
-    nodes_and_edges=get_wiring_diagram(project_id, lower_treenode_number_limit)
+    """ Return the wiring diagram of the project: a node for each skeleton with
+    at least lower_skeleton_count treenodes that makes or receives synapses,
+    and a directed edge for each pair of synaptically connected skeletons,
+    weighted by the number of synapses. The edges are read in one pass from
+    the skeleton_connectivity table and streamed into the response. """
+    lower_treenode_number_limit = int(request.POST.get('lower_skeleton_count', 0))
+
+    edges = stream_rows("""
+    SELECT sc.pre_skeleton_id, sc.post_skeleton_id, sc.num_synapses,
+           s1.node_count, s2.node_count
+    FROM skeleton_connectivity sc,
+         skeleton_summary s1,
+         skeleton_summary s2
+    WHERE sc.project_id = %(project_id)s
+      AND sc.num_synapses > 0
+      AND s1.skeleton_id = sc.pre_skeleton_id
+      AND s2.skeleton_id = sc.post_skeleton_id
+      AND s1.node_count >= %(limit)s
+      AND s2.node_count >= %(limit)s
+    """, {'project_id': int(project_id),
+          'limit': lower_treenode_number_limit})
 
     nodesDataSchema=[
             {'name':'id','type':'string'},
@@ -125,10 +108,29 @@ def export_wiring_diagram(request, project_id=None):
             {'name': "directed", "type": "boolean", "defValue": True}
     ]
 
-    data={
-        'dataSchema':{'nodes':nodesDataSchema,'edges':edgesDataSchema},
-        'data':{'nodes':nodes_and_edges['nodes'],'edges':nodes_and_edges['edges']}
-    }
+    # Skeleton ID vs number of treenodes, for the skeletons of the edges
+    skeletons = {}
+
+    def encode_edge(row):
+        skeletons[row[0]] = row[3]
+        skeletons[row[1]] = row[4]
+        return json.dumps({
+            "id": "%s_%s" % (row[0], row[1]),
+            "source": str(row[0]),
+            "target": str(row[1]),
+            "number_of_connector": row[2]}, sort_keys=True)
+
+    def chunks():
+        yield '{"data": {"edges": '
+        for chunk in json_array_chunks(edges, encode_edge):
+            yield chunk
+        yield ', "nodes": '
+        for chunk in json_array_chunks(skeletons.iteritems(), lambda (k, n): json.dumps({
+                "id": str(k),
+                "label": "Skeleton " + str(k),
+                "node_count": n}, sort_keys=True)):
+            yield chunk
+        yield '}, "dataSchema": ' + json.dumps({'nodes': nodesDataSchema,
+                'edges': edgesDataSchema}, sort_keys=True) + '}'
 
-    json_return = json.dumps(data, sort_keys=True, indent=4)
-    return HttpResponse(json_return, mimetype='text/json')
\ No newline at end of file
+    return streaming_json_response(chunks())
@@ -0,0 +1,51 @@
+# A pool of worker processes for CPU-bound computations on numpy arrays, like
+# measuring skeletons and evaluating reviews, shared by all views of a server
+# process.
+#
+# The pool has to be forked before the process opens database connections,
+# starts threads or fills its caches, which forked workers would otherwise
+# inherit, so it is never created from within a request. The WSGI entry point
+# starts it when the server process starts, and it is closed when the process
+# exits. Where it hasn't been started, like in the development server or in
+# management commands, computations run within the calling process.
+
+import atexit
+import os
+from multiprocessing import Pool
+
+from django.conf import settings
+
+# The pool and the ID of the process that started it
+_pool = None
+_pool_pid = None
+
+
+def start_worker_pool():
+    """ Fork the WORKER_PROCESSES worker processes of this server process,
+    unless fewer than two are configured. To be called at startup, before
+    any database connection is opened. """
+    global _pool, _pool_pid
+    processes = getattr(settings, 'WORKER_PROCESSES', 0)
+    if _pool is not None or processes < 2:
+        return
+    _pool = Pool(processes)
+    _pool_pid = os.getpid()
+    atexit.register(_close_worker_pool)
+
+
+def _close_worker_pool():
+    global _pool
+    if _pool is not None and os.getpid() == _pool_pid:
+        _pool.close()
+        _pool.join()
+    _pool = None
+
+
+def worker_pool():
+    """ Return the pool of worker processes of this server process, or None if
+    none has been started, in which case computations should run within the
+    calling process. The pool of a parent process, like that of a server that
+    forks its workers after loading the application, is not usable. """
+    if _pool is not None and os.getpid() == _pool_pid:
+        return _pool
+    return None
@@ -475,6 +475,95 @@ class TreenodeConnector(UserFocusedModel):
     skeleton = models.ForeignKey(ClassInstance)
     confidence = models.IntegerField(default=5)
 
+class NodeTileVersion(models.Model):
+    """ The edit version of a spatial tile of the tracing overlay, used to
+    validate cached tiles (see catmaid.control.nodecache). A tile without a
+    row is at version zero. """
+    class Meta:
+        db_table = "node_tile_version"
+        unique_together = (('project', 'z', 'col', 'row'),)
+    project = models.ForeignKey(Project)
+    z = models.FloatField()
+    col = models.IntegerField()
+    row = models.IntegerField()
+    version = models.IntegerField(default=0)
+
+class SkeletonSummary(models.Model):
+    """ Aggregates of the treenodes and synapses of a skeleton, kept current
+    by triggers on the treenode and treenode_connector tables. A cable length
+    of None means that an edit could not update it incrementally and that it
+    has to be measured again. """
+    class Meta:
+        db_table = "skeleton_summary"
+    skeleton = models.OneToOneField(ClassInstance, primary_key=True)
+    project = models.ForeignKey(Project)
+    node_count = models.IntegerField(default=0)
+    cable_length = models.FloatField(null=True, default=0)
+    num_presynaptic = models.IntegerField(default=0)
+    num_postsynaptic = models.IntegerField(default=0)
+    last_edition_time = models.DateTimeField(default=datetime.now)
+
+class SkeletonReviewerSummary(models.Model):
+    """ The number of treenodes of a skeleton reviewed by each reviewer, where
+    a reviewer ID of -1 counts the treenodes not reviewed yet. Kept current
+    along with SkeletonSummary. """
+    class Meta:
+        db_table = "skeleton_reviewer_summary"
+        unique_together = (('skeleton', 'reviewer_id'),)
+    skeleton = models.ForeignKey(ClassInstance)
+    reviewer_id = models.IntegerField()
+    node_count = models.IntegerField(default=0)
+
+class SkeletonConnectivity(models.Model):
+    """ The number of synapses from one skeleton onto another, that is, of
+    pairs of presynaptic and postsynaptic links to the same connector. Kept
+    current by a trigger on the treenode_connector table. Rows are not
+    deleted when the count drops to zero, and change_txid is the ID of the
+    transaction that last changed a row, so that in-memory copies can be
+    updated incrementally (see catmaid.control.connectivity). Skeleton IDs
+    are plain integers to keep the rows of deleted skeletons until then. """
+    class Meta:
+        db_table = "skeleton_connectivity"
+        unique_together = (('pre_skeleton_id', 'post_skeleton_id'),)
+    project = models.ForeignKey(Project)
+    pre_skeleton_id = models.IntegerField()
+    post_skeleton_id = models.IntegerField()
+    num_synapses = models.IntegerField(default=0)
+    change_txid = models.BigIntegerField()
+
+class AnnotationGraphVersion(models.Model):
+    """ The ID of the transaction that last changed an annotated_with link of
+    a project, kept current by a trigger on the class_instance_class_instance
+    table. In-memory copies of the annotation graph of the project are valid
+    as long as it doesn't change (see catmaid.control.annotationgraph). """
+    class Meta:
+        db_table = "annotation_graph_version"
+    project = models.OneToOneField(Project, primary_key=True)
+    change_txid = models.BigIntegerField(default=0)
+
+class OntologyVersion(models.Model):
+    """ The ID of the transaction that last changed a relation or a class of a
+    project, and the number of such changes, kept current by triggers on the
+    relation and class tables. In-memory name to ID maps of the relations and
+    classes of the project are valid as long as they don't change (see
+    catmaid.control.common). """
+    class Meta:
+        db_table = "ontology_version"
+    project = models.OneToOneField(Project, primary_key=True)
+    change_txid = models.BigIntegerField(default=0)
+    change_count = models.BigIntegerField(default=0)
+
+class UserDomainVersion(models.Model):
+    """ The ID of the transaction that last changed a group, a group
+    membership or a username, and the number of such changes, kept current by
+    triggers on the tables of users and groups. Edit domains of users are
+    cached under them (see catmaid.control.authentication.user_domain). The
+    table has a single row. """
+    class Meta:
+        db_table = "user_domain_version"
+    change_txid = models.BigIntegerField(default=0)
+    change_count = models.BigIntegerField(default=0)
+
 class RegionOfInterest(UserFocusedModel):
     class Meta:
         db_table = "region_of_interest"
@@ -670,6 +759,28 @@ class ApiKey(models.Model):
     description = models.TextField()
     key = models.CharField(max_length=128)
 
+class Job(UserFocusedModel):
+    """ A long running analysis or export, computed by a view outside of the
+    request that submitted it (see catmaid.control.jobs). """
+    class Meta:
+        db_table = "job"
+    kind = models.CharField(max_length=255)
+    # The URL-encoded parameters of the view, and the hash by which the
+    # result of identical jobs is reused
+    params = models.TextField()
+    params_hash = models.CharField(max_length=40, db_index=True)
+    status = models.CharField(max_length=16, default='queued',
+            choices=(('queued', 'Queued'), ('running', 'Running'),
+                     ('done', 'Done'), ('failed', 'Failed'),
+                     ('cancelled', 'Cancelled')))
+    progress = models.FloatField(default=0)
+    error = models.TextField(blank=True, default='')
+    # The response of the view; its content is base64-encoded unless text
+    result = models.TextField(blank=True, default='')
+    result_mimetype = models.CharField(max_length=255, blank=True, default='')
+    result_disposition = models.CharField(max_length=255, blank=True, default='')
+    completion_time = models.DateTimeField(null=True)
+
 class Log(UserFocusedModel):
     class Meta:
         db_table = "log"
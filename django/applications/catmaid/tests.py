@@ -42,6 +42,43 @@ def ensure_schema_and_data_exist():
         cursor.execute(fp.read())
 
 
+def add_annotation_ontology(project_id):
+    """ Add the annotation class and the annotated_with relation, which the
+    example data lacks, to the project and return them. """
+    from catmaid.models import Class, Relation
+    annotation_class = Class.objects.create(user_id=3, project_id=project_id,
+            class_name='annotation', description='')
+    annotated_with = Relation.objects.create(user_id=3, project_id=project_id,
+            relation_name='annotated_with', uri='', description='',
+            isreciprocal=False)
+    return annotation_class, annotated_with
+
+
+class CountingCursor(object):
+    """ A database cursor wrapper that counts the executed queries. """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.count = 0
+
+    def execute(self, *args):
+        self.count += 1
+        return self.cursor.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def new_connection():
+    """ Open a new connection to the test database, with its own session. """
+    import psycopg2
+    settings = connection.settings_dict
+    params = {'database': settings['NAME'], 'user': settings['USER'],
+              'password': settings['PASSWORD'], 'host': settings['HOST'],
+              'port': settings['PORT']}
+    return psycopg2.connect(**{k: v for k, v in params.iteritems() if v})
+
+
 def remove_example_data():
     """
     This function will remove example data from the database, without touching
@@ -283,6 +320,23 @@ class ViewPageTests(TestCase):
         self.client.cookies['PHPSESSID'] = 'f9v85q77vuvamsr0tlnv5inkk5'
         self.client.cookies['PHPSESSID']['path'] = '/'
 
+    def test_skeleton_summaries(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT count(*) FROM treenode WHERE skeleton_id = 235
+        ''')
+        node_count = cursor.fetchone()[0]
+        response = self.client.post(
+                '/%d/skeletons/summary' % self.test_project_id,
+                {'skeleton_ids[0]': 235})
+        self.assertEqual(response.status_code, 200)
+        summaries = json.loads(response.content)
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0][0], 235)
+        self.assertEqual(summaries[0][1], node_count)
+        self.assertTrue(summaries[0][2] > 0)
+
     def compare_swc_data(self, s1, s2):
         m1 = swc_string_to_sorted_matrix(s1)
         m2 = swc_string_to_sorted_matrix(s2)
@@ -2577,3 +2631,1576 @@ class TreenodeTests(TestCase):
         connectors = Connector.objects.filter(
             treenodeconnector__treenode__treenodeclassinstance__class_instance=skeleton)
         self.assertEqual(len(connectors), 3)
+
+    def update_radius(self, treenode_id, option):
+        """ Set the radius of the treenode with the given option, and return
+        the set of IDs of the treenodes of skeleton 235 that changed. """
+        if not User.objects.filter(username='editor').exists():
+            User.objects.create_superuser('editor', 'editor@example.com', 'e')
+        self.client.login(username='editor', password='e')
+        Treenode.objects.filter(skeleton=235).update(radius=-1)
+        response = self.client.post('/%d/treenode/%d/radius' % (
+                self.test_project_id, treenode_id), {'radius': 7, 'option': option})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'success': True})
+        return set(Treenode.objects.filter(skeleton=235, radius=7) \
+                .values_list('id', flat=True))
+
+    # Skeleton 235 runs from its root 237 along 239 ... 251 to the branch
+    # node 253, which continues to the end node 261 along 255, 257 and 259,
+    # and along 263 to the branch node 265 with the end nodes 277 and 417.
+
+    def test_update_radius_down_to_branch(self):
+        self.assertEqual(self.update_radius(241, 1),
+                set([241, 243, 245, 247, 249, 251, 253]))
+        self.assertEqual(self.update_radius(255, 1), set([255, 257, 259, 261]))
+        self.assertEqual(self.update_radius(253, 1), set([253]))
+        self.assertEqual(self.update_radius(261, 1), set([261]))
+
+    def test_update_radius_up_to_branch(self):
+        self.assertEqual(self.update_radius(261, 2), set([255, 257, 259, 261]))
+        # Up to the root, which has a single child
+        self.assertEqual(self.update_radius(243, 2), set([237, 239, 241, 243]))
+        self.assertEqual(self.update_radius(237, 2), set([237]))
+
+    def test_update_radius_up_to_root(self):
+        self.assertEqual(self.update_radius(277, 3), set([277, 275, 273, 271,
+                269, 265, 263, 253, 251, 249, 247, 245, 243, 241, 239, 237]))
+        self.assertEqual(self.update_radius(237, 3), set([237]))
+
+
+class NodeListTests(TestCase):
+
+    def setUp(self):
+        from catmaid.control.nodecache import _node_tiles
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+        User.objects.create_superuser('tracer', 'tracer@example.com', 't')
+        self.client = Client()
+        self.client.login(username='tracer', password='t')
+        _node_tiles.clear()
+
+    def node_list(self, tile_size, **view):
+        from django.test.utils import override_settings
+        params = {'z': 0, 'zres': 9, 'left': 4430, 'top': 2280,
+                  'width': 8000, 'height': 3450}
+        params.update(view)
+        with override_settings(NODE_LIST_TILE_SIZE=tile_size):
+            response = self.client.post('/%d/node/list' % self.test_project_id,
+                    params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def ids(self, rows):
+        return set(row[0] for row in rows)
+
+    def in_view(self, left, top, right, bottom):
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT id FROM treenode
+        WHERE project_id = %s
+          AND (location).z >= -4.5 AND (location).z < 4.5
+          AND (location).x >= %s AND (location).x < %s
+          AND (location).y >= %s AND (location).y < %s
+        ''', (self.test_project_id, left, right, top, bottom))
+        return set(row[0] for row in cursor.fetchall())
+
+    def create_treenode(self, x, y):
+        response = self.client.post('/%d/treenode/create' % self.test_project_id,
+                {'x': x, 'y': y, 'z': 0, 'confidence': 5, 'radius': -1})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['treenode_id']
+
+    def test_tiles_match_the_view(self):
+        untiled = self.node_list(0)
+        self.assertTrue(self.in_view(4430, 2280, 12430, 5730) <= self.ids(untiled[0]))
+        self.assertFalse(untiled[3])
+        # Tiles smaller and larger than the view, fetched and then cached
+        for tile_size in (1000, 4096, 1000, 4096):
+            tiled = self.node_list(tile_size)
+            self.assertEqual(self.ids(tiled[0]), self.ids(untiled[0]))
+            self.assertEqual(self.ids(tiled[1]), self.ids(untiled[1]))
+            self.assertEqual(tiled[3], untiled[3])
+
+    def test_right_and_bottom_bounds_are_exclusive(self):
+        # A root on the corner of four tiles of 1000 units
+        treenode_id = self.create_treenode(3000, 3000)
+        views = (
+            ((2000, 2000, 1000, 1000), False),
+            ((2000, 3000, 1000, 10), False),
+            ((3000, 2000, 10, 1000), False),
+            ((3000, 3000, 10, 10), True),
+            ((2500, 2500, 1000, 1000), True))
+        for tile_size in (0, 1000):
+            for (left, top, width, height), shown in views:
+                nodes = self.node_list(tile_size, left=left, top=top,
+                        width=width, height=height)
+                self.assertEqual(treenode_id in self.ids(nodes[0]), shown)
+
+    def test_limit_applies_to_the_view(self):
+        from catmaid.control.node import _node_list_params, _section_node_lists
+        from catmaid.control.common import get_relation_to_id_map
+        from django.test.utils import override_settings
+
+        class FakeRequest(object):
+            POST = {'z': 0, 'zres': 9, 'left': 4430, 'top': 2280,
+                    'width': 8000, 'height': 3450}
+
+        cursor = connection.cursor()
+        relation_map = get_relation_to_id_map(self.test_project_id)
+        shown = self.in_view(4430, 2280, 12430, 5730)
+        params = _node_list_params(FakeRequest(), self.test_project_id)
+        for tile_size in (0, 1000, 4096):
+            with override_settings(NODE_LIST_TILE_SIZE=tile_size):
+                # Nodes of the tiles outside of the view don't count
+                params['limit'] = len(shown)
+                views, limit_reached = _section_node_lists(cursor,
+                        self.test_project_id, (0.0,), params, relation_map, False)
+                self.assertEqual(limit_reached, set())
+                self.assertTrue(shown <= set(views[0.0]['treenodes']))
+                # The treenode with the highest ID is left out
+                params['limit'] = len(shown) - 1
+                views, limit_reached = _section_node_lists(cursor,
+                        self.test_project_id, (0.0,), params, relation_map, False)
+                self.assertEqual(limit_reached, set([0.0]))
+                self.assertTrue(set(sorted(shown)[:-1]) <= set(views[0.0]['treenodes']))
+
+    def test_edits_invalidate_cached_tiles(self):
+        tile_a = {'left': 2000, 'top': 2000, 'width': 1000, 'height': 1000}
+        tile_b = {'left': 3000, 'top': 2000, 'width': 1000, 'height': 1000}
+
+        def nodes(view, labels=False):
+            return self.node_list(1000, labels='true' if labels else 'false',
+                    **view)
+
+        def post(url, data):
+            response = self.client.post(url % self.test_project_id, data)
+            self.assertEqual(response.status_code, 200)
+            result = json.loads(response.content)
+            self.assertFalse(isinstance(result, dict) and 'error' in result)
+            return result
+
+        # Fill the cache with both tiles
+        nodes(tile_a)
+        nodes(tile_b)
+
+        # Creation
+        root_id = self.create_treenode(2500, 2700)
+        treenode_id = post('/%d/treenode/create', {'x': 2500, 'y': 2500,
+                'z': 0, 'confidence': 5, 'radius': -1,
+                'parent_id': root_id})['treenode_id']
+        self.assertTrue(set([root_id, treenode_id]) <= self.ids(nodes(tile_a)[0]))
+        self.assertFalse(treenode_id in self.ids(nodes(tile_b)[0]))
+
+        # Move across the border of the tiles: both change
+        post('/%d/node/update', {'t[0][0]': treenode_id, 't[0][1]': 3500,
+                't[0][2]': 2500, 't[0][3]': 0})
+        self.assertFalse(treenode_id in self.ids(nodes(tile_a)[0]))
+        moved = [row for row in nodes(tile_b)[0] if row[0] == treenode_id]
+        self.assertEqual(len(moved), 1)
+        self.assertEqual((moved[0][2], moved[0][3]), (3500, 2500))
+
+        # Link to a connector
+        connector_id = post('/%d/connector/create', {'x': 3600, 'y': 2600,
+                'z': 0, 'confidence': 5})['connector_id']
+        connectors = dict((row[0], row) for row in nodes(tile_b)[1])
+        self.assertEqual(connectors[connector_id][5], [])
+        post('/%d/link/create', {'from_id': treenode_id, 'to_id': connector_id,
+                'link_type': 'presynaptic_to'})
+        connectors = dict((row[0], row) for row in nodes(tile_b)[1])
+        self.assertEqual(connectors[connector_id][5], [[treenode_id, 5]])
+
+        # Labels
+        self.assertFalse(str(treenode_id) in nodes(tile_b, True)[2])
+        post('/%%d/label/treenode/%d/update' % treenode_id, {'tags': 'cached'})
+        self.assertEqual(nodes(tile_b, True)[2][str(treenode_id)], ['cached'])
+
+        # Deletion
+        post('/%d/treenode/delete', {'treenode_id': treenode_id})
+        self.assertFalse(treenode_id in self.ids(nodes(tile_b)[0]))
+        self.assertTrue(root_id in self.ids(nodes(tile_a)[0]))
+
+    def test_sections_match_single_sections(self):
+        from django.test.utils import override_settings
+        # Sections 9 units apart around the one of the treenodes at z 0
+        for tile_size in (0, 1000):
+            with override_settings(NODE_LIST_TILE_SIZE=tile_size):
+                response = self.client.post(
+                        '/%d/node/list-sections' % self.test_project_id,
+                        {'z': 0, 'zres': 9, 'left': 4430, 'top': 2280,
+                         'width': 8000, 'height': 3450, 'n_sections': 2})
+            self.assertEqual(response.status_code, 200)
+            sections = json.loads(response.content)
+            self.assertEqual([z for z, nodes in sections],
+                    [-18, -9, 0, 9, 18])
+            for z, nodes in sections:
+                single = self.node_list(tile_size, z=z)
+                self.assertEqual(self.ids(nodes[0]), self.ids(single[0]))
+                self.assertEqual(self.ids(nodes[1]), self.ids(single[1]))
+                self.assertEqual(nodes[3], single[3])
+            self.assertTrue(self.in_view(4430, 2280, 12430, 5730) <=
+                    self.ids(sections[2][1][0]))
+
+
+class SkeletonSummaryTests(TestCase):
+
+    def setUp(self):
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+        self.cursor = connection.cursor()
+
+    def summary(self, skeleton_id):
+        self.cursor.execute('''
+        SELECT node_count, cable_length, num_presynaptic, num_postsynaptic
+        FROM skeleton_summary
+        WHERE skeleton_id = %s
+        ''', (skeleton_id,))
+        row = self.cursor.fetchone()
+        self.cursor.execute('''
+        SELECT sum(node_count) FROM skeleton_reviewer_summary
+        WHERE skeleton_id = %s
+        ''', (skeleton_id,))
+        return row[0], round(row[1], 3), row[2], row[3], self.cursor.fetchone()[0]
+
+    def recount(self, skeleton_id):
+        self.cursor.execute('''
+        SELECT count(*),
+               COALESCE(sum(CASE WHEN p.id IS NULL THEN 0.0 ELSE
+                   sqrt(((p.location).x - (t.location).x) ^ 2
+                      + ((p.location).y - (t.location).y) ^ 2
+                      + ((p.location).z - (t.location).z) ^ 2) END), 0.0)
+        FROM treenode t LEFT OUTER JOIN treenode p ON t.parent_id = p.id
+        WHERE t.skeleton_id = %s
+        ''', (skeleton_id,))
+        node_count, cable_length = self.cursor.fetchone()
+        self.cursor.execute('''
+        SELECT sum(CASE WHEN r.relation_name = 'presynaptic_to' THEN 1 ELSE 0 END),
+               sum(CASE WHEN r.relation_name = 'postsynaptic_to' THEN 1 ELSE 0 END)
+        FROM treenode_connector tc, relation r
+        WHERE tc.skeleton_id = %s
+          AND tc.relation_id = r.id
+        ''', (skeleton_id,))
+        pre, post = self.cursor.fetchone()
+        return node_count, round(cable_length, 3), pre or 0, post or 0, node_count
+
+    def test_triggers_follow_edits(self):
+        self.assertEqual(self.summary(235), self.recount(235))
+        treenode = Treenode.objects.filter(skeleton=235,
+                parent__isnull=False)[0]
+        treenode.location = Double3D(treenode.location.x + 100,
+                treenode.location.y, treenode.location.z)
+        treenode.save()
+        self.assertEqual(self.summary(235), self.recount(235))
+
+    def test_defer_setting_is_off_unless_set(self):
+        # A new session has never set it, and there is no database default
+        other = new_connection()
+        try:
+            cursor = other.cursor()
+            cursor.execute('SELECT skeleton_summary_deferred()')
+            self.assertEqual(cursor.fetchone()[0], False)
+        finally:
+            other.close()
+        self.cursor.execute('''
+        SELECT set_config('catmaid.defer_skeleton_summary', 'on', true),
+               skeleton_summary_deferred()
+        ''')
+        self.assertEqual(self.cursor.fetchone()[1], True)
+        self.cursor.execute('''
+        SELECT set_config('catmaid.defer_skeleton_summary', 'off', true),
+               skeleton_summary_deferred()
+        ''')
+        self.assertEqual(self.cursor.fetchone()[1], False)
+
+    def test_bulk_moves(self):
+        from catmaid.control.skeleton import _move_treenodes, _subtree
+        skeleton = ClassInstance(user_id=3, project_id=self.test_project_id,
+                class_column_id=get_class_to_id_map(self.test_project_id)['skeleton'],
+                name='moved')
+        skeleton.save()
+        treenode = Treenode.objects.filter(skeleton=235,
+                parent__isnull=False).order_by('id')[0]
+        moved = _subtree(self.cursor, treenode.id)
+        _move_treenodes(self.cursor, moved, skeleton.id)
+        self.assertEqual(Treenode.objects.filter(skeleton=skeleton.id).count(),
+                len(moved))
+        self.assertEqual(self.summary(235), self.recount(235))
+        self.assertEqual(self.summary(skeleton.id), self.recount(skeleton.id))
+        # Row by row updates resume after the move
+        Treenode.objects.filter(id=moved[-1]).delete()
+        self.assertEqual(self.summary(skeleton.id), self.recount(skeleton.id))
+
+
+class SkeletonMeasurementTests(TestCase):
+
+    def setUp(self):
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+        User.objects.create_superuser('measurer', 'measurer@example.com', 'm')
+        self.client = Client()
+        self.client.login(username='measurer', password='m')
+
+    def reference(self, skeleton_id):
+        """ The measurements as computed node by node before they were
+        computed on arrays: raw, smooth and principal branch cable, and the
+        number of ends and branches. """
+        from collections import defaultdict
+        from math import sqrt
+        from catmaid.control.tree_util import Arbor, partition
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT id, parent_id, (location).x, (location).y, (location).z
+        FROM treenode WHERE skeleton_id = %s
+        ''', (skeleton_id,))
+        rows = cursor.fetchall()
+        parents = {row[0]: row[1] for row in rows}
+        locations = {row[0]: row[2:5] for row in rows}
+        children = defaultdict(dict)
+
+        def distance(a, b):
+            return sqrt(sum((u - v) ** 2 for u, v in zip(a, b)))
+
+        raw_cable = 0
+        for node, parent in parents.iteritems():
+            if parent:
+                children[parent][node] = distance(locations[node], locations[parent])
+                raw_cable += children[parent][node]
+        n_ends, n_branch = 0, 0
+        smooth = dict(locations)
+        for node, parent in parents.iteritems():
+            n_children = len(children[node])
+            if not parent:
+                if 1 == n_children:
+                    n_ends += 1
+                    continue
+                if n_children > 2:
+                    n_branch += 1
+                    continue
+                # A root with two children is a slab node
+            elif 0 == n_children:
+                n_ends += 1
+                continue
+            elif n_children > 1:
+                n_branch += 1
+                continue
+            others = dict(children[node])
+            if parent:
+                others[parent] = children[parent][node]
+            total = sum(others.itervalues())
+            if total > 0:
+                smooth[node] = tuple(0.4 * locations[node][k] + 0.6 *
+                        sum(locations[o][k] * d / total for o, d in others.iteritems())
+                        for k in xrange(3))
+        sequences = sorted(partition(Arbor.from_rows(
+                (node, parent) for node, parent in parents.iteritems())), key=len)
+        principal = set(sequences[-1]) if sequences else set()
+        smooth_cable, principal_branch_cable = 0, 0
+        for node, parent in parents.iteritems():
+            if parent:
+                length = distance(smooth[node], smooth[parent])
+                smooth_cable += length
+                if node in principal:
+                    principal_branch_cable += length
+        return raw_cable, smooth_cable, principal_branch_cable, n_ends, n_branch
+
+    def create_treenode(self, x, y, parent_id=-1):
+        response = self.client.post('/%d/treenode/create' % self.test_project_id,
+                {'x': x, 'y': y, 'z': 0, 'confidence': 5, 'radius': -1,
+                 'parent_id': parent_id})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_measure_arbor(self):
+        from math import sqrt
+        from catmaid.control.morphology import measure_arbor
+        # A root with two children, which makes it a slab node
+        m = measure_arbor([1, 2, 3, 4], [None, 1, 1, 2],
+                [(0, 0, 0), (100, 0, 0), (-100, 0, 0), (100, 100, 0)])
+        self.assertEqual((m.n_nodes, m.n_ends, m.n_branch), (4, 2, 0))
+        self.assertAlmostEqual(m.raw_cable, 300)
+        # Node 2 moves to (70, 30, 0), the root stays in place
+        self.assertAlmostEqual(m.smooth_cable, 100 + 2 * sqrt(5800))
+        self.assertAlmostEqual(m.principal_branch_cable, 2 * sqrt(5800))
+
+    def test_matches_reference(self):
+        from catmaid.control.skeletonexport import _measure_skeletons
+        # A skeleton whose root has two children
+        root = self.create_treenode(0, 0)
+        a = self.create_treenode(100, 0, root['treenode_id'])['treenode_id']
+        self.create_treenode(-100, 0, root['treenode_id'])
+        self.create_treenode(100, 100, a)
+        self.create_treenode(100, 250, a)
+        skeleton_ids = (235, 361, 373, 2433, root['skeleton_id'])
+        skeletons = _measure_skeletons(skeleton_ids)
+        for skeleton_id in skeleton_ids:
+            sk = skeletons[skeleton_id]
+            expected = self.reference(skeleton_id)
+            measured = (sk.raw_cable, sk.smooth_cable,
+                    sk.principal_branch_cable, sk.n_ends, sk.n_branch)
+            for e, m in zip(expected, measured):
+                self.assertAlmostEqual(e, m)
+            self.assertEqual(sk.n_nodes, Treenode.objects.filter(
+                    skeleton=skeleton_id).count())
+        self.assertEqual((skeletons[root['skeleton_id']].n_ends,
+                skeletons[root['skeleton_id']].n_branch), (3, 1))
+
+
+class SkeletonConnectivityTests(TestCase):
+
+    def setUp(self):
+        from catmaid.control.connectivity import _indices
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+        self.cursor = connection.cursor()
+        relations = get_relation_to_id_map(self.test_project_id)
+        self.pre = relations['presynaptic_to']
+        self.post = relations['postsynaptic_to']
+        add_annotation_ontology(self.test_project_id)
+        User.objects.create_superuser('wirer', 'wirer@example.com', 'w')
+        self.client = Client()
+        self.client.login(username='wirer', password='w')
+        _indices.clear()
+
+    def stored(self):
+        self.cursor.execute('''
+        SELECT pre_skeleton_id, post_skeleton_id, num_synapses
+        FROM skeleton_connectivity
+        WHERE project_id = %s
+          AND num_synapses <> 0
+        ''', (self.test_project_id,))
+        return {(row[0], row[1]): row[2] for row in self.cursor.fetchall()}
+
+    def recount(self):
+        self.cursor.execute('''
+        SELECT tc1.skeleton_id, tc2.skeleton_id, count(*)
+        FROM treenode_connector tc1, treenode_connector tc2
+        WHERE tc1.project_id = %s
+          AND tc1.relation_id = %s
+          AND tc2.connector_id = tc1.connector_id
+          AND tc2.relation_id = %s
+        GROUP BY tc1.skeleton_id, tc2.skeleton_id
+        ''', (self.test_project_id, self.pre, self.post))
+        return {(row[0], row[1]): row[2] for row in self.cursor.fetchall()}
+
+    def create_connector(self):
+        response = self.client.post('/%d/connector/create' % self.test_project_id,
+                {'x': 5000, 'y': 3000, 'z': 0, 'confidence': 5})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['connector_id']
+
+    def link(self, treenode_id, connector_id, relation_id):
+        TreenodeConnector.objects.create(user_id=3, project_id=self.test_project_id,
+                relation_id=relation_id, treenode_id=treenode_id,
+                connector_id=connector_id,
+                skeleton_id=Treenode.objects.get(id=treenode_id).skeleton_id)
+
+    def test_insert_and_delete(self):
+        self.assertEqual(self.stored(), self.recount())
+        before = self.stored()
+        connector_id = self.create_connector()
+        # Skeletons 361, 373 and 2433 through their nodes 367, 377 and 2437
+        self.link(367, connector_id, self.pre)
+        self.assertEqual(self.stored(), before)
+        self.link(377, connector_id, self.post)
+        self.assertEqual(self.stored(), self.recount())
+        self.assertEqual(self.stored()[(361, 373)], before.get((361, 373), 0) + 1)
+        # A second presynaptic link to the connector is counted as well
+        self.link(2437, connector_id, self.pre)
+        self.assertEqual(self.stored(), self.recount())
+        self.assertEqual(self.stored()[(2433, 373)], before.get((2433, 373), 0) + 1)
+        TreenodeConnector.objects.filter(treenode=367, connector=connector_id).delete()
+        self.assertEqual(self.stored(), self.recount())
+        # Both remaining links, deleted by one statement
+        self.cursor.execute('''
+        DELETE FROM treenode_connector WHERE connector_id = %s
+        ''', (connector_id,))
+        self.assertEqual(self.stored(), before)
+
+    def test_multi_row_insert(self):
+        before = self.stored()
+        connector_id = self.create_connector()
+        # One presynaptic and two postsynaptic links, inserted together
+        self.cursor.execute('''
+        INSERT INTO treenode_connector (user_id, project_id, relation_id,
+                treenode_id, connector_id, skeleton_id)
+        SELECT 3, t.project_id, CASE WHEN t.id = 367 THEN %s ELSE %s END,
+               t.id, %s, t.skeleton_id
+        FROM treenode t
+        WHERE t.id IN (367, 377, 2437)
+        ''', (self.pre, self.post, connector_id))
+        self.assertEqual(self.stored(), self.recount())
+        self.assertEqual(self.stored()[(361, 373)], before.get((361, 373), 0) + 1)
+        self.assertEqual(self.stored()[(361, 2433)], before.get((361, 2433), 0) + 1)
+
+    def test_skeleton_changes(self):
+        connector_id = self.create_connector()
+        # From skeleton 361 to a branch of skeleton 235 and to skeleton 373
+        self.link(367, connector_id, self.pre)
+        self.link(267, connector_id, self.post)
+        self.link(377, connector_id, self.post)
+        before = self.stored()
+        response = self.client.post('/%d/skeleton/split' % self.test_project_id,
+                {'treenode_id': 265})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored(), self.recount())
+        response = self.client.post('/%d/skeleton/join' % self.test_project_id,
+                {'from_id': 263, 'to_id': 265})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored(), self.recount())
+        self.assertEqual(self.stored(), before)
+        # All links of the connector move to one skeleton in one statement,
+        # which changes both ends of its synapses
+        self.cursor.execute('''
+        UPDATE treenode_connector SET skeleton_id = 2433
+        WHERE connector_id = %s
+        ''', (connector_id,))
+        self.assertEqual(self.stored(), self.recount())
+        self.assertEqual(self.stored()[(2433, 2433)], before.get((2433, 2433), 0) + 2)
+
+    def previous_export(self, limit):
+        """ The edges and skeletons of the export, as the query of the export
+        computed them before it read skeleton_connectivity. """
+        self.cursor.execute('''
+        WITH counts AS (
+            SELECT skeleton_id, count(*) AS n
+            FROM treenode
+            WHERE project_id = %(project_id)s
+            GROUP BY skeleton_id
+            HAVING count(*) >= %(limit)s)
+        SELECT tc1.skeleton_id, tc2.skeleton_id, count(*), c1.n, c2.n
+        FROM treenode_connector tc1,
+             treenode_connector tc2,
+             counts c1,
+             counts c2
+        WHERE tc1.project_id = %(project_id)s
+          AND tc1.relation_id = %(pre)s
+          AND tc2.connector_id = tc1.connector_id
+          AND tc2.relation_id = %(post)s
+          AND c1.skeleton_id = tc1.skeleton_id
+          AND c2.skeleton_id = tc2.skeleton_id
+        GROUP BY tc1.skeleton_id, tc2.skeleton_id, c1.n, c2.n
+        ''', {'project_id': self.test_project_id, 'limit': limit,
+              'pre': self.pre, 'post': self.post})
+        edges, nodes = {}, {}
+        for row in self.cursor.fetchall():
+            edges[(str(row[0]), str(row[1]))] = row[2]
+            nodes[str(row[0])] = row[3]
+            nodes[str(row[1])] = row[4]
+        return edges, nodes
+
+    def previous_diagram(self, limit):
+        """ The edges of get_wiring_diagram, as it computed them from the
+        links before it read the connectivity index, except that every
+        presynaptic link of a connector is counted, not only the first. """
+        from collections import defaultdict
+        from django.db.models import Count
+        pre = defaultdict(list)
+        for e in TreenodeConnector.objects.filter(project=self.test_project_id,
+                relation=self.pre):
+            pre[e.connector_id].append(e.skeleton_id)
+        skeletons = dict(Treenode.objects.filter(project=self.test_project_id) \
+                .values_list('skeleton').annotate(Count('id')))
+        edges = defaultdict(int)
+        for e in TreenodeConnector.objects.filter(project=self.test_project_id,
+                relation=self.post):
+            for skeleton_id in pre.get(e.connector_id, ()):
+                if skeletons[skeleton_id] >= limit and skeletons[e.skeleton_id] >= limit:
+                    edges[(str(skeleton_id), str(e.skeleton_id))] += 1
+        return dict(edges), skeletons
+
+    def test_exports_match_previous_output(self):
+        from itertools import chain
+        from catmaid.control.wiringdiagram import get_wiring_diagram
+        # A connector with two presynaptic links, each of which now counts
+        connector_id = self.create_connector()
+        self.link(367, connector_id, self.pre)
+        self.link(2437, connector_id, self.pre)
+        self.link(377, connector_id, self.post)
+        for limit in (0, 6):
+            response = self.client.post('/%d/wiringdiagram/json' % self.test_project_id,
+                    {'lower_skeleton_count': limit})
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content)['data']
+            edges, nodes = self.previous_export(limit)
+            self.assertEqual({(e['source'], e['target']): e['number_of_connector']
+                              for e in data['edges']}, edges)
+            self.assertEqual({n['id']: n['node_count'] for n in data['nodes']}, nodes)
+
+            diagram = get_wiring_diagram(self.test_project_id, limit)
+            edges, skeletons = self.previous_diagram(limit)
+            self.assertEqual({(e['source'], e['target']): e['number_of_connector']
+                              for e in diagram['edges']}, edges)
+            self.assertEqual({n['id']: n['node_count'] for n in diagram['nodes']},
+                    {k: skeletons[int(k)] for k in set(chain(*edges))})
+            if 0 == limit:
+                self.assertTrue(('361', '373') in edges)
+                self.assertTrue(('2433', '373') in edges)
+
+
+class SkeletonEditTests(TestCase):
+
+    def setUp(self):
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+        add_annotation_ontology(self.test_project_id)
+        User.objects.create_superuser('editor', 'editor@example.com', 'e')
+        self.client = Client()
+        self.client.login(username='editor', password='e')
+
+    def nodes(self, skeleton_id):
+        return set(Treenode.objects.filter(skeleton=skeleton_id) \
+                .values_list('id', flat=True))
+
+    def neuron_of(self, skeleton_id):
+        return ClassInstanceClassInstance.objects.get(
+                class_instance_a=skeleton_id,
+                relation__relation_name='model_of').class_instance_b_id
+
+    def downstream(self, treenode_id):
+        from collections import defaultdict
+        children = defaultdict(list)
+        for node_id, parent_id in Treenode.objects.filter(
+                skeleton=Treenode.objects.get(id=treenode_id).skeleton_id) \
+                .values_list('id', 'parent_id'):
+            children[parent_id].append(node_id)
+        nodes = [treenode_id]
+        for node_id in nodes:
+            nodes.extend(children[node_id])
+        return set(nodes)
+
+    def count_moves(self):
+        """ Record the number of treenodes moved between skeletons. """
+        from catmaid.control import skeleton
+        moves = []
+        move_treenodes = skeleton._move_treenodes
+        def count(cursor, treenode_ids, skeleton_id):
+            moves.append(len(treenode_ids))
+            return move_treenodes(cursor, treenode_ids, skeleton_id)
+        skeleton._move_treenodes = count
+        self.addCleanup(setattr, skeleton, '_move_treenodes', move_treenodes)
+        return moves
+
+    def test_split_moves_upstream_part(self):
+        # Skeleton 235 of neuron 233 is split below its root 237, so that
+        # nearly all of its nodes are downstream and stay in the skeleton,
+        # which models the new neuron. Only the root moves to a new skeleton,
+        # which models neuron 233.
+        nodes = self.nodes(235)
+        moves = self.count_moves()
+        response = self.client.post('/%d/skeleton/split' % self.test_project_id,
+                {'treenode_id': 239})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {})
+        self.assertEqual(moves, [1])
+        self.assertEqual(self.nodes(235), nodes - set([237]))
+        new_skeleton_id = Treenode.objects.get(id=237).skeleton_id
+        self.assertNotEqual(new_skeleton_id, 235)
+        self.assertEqual(self.nodes(new_skeleton_id), set([237]))
+        self.assertEqual(Treenode.objects.get(id=239).parent_id, None)
+        self.assertEqual(self.neuron_of(new_skeleton_id), 233)
+        self.assertNotEqual(self.neuron_of(235), 233)
+        # Links to connectors move with their treenodes
+        self.assertFalse(TreenodeConnector.objects.filter(
+                skeleton=new_skeleton_id).exclude(treenode=237).exists())
+        self.assertFalse(TreenodeConnector.objects.filter(skeleton=235,
+                treenode=237).exists())
+        log = Log.objects.filter(operation_type='split_skeleton').latest('id')
+        self.assertTrue(log.freetext.startswith(
+                'Split skeleton with ID %s ' % new_skeleton_id))
+
+    def test_moves_are_bounded_by_smaller_part(self):
+        moves = self.count_moves()
+        # A split at a twig moves the twig, and the skeleton keeps neuron 233
+        nodes = self.nodes(235)
+        twig = self.downstream(255)
+        self.assertTrue(len(twig) < len(nodes) - len(twig))
+        self.client.post('/%d/skeleton/split' % self.test_project_id,
+                {'treenode_id': 255})
+        self.assertEqual(moves, [len(twig)])
+        self.assertEqual(self.nodes(235), nodes - twig)
+        self.assertEqual(self.neuron_of(235), 233)
+        # Splits anywhere along the main chain move the smaller part
+        for treenode_id in (243, 249, 253):
+            del moves[:]
+            skeleton_id = Treenode.objects.get(id=treenode_id).skeleton_id
+            total = len(self.nodes(skeleton_id))
+            downstream = len(self.downstream(treenode_id))
+            self.client.post('/%d/skeleton/split' % self.test_project_id,
+                    {'treenode_id': treenode_id})
+            self.assertEqual(moves, [min(downstream, total - downstream)])
+        # A join moves the nodes of the smaller skeleton, whichever side it
+        # is on
+        del moves[:]
+        self.client.post('/%d/skeleton/join' % self.test_project_id,
+                {'from_id': 383, 'to_id': 2437})
+        self.assertEqual(moves, [1])
+
+    def test_join_keeps_larger_skeleton(self):
+        # The single node skeleton 2433 of neuron 2434 is joined with
+        # skeleton 361 of neuron 362, which is larger. Its node moves to
+        # skeleton 361, which then models neuron 2434.
+        nodes = self.nodes(361) | self.nodes(2433)
+        moves = self.count_moves()
+        response = self.client.post('/%d/skeleton/join' % self.test_project_id,
+                {'from_id': 2437, 'to_id': 383})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['message'], 'success')
+        self.assertEqual(moves, [1])
+        self.assertEqual(self.nodes(361), nodes)
+        self.assertEqual(self.nodes(2433), set())
+        self.assertFalse(ClassInstance.objects.filter(id=2433).exists())
+        self.assertFalse(ClassInstance.objects.filter(id=362).exists())
+        self.assertEqual(self.neuron_of(361), 2434)
+        self.assertEqual(Treenode.objects.get(id=383).parent_id, 2437)
+        self.assertFalse(TreenodeConnector.objects.filter(skeleton=2433).exists())
+        log = Log.objects.filter(operation_type='join_skeleton').latest('id')
+        self.assertTrue(log.freetext.startswith('Joined skeleton with ID 2433 '))
+
+
+class SkeletonCacheTests(TestCase):
+
+    def setUp(self):
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+
+    def test_versions_change_with_edits(self):
+        from catmaid.control.skeletoncache import skeleton_versions
+        cursor = connection.cursor()
+        link = TreenodeConnector.objects.filter(
+                project=self.test_project_id)[0]
+        skeleton_id = link.skeleton_id
+        version = skeleton_versions(cursor, [skeleton_id])[skeleton_id]
+        # Links count as part of their skeleton, down to their confidence
+        cursor.execute('''
+        UPDATE treenode_connector SET confidence = 4 WHERE id = %s
+        ''', (link.id,))
+        self.assertNotEqual(version,
+                skeleton_versions(cursor, [skeleton_id])[skeleton_id])
+        self.assertEqual(skeleton_versions(cursor, [-1]), {-1: (0, None)})
+
+
+class NameToIdMapTests(TestCase):
+
+    def setUp(self):
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+
+    def test_maps_follow_database_changes(self):
+        relation_map = get_relation_to_id_map(self.test_project_id)
+        model_of = relation_map['model_of']
+        self.assertEqual(relation_map.get('not_a_relation', -1), -1)
+        self.assertFalse('not_a_relation' in relation_map)
+        # Changes made with raw SQL are noticed as well
+        cursor = connection.cursor()
+        cursor.execute('''
+        UPDATE relation SET relation_name = 'not_a_relation' WHERE id = %s
+        ''', (model_of,))
+        relation_map = get_relation_to_id_map(self.test_project_id)
+        self.assertEqual(relation_map.get('not_a_relation'), model_of)
+        self.assertEqual(relation_map.get('model_of', -1), -1)
+
+        class_map = get_class_to_id_map(self.test_project_id)
+        self.assertTrue('skeleton' in class_map)
+        cursor.execute('''
+        UPDATE class SET class_name = 'not_a_class' WHERE id = %s
+        ''', (class_map['skeleton'],))
+        self.assertFalse('skeleton' in get_class_to_id_map(self.test_project_id))
+
+    def test_version_is_read_once_per_request(self):
+        from catmaid.control import cache
+        cache._start_request(None)
+        try:
+            relation_map = get_relation_to_id_map(self.test_project_id)
+            # The version isn't read again for the rest of the request, so
+            # a raw SQL change goes unnoticed
+            cursor = connection.cursor()
+            cursor.execute('''
+            UPDATE relation SET description = 'changed' WHERE id = %s
+            ''', (relation_map['model_of'],))
+            self.assertTrue(get_relation_to_id_map(self.test_project_id) is relation_map)
+            # Absent names are looked up once
+            self.assertFalse('not_a_relation' in relation_map)
+            self.assertFalse('not_a_relation' in relation_map)
+            self.assertEqual(relation_map.absent, set(['not_a_relation']))
+            # Relations created within the request are seen by the rest of it
+            relation, annotated_with = add_annotation_ontology(self.test_project_id)
+            self.assertEqual(get_relation_to_id_map(self.test_project_id)['annotated_with'],
+                    annotated_with.id)
+        finally:
+            cache._finish_request(None)
+
+
+class UserDomainTests(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import Group
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'a')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'b')
+        self.group = Group.objects.create(name='bob')
+
+    def test_domain_follows_group_changes(self):
+        from catmaid.control.authentication import user_domain
+        cursor = connection.cursor()
+        self.assertEqual(user_domain(cursor, self.alice.id),
+                frozenset([self.alice.id]))
+        # Memberships changed with raw SQL are noticed as well
+        cursor.execute('''
+        INSERT INTO auth_user_groups (user_id, group_id) VALUES (%s, %s)
+        ''', (self.alice.id, self.group.id))
+        self.assertEqual(user_domain(cursor, self.alice.id),
+                frozenset([self.alice.id, self.bob.id]))
+        self.group.name = 'carol'
+        self.group.save()
+        self.assertEqual(user_domain(cursor, self.alice.id),
+                frozenset([self.alice.id]))
+        self.bob.username = 'carol'
+        self.bob.save()
+        self.assertEqual(user_domain(cursor, self.alice.id),
+                frozenset([self.alice.id, self.bob.id]))
+        self.alice.groups.clear()
+        self.assertEqual(user_domain(cursor, self.alice.id),
+                frozenset([self.alice.id]))
+
+    def test_version_is_read_once_per_request(self):
+        from catmaid.control import cache
+        from catmaid.control.authentication import user_domain
+        cache._start_request(None)
+        try:
+            cursor = CountingCursor(connection.cursor())
+            user_domain(cursor, self.alice.id)
+            self.assertEqual(cursor.count, 2)
+            # Only the domain of a new user is queried
+            user_domain(cursor, self.alice.id)
+            user_domain(cursor, self.bob.id)
+            self.assertEqual(cursor.count, 3)
+            # Changes made within the request are seen by the rest of it
+            self.alice.groups.add(self.group)
+            self.assertEqual(user_domain(cursor, self.alice.id),
+                    frozenset([self.alice.id, self.bob.id]))
+        finally:
+            cache._finish_request(None)
+
+
+class BrokenSliceTests(TestCase):
+
+    def setUp(self):
+        ensure_schema_and_data_exist()
+        self.test_stack_id = 3
+
+    def test_broken_slices_follow_changes(self):
+        from catmaid.control.stack import get_broken_slices
+        from catmaid.models import BrokenSlice
+        self.assertEqual(get_broken_slices(self.test_stack_id), frozenset())
+        # Slices changed with raw SQL are noticed as well
+        cursor = connection.cursor()
+        cursor.execute('''
+        INSERT INTO broken_slice (stack_id, index) VALUES (%s, 5), (%s, 7)
+        ''', (self.test_stack_id, self.test_stack_id))
+        self.assertEqual(get_broken_slices(self.test_stack_id), frozenset([5, 7]))
+        BrokenSlice.objects.filter(stack=self.test_stack_id, index=5).delete()
+        self.assertEqual(get_broken_slices(self.test_stack_id), frozenset([7]))
+
+
+class AnnotationQueryTests(TestCase):
+
+    def setUp(self):
+        from catmaid.models import ClassInstanceClassInstance
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+        annotation_class, annotated_with = add_annotation_ontology(
+                self.test_project_id)
+        def annotation(name):
+            return ClassInstance.objects.create(user_id=3,
+                    project_id=self.test_project_id,
+                    class_column=annotation_class, name=name).id
+        def annotate(entity_id, annotation_id, user_id):
+            ClassInstanceClassInstance.objects.create(user_id=user_id,
+                    project_id=self.test_project_id, relation=annotated_with,
+                    class_instance_a_id=entity_id,
+                    class_instance_b_id=annotation_id)
+        # Neuron 2 is annotated with A and B, neuron 233 with A and
+        # annotation B with the meta annotation C
+        self.a = annotation('A')
+        self.b = annotation('B')
+        self.c = annotation('C')
+        annotate(2, self.a, 3)
+        annotate(2, self.b, 2)
+        annotate(233, self.a, 2)
+        annotate(self.b, self.c, 3)
+
+    def query(self, params):
+        from catmaid.control.neuron_annotations import create_annotation_query
+        return set(create_annotation_query(self.test_project_id, params) \
+                .values_list('id', flat=True))
+
+    def test_graph_constraints(self):
+        self.assertEqual(self.query({}), set([self.a, self.b, self.c]))
+        self.assertEqual(self.query({'parallel_annotations[0]': str(self.b)}),
+                set([self.a, self.b]))
+        self.assertEqual(self.query({'annotations[0]': str(self.b)}),
+                set([self.c]))
+        self.assertEqual(self.query({'annotates[0]': str(self.c)}),
+                set([self.b]))
+        self.assertEqual(self.query({'neuron_id': '233'}), set([self.a]))
+        self.assertEqual(self.query({'user_id': '2'}), set([self.a, self.b]))
+        # Constraints are combined
+        self.assertEqual(self.query({'user_id': '3',
+                'parallel_annotations[0]': str(self.b)}), set([self.a]))
+
+    def test_co_annotation_table(self):
+        User.objects.create_superuser('annotator', 'annotator@example.com', 'a')
+        self.client = Client()
+        self.client.login(username='annotator', password='a')
+        response = self.client.post('/%d/annotations/table-list' % self.test_project_id,
+                {'parallel_annotations[0]': self.a, 'iSortCol_0': 2,
+                 'iSortingCols': 1, 'sSortDir_0': 'desc',
+                 'iDisplayStart': 0, 'iDisplayLength': 1})
+        self.assertEqual(response.status_code, 200)
+        table = json.loads(response.content)
+        # A and B, sorted by usage and paged in the database
+        self.assertEqual(table['iTotalRecords'], 2)
+        self.assertEqual(len(table['aaData']), 1)
+        self.assertEqual(table['aaData'][0][0], 'A')
+        self.assertEqual(table['aaData'][0][2], 2)
+        self.assertEqual(table['aaData'][0][4], self.a)
+
+
+class DatatableTests(TestCase):
+
+    # Ten rows with a nullable and a unique column
+    query = '''
+    SELECT i AS id, CASE WHEN i %% 3 = 0 THEN NULL ELSE i %% 4 END AS v
+    FROM generate_series(1, %s) i
+    '''
+
+    def setUp(self):
+        ensure_schema_and_data_exist()
+        self.cursor = connection.cursor()
+
+    def test_seek(self):
+        from catmaid.control.datatable import SortColumn, _seek
+        order = [SortColumn('v', True, True), SortColumn('id', False, False)]
+        self.assertEqual(_seek(order, (2, 5)),
+                ('q.v <= %s AND ((q.v < %s) OR (q.v = %s AND q.id > %s))',
+                 [2, 2, 2, 5]))
+        # NULLs sort first
+        self.assertEqual(_seek(order, (None, 6)),
+                ('((q.v IS NOT NULL) OR (q.v IS NULL AND q.id > %s))', [6]))
+
+    def test_page_rows(self):
+        from catmaid.control import datatable
+        from catmaid.control.datatable import SortColumn, page_rows, \
+                table_versions
+        order = [SortColumn('v', True, True), SortColumn('id', False, False)]
+        self.cursor.execute('SELECT p.id FROM (' + self.query + ') p '
+                'ORDER BY p.v DESC NULLS FIRST, p.id', [10])
+        expected = [row[0] for row in self.cursor.fetchall()]
+
+        def page(start, length, version):
+            return [row[0] for row in page_rows(self.cursor, self.query, [10],
+                    ['id', 'v'], order, start, length, version, select='p.id')]
+
+        version = table_versions(self.cursor, ('treenode',))
+        # Pages read one after the other seek from the end of the previous
+        self.assertEqual(page(0, 3, version) + page(3, 3, version)
+                + page(6, 3, version) + page(9, 3, version), expected)
+        signature = (self.query, repr([10]), tuple(order))
+        self.assertEqual(sorted(datatable._anchors.get(signature)[1]), [3, 6, 9])
+        # Others seek from the nearest page before them and skip the rest
+        self.assertEqual(page(7, 2, version), expected[7:9])
+        # Anchors are dropped when a table changes
+        Treenode.objects.filter(id=237).update(confidence=4)
+        changed = table_versions(self.cursor, ('treenode',))
+        self.assertNotEqual(changed, version)
+        self.assertEqual(page(4, 5, changed), expected[4:9])
+        self.assertEqual(sorted(datatable._anchors.get(signature)[1]), [9])
+        # also by later statements of the same transaction
+        Treenode.objects.filter(id=237).update(confidence=5)
+        self.assertNotEqual(table_versions(self.cursor, ('treenode',)), changed)
+
+    def test_writers_dont_wait_for_each_other(self):
+        from catmaid.control.datatable import table_versions
+        version = table_versions(self.cursor, ('treenode',))
+        self.assertNotEqual(version, None)
+        writers = [new_connection(), new_connection()]
+        try:
+            cursors = [writer.cursor() for writer in writers]
+            for cursor in cursors:
+                # Give up rather than wait for the other writer
+                cursor.execute("SET statement_timeout = '5s'")
+            # Statement triggers fire even for statements that change no rows,
+            # and both transactions stay open
+            for cursor in cursors:
+                cursor.execute('UPDATE treenode SET confidence = confidence WHERE id = -1')
+            # Their changes aren't visible to this transaction yet
+            self.assertEqual(table_versions(self.cursor, ('treenode',)), None)
+            writers[0].commit()
+            self.assertEqual(table_versions(self.cursor, ('treenode',)), None)
+            writers[1].commit()
+        finally:
+            for writer in writers:
+                writer.close()
+        changed = table_versions(self.cursor, ('treenode',))
+        self.assertNotEqual(changed, None)
+        self.assertNotEqual(changed, version)
+
+
+def echo_job_view(request, project_id=None):
+    return HttpResponse(json.dumps([project_id, request.POST.get('value')]),
+            mimetype='text/json')
+
+
+def failing_job_view(request, project_id=None):
+    raise Exception('Failed on purpose')
+
+
+def slow_job_view(request, project_id=None):
+    import time
+    time.sleep(0.2)
+    return echo_job_view(request, project_id)
+
+
+class JobTests(TestCase):
+
+    def setUp(self):
+        from catmaid.control import jobs
+        ensure_schema_and_data_exist()
+        self.test_project_id = 3
+        self.jobs = jobs
+        jobs._job_kinds['test_echo'] = jobs.JobKind('catmaid.tests.echo_job_view',
+                jobs._browse, 'POST', ('project_id',), False)
+        jobs._job_kinds['test_failure'] = jobs.JobKind('catmaid.tests.failing_job_view',
+                jobs._browse, 'POST', ('project_id',), False)
+        jobs._job_kinds['test_private'] = jobs.JobKind('catmaid.tests.echo_job_view',
+                jobs._browse, 'POST', ('project_id',), True)
+        jobs._job_kinds['test_slow'] = jobs.JobKind('catmaid.tests.slow_job_view',
+                jobs._browse, 'POST', ('project_id',), False)
+        # Record submitted jobs rather than running them on other threads,
+        # which wouldn't see the transaction of the test
+        self.backend = jobs._backend
+        self.submitted = []
+        test = self
+        class RecordingBackend(object):
+            def submit(self, job_id):
+                test.submitted.append(job_id)
+        jobs._backend = RecordingBackend()
+        User.objects.create_superuser('jobs', 'jobs@example.com', 'jobs')
+        self.client = Client()
+        self.client.login(username='jobs', password='jobs')
+
+    def tearDown(self):
+        del self.jobs._job_kinds['test_echo']
+        del self.jobs._job_kinds['test_failure']
+        del self.jobs._job_kinds['test_private']
+        del self.jobs._job_kinds['test_slow']
+        self.jobs._backend = self.backend
+
+    def submit(self, kind, value):
+        response = self.client.post('/%d/jobs/submit' % self.test_project_id,
+                {'kind': kind, 'value': value})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def status(self, job_id):
+        response = self.client.get('/%d/jobs/%d/status' % (self.test_project_id, job_id))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_success(self):
+        job = self.submit('test_echo', 'a')
+        self.assertEqual(job['status'], 'queued')
+        self.assertEqual(self.submitted, [job['id']])
+        self.jobs.run_job(job['id'])
+        self.assertEqual(self.status(job['id'])['status'], 'done')
+        response = self.client.get('/%d/jobs/%d/result' % (self.test_project_id, job['id']))
+        self.assertEqual(response['Content-Type'], 'text/json')
+        self.assertEqual(json.loads(response.content), [str(self.test_project_id), 'a'])
+
+    def test_failure(self):
+        job = self.submit('test_failure', 'a')
+        self.jobs.run_job(job['id'])
+        status = self.status(job['id'])
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['error'], 'Failed on purpose')
+
+    def test_cancel(self):
+        job = self.submit('test_echo', 'a')
+        response = self.client.post('/%d/jobs/%d/cancel' % (self.test_project_id, job['id']))
+        self.assertEqual(json.loads(response.content)['status'], 'cancelled')
+        # Cancelled jobs don't start
+        self.jobs.run_job(job['id'])
+        self.assertEqual(self.status(job['id'])['status'], 'cancelled')
+        # and aren't shared with identical submissions
+        self.assertNotEqual(self.submit('test_echo', 'a')['id'], job['id'])
+
+    def test_dedupe(self):
+        from catmaid.models import Job
+        job = self.submit('test_echo', 'a')
+        # Identical submissions share the queued job, and then its result
+        self.assertEqual(self.submit('test_echo', 'a')['id'], job['id'])
+        self.jobs.run_job(job['id'])
+        self.assertEqual(self.submit('test_echo', 'a')['id'], job['id'])
+        self.assertNotEqual(self.submit('test_echo', 'b')['id'], job['id'])
+        self.assertEqual(len(self.submitted), 2)
+        # Jobs stuck without progress fail, and aren't shared
+        stuck = self.submit('test_echo', 'c')
+        def get_stuck():
+            Job.objects.filter(pk=stuck['id']).update(status='running',
+                    edition_time=datetime.datetime.now() - datetime.timedelta(days=1))
+        get_stuck()
+        self.assertEqual(self.status(stuck['id'])['status'], 'failed')
+        get_stuck()
+        self.assertNotEqual(self.submit('test_echo', 'c')['id'], stuck['id'])
+        self.assertEqual(Job.objects.get(pk=stuck['id']).status, 'failed')
+
+    def test_access(self):
+        private = self.submit('test_private', 'a')
+        shared = self.submit('test_echo', 'a')
+        self.jobs.run_job(private['id'])
+        self.jobs.run_job(shared['id'])
+        User.objects.create_superuser('other', 'other@example.com', 'other')
+        User.objects.create_user('guest', 'guest@example.com', 'guest')
+        for username, can_see_shared in (('other', True), ('guest', False)):
+            client = Client()
+            client.login(username=username, password=username)
+            for job, allowed in ((private, False), (shared, can_see_shared)):
+                for action in ('status', 'result', 'cancel'):
+                    response = client.post('/%d/jobs/%d/%s' % (
+                            self.test_project_id, job['id'], action))
+                    self.assertEqual(response.status_code, 200)
+                    denied = 'permission_error' in json.loads(response.content)
+                    self.assertEqual(denied, not allowed)
+        # The user who submitted the job can still fetch its result
+        response = self.client.get('/%d/jobs/%d/result' % (self.test_project_id, private['id']))
+        self.assertEqual(json.loads(response.content), [str(self.test_project_id), 'a'])
+
+    def test_heartbeat(self):
+        import time
+        from django.test.utils import override_settings
+        # The heartbeat thread has a connection of its own, which wouldn't
+        # see the transaction of the test, so record the beats instead
+        beats = []
+        beat = self.jobs._beat
+        self.jobs._beat = beats.append
+        try:
+            job = self.submit('test_slow', 'a')
+            with override_settings(JOB_HEARTBEAT=0.01):
+                self.jobs.run_job(job['id'])
+            self.assertEqual(self.status(job['id'])['status'], 'done')
+            # The view reported no progress, but the job was kept alive
+            self.assertTrue(beats)
+            self.assertEqual(set(beats), set([job['id']]))
+            # and the heartbeat stopped with it
+            time.sleep(0.05)
+            n_beats = len(beats)
+            time.sleep(0.1)
+            self.assertEqual(len(beats), n_beats)
+        finally:
+            self.jobs._beat = beat
+
+
+class ArborTests(TestCase):
+
+    def setUp(self):
+        # A tree rooted at 1 with a branch at 3:
+        # 1 - 2 - 3 - 4 - 5
+        #          \
+        #           6 - 7
+        from catmaid.control.tree_util import Arbor
+        rows = ((1, None), (2, 1), (3, 2), (4, 3), (5, 4), (6, 3), (7, 6))
+        self.arbor = Arbor.from_rows((i, p, i, 0, 0) for i, p in rows)
+
+    def test_structure(self):
+        self.assertEqual(self.arbor.root, 1)
+        self.assertEqual(sorted(self.arbor.end_nodes().tolist()), [5, 7])
+        self.assertEqual(self.arbor.branch_nodes().tolist(), [3])
+        self.assertEqual(self.arbor.edge_count_to_root(),
+                {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 4, 7: 5})
+        self.assertEqual(self.arbor.find_common_ancestor([5, 7]), (3, 3))
+        self.assertEqual(list(self.arbor.find_common_ancestors(
+                [[4, 5], [5, 6, 2], [7]])), [(4, 4), (2, 2), (7, 0)])
+        self.assertEqual(self.arbor._subtree_sums(
+                [1, 1, 1, 1, 1, 1, 1]).tolist(), [7, 6, 5, 2, 1, 2, 1])
+        pre, size = self.arbor._preorder()
+        self.assertEqual(pre.tolist(), [0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(size.tolist(), [7, 6, 5, 2, 1, 2, 1])
+
+    def test_edge_count_to_root(self):
+        from catmaid.control.tree_util import edge_count_to_root
+        self.assertEqual(edge_count_to_root(self.arbor, root_node=5),
+                {5: 1, 4: 2, 3: 3, 2: 4, 1: 5, 6: 4, 7: 5})
+        self.assertEqual(self.arbor.root, 1)
+
+    def test_reroot(self):
+        arbor = self.arbor.copy()
+        arbor.reroot(5)
+        self.assertEqual(arbor.root, 5)
+        self.assertEqual(self.arbor.root, 1)
+        self.assertEqual(sorted(arbor.end_nodes().tolist()), [1, 7])
+
+    def test_partition_and_simplify(self):
+        sequences = list(self.arbor.partition())
+        self.assertEqual(sequences, [[5, 4, 3, 2, 1], [7, 6, 3]])
+        mini = self.arbor.simplify([1, 5, 7])
+        self.assertEqual(sorted(mini.nodes()), [1, 3, 5, 7])
+        self.assertEqual(sorted(tuple(sorted(e)) for e in mini.edges_iter()),
+                [(1, 3), (3, 5), (3, 7)])
+
+    def test_cable_length(self):
+        # Locations are (id, 0, 0), so each edge spans the difference of IDs
+        self.assertEqual(self.arbor.cable_length(), 4 + 4)
+        spanning = self.arbor.spanning_tree([2, 4])
+        self.assertEqual(sorted(spanning.nodes()), [2, 3, 4])
+        self.assertEqual(spanning.cable_length(), 2)
+
+    def test_split_and_select(self):
+        import numpy as np
+        # Cut the edges from 2 and 6 to their parents
+        cut = np.array([False, True, False, False, False, True, False])
+        parts = self.arbor.split(cut)
+        self.assertEqual([sorted(part.nodes()) for part in parts],
+                [[2, 3, 4, 5], [6, 7], [1]])
+        self.assertEqual([part.root for part in parts], [2, 6, 1])
+        self.assertEqual(parts[0].cable_length(), 3)
+        # Nothing to split, the root has no edge to cut
+        cut = np.array([True, False, False, False, False, False, False])
+        self.assertTrue(self.arbor.split(cut)[0] is self.arbor)
+        selected = self.arbor.select([7, 3, 3])
+        self.assertEqual(sorted(selected.nodes()), [3, 7])
+        self.assertEqual(list(selected.edges_iter()), [])
+
+    def test_split_skeleton_by_confidence(self):
+        from catmaid.control.graph2 import split_skeleton
+        # The edge from 6 to 3 has a low confidence
+        rows = [(i, p, 1 if 6 == i else 5, i, 0, 0) for i, p in
+                ((1, None), (2, 1), (3, 2), (4, 3), (5, 4), (6, 3), (7, 6))]
+        synapses = [(5, 100, 'pre'), (7, 101, 'post')]
+        nodes, branch_nodes, intraedges, memberships = split_skeleton(10,
+                rows, synapses, 3, 0)
+        self.assertEqual(nodes, ['10_1', '10_2'])
+        self.assertEqual(sorted(memberships),
+                [(100, 'pre', '10_1'), (101, 'post', '10_2')])
+        # A node left without edges belongs to no part
+        rows[4] = (5, 4, 1, 5, 0, 0)
+        nodes, branch_nodes, intraedges, memberships = split_skeleton(10,
+                rows, synapses, 3, 0)
+        self.assertEqual(memberships, [(101, 'post', '10_2')])
+
+
+class SynapseClusteringTests(TestCase):
+
+    def setUp(self):
+        # A branched tree, with edges of different lengths:
+        # 9 - 2 - 1
+        #      \
+        #       3 - 4 - 5
+        #        \
+        #         6 - 7 - 8
+        self.locations = {1: (0, 0, 0), 2: (3, 0, 0), 3: (3, 1.5, 0),
+                4: (5, 1.5, 0), 5: (5, 6, 0), 6: (4, 1.5, 0), 7: (4, 4, 0),
+                8: (4, 4.5, 0), 9: (3, -6, 0)}
+        self.parents = {1: None, 2: 1, 3: 2, 4: 3, 5: 4, 6: 3, 7: 6, 8: 7, 9: 2}
+        # Node 8 hosts two synapses
+        self.synapse_nodes = [5, 7, 8, 8, 9]
+
+    def graph(self):
+        import networkx as nx
+        from math import sqrt
+        graph = nx.Graph()
+        for node, parent in self.parents.iteritems():
+            if parent:
+                a, b = self.locations[node], self.locations[parent]
+                graph.add_edge(parent, node,
+                        weight=sqrt(sum((u - v) ** 2 for u, v in zip(a, b))))
+        return graph
+
+    def test_density_and_climb_match_brute_force(self):
+        import networkx as nx
+        import numpy as np
+        from math import exp
+        from catmaid.control.synapseclustering import adjacency, \
+                synapseDensity, climbDensity
+        graph = self.graph()
+        nodeList, id2index, indptr, neighbors, weights = adjacency(graph)
+        synapses = sorted(set(self.synapse_nodes))
+        synIndices = np.array([id2index[node] for node in synapses])
+        distances = {s: nx.single_source_dijkstra_path_length(graph, s)
+                     for s in synapses}
+        h_list = [1.0, 3.0]
+        for cutoff in (None, 2.0):
+            densities = synapseDensity(indptr, neighbors, weights, synIndices,
+                    h_list, cutoff, chunk_size=2)
+            for h, density in zip(h_list, densities):
+                expected = [sum(exp(-(distances[s][node] ** 2) / (h * h))
+                                for s in synapses
+                                if cutoff is None or distances[s][node] <= cutoff * h)
+                            for node in nodeList]
+                self.assertTrue(np.allclose(density, expected))
+                # Hill climbing, one neighbor of highest density at a time
+                target = climbDensity(indptr, neighbors, density)
+                field = dict(zip(nodeList, density))
+                for node in nodeList:
+                    current = node
+                    while True:
+                        best = max(graph.neighbors(current), key=field.get)
+                        if field[best] <= field[current]:
+                            break
+                        current = best
+                    self.assertEqual(nodeList[target[id2index[node]]], current)
+
+    def test_arbor_matches_graph(self):
+        from catmaid.control.synapseclustering import tree_max_density
+        from catmaid.control.tree_util import Arbor
+        arbor = Arbor.from_rows((node, parent) + self.locations[node]
+                                for node, parent in self.parents.iteritems())
+        connector_ids = range(len(self.synapse_nodes))
+        relations = ['presynaptic_to'] * len(self.synapse_nodes)
+
+        def groups(tree):
+            domains = tree_max_density(tree, self.synapse_nodes, connector_ids,
+                    relations, [2.0]).values()[0]
+            return sorted((d.local_max, sorted(d.node_ids)) for d in domains.itervalues())
+
+        self.assertEqual(groups(arbor), groups(self.graph()))
+
+
+class ConnectivityIndexTests(TestCase):
+
+    def setUp(self):
+        from catmaid.control.connectivity import ConnectivityIndex
+        import numpy as np
+        # 1 -> 2 -> 3 -> 4, 1 -> 3 with a single synapse, 5 -> 1
+        self.index = ConnectivityIndex(3)
+        self.index._build(np.array([1, 2, 3, 1, 5]), np.array([2, 3, 4, 3, 1]),
+                np.array([3, 2, 4, 1, 2]))
+
+    def test_neighbors(self):
+        self.assertEqual(self.index.downstream(1), {2: 3, 3: 1})
+        self.assertEqual(self.index.upstream(3, 2), {2: 2})
+        self.assertEqual(self.index.neighbors([1], 2, 1), set([2, 5]))
+        self.assertEqual(self.index.circles([1], 2, 2, None), set([1, 2, 3]))
+
+    def test_incremental_updates(self):
+        self.index._set(1, 3, 0)
+        self.index._set(4, 1, 6)
+        self.assertEqual(self.index.downstream(1), {2: 3})
+        self.assertEqual(self.index.upstream(1), {4: 6, 5: 2})
+        self.index._merge()
+        self.assertEqual(self.index.pending, {})
+        self.assertEqual(sorted(self.index.edges()),
+                [(1, 2, 3), (2, 3, 2), (3, 4, 4), (4, 1, 6), (5, 1, 2)])
+
+    def test_directed_paths(self):
+        self.assertEqual(self.index.directed_paths([1, 4], 2), set([1, 3, 4]))
+        self.assertEqual(self.index.directed_paths([1, 4], 3), set([1, 2, 3, 4]))
+        self.assertEqual(self.index.directed_paths([1, 4], 3, 2), set([1, 2, 3, 4]))
+        self.assertEqual(self.index.directed_paths([5, 4], 2), set())
+
+
+class SectionTests(TestCase):
+
+    def test_section_of(self):
+        from catmaid.control.spatial import section_of
+        self.assertEqual(section_of(9.0, (0.0, 10.0), 5.0), 10.0)
+        self.assertEqual(section_of(4.99, (0.0, 10.0), 5.0), 0.0)
+        self.assertEqual(section_of(5.0, (0.0, 10.0), 5.0), 10.0)
+        self.assertEqual(section_of(15.0, (0.0, 10.0), 5.0), None)
+        self.assertEqual(section_of(10.0, (0.0, 10.0), 0.0), 10.0)
+        self.assertEqual(section_of(9.0, (0.0, 10.0), 0.0), None)
+
+    def test_section_condition(self):
+        from catmaid.control.spatial import section_condition
+        params = [1]
+        condition = section_condition('z', (0.0, 10.0), 5.0, params)
+        self.assertEqual(condition,
+                '((z >= %s AND z < %s) OR (z >= %s AND z < %s))')
+        self.assertEqual(params, [1, -5.0, 5.0, 5.0, 15.0])
+        params = []
+        self.assertEqual(section_condition('z', (0.0, 10.0), 0.0, params),
+                'z IN %s')
+        self.assertEqual(params, [(0.0, 10.0)])
+
+    def test_section_case(self):
+        from catmaid.control.spatial import section_case
+        params = []
+        self.assertEqual(section_case('z', (0.0, 10.0), 5.0, params),
+                'CASE WHEN z >= %s AND z < %s THEN %s '
+                'WHEN z >= %s AND z < %s THEN %s END')
+        self.assertEqual(params, [-5.0, 5.0, 0.0, 5.0, 15.0, 10.0])
+        params = []
+        self.assertEqual(section_case('z', (0.0, 10.0), 0.0, params),
+                'CASE WHEN z = %s THEN %s WHEN z = %s THEN %s END')
+        self.assertEqual(params, [0.0, 0.0, 10.0, 10.0])
+
+
+class AnnotationGraphTests(TestCase):
+
+    def setUp(self):
+        from catmaid.control.annotationgraph import AnnotationGraph
+        self.times = [datetime.datetime(2013, 1, day) for day in xrange(1, 6)]
+        # Link ID, entity ID, annotation ID, user ID, edition time, whether
+        # the entity is a neuron: neurons 1 and 2 are annotated with 10,
+        # neuron 1 with 11, neuron 2 with 13 and annotation 11 with 12
+        self.graph = AnnotationGraph(3)
+        self.graph._add_rows([
+            (1, 1, 10, 3, self.times[0], True),
+            (2, 1, 11, 4, self.times[1], True),
+            (3, 2, 10, 3, self.times[2], True),
+            (4, 11, 12, 4, self.times[3], False),
+            (5, 2, 13, 5, self.times[4], True)])
+
+    def test_sets(self):
+        graph = self.graph
+        self.assertEqual(graph.members(10).tolist(), [1, 2])
+        self.assertEqual(graph.annotations(1).tolist(), [10, 11])
+        self.assertEqual(graph.annotations(11).tolist(), [12])
+        self.assertEqual(graph.user_annotations(4).tolist(), [11, 12])
+        self.assertEqual(graph.annotated_with_all([10, 11]).tolist(), [1])
+        self.assertEqual(graph.annotated_with_all([12]).tolist(), [11])
+        self.assertEqual(graph.annotated_with_all([12], True).tolist(), [])
+        self.assertEqual(graph.annotated_with_all([]).tolist(), [])
+        self.assertEqual(graph.annotations_of_any([1, 2]).tolist(), [10, 11, 13])
+        self.assertEqual(graph.co_annotations([11]).tolist(), [10, 11])
+        self.assertEqual(graph.co_annotations([12]).tolist(), [])
+        self.assertEqual(graph.users(10), set([3]))
+
+    def test_usage(self):
+        self.assertEqual(self.graph.usage(10), (2, self.times[2], 3))
+        self.assertEqual(self.graph.usage(99), (0, None, None))
+
+    def test_update(self):
+        graph = self.graph
+        self.assertEqual(graph.annotations(2).tolist(), [10, 13])
+        graph.update(None, 2, (), [5])
+        self.assertEqual(graph.version, 2)
+        # Derived sets are updated as well
+        self.assertEqual(graph.annotations(2).tolist(), [10])
+        self.assertEqual(graph.user_annotations(5).tolist(), [])
+        self.assertEqual(graph.co_annotations([10]).tolist(), [10, 11])
+
+
+class UserEvaluationTests(TestCase):
+
+    def setUp(self):
+        # A chain 1 - 2 - 3 - 4 - 5, where user 10 created 1 to 3 and the
+        # reviewer, user 20, appended 4 and 5 while reviewing all of them.
+        from catmaid.control.tree_util import Arbor
+        import numpy as np
+        self.arbor = Arbor([1, 2, 3, 4, 5], [None, 1, 2, 3, 4],
+                [(i * 10, 0, 0) for i in xrange(1, 6)],
+                {'user_id': [10, 10, 10, 20, 20],
+                 'creation_time': [100.0, 110.0, 120.0, 1001.5, 1001.6],
+                 'reviewer_id': [20, 20, 20, 20, 20],
+                 'review_time': [1000.0, 1001.0, 1002.0, 1002.0, 1002.0]})
+        self.relations = {'presynaptic_to': 1, 'postsynaptic_to': 2}
+        self.synapses = {
+            'node': self.arbor.index([3, 5]),
+            'user_id': np.array([20, 20]),
+            'relation_id': np.array([1, 2]),
+            'creation_time': np.array([1001.0, 2000.0])}
+
+    def test_evaluate_epochs(self):
+        from catmaid.control.user_evaluation import _split_into_epochs, \
+                _evaluate_epochs
+        import numpy as np
+        epochs = _split_into_epochs(1, self.arbor, 100)
+        self.assertEqual([(reviewer_id, sorted(nodes.tolist()))
+                for reviewer_id, nodes in epochs], [(20, [0, 1, 2, 3, 4])])
+        log_ops = [
+            # Joined at node 2, attributed to the creator of its parent
+            ('join_skeleton', 1001.0, 20, np.array([20.0, 0, 0])),
+            ('split_skeleton', 1001.0, 20, np.array([31.0, 0, 0])),
+            # By another user or outside of the epoch
+            ('split_skeleton', 1001.0, 99, np.array([30.0, 0, 0])),
+            ('split_skeleton', 3000.0, 20, np.array([30.0, 0, 0]))]
+        ops = _evaluate_epochs(epochs, 1, self.arbor, self.synapses, log_ops,
+                self.relations)
+        self.assertEqual(len(ops), 1)
+        ops = ops[0]
+        self.assertEqual(ops.reviewer_id, 20)
+        self.assertEqual(ops.review_date_range, [1000.0, 1002.0])
+        self.assertEqual(ops.user_node_counts, {10: 3, 20: 2})
+        self.assertEqual(ops.node_count, 5)
+        self.assertEqual(dict(ops.splits), {10: 1})
+        self.assertEqual(dict(ops.merges), {10: 1})
+        self.assertEqual(dict(ops.appended), {10: [2]})
+        self.assertEqual((ops.n_pre, ops.n_post), (1, 1))
+        # Only the presynaptic link was made by the reviewer within the epoch
+        self.assertEqual(ops.reviewer_n_pre, {10: 1})
+        self.assertEqual(ops.reviewer_n_post, {})
+        self.assertEqual(ops.newer_pre_count, {10: 1})
+        self.assertEqual(ops.newer_post_count, {})
+
+    def test_epochs_split_at_gaps(self):
+        from catmaid.control.user_evaluation import _split_into_epochs
+        epochs = _split_into_epochs(1, self.arbor, 1.5)
+        self.assertEqual([sorted(nodes.tolist()) for reviewer_id, nodes in epochs],
+                [[0, 1, 2, 3, 4]])
+        epochs = _split_into_epochs(1, self.arbor, 0.5)
+        self.assertEqual([sorted(nodes.tolist()) for reviewer_id, nodes in epochs],
+                [[0], [1], [2, 3, 4]])
+
+
+class LRUCacheTests(TestCase):
+
+    def test_bytes_bound(self):
+        from catmaid.control.cache import LRUCache
+        cache = LRUCache(10, 10, len)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.set('c', 'cccc')
+        # The least recently used value is dropped to make room
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.bytes, 8)
+        # Values larger than the bound aren't kept
+        cache.set('d', 'd' * 11)
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.bytes, 8)
+        cache.set('b', 'bb')
+        self.assertEqual(cache.bytes, 6)
+        cache.delete('c')
+        self.assertEqual(cache.bytes, 2)
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+
+class TileServerTests(TestCase):
+
+    def setUp(self):
+        import tempfile
+        import numpy as np
+        from catmaid.control import tileserver
+        self.tileserver = tileserver
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'stack.hdf')
+        with tileserver.open_hdf5_for_writing(self.path, 'w') as hfile:
+            hfile['data'] = np.arange(15, dtype=np.uint8).reshape(3, 5)
+
+    def tearDown(self):
+        import shutil
+        self.tileserver.evict_hdf5_file(self.path)
+        shutil.rmtree(self.directory)
+
+    def test_padding(self):
+        version = self.tileserver.file_version(self.path)
+        data = self.tileserver._handles.read(self.path, version, 'data', 2, 3, 4, 4)
+        self.assertEqual(data.shape, (4, 4))
+        self.assertEqual(data[0].tolist(), [13, 14, 0, 0])
+        self.assertEqual(data[1:].sum(), 0)
+
+    def test_missing_datasets(self):
+        blank = self.tileserver.blank_tile(4, 4)
+        self.assertEqual(self.tileserver.tile(self.path, 'other', 0, 0, 4, 4), blank)
+        self.assertEqual(self.tileserver.tile(
+                os.path.join(self.directory, 'other.hdf'), 'data', 0, 0, 4, 4), blank)
+        self.assertNotEqual(self.tileserver.tile(self.path, 'data', 0, 0, 4, 4), blank)
+
+    def test_invalidation(self):
+        tile = self.tileserver.tile(self.path, 'data', 0, 0, 4, 4)
+        self.assertTrue(self.tileserver.tile(self.path, 'data', 0, 0, 4, 4) is tile)
+        # Writes are noticed, also within the same second
+        with self.tileserver.open_hdf5_for_writing(self.path) as hfile:
+            hfile['data'][0, 0] = 255
+        changed = self.tileserver.tile(self.path, 'data', 0, 0, 4, 4)
+        self.assertNotEqual(changed, tile)
+        self.assertTrue(self.tileserver.tile(self.path, 'data', 0, 0, 4, 4) is changed)
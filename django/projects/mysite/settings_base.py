@@ -102,6 +102,56 @@ ROI_AUTO_CREATE_IMAGE = False
 IMPORTER_DEFAULT_TILE_WIDTH = 256
 IMPORTER_DEFAULT_TILE_HEIGHT = 256
 
+# The tracing overlay's field of view is served as the union of square
+# spatial tiles of this edge length (in calibrated units, e.g. nm). Tiles
+# are the unit of querying and caching of nodes. Set to 0 to query the
+# exact field of view instead.
+NODE_LIST_TILE_SIZE = 4096
+
+# The maximum number of node tiles each server process keeps in memory. Tiles
+# are invalidated by edits, so this is only a matter of memory usage. Set to 0
+# to disable the node tile cache.
+NODE_TILE_CACHE_SIZE = 2048
+
+# The maximum number of per-skeleton computations, like the arbor
+# decompositions of the circuit graph, that each server process keeps in
+# memory. They are validated against the edit version of their skeleton, so
+# this is only a matter of memory usage. Set to 0 to disable this cache.
+SKELETON_CACHE_SIZE = 512
+
+# The maximum number of row counts and of page positions of datatable queries
+# that each server process keeps in memory, which let tables page by seeking
+# rather than skipping rows. Both are validated against the edits of the
+# tables they read from, so this is only a matter of memory usage. Set to 0
+# to disable them.
+DATATABLE_CACHE_SIZE = 1024
+
+# Image tiles of HDF5 stacks are read through a pool of at most this many
+# open files per server process, and at most HDF5_TILE_CACHE_SIZE encoded
+# tiles, of at most HDF5_TILE_CACHE_BYTES bytes in total, are cached per
+# process, validated against the inode, times and size of their file. Set
+# HDF5_TILE_CACHE_SIZE to 0 to disable the tile cache.
+HDF5_HANDLE_POOL_SIZE = 16
+HDF5_TILE_CACHE_SIZE = 4096
+HDF5_TILE_CACHE_BYTES = 64 * 1024 * 1024
+
+# The number of worker processes that each server process forks at startup
+# to spread computations over, like measuring skeletons and evaluating
+# reviews. Values below 2 run them within the server process.
+WORKER_PROCESSES = 0
+
+# Long running analyses and exports can be submitted as jobs (see
+# catmaid.control.jobs). The 'local' backend runs them on JOB_THREADS threads
+# of each web server process, 'celery' on the Celery workers. Results of
+# identical jobs are reused for JOB_RESULT_MAX_AGE seconds. Running jobs
+# record a heartbeat every JOB_HEARTBEAT seconds. Jobs that stay queued, or
+# running without a heartbeat, for JOB_TIMEOUT seconds have failed.
+JOB_BACKEND = 'local'
+JOB_THREADS = 2
+JOB_RESULT_MAX_AGE = 3600
+JOB_HEARTBEAT = 60
+JOB_TIMEOUT = 1800
+
 # A couple of functions useful for generating default directories to
 # be used in the settings files:
 
@@ -59,6 +59,10 @@ urlpatterns += patterns(
     # Views
     (r'^useranalytics$', 'catmaid.control.plot_useranalytics'),
     (r'^(?P<project_id>\d+)/userproficiency$', 'catmaid.control.user_evaluation.evaluate_user'),
+    (r'^(?P<project_id>\d+)/jobs/submit$', 'catmaid.control.jobs.submit_job'),
+    (r'^(?P<project_id>\d+)/jobs/(?P<job_id>\d+)/status$', 'catmaid.control.jobs.job_status'),
+    (r'^(?P<project_id>\d+)/jobs/(?P<job_id>\d+)/result$', 'catmaid.control.jobs.job_result'),
+    (r'^(?P<project_id>\d+)/jobs/(?P<job_id>\d+)/cancel$', 'catmaid.control.jobs.cancel_job'),
     (r'^(?P<project_id>\d+)/exportwidget$', ExportWidgetView.as_view() ),
     (r'^(?P<project_id>\d+)/statisticswidget$', ProjectStatisticsWidgetView.as_view() ),
 
@@ -130,6 +134,7 @@ urlpatterns += patterns(
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/review/reset-others$', 'catmaid.control.reset_other_reviewer_ids'),
     (r'^(?P<project_id>\d+)/skeleton/connectivity$', 'catmaid.control.skeleton_info_raw'),
     (r'^(?P<project_id>\d+)/skeleton/review-status$', 'catmaid.control.review_status'),
+    (r'^(?P<project_id>\d+)/skeletons/summary$', 'catmaid.control.skeleton_summaries'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/statistics$', 'catmaid.control.skeleton_statistics'),
     (r'^(?P<project_id>\d+)/skeletons/measure$', 'catmaid.control.measure_skeletons'),
     (r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/openleaf$', 'catmaid.control.last_openleaf'),
@@ -161,6 +166,7 @@ urlpatterns += patterns(
     (r'^(?P<project_id>\d+)/node/nearest$', 'catmaid.control.node_nearest'),
     (r'^(?P<project_id>\d+)/node/update$', 'catmaid.control.node_update'),
     (r'^(?P<project_id>\d+)/node/list$', 'catmaid.control.node_list_tuples'),
+    (r'^(?P<project_id>\d+)/node/list-sections$', 'catmaid.control.node_list_sections'),
     (r'^(?P<project_id>\d+)/node/previous_branch_or_root$', 'catmaid.control.find_previous_branchnode_or_root'),
     (r'^(?P<project_id>\d+)/node/next_branch_or_end$', 'catmaid.control.find_next_branchnode_or_end'),
     (r'^(?P<project_id>\d+)/node/get_location$', 'catmaid.control.get_location'),
@@ -2,6 +2,10 @@ import os
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings_production")
 
+# Fork the worker processes before any database connection is opened.
+from catmaid.control.workers import start_worker_pool
+start_worker_pool()
+
 # This application object is used by the development server
 # as well as any WSGI server configured to use this file.
 from django.core.wsgi import get_wsgi_application